@@ -0,0 +1,34 @@
+"""Cost of create_db from the different kinds of connection options"""
+
+from sqlgold import create_db
+from sqlgold.config import cfg, set_database_config
+
+from harness import benchmark
+
+
+def _disposing(make_db):
+    def run():
+        db = make_db()
+        db.engine.dispose()
+
+    return run
+
+
+@benchmark("create_db.url", number=200, params=("memory", "file"))
+def bench_create_db_url(ctx):
+    url = ctx.sqlite_url()
+    yield _disposing(lambda: create_db(url, Base=None, alias="bench"))
+
+
+@benchmark("create_db.dict", number=200, params=("memory", "file"))
+def bench_create_db_dict(ctx):
+    config = {"url": ctx.sqlite_url()}
+    yield _disposing(lambda: create_db(config, Base=None, alias="bench"))
+
+
+@benchmark("create_db.section", number=200, params=("memory", "file"))
+def bench_create_db_section(ctx):
+    saved = dict(cfg)
+    set_database_config({"default": "bench", "bench": {"url": ctx.sqlite_url()}})
+    yield _disposing(lambda: create_db("bench", Base=None, alias="bench"))
+    set_database_config(saved)
@@ -0,0 +1,34 @@
+"""Cost of ``import sqlgold`` in a fresh interpreter"""
+
+import os
+import subprocess
+import sys
+
+from harness import benchmark
+
+_IMPORT_SNIPPET = (
+    "import time; start = time.perf_counter(); import sqlgold; "
+    "print(time.perf_counter() - start)"
+)
+## import the checkout, like run.py does, not an installed sqlgold
+_REPO_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+@benchmark("import.sqlgold", number=1, repeat=5)
+def bench_import(ctx):
+    env = dict(os.environ)
+    env["PYTHONPATH"] = os.pathsep.join(
+        p for p in (_REPO_DIR, env.get("PYTHONPATH")) if p
+    )
+
+    def run():
+        out = subprocess.run(
+            [sys.executable, "-c", _IMPORT_SNIPPET],
+            env=env,
+            check=True,
+            capture_output=True,
+            text=True,
+        )
+        return float(out.stdout.strip())
+
+    yield run
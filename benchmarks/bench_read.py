@@ -0,0 +1,69 @@
+"""Read-only rows from DB.read compared with ORM instances"""
+
+from sqlalchemy import insert, select
+
+from sqlgold import create_db
+
+from harness import benchmark
+from models import make_schema
+
+ROWS = 5000
+
+
+def _make_db(ctx):
+    Base, models = make_schema(1)
+    Model = models[0]
+    db = create_db(ctx.sqlite_url(), Base=Base, create_all=True, alias="bench")
+    rows = [{"id": i, "name": f"name_{i}", "value": i * 0.5} for i in range(ROWS)]
+    with db.Session.begin() as session:
+        session.execute(insert(Model), rows)
+    return db, Model
+
+
+@benchmark("read.orm", number=5, ops=ROWS, params=("memory", "file"), memory=True)
+def bench_read_orm(ctx):
+    db, Model = _make_db(ctx)
+    stmt = select(Model)
+
+    def run():
+        with db.Session() as session:
+            return session.scalars(stmt).all()
+
+    yield run
+    db.engine.dispose()
+
+
+@benchmark("read.rows", number=5, ops=ROWS, params=("memory", "file"), memory=True)
+def bench_read_rows(ctx):
+    db, Model = _make_db(ctx)
+    stmt = select(Model)
+
+    def run():
+        return db.read(stmt)
+
+    yield run
+    db.engine.dispose()
+
+
+@benchmark("read.tuple", number=5, ops=ROWS, params=("memory", "file"), memory=True)
+def bench_read_tuple(ctx):
+    db, Model = _make_db(ctx)
+    stmt = select(Model)
+
+    def run():
+        return db.read(stmt, as_=tuple)
+
+    yield run
+    db.engine.dispose()
+
+
+@benchmark("read.dict", number=5, ops=ROWS, params=("memory", "file"), memory=True)
+def bench_read_dict(ctx):
+    db, Model = _make_db(ctx)
+    stmt = select(Model)
+
+    def run():
+        return db.read(stmt, as_=dict)
+
+    yield run
+    db.engine.dispose()
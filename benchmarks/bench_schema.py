@@ -0,0 +1,34 @@
+"""Cost of create_all and create_test_db on a synthetic schema"""
+
+from sqlgold import create_db
+from sqlgold.utils.test_db_utils import create_test_db
+
+from harness import benchmark
+from models import make_schema
+
+NUM_TABLES = 50
+
+
+@benchmark("schema.create_all", number=5, ops=NUM_TABLES, params=("memory", "file"))
+def bench_create_all(ctx):
+    Base, __ = make_schema(NUM_TABLES)
+
+    def run():
+        db = create_db(ctx.sqlite_url(), Base=Base, alias="bench")
+        db.create_all()
+        db.drop_all()
+        db.engine.dispose()
+
+    yield run
+
+
+@benchmark("schema.create_test_db", number=5, params=("memory", "file"))
+def bench_create_test_db(ctx):
+    Base, __ = make_schema(NUM_TABLES)
+
+    def run():
+        with create_test_db(url=ctx.sqlite_url(), Base=Base) as db:
+            pass
+        db.engine.dispose()
+
+    yield run
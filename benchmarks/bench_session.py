@@ -0,0 +1,34 @@
+"""Cost of opening and closing sessions"""
+
+from sqlalchemy import select
+
+from sqlgold import create_db
+
+from harness import benchmark
+from models import make_schema
+
+
+@benchmark("session.open_close", number=2000, params=("memory", "file"))
+def bench_session_open_close(ctx):
+    db = create_db(ctx.sqlite_url(), Base=None, alias="bench")
+
+    def run():
+        with db.Session():
+            pass
+
+    yield run
+    db.engine.dispose()
+
+
+@benchmark("session.begin_commit", number=1000, params=("memory", "file"))
+def bench_session_begin_commit(ctx):
+    Base, models = make_schema(1)
+    db = create_db(ctx.sqlite_url(), Base=Base, create_all=True, alias="bench")
+    stmt = select(models[0]).limit(1)
+
+    def run():
+        with db.Session.begin() as session:
+            session.execute(stmt)
+
+    yield run
+    db.engine.dispose()
@@ -0,0 +1,81 @@
+"""Insert and select throughput through DB sessions"""
+
+from sqlalchemy import insert, select
+
+from sqlgold import create_db
+
+from harness import benchmark
+from models import make_schema
+
+BATCH = 1000
+
+
+def _make_db(ctx):
+    Base, models = make_schema(1)
+    db = create_db(ctx.sqlite_url(), Base=Base, create_all=True, alias="bench")
+    return db, models[0]
+
+
+def _rows(start, n):
+    return [
+        {"id": i, "name": f"name_{i}", "value": i * 0.5}
+        for i in range(start, start + n)
+    ]
+
+
+@benchmark("insert.orm", number=3, ops=BATCH, params=("memory", "file"))
+def bench_insert_orm(ctx):
+    db, Model = _make_db(ctx)
+    next_id = [0]
+
+    def run():
+        with db.Session.begin() as session:
+            session.add_all(Model(**row) for row in _rows(next_id[0], BATCH))
+        next_id[0] += BATCH
+
+    yield run
+    db.engine.dispose()
+
+
+@benchmark("insert.core", number=3, ops=BATCH, params=("memory", "file"))
+def bench_insert_core(ctx):
+    db, Model = _make_db(ctx)
+    next_id = [0]
+
+    def run():
+        with db.Session.begin() as session:
+            session.execute(insert(Model), _rows(next_id[0], BATCH))
+        next_id[0] += BATCH
+
+    yield run
+    db.engine.dispose()
+
+
+@benchmark("select.orm", number=3, ops=BATCH, params=("memory", "file"))
+def bench_select_orm(ctx):
+    db, Model = _make_db(ctx)
+    with db.Session.begin() as session:
+        session.execute(insert(Model), _rows(0, BATCH))
+    stmt = select(Model)
+
+    def run():
+        with db.Session() as session:
+            session.scalars(stmt).all()
+
+    yield run
+    db.engine.dispose()
+
+
+@benchmark("select.rows", number=3, ops=BATCH, params=("memory", "file"))
+def bench_select_rows(ctx):
+    db, Model = _make_db(ctx)
+    with db.Session.begin() as session:
+        session.execute(insert(Model), _rows(0, BATCH))
+    stmt = select(*Model.__table__.columns)
+
+    def run():
+        with db.Session() as session:
+            session.execute(stmt).all()
+
+    yield run
+    db.engine.dispose()
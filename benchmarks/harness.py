@@ -0,0 +1,280 @@
+"""Small benchmark harness for measuring sqlgold's own overhead
+
+Benchmarks are generator functions registered with the ``benchmark`` decorator.
+Everything before the ``yield`` is setup, the yielded callable is what gets
+timed, and everything after the ``yield`` is teardown. A timed callable that
+returns a float reports its own duration in seconds, which is used instead of
+the wall time of the call (e.g. for work done in a subprocess). Benchmarks
+registered with ``memory=True`` also report the peak memory allocated by one
+call, measured with tracemalloc in a separate untimed call::
+
+    @benchmark("session.open_close", number=1000)
+    def bench_session(ctx):
+        db = create_db(ctx.sqlite_url("memory"))
+        def run():
+            with db.Session():
+                pass
+        yield run
+        db.engine.dispose()
+"""
+
+import gc
+import os
+import platform
+import statistics
+import tempfile
+import time
+import tracemalloc
+from dataclasses import asdict, dataclass, field
+from typing import Any, Callable, Dict, Iterator, List, Optional, Sequence
+
+BenchmarkFunc = Callable[["BenchContext"], Iterator[Callable[[], Any]]]
+
+
+@dataclass
+class Benchmark:
+    """A registered benchmark"""
+
+    name: str
+    func: BenchmarkFunc
+    number: int = 1  ## calls per repeat
+    repeat: int = 5
+    ops: int = 1  ## operations done by a single call, e.g. rows inserted
+    params: Sequence[str] = ()
+    memory: bool = False  ## also measure the peak memory of a call
+
+
+@dataclass
+class BenchResult:
+    """Timing of a single benchmark, times are seconds per operation"""
+
+    name: str
+    min: float
+    median: float
+    mean: float
+    stdev: float
+    ops_per_sec: float
+    number: int
+    repeat: int
+    ops: int
+    peak_bytes: Optional[int] = None  ## per call, for memory benchmarks
+
+
+@dataclass
+class BenchContext:
+    """Passed to every benchmark, holds the parameter and a scratch directory"""
+
+    param: Optional[str]
+    tmpdir: str
+    scale: float = 1.0
+    _counter: List[int] = field(default_factory=lambda: [0])
+
+    def sqlite_url(self, kind: Optional[str] = None) -> str:
+        """Return a fresh sqlite url
+
+        Args:
+            kind (Optional[str], optional): "memory" or "file". Defaults to the
+                benchmark parameter.
+
+        Returns:
+            str: the sqlite url
+        """
+        kind = kind or self.param or "memory"
+        if kind == "memory":
+            return "sqlite:///:memory:"
+        self._counter[0] += 1
+        return f"sqlite:///{os.path.join(self.tmpdir, f'bench_{self._counter[0]}.db')}"
+
+    def scaled(self, n: int) -> int:
+        """Scale a size by the --scale option"""
+        return max(1, int(n * self.scale))
+
+
+_registry: Dict[str, Benchmark] = {}
+
+
+def benchmark(
+    name: str,
+    number: int = 1,
+    repeat: int = 5,
+    ops: int = 1,
+    params: Sequence[str] = (),
+    memory: bool = False,
+):
+    """Register a benchmark
+
+    Args:
+        name (str): unique name, parameters are appended as ``name[param]``
+        number (int, optional): calls of the timed callable per repeat. Defaults to 1.
+        repeat (int, optional): number of repeats. Defaults to 5.
+        ops (int, optional): operations per call, used for ops/sec. Defaults to 1.
+        params (Sequence[str], optional): run once per parameter. Defaults to ().
+        memory (bool, optional): also report the peak memory allocated by a
+            call. Defaults to False.
+    """
+
+    def decorator(func: BenchmarkFunc) -> BenchmarkFunc:
+        if name in _registry:
+            raise ValueError(f"Benchmark '{name}' registered twice")
+        _registry[name] = Benchmark(
+            name=name,
+            func=func,
+            number=number,
+            repeat=repeat,
+            ops=ops,
+            params=params,
+            memory=memory,
+        )
+        return func
+
+    return decorator
+
+
+def registered() -> List[Benchmark]:
+    return list(_registry.values())
+
+
+def _run_one(bench: Benchmark, param: Optional[str], scale: float) -> BenchResult:
+    name = f"{bench.name}[{param}]" if param else bench.name
+    number = max(1, int(bench.number * scale))
+    peak_bytes = None
+    with tempfile.TemporaryDirectory(prefix="sqlgold_bench_") as tmpdir:
+        ctx = BenchContext(param=param, tmpdir=tmpdir, scale=scale)
+        gen = bench.func(ctx)
+        run = next(gen)
+        run()  ## warm up caches (statement compilation, imports)
+        times = []
+        gc_was_enabled = gc.isenabled()
+        gc.disable()
+        try:
+            for __ in range(bench.repeat):
+                total = 0.0
+                for __ in range(number):
+                    start = time.perf_counter()
+                    reported = run()
+                    elapsed = time.perf_counter() - start
+                    total += reported if isinstance(reported, float) else elapsed
+                times.append(total / (number * bench.ops))
+            if bench.memory:
+                peak_bytes = _peak_memory(run)
+        finally:
+            if gc_was_enabled:
+                gc.enable()
+            for __ in gen:  ## teardown
+                pass
+    median = statistics.median(times)
+    return BenchResult(
+        name=name,
+        min=min(times),
+        median=median,
+        mean=statistics.fmean(times),
+        stdev=statistics.stdev(times) if len(times) > 1 else 0.0,
+        ops_per_sec=1 / median if median else float("inf"),
+        number=number,
+        repeat=bench.repeat,
+        ops=bench.ops,
+        peak_bytes=peak_bytes,
+    )
+
+
+def _peak_memory(run: Callable[[], Any]) -> int:
+    """Peak bytes allocated during a call, including what it returns"""
+    tracemalloc.start()
+    try:
+        result = run()
+        __, peak = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+    del result
+    return peak
+
+
+def run_benchmarks(
+    benchmarks: Sequence[Benchmark], scale: float = 1.0, verbose: bool = True
+) -> List[BenchResult]:
+    """Run the benchmarks
+
+    Args:
+        benchmarks (Sequence[Benchmark]): benchmarks to run
+        scale (float, optional): multiplier for iteration counts and sizes. Defaults to 1.0.
+        verbose (bool, optional): print results as they finish. Defaults to True.
+
+    Returns:
+        List[BenchResult]: a result per benchmark and parameter
+    """
+    results = []
+    for bench in benchmarks:
+        for param in bench.params or (None,):
+            result = _run_one(bench, param, scale)
+            results.append(result)
+            if verbose:
+                memory = ""
+                if result.peak_bytes is not None:
+                    memory = f"  peak {result.peak_bytes / 1024:.0f} KiB"
+                print(
+                    f"{result.name:<45} {result.median * 1e6:>12.2f} us/op "
+                    f"{result.ops_per_sec:>14.1f} ops/s  (+-{result.stdev * 1e6:.2f})"
+                    f"{memory}"
+                )
+    return results
+
+
+def environment() -> Dict[str, str]:
+    import sqlalchemy
+
+    return {
+        "python": platform.python_version(),
+        "implementation": platform.python_implementation(),
+        "platform": platform.platform(),
+        "sqlalchemy": sqlalchemy.__version__,
+    }
+
+
+def results_to_json(results: Sequence[BenchResult]) -> Dict[str, Any]:
+    return {
+        "environment": environment(),
+        "timestamp": time.time(),
+        "results": {r.name: asdict(r) for r in results},
+    }
+
+
+@dataclass
+class Comparison:
+    """Comparison of a result to its baseline, ratio > 1 is slower"""
+
+    name: str
+    baseline: float
+    current: float
+    ratio: float
+    regression: bool
+
+
+def compare(
+    results: Dict[str, Any], baseline: Dict[str, Any], tolerance: float
+) -> List[Comparison]:
+    """Compare median times with a baseline
+
+    Args:
+        results (Dict[str, Any]): json results of this run
+        baseline (Dict[str, Any]): json results of the baseline run
+        tolerance (float): allowed slowdown, 0.25 allows 25% slower
+
+    Returns:
+        List[Comparison]: one entry per benchmark present in both
+    """
+    comparisons = []
+    for name, result in results["results"].items():
+        base = baseline.get("results", {}).get(name)
+        if not base:
+            continue
+        ratio = result["median"] / base["median"] if base["median"] else 1.0
+        comparisons.append(
+            Comparison(
+                name=name,
+                baseline=base["median"],
+                current=result["median"],
+                ratio=ratio,
+                regression=ratio > 1 + tolerance,
+            )
+        )
+    return comparisons
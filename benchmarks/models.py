@@ -0,0 +1,28 @@
+"""Synthetic schemas used by the benchmarks"""
+
+from typing import Any, List, Tuple
+
+from sqlalchemy import Float, Integer, String
+from sqlalchemy.orm import declarative_base, mapped_column
+
+
+def make_schema(num_tables: int) -> Tuple[Any, List[type]]:
+    """Create a declarative base with num_tables simple mapped classes
+
+    Args:
+        num_tables (int): number of tables
+
+    Returns:
+        Tuple[Any, List[type]]: the Base and the mapped classes
+    """
+    Base = declarative_base()
+    models = []
+    for i in range(num_tables):
+        attrs = {
+            "__tablename__": f"bench_table_{i}",
+            "id": mapped_column(Integer, primary_key=True),
+            "name": mapped_column(String(64), index=True),
+            "value": mapped_column(Float),
+        }
+        models.append(type(f"BenchTable{i}", (Base,), attrs))
+    return Base, models
@@ -0,0 +1,92 @@
+"""Run the sqlgold micro-benchmarks
+
+Examples:
+    python benchmarks/run.py                      # run all, compare with baseline.json
+    python benchmarks/run.py -k session           # only benchmarks matching 'session'
+    python benchmarks/run.py --output out.json    # write the results as json
+    python benchmarks/run.py --save-baseline      # store this run as the new baseline
+"""
+
+import argparse
+import importlib
+import json
+import os
+import sys
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, BENCH_DIR)
+sys.path.insert(1, os.path.dirname(BENCH_DIR))  ## run against the checkout
+
+from harness import compare, registered, results_to_json, run_benchmarks
+
+DEFAULT_BASELINE = os.path.join(BENCH_DIR, "baseline.json")
+
+
+def load_benchmark_modules():
+    for filename in sorted(os.listdir(BENCH_DIR)):
+        if filename.startswith("bench_") and filename.endswith(".py"):
+            importlib.import_module(filename[:-3])
+
+
+def main(argv=None) -> int:
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("-k", "--filter", help="only run benchmarks containing this")
+    parser.add_argument("--output", help="write json results to this file")
+    parser.add_argument("--baseline", default=DEFAULT_BASELINE)
+    parser.add_argument(
+        "--tolerance",
+        type=float,
+        default=0.25,
+        help="allowed slowdown relative to the baseline (0.25 = 25%%)",
+    )
+    parser.add_argument(
+        "--scale", type=float, default=1.0, help="multiplier for iteration counts"
+    )
+    parser.add_argument("--save-baseline", action="store_true")
+    parser.add_argument(
+        "--no-fail", action="store_true", help="exit 0 even if there are regressions"
+    )
+    args = parser.parse_args(argv)
+
+    load_benchmark_modules()
+    benchmarks = [b for b in registered() if not args.filter or args.filter in b.name]
+    results = results_to_json(run_benchmarks(benchmarks, scale=args.scale))
+
+    if args.output:
+        with open(args.output, "w") as fp:
+            json.dump(results, fp, indent=2)
+    if args.save_baseline:
+        baseline = {}
+        if os.path.isfile(args.baseline):
+            with open(args.baseline) as fp:
+                baseline = json.load(fp)
+        baseline["environment"] = results["environment"]
+        baseline["timestamp"] = results["timestamp"]
+        baseline.setdefault("results", {}).update(results["results"])
+        with open(args.baseline, "w") as fp:
+            json.dump(baseline, fp, indent=2, sort_keys=True)
+        print(f"Saved baseline to {args.baseline}")
+        return 0
+
+    if not os.path.isfile(args.baseline):
+        print(f"No baseline at {args.baseline}, skipping comparison")
+        return 0
+    with open(args.baseline) as fp:
+        baseline = json.load(fp)
+
+    comparisons = compare(results, baseline, args.tolerance)
+    regressions = [c for c in comparisons if c.regression]
+    print(
+        f"\n----- Compared with {args.baseline} (tolerance {args.tolerance:.0%}) -----"
+    )
+    for c in comparisons:
+        flag = "REGRESSION" if c.regression else ""
+        print(f"{c.name:<45} {c.ratio:>7.2f}x {flag}")
+    if regressions:
+        print(f"{len(regressions)} benchmark(s) regressed beyond tolerance")
+        return 0 if args.no_fail else 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -1,4 +1,5 @@
 from sqlgold import config as config
+from sqlgold import metrics as metrics
 
 from .engine import create_db as create_db
 from .engine.db import DB as DB
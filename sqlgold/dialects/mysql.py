@@ -1,12 +1,133 @@
-from typing import Any, Dict, Self, Type
+import csv
+import hashlib
+import logging
+import os
+import re
+import shutil
+import tempfile
+from typing import Any, Dict, List, Optional, Self, Sequence, Set, Tuple, Type
 
-from sqlalchemy import Engine, create_engine, quoted_name
+from sqlalchemy import (
+    Column,
+    Connection,
+    Engine,
+    MetaData,
+    Table,
+    create_engine,
+    insert,
+    quoted_name,
+    types,
+)
+from sqlalchemy.exc import DBAPIError
 from sqlalchemy.engine import make_url as sa_make_url
 from sqlalchemy.orm import Session
 from sqlalchemy.orm import sessionmaker as sa_sessionmaker
 from sqlalchemy.sql import text
 
+from sqlgold.engine import bulk_load
 from sqlgold.engine.db import DB, sentinel
+from sqlgold.ext.explain import PlanStep, parse_mysql_plan
+
+## MySQL error codes of errors that succeed when the transaction is retried
+MYSQL_RETRYABLE_ERRORS = {
+    1205: "lock_wait_timeout",  ## ER_LOCK_WAIT_TIMEOUT
+    1213: "deadlock",  ## ER_LOCK_DEADLOCK
+    2006: "disconnect",  ## CR_SERVER_GONE_ERROR
+    2013: "disconnect",  ## CR_SERVER_LOST
+    2055: "disconnect",  ## CR_SERVER_LOST_EXTENDED
+}
+
+## Statements aborted by MAX_EXECUTION_TIME (MySQL) or max_statement_time (MariaDB)
+MYSQL_STATEMENT_TIMEOUT_ERRORS = (
+    3024,  ## ER_QUERY_TIMEOUT
+    1969,  ## ER_STATEMENT_TIMEOUT, MariaDB
+)
+
+## The optimizer hint only applies to top level SELECTs
+_SELECT = re.compile(r"^\s*SELECT\b", re.IGNORECASE)
+## Prefixing inserts would stop the driver from batching executemany rows
+_INSERT = re.compile(r"^\s*(INSERT|REPLACE)\b", re.IGNORECASE)
+
+## LOAD DATA LOCAL is disabled on the client or the server
+MYSQL_LOCAL_INFILE_ERRORS = (1148, 2068, 3948)
+
+## MySQL character sets of python encodings, by normalized encoding name
+MYSQL_LOAD_CHARSETS = {
+    "utf8": "utf8mb4",
+    "utf8mb4": "utf8mb4",
+    "ascii": "ascii",
+    "usascii": "ascii",
+    "latin1": "latin1",
+    "iso88591": "latin1",
+    "cp1252": "latin1",  ## MySQL's latin1 is cp1252
+    "latin2": "latin2",
+    "iso88592": "latin2",
+    "cp1250": "cp1250",
+    "cp1251": "cp1251",
+    "cp1256": "cp1256",
+    "cp1257": "cp1257",
+    "utf16": "utf16",
+    "utf16le": "utf16le",
+    "utf32": "utf32",
+    "big5": "big5",
+    "gbk": "gbk",
+    "gb18030": "gb18030",
+    "shiftjis": "sjis",
+    "sjis": "sjis",
+    "eucjp": "ujis",
+    "euckr": "euckr",
+}
+
+## Groups of at least this many rows are bulk updated with a joined UPDATE
+## from a temporary table, one statement instead of one per row
+MYSQL_STAGED_UPDATE_ROWS = 20000
+
+
+def _mysql_error_code(exc: Exception) -> Optional[int]:
+    orig = getattr(exc, "orig", None)
+    args = getattr(orig, "args", None)
+    if args and isinstance(args[0], int):
+        return args[0]
+    return None
+
+
+def mysql_charset(encoding: str) -> str:
+    """The MySQL character set of a python encoding, raises ValueError for
+    encodings without one"""
+    charset = MYSQL_LOAD_CHARSETS.get(re.sub(r"[-_\s]", "", encoding.lower()))
+    if charset is None:
+        raise ValueError(f"No MySQL character set for the encoding '{encoding}'")
+    return charset
+
+
+def staged_update_sql(
+    dialect: Any,
+    table: Table,
+    stage: Table,
+    keys: Sequence[str],
+    columns: Sequence[str],
+) -> Tuple[str, str]:
+    """The joined UPDATE of table from stage, skipping rows already holding
+    the values, and the SELECT counting the rows matched"""
+    preparer = dialect.identifier_preparer
+    target, source = preparer.format_table(table), preparer.format_table(stage)
+    quote = preparer.quote
+    join = " AND ".join(
+        f"t.{quote(table.c[k].name)} = s.{quote(stage.c[k].name)}" for k in keys
+    )
+    assignments = ", ".join(
+        f"t.{quote(table.c[c].name)} = s.{quote(stage.c[c].name)}" for c in columns
+    )
+    differs = " OR ".join(
+        f"NOT (t.{quote(table.c[c].name)} <=> s.{quote(stage.c[c].name)})"
+        for c in columns
+    )
+    update = (
+        f"UPDATE {target} AS t JOIN {source} AS s ON {join} "
+        f"SET {assignments} WHERE {differs}"
+    )
+    matched = f"SELECT COUNT(*) FROM {target} AS t JOIN {source} AS s ON {join}"
+    return update, matched
 
 
 class MysqlDB(DB):
@@ -16,16 +137,75 @@ class MysqlDB(DB):
         return f"{url.drivername}://{url.username}:{url.password}@{url.host}"
 
     @classmethod
-    def create_db(
-        cls,
-        engine: Engine,
-        Base: Any = sentinel,
-        create_all: bool = False,
-        session: Session = None,
-        sessionmaker: Type[sa_sessionmaker] = None,
-        session_args: Dict[str, Any] = None,
-    ) -> Self:
+    def retryable_error_reason(cls, exc: Exception) -> Optional[str]:
+        reason = MYSQL_RETRYABLE_ERRORS.get(_mysql_error_code(exc))
+        return reason or super().retryable_error_reason(exc)
+
+    @classmethod
+    def is_disconnect_error(cls, exc: Exception) -> bool:
+        if MYSQL_RETRYABLE_ERRORS.get(_mysql_error_code(exc)) == "disconnect":
+            return True
+        return super().is_disconnect_error(exc)
+
+    @classmethod
+    def is_statement_timeout(cls, exc: Exception) -> bool:
+        args = getattr(exc, "args", None)
+        code = args[0] if args and isinstance(args[0], int) else None
+        return code in MYSQL_STATEMENT_TIMEOUT_ERRORS
+
+    def _apply_statement_deadline(
+        self, connection: Connection, cursor: Any, statement: str, remaining_ms: float
+    ) -> str:
+        """Have the server abort the statement once the time is up. MariaDB
+        limits statements other than inserts with SET STATEMENT
+        max_statement_time, MySQL only limits SELECTs, with the
+        MAX_EXECUTION_TIME optimizer hint"""
+        if connection.dialect.is_mariadb:
+            if _INSERT.match(statement):
+                return statement
+            seconds = max(remaining_ms, 1) / 1000
+            return f"SET STATEMENT max_statement_time={seconds:.3f} FOR {statement}"
+        if "MAX_EXECUTION_TIME" in statement or not _SELECT.match(statement):
+            return statement
+        ms = max(int(remaining_ms), 1)
+        return _SELECT.sub(f"SELECT /*+ MAX_EXECUTION_TIME({ms}) */", statement, 1)
+
+    def _explain_statement(
+        self, cursor: Any, statement: str, parameters: Any
+    ) -> List[PlanStep]:
+        cursor.execute(f"EXPLAIN {statement}", parameters)
+        names = [d[0] for d in cursor.description]
+        return parse_mysql_plan([dict(zip(names, row)) for row in cursor.fetchall()])
 
+    def _approximate_count(self, connection: Connection, table: Table) -> Optional[int]:
+        ## InnoDB's estimate, refreshed by ANALYZE TABLE and as the table changes
+        n = connection.execute(
+            text(
+                "SELECT TABLE_ROWS FROM information_schema.TABLES "
+                "WHERE TABLE_SCHEMA = COALESCE(:schema, DATABASE()) "
+                "AND TABLE_NAME = :table"
+            ),
+            {"schema": table.schema, "table": table.name},
+        ).scalar()
+        return int(n) if n is not None else None
+
+    def _open_transaction_ids(self, connection: Connection) -> Optional[Set[Any]]:
+        ## innodb_trx needs the PROCESS privilege
+        try:
+            return set(
+                connection.execute(
+                    text(
+                        "SELECT trx_id FROM information_schema.innodb_trx "
+                        "WHERE trx_mysql_thread_id <> CONNECTION_ID()"
+                    )
+                ).scalars()
+            )
+        except DBAPIError as e:
+            logging.debug(f"Can't list the open transactions of {self}: {e.orig}")
+            return None
+
+    @classmethod
+    def ensure_database(cls, engine: Engine) -> None:
         connection_url = cls.create_connection_url(engine.url)
         database = engine.url.database
 
@@ -40,6 +220,18 @@ class MysqlDB(DB):
             s.execute(text(stmt))
             s.execute(text(f"USE {quoted_name(database, True)};"))
         engine_for_creating.dispose()
+
+    @classmethod
+    def create_db(
+        cls,
+        engine: Engine,
+        Base: Any = sentinel,
+        create_all: bool = False,
+        session: Session = None,
+        sessionmaker: Type[sa_sessionmaker] = None,
+        session_args: Dict[str, Any] = None,
+    ) -> Self:
+        cls.ensure_database(engine)
         db = MysqlDB(
             engine=engine,
             Base=Base,
@@ -51,3 +243,198 @@ class MysqlDB(DB):
         if create_all and Base is not None:
             db.create_all()
         return db
+
+    def schema_signature(
+        self, connection: Connection, schema: Optional[str] = None
+    ) -> str:
+        """Checksum of the columns, indexes and foreign keys of the schema in
+        information_schema, which change with every DDL affecting reflection,
+        including renames and in-place or instant ALTERs that keep CREATE_TIME.
+        The server hashes each row and folds the hashes with BIT_XOR, only
+        the row count and the folded hash are sent back"""
+        stmt = text(
+            "SELECT COUNT(*), BIT_XOR(CAST(CONV(LEFT(SHA1(CONCAT_WS(',', "
+            "QUOTE(kind), QUOTE(tbl), QUOTE(name), QUOTE(pos), QUOTE(a), "
+            "QUOTE(b), QUOTE(c), QUOTE(d), QUOTE(e))), 16), 16, 10) AS UNSIGNED)) "
+            "FROM ("
+            "SELECT 'c' AS kind, TABLE_NAME AS tbl, COLUMN_NAME AS name, "
+            "ORDINAL_POSITION AS pos, COLUMN_TYPE AS a, IS_NULLABLE AS b, "
+            "COLUMN_KEY AS c, COLUMN_DEFAULT AS d, EXTRA AS e "
+            "FROM information_schema.COLUMNS "
+            "WHERE TABLE_SCHEMA = COALESCE(:schema, DATABASE()) "
+            "UNION ALL "
+            "SELECT 'i', TABLE_NAME, INDEX_NAME, SEQ_IN_INDEX, COLUMN_NAME, "
+            "NON_UNIQUE, NULL, NULL, NULL "
+            "FROM information_schema.STATISTICS "
+            "WHERE TABLE_SCHEMA = COALESCE(:schema, DATABASE()) "
+            "UNION ALL "
+            "SELECT 'f', TABLE_NAME, CONSTRAINT_NAME, ORDINAL_POSITION, COLUMN_NAME, "
+            "REFERENCED_TABLE_NAME, REFERENCED_COLUMN_NAME, NULL, NULL "
+            "FROM information_schema.KEY_COLUMN_USAGE "
+            "WHERE TABLE_SCHEMA = COALESCE(:schema, DATABASE()) "
+            "AND REFERENCED_TABLE_NAME IS NOT NULL"
+            ") AS schema_rows"
+        )
+        count, folded = connection.execute(stmt, {"schema": schema}).one()
+        return hashlib.sha1(f"{count}:{folded}".encode()).hexdigest()
+
+    def load_file(
+        self,
+        table: Any,
+        path: str,
+        format: Optional[str] = None,
+        columns: Optional[Sequence[str]] = None,
+        batch_size: int = 10000,
+        progress: Optional[bulk_load.ProgressCallback] = None,
+        header: bool = True,
+        delimiter: str = ",",
+        encoding: str = "utf-8",
+    ) -> int:
+        """csv files are loaded with LOAD DATA LOCAL INFILE, compressed files
+        are first decompressed to a temporary file. Needs local_infile=True in
+        the connect_args of the engine and on the server, otherwise and for
+        ndjson files this falls back to batched inserts"""
+        table = self._load_table(table)
+        format = format or bulk_load.infer_format(path)
+        if format != "csv":
+            return super().load_file(
+                table,
+                path,
+                format,
+                columns,
+                batch_size,
+                progress,
+                header,
+                delimiter,
+                encoding,
+            )
+        __, compression = bulk_load.split_suffixes(path)
+        if compression is None:
+            rows = self._load_data_infile(
+                table, path, columns, header, delimiter, encoding
+            )
+        else:
+            with tempfile.NamedTemporaryFile(suffix=".csv") as tmp:
+                with bulk_load.open_text(path, encoding=encoding) as (fp, __):
+                    with open(tmp.name, "w", encoding=encoding, newline="") as out:
+                        shutil.copyfileobj(fp, out)
+                rows = self._load_data_infile(
+                    table, tmp.name, columns, header, delimiter, encoding
+                )
+        if rows is None:
+            return super().load_file(
+                table,
+                path,
+                format,
+                columns,
+                batch_size,
+                progress,
+                header,
+                delimiter,
+                encoding,
+            )
+        if progress is not None:
+            size = os.path.getsize(path)
+            progress(rows, size, size)
+        return rows
+
+    def _bulk_update_group(
+        self,
+        connection: Connection,
+        table: Table,
+        keys: Sequence[str],
+        columns: Sequence[str],
+        rows: List[Dict[str, Any]],
+        batch_size: int,
+        count_matched: bool = False,
+    ) -> Tuple[Optional[int], int, int]:
+        """Large groups are inserted into a temporary table and applied with
+        a single joined UPDATE"""
+        if len(rows) < MYSQL_STAGED_UPDATE_ROWS:
+            return super()._bulk_update_group(
+                connection, table, keys, columns, rows, batch_size, count_matched
+            )
+        stage = Table(
+            f"_sqlgold_stage_{table.name}",
+            MetaData(),
+            *(
+                Column(table.c[c].name, table.c[c].type, key=c, primary_key=c in keys)
+                for c in (*keys, *columns)
+            ),
+            prefixes=["TEMPORARY"],
+        )
+        stage.create(connection)
+        try:
+            names = (*keys, *columns)
+            for start in range(0, len(rows), batch_size):
+                batch = rows[start : start + batch_size]
+                connection.execute(
+                    insert(stage), [{c: row[c] for c in names} for row in batch]
+                )
+            update, matched = staged_update_sql(
+                connection.dialect, table, stage, keys, columns
+            )
+            changed = connection.exec_driver_sql(update).rowcount
+            matched = (
+                connection.exec_driver_sql(matched).scalar_one()
+                if count_matched
+                else None
+            )
+        finally:
+            preparer = connection.dialect.identifier_preparer
+            connection.exec_driver_sql(
+                f"DROP TEMPORARY TABLE {preparer.format_table(stage)}"
+            )
+        return matched, changed, 1
+
+    def _load_data_infile(
+        self,
+        table,
+        path: str,
+        columns: Optional[Sequence[str]],
+        header: bool,
+        delimiter: str,
+        encoding: str,
+    ) -> Optional[int]:
+        """LOAD DATA LOCAL INFILE, None if local infile is disabled"""
+        with open(path, "rb") as fp:
+            first_line = fp.readline()
+        line_terminator = "\\r\\n" if first_line.endswith(b"\r\n") else "\\n"
+        if columns is None:
+            if header:
+                columns = next(
+                    csv.reader([first_line.decode(encoding)], delimiter=delimiter)
+                )
+                columns = [c.strip() for c in columns]
+            else:
+                columns = [c.key for c in table.columns]
+        quote = self.engine.dialect.identifier_preparer.quote
+        variables, assignments = [], []
+        for i, key in enumerate(columns):
+            column = table.columns[key]
+            variables.append(f"@v{i}")
+            value = f"@v{i}"
+            if not isinstance(column.type, (types.String, types.Enum)):
+                value = f"NULLIF({value}, '')"  ## empty fields are NULL
+            assignments.append(f"{quote(column.name)} = {value}")
+        charset = mysql_charset(encoding)
+        stmt = (
+            f"LOAD DATA LOCAL INFILE %s INTO TABLE {quote(table.name)} "
+            f"CHARACTER SET {charset} "
+            f"FIELDS TERMINATED BY %s OPTIONALLY ENCLOSED BY '\"' ESCAPED BY '' "
+            f"LINES TERMINATED BY '{line_terminator}' "
+            f"{'IGNORE 1 LINES ' if header else ''}"
+            f"({', '.join(variables)}) SET {', '.join(assignments)}"
+        )
+        try:
+            with self.engine.begin() as connection:
+                result = connection.exec_driver_sql(stmt, (path, delimiter))
+                return result.rowcount
+        except DBAPIError as e:
+            if _mysql_error_code(e) in MYSQL_LOCAL_INFILE_ERRORS:
+                logging.warning(
+                    f"LOAD DATA LOCAL INFILE is disabled for {self}, "
+                    f"falling back to batched inserts: {e.orig}"
+                )
+                return None
+            raise
@@ -1,14 +1,122 @@
+import hashlib
+import logging
 import os
-from typing import Any, Dict, Self, Type
+import sqlite3
+import time
+from contextlib import contextmanager
+from typing import TYPE_CHECKING, Any, Dict, Iterator, List, Optional, Self, Set, Type
 
-from sqlalchemy import Engine
+from sqlalchemy import Connection, Engine, Table, create_engine
 from sqlalchemy.orm import Session
 from sqlalchemy.orm import sessionmaker as sa_sessionmaker
+from sqlalchemy.sql import text
 
 from sqlgold.engine.db import DB, sentinel
+from sqlgold.ext.explain import PlanStep, parse_sqlite_plan
+
+if TYPE_CHECKING:
+    from sqlgold.ext.sqlite_checkpoint import MemoryCheckpointer
+    from sqlgold.ext.sqlite_queue import SqliteWriteQueue
+
+## Pragmas set while bulk loading, the previous values are restored afterwards
+BULK_LOAD_PRAGMAS = {
+    "synchronous": "OFF",
+    "cache_size": "-262144",  ## 256MB
+    "temp_store": "MEMORY",
+}
+
+## Virtual machine instructions between checks of a statement's deadline
+DEADLINE_CHECK_INSTRUCTIONS = 1000
 
 
 class Sqlite3DB(DB):
+    write_queue: Optional["SqliteWriteQueue"] = None
+    checkpointer: Optional["MemoryCheckpointer"] = None
+
+    @classmethod
+    def retryable_error_reason(cls, exc: Exception) -> Optional[str]:
+        message = str(getattr(exc, "orig", "")).lower()
+        if "database is locked" in message or "database table is locked" in message:
+            return "locked"
+        return super().retryable_error_reason(exc)
+
+    @classmethod
+    def is_statement_timeout(cls, exc: Exception) -> bool:
+        ## what sqlite3 raises when the progress handler aborts a statement
+        return isinstance(exc, sqlite3.OperationalError) and str(exc) == "interrupted"
+
+    def _apply_statement_deadline(
+        self, connection: Connection, cursor: Any, statement: str, remaining_ms: float
+    ) -> str:
+        """Interrupt the statement from sqlite's progress handler once the time
+        is up. The handler stays installed while the rows are fetched"""
+        expires_at = time.monotonic() + remaining_ms / 1000
+        connection.connection.dbapi_connection.set_progress_handler(
+            lambda: time.monotonic() > expires_at, DEADLINE_CHECK_INSTRUCTIONS
+        )
+        return statement
+
+    def _clear_statement_deadline(self, dbapi_connection: Any) -> None:
+        dbapi_connection.set_progress_handler(None, 0)
+
+    def _explain_statement(
+        self, cursor: Any, statement: str, parameters: Any
+    ) -> List[PlanStep]:
+        cursor.execute(f"EXPLAIN QUERY PLAN {statement}", parameters)
+        return parse_sqlite_plan(cursor.fetchall())
+
+    def _approximate_count(self, connection: Connection, table: Table) -> Optional[int]:
+        ## sqlite_stat1 is created by ANALYZE, the stat of every row of a table
+        ## starts with its row count
+        if not connection.execute(
+            text("SELECT 1 FROM sqlite_master WHERE name = 'sqlite_stat1'")
+        ).first():
+            return None
+        stats = connection.execute(
+            text("SELECT stat FROM sqlite_stat1 WHERE tbl = :table"),
+            {"table": table.name},
+        ).scalars()
+        counts = [int(stat.split()[0]) for stat in stats if stat]
+        return max(counts) if counts else None
+
+    def _open_transaction_ids(self, connection: Connection) -> Optional[Set[Any]]:
+        ## writers are serialized by the database lock, a transaction that
+        ## wrote rows committed or rolled back before the next one could write
+        return set()
+
+    def enable_write_queue(
+        self, readers: int = 4, max_batch: int = 64, max_delay_ms: float = 10
+    ) -> "SqliteWriteQueue":
+        """Read through a pool of read-only connections and queue write
+        transactions for a single writer connection that commits them in
+        groups, for many threads writing to a file backed db.
+        Switches the db to WAL mode. See sqlgold.ext.sqlite_queue
+
+        Args:
+            readers (int, optional): size of the read-only pool. Defaults to 4.
+            max_batch (int, optional): most transactions committed together.
+                Defaults to 64.
+            max_delay_ms (float, optional): longest a committed transaction
+                waits for more to join its group. Defaults to 10.
+
+        Returns:
+            SqliteWriteQueue: the attached queue
+        """
+        from sqlgold.ext.sqlite_queue import SqliteWriteQueue
+
+        self.disable_write_queue()
+        self.write_queue = SqliteWriteQueue(
+            self, readers=readers, max_batch=max_batch, max_delay_ms=max_delay_ms
+        )
+        self.write_queue.attach()
+        return self.write_queue
+
+    def disable_write_queue(self) -> None:
+        """Go back to sessions bound to the engine"""
+        if self.write_queue is not None:
+            self.write_queue.detach()
+            self.write_queue = None
+
     @classmethod
     def create_db(
         cls,
@@ -30,8 +138,129 @@ class Sqlite3DB(DB):
             db.create_all()
         return db
 
+    @classmethod
+    def create_memory_db(
+        cls,
+        path: str,
+        Base: Any = sentinel,
+        create_all: bool = False,
+        checkpoint_interval: Optional[float] = 60.0,
+        pages_per_step: int = 1024,
+        session: Session = None,
+        sessionmaker: Type[sa_sessionmaker] = None,
+        session_args: Dict[str, Any] = None,
+        **kwargs,
+    ) -> Self:
+        """Create a db working in memory, loaded from path if it exists and
+        checkpointed back to it in the background and at exit.
+        Sessions share the one connection of the in-memory database, in turn.
+        See sqlgold.ext.sqlite_checkpoint
+
+        Args:
+            path (str): the database file
+            checkpoint_interval (Optional[float], optional): seconds between
+                checkpoints, None only checkpoints at close. Defaults to 60.0.
+            pages_per_step (int, optional): pages copied per backup step, the
+                longest a checkpoint holds up writers. Defaults to 1024.
+            kwargs: Arguments passed to sqlalchemy create_engine
+
+        Returns:
+            Self: The database instance, with the checkpointer in db.checkpointer
+        """
+        from sqlgold.ext import sqlite_checkpoint
+
+        kwargs.setdefault("pool_timeout", 30)
+        engine = create_engine(
+            "sqlite://",
+            poolclass=sqlite_checkpoint.CheckpointPool,
+            pool_size=1,
+            max_overflow=0,
+            connect_args={"check_same_thread": False},
+            **kwargs,
+        )
+        if os.path.exists(path):
+            sqlite_checkpoint.load_file(engine, path)
+        db = cls.create_db(
+            engine,
+            Base=Base,
+            create_all=create_all,
+            session=session,
+            sessionmaker=sessionmaker,
+            session_args=session_args,
+        )
+        db.checkpointer = sqlite_checkpoint.MemoryCheckpointer(
+            db, path, interval=checkpoint_interval, pages=pages_per_step
+        )
+        return db
+
+    @classmethod
+    def ensure_database(cls, engine: Engine) -> None:
+        """sqlite creates the database file on connect"""
+
     def drop_db(self, **kwargs):
         if not self.database:
             return
         if self.database != ":memory:":
             os.remove(self.database)
+
+    def schema_signature(
+        self, connection: Connection, schema: Optional[str] = None
+    ) -> str:
+        """Checksum of sqlite_master, which holds the sql of every schema object"""
+        master = f"{schema}.sqlite_master" if schema else "sqlite_master"
+        rows = connection.execute(
+            text(f"SELECT type, name, tbl_name, sql FROM {master} ORDER BY type, name")
+        )
+        h = hashlib.sha1()
+        for row in rows:
+            h.update(repr(tuple(row)).encode())
+        return h.hexdigest()
+
+    @contextmanager
+    def _bulk_load_context(
+        self, connection: Connection, table: Table
+    ) -> Iterator[None]:
+        """Relax durability pragmas and drop the table's non-unique indexes while
+        loading, the indexes are rebuilt once at the end which is much cheaper
+        than maintaining them row by row. sqlite DDL is transactional: the
+        indexes are dropped and rebuilt in the load transaction, so a failed
+        or interrupted load keeps them and readers never see them missing"""
+        ## the pragmas are set on the driver connection, outside of any
+        ## transaction: sqlite refuses to change synchronous inside one, and
+        ## engines beginning transactions from a "begin" listener would begin
+        ## one for them
+        driver_connection = connection.connection.driver_connection
+        previous = {}
+        try:
+            for pragma, value in BULK_LOAD_PRAGMAS.items():
+                previous[pragma] = driver_connection.execute(
+                    f"PRAGMA {pragma}"
+                ).fetchone()[0]
+                driver_connection.execute(f"PRAGMA {pragma} = {value}")
+            with connection.begin():
+                ## pysqlite only begins transactions before DML by itself,
+                ## unless the engine's "begin" listener already did
+                if not driver_connection.in_transaction:
+                    connection.exec_driver_sql("BEGIN")
+                quote = connection.dialect.identifier_preparer.quote
+                indexes = []
+                for row in connection.exec_driver_sql(
+                    f"PRAGMA index_list({quote(table.name)})"
+                ).all():
+                    ## (seq, name, unique, origin, partial), origin "c" is CREATE INDEX
+                    if not row[2] and row[3] == "c":
+                        sql = connection.exec_driver_sql(
+                            "SELECT sql FROM sqlite_master "
+                            "WHERE type = 'index' AND name = ?",
+                            (row[1],),
+                        ).scalar()
+                        indexes.append((row[1], sql))
+                for name, __ in indexes:
+                    connection.exec_driver_sql(f"DROP INDEX {quote(name)}")
+                yield
+                for name, sql in indexes:
+                    logging.debug(f"Rebuilding index '{name}' after bulk load")
+                    connection.exec_driver_sql(sql)
+        finally:
+            for pragma, value in previous.items():
+                driver_connection.execute(f"PRAGMA {pragma} = {value}")
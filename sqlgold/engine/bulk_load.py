@@ -0,0 +1,194 @@
+"""Helpers for DB.load_file: streaming readers for csv and ndjson files
+
+Files are read incrementally, optionally through a gzip, bz2 or xz
+decompressor picked from the file suffix, and yield batches of rows ready for
+an executemany INSERT. Nothing holds more than one batch in memory.
+"""
+
+import bz2
+import csv
+import datetime
+import decimal
+import gzip
+import io
+import json
+import lzma
+import os
+from contextlib import contextmanager
+from typing import IO, Any, Callable, Dict, Iterator, List, Optional, Sequence, Tuple
+
+from sqlalchemy import Table, types
+
+FORMATS = ("csv", "ndjson")
+## Decompressing file objects by suffix
+COMPRESSIONS = {
+    ".gz": lambda fp: gzip.GzipFile(fileobj=fp),
+    ".bz2": bz2.BZ2File,
+    ".xz": lzma.LZMAFile,
+}
+
+## progress(rows loaded, bytes read from the file, size of the file)
+ProgressCallback = Callable[[int, int, int], None]
+
+
+def split_suffixes(path: str) -> Tuple[str, Optional[str]]:
+    """The format suffix and compression suffix of a path, e.g. ('.csv', '.gz')"""
+    root, ext = os.path.splitext(path)
+    compression = None
+    if ext.lower() in COMPRESSIONS:
+        compression = ext.lower()
+        root, ext = os.path.splitext(root)
+    return ext.lower(), compression
+
+
+def infer_format(path: str) -> str:
+    ext, __ = split_suffixes(path)
+    if ext == ".csv":
+        return "csv"
+    if ext in (".ndjson", ".jsonl", ".json"):
+        return "ndjson"
+    raise ValueError(f"Can't infer the format of '{path}', pass format=")
+
+
+class CountingReader(io.RawIOBase):
+    """Wraps a binary file and counts the bytes read from it"""
+
+    def __init__(self, raw: IO[bytes]):
+        self.raw = raw
+        self.bytes_read = 0
+
+    def readable(self) -> bool:
+        return True
+
+    def readinto(self, b) -> int:
+        n = self.raw.readinto(b)
+        self.bytes_read += n or 0
+        return n
+
+
+@contextmanager
+def open_text(
+    path: str, encoding: str = "utf-8"
+) -> Iterator[Tuple[IO[str], CountingReader]]:
+    """Open a possibly compressed file for reading text
+
+    Yields:
+        Tuple[IO[str], CountingReader]: the text stream and the counter of
+            (compressed) bytes read from disk
+    """
+    __, compression = split_suffixes(path)
+    with open(path, "rb") as raw:
+        counter = CountingReader(raw)
+        stream: IO[bytes] = io.BufferedReader(counter)
+        if compression is not None:
+            stream = COMPRESSIONS[compression](stream)
+        with io.TextIOWrapper(stream, encoding=encoding, newline="") as text:
+            yield text, counter
+
+
+def _converter(sa_type: types.TypeEngine) -> Optional[Callable[[str], Any]]:
+    """Parse csv strings for a column, empty strings are NULL"""
+    if isinstance(sa_type, (types.String, types.Enum)):
+        return None
+    if isinstance(sa_type, types.Boolean):
+        parse = lambda v: v.strip().lower() in ("1", "t", "true", "y", "yes")
+    elif isinstance(sa_type, types.Integer):
+        parse = int
+    elif isinstance(sa_type, types.Float):
+        parse = float
+    elif isinstance(sa_type, types.Numeric):
+        parse = decimal.Decimal
+    elif isinstance(sa_type, types.DateTime):
+        parse = datetime.datetime.fromisoformat
+    elif isinstance(sa_type, types.Date):
+        parse = datetime.date.fromisoformat
+    elif isinstance(sa_type, types.Time):
+        parse = datetime.time.fromisoformat
+    else:
+        return None
+    return lambda v: None if v == "" else parse(v)
+
+
+def _json_converter(sa_type: types.TypeEngine) -> Optional[Callable[[Any], Any]]:
+    """JSON has no dates, parse them from their iso strings"""
+    for type_, parse in (
+        (types.DateTime, datetime.datetime.fromisoformat),
+        (types.Date, datetime.date.fromisoformat),
+        (types.Time, datetime.time.fromisoformat),
+    ):
+        if isinstance(sa_type, type_):
+            return lambda v: parse(v) if isinstance(v, str) else v
+    return None
+
+
+def _resolve_columns(table: Table, columns: Sequence[str]) -> List[str]:
+    keys = [c.key for c in table.columns]
+    unknown = [c for c in columns if c not in table.columns]
+    if unknown:
+        raise ValueError(f"Columns {unknown} are not in table '{table.name}' ({keys})")
+    return list(columns)
+
+
+def read_csv_batches(
+    fp: IO[str],
+    table: Table,
+    columns: Optional[Sequence[str]],
+    batch_size: int,
+    header: bool = True,
+    delimiter: str = ",",
+) -> Iterator[List[Dict[str, Any]]]:
+    reader = csv.reader(fp, delimiter=delimiter)
+    file_columns = next(reader, None) if header else None
+    if columns is None:
+        columns = (
+            file_columns if file_columns is not None else [c.key for c in table.columns]
+        )
+    columns = _resolve_columns(table, columns)
+    converters = [_converter(table.columns[c].type) for c in columns]
+    if not any(converters):
+        converters = None
+
+    batch = []
+    for record in reader:
+        if not record:
+            continue
+        if converters is not None:
+            record = [v if f is None else f(v) for f, v in zip(converters, record)]
+        batch.append(dict(zip(columns, record)))
+        if len(batch) >= batch_size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+
+def read_ndjson_batches(
+    fp: IO[str],
+    table: Table,
+    columns: Optional[Sequence[str]],
+    batch_size: int,
+) -> Iterator[List[Dict[str, Any]]]:
+    converters = None
+    batch = []
+    for line in fp:
+        line = line.strip()
+        if not line:
+            continue
+        obj = json.loads(line)
+        if columns is None:
+            ## executemany needs the same keys in every row, take the first object's
+            columns = list(obj)
+        if converters is None:
+            columns = _resolve_columns(table, columns)
+            converters = {
+                c: f for c in columns if (f := _json_converter(table.columns[c].type))
+            }
+        row = {c: obj.get(c) for c in columns}
+        for c, f in converters.items():
+            row[c] = f(row[c])
+        batch.append(row)
+        if len(batch) >= batch_size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
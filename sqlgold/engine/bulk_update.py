@@ -0,0 +1,152 @@
+"""Helpers for DB.bulk_update: grouping rows by the columns they change
+
+Rows are dicts holding the primary key (or ``key``) and the new values of some
+columns. Rows setting the same columns share one UPDATE statement, executed
+with executemany in batches. The WHERE clause skips rows whose values are
+already current, so the row count of the statement is the number of rows
+changed. Counting the rows matched by key takes an extra SELECT per batch and
+is only done on request.
+
+Rows with the same key are merged in order, later values win, so every key is
+updated once whichever way the dialect applies the group.
+"""
+
+from dataclasses import dataclass
+from typing import Any, Dict, Iterable, List, Optional, Sequence, Tuple
+
+from sqlalchemy import Table, Update, bindparam, func, or_, select, tuple_, update
+from sqlalchemy.sql import Select
+
+## Bound parameter prefixes, they can't collide with column names
+KEY_PREFIX = "_k_"
+VALUE_PREFIX = "_v_"
+
+
+@dataclass
+class BulkUpdateResult:
+    rows: int = 0  ## rows given
+    matched: Optional[int] = None  ## rows of the table with the given keys
+    changed: int = 0  ## rows whose values were changed
+    statements: int = 0  ## UPDATE statements executed, executemany counts once
+
+    def add(self, matched: Optional[int], changed: int, statements: int) -> None:
+        if matched is not None:
+            self.matched = (self.matched or 0) + matched
+        self.changed += changed
+        self.statements += statements
+
+
+def key_columns(table: Table, key: Optional[Any]) -> List[str]:
+    """The keys of the key columns, the primary key by default"""
+    if key is None:
+        keys = [c.key for c in table.primary_key.columns]
+        if not keys:
+            raise ValueError(f"Table '{table.name}' has no primary key, pass key=")
+        return keys
+    keys = [key] if isinstance(key, str) else list(key)
+    for k in keys:
+        if k not in table.c:
+            raise ValueError(f"Table '{table.name}' has no column '{k}'")
+    return keys
+
+
+def group_rows(
+    table: Table,
+    rows: Iterable[Dict[str, Any]],
+    keys: Sequence[str],
+    columns: Optional[Sequence[str]] = None,
+) -> Tuple[int, Dict[Tuple[str, ...], List[Dict[str, Any]]]]:
+    """Group rows by the columns they set, in table column order. Rows with
+    the same key are merged into one, later values win
+
+    Args:
+        table (Table): the table
+        rows (Iterable[Dict[str, Any]]): dicts of column key to value
+        keys (Sequence[str]): the key columns every row must have
+        columns (Optional[Sequence[str]], optional): only update these columns,
+            other values in the rows are ignored. Defaults to every column
+            given in a row.
+
+    Returns:
+        Tuple[int, Dict]: the number of rows given and the rows by set columns
+    """
+    order = {c.key: i for i, c in enumerate(table.columns)}
+    allowed = None if columns is None else set(columns)
+    signatures: Dict[frozenset, Tuple[str, ...]] = {}
+
+    def signature_of(row: Dict[str, Any], n: int) -> Tuple[str, ...]:
+        names = frozenset(row)
+        signature = signatures.get(names)
+        if signature is None:
+            missing = [k for k in keys if k not in names]
+            if missing:
+                raise ValueError(f"Row {n} has no value for the key {missing}")
+            set_columns = [
+                c for c in names if c not in keys and (allowed is None or c in allowed)
+            ]
+            unknown = [c for c in set_columns if c not in order]
+            if unknown:
+                raise ValueError(f"Table '{table.name}' has no columns {unknown}")
+            signature = tuple(sorted(set_columns, key=order.__getitem__))
+            signatures[names] = signature
+        return signature
+
+    by_key: Dict[Tuple[Any, ...], Tuple[Tuple[str, ...], Dict[str, Any]]] = {}
+    n = 0
+    for row in rows:
+        n += 1
+        signature = signature_of(row, n)
+        key = tuple(row[k] for k in keys)
+        previous = by_key.get(key)
+        if previous is not None:
+            ## a duplicate key, the rows would otherwise be applied in an
+            ## unspecified order (or fail on the staging table's primary key)
+            row = {**previous[1], **row}
+            signature = signature_of(row, n)
+        by_key[key] = (signature, row)
+
+    groups: Dict[Tuple[str, ...], List[Dict[str, Any]]] = {}
+    for signature, row in by_key.values():
+        if signature:
+            groups.setdefault(signature, []).append(row)
+    return n, groups
+
+
+def update_statement(
+    table: Table, keys: Sequence[str], columns: Sequence[str]
+) -> Update:
+    """UPDATE of columns by key, skipping rows already holding the values"""
+    return (
+        update(table)
+        .where(*(table.c[k] == bindparam(KEY_PREFIX + k) for k in keys))
+        .where(
+            or_(
+                *(
+                    table.c[c].is_distinct_from(bindparam(VALUE_PREFIX + c))
+                    for c in columns
+                )
+            )
+        )
+        .values({c: bindparam(VALUE_PREFIX + c) for c in columns})
+    )
+
+
+def update_params(
+    rows: Sequence[Dict[str, Any]], keys: Sequence[str], columns: Sequence[str]
+) -> List[Dict[str, Any]]:
+    names = [(KEY_PREFIX + k, k) for k in keys] + [
+        (VALUE_PREFIX + c, c) for c in columns
+    ]
+    return [{param: row[name] for param, name in names} for row in rows]
+
+
+def matched_statement(
+    table: Table, keys: Sequence[str], rows: Sequence[Dict[str, Any]]
+) -> Select:
+    """Count the rows of the table with the keys of rows"""
+    if len(keys) == 1:
+        where = table.c[keys[0]].in_({row[keys[0]] for row in rows})
+    else:
+        values = {tuple(row[k] for k in keys) for row in rows}
+        where = tuple_(*(table.c[k] for k in keys)).in_(values)
+    return select(func.count()).select_from(table).where(where)
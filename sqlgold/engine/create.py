@@ -51,6 +51,16 @@ class DriverType(StrEnum):
 class DBFactory:
     """Factory for creating DB instances."""
 
+    @staticmethod
+    def db_class(url: URL) -> Type[DB]:
+        """The DB class for the driver of the url"""
+        dt = DriverType.from_str(url.drivername)
+        if dt == DriverType.mysql:
+            return MysqlDB
+        if dt == DriverType.sqlite3:
+            return Sqlite3DB
+        return DB
+
     @staticmethod
     def create_db_from_engine(
         engine: Engine,
@@ -112,11 +122,23 @@ class DBFactory:
         session: Session = None,
         sessionmaker: Type[sessionmaker] = None,
         session_args: Dict[str, Any] = None,
+        lazy: bool = False,
         *args,
         **kwargs,
     ) -> DB:
+        if lazy:
+            return DBFactory.db_class(sa_make_url(url)).create_lazy_db(
+                url,
+                Base=Base,
+                create_all=create_all,
+                session=session,
+                sessionmaker=sessionmaker,
+                session_args=session_args,
+                engine_args=args,
+                engine_kwargs=kwargs,
+            )
         engine = create_engine(url, *args, **kwargs)
-        return DBFactory.create_db_from_engine(
+        db = DBFactory.create_db_from_engine(
             engine,
             Base=Base,
             create_all=create_all,
@@ -124,6 +146,9 @@ class DBFactory:
             sessionmaker=sessionmaker,
             session_args=session_args,
         )
+        db.engine_args = args
+        db.engine_kwargs = kwargs
+        return db
 
     @staticmethod
     def create_db_from_dict(
@@ -133,6 +158,7 @@ class DBFactory:
         session: Session = None,
         sessionmaker: Type[sessionmaker] = None,
         session_args: Dict[str, Any] = None,
+        lazy: bool = False,
         *args,
         **kwargs,
     ) -> DB:
@@ -155,6 +181,7 @@ class DBFactory:
                 session=session,
                 sessionmaker=sessionmaker,
                 session_args=session_args,
+                lazy=lazy,
                 *args,
                 **kwargs,
             )
@@ -170,6 +197,7 @@ class DBFactory:
             session=session,
             sessionmaker=sessionmaker,
             session_args=session_args,
+            lazy=lazy,
             *args,
             **kwargs,
         )
@@ -182,6 +210,7 @@ class DBFactory:
         session: Session = None,
         sessionmaker: Type[sessionmaker] = None,
         session_args: Dict[str, Any] = None,
+        lazy: bool = False,
         *args,
         **kwargs,
     ) -> DB:
@@ -207,6 +236,7 @@ class DBFactory:
             session=session,
             sessionmaker=sessionmaker,
             session_args=session_args,
+            lazy=lazy,
             *args,
             **kwargs,
         )
@@ -219,6 +249,7 @@ class DBFactory:
         session: Session = None,
         sessionmaker: Type[sessionmaker] = None,
         session_args: Dict[str, Any] = None,
+        lazy: bool = False,
         *args,
         **kwargs,
     ) -> DB:
@@ -251,6 +282,7 @@ class DBFactory:
                 session=session,
                 sessionmaker=sessionmaker,
                 session_args=session_args,
+                lazy=lazy,
                 *args,
                 **kwargs,
             )
@@ -262,6 +294,7 @@ class DBFactory:
                 session=session,
                 sessionmaker=sessionmaker,
                 session_args=session_args,
+                lazy=lazy,
                 *args,
                 **kwargs,
             )
@@ -274,6 +307,7 @@ class DBFactory:
                     session=session,
                     sessionmaker=sessionmaker,
                     session_args=session_args,
+                    lazy=lazy,
                     *args,
                     **kwargs,
                 )
@@ -285,6 +319,7 @@ class DBFactory:
                     session=session,
                     sessionmaker=sessionmaker,
                     session_args=session_args,
+                    lazy=lazy,
                     *args,
                     **kwargs,
                 )
@@ -304,6 +339,7 @@ class DBFactory:
         session: Session = None,
         sessionmaker: Type[sessionmaker] = None,
         session_args: Dict[str, Any] = None,
+        lazy: bool = False,
         *args,
         **kwargs,
     ) -> DB:
@@ -318,6 +354,8 @@ class DBFactory:
             alias: An alias for this db that can be used for retrieval later
             If not specified the string or hash of section_dict_url will
             be used
+            lazy: Create the engine, ensure the database and create the tables
+            when the db is first used instead of now
             args: Arguments passed to sqlalchemy create_engine
             kwargs: Arguments passed to sqlalchemy create_engine
 
@@ -344,6 +382,7 @@ class DBFactory:
             session=session,
             sessionmaker=sessionmaker,
             session_args=session_args,
+            lazy=lazy,
             *args,
             **kwargs,
         )
@@ -362,6 +401,7 @@ def create_db(
     session: Session = None,
     sessionmaker: Type[sessionmaker] = None,
     session_args: Dict[str, Any] = None,
+    lazy: bool = False,
     *args,
     **kwargs,
 ) -> DB:
@@ -376,6 +416,8 @@ def create_db(
         alias: An alias for this db that can be used for retrieval later
         If not specified the string or hash of section_dict_url will
         be used
+        lazy: Create the engine, ensure the database and create the tables
+        when the db is first used instead of now
         args: Arguments passed to sqlalchemy create_engine
         kwargs: Arguments passed to sqlalchemy create_engine
 
@@ -394,6 +436,7 @@ def create_db(
         sessionmaker=sessionmaker,
         alias=alias,
         session_args=session_args,
+        lazy=lazy,
         *args,
         **kwargs,
     )
@@ -7,21 +7,130 @@ Flush: the flush occurs before any individual SQL statement is
     It also occurs before a SAVEPOINT is issued when Session.begin_nested() is used.
 
 """
+import hashlib
+import importlib
 import logging
-from typing import Any, Dict, Optional, Self
+import os
+import sys
+import threading
+import weakref
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from typing import TYPE_CHECKING, Any, Callable, Dict, Iterator, List, Optional, Self
 from typing import Sequence as _typing_Sequence
-from typing import Set, Type
+from typing import Iterable, Set, Tuple, Type, Union
 
-from sqlalchemy import Engine, create_engine, quoted_name
+from sqlalchemy import (
+    Connection,
+    Engine,
+    MetaData,
+    create_engine,
+    func,
+    inspect,
+    quoted_name,
+    select,
+)
+from sqlalchemy import insert as sa_insert
+from sqlalchemy.engine import URL
+from sqlalchemy.engine import make_url as sa_make_url
+from sqlalchemy.exc import DBAPIError
+from sqlalchemy.orm import declarative_base as sa_declarative_base
 from sqlalchemy.orm import Session as sa_Session
 from sqlalchemy.orm import sessionmaker as sa_sessionmaker
+from sqlalchemy.pool import QueuePool
 from sqlalchemy.schema import Table
 from sqlalchemy.sql import text
 
+from sqlgold.exceptions import UnsupportedDialectError
+from sqlgold.metrics import MetricsRegistry
+
+from . import bulk_load, bulk_update
+from .db_metrics import DBMetrics
 from .db_options import DBOptions
+from .deadline import DEADLINE_KEY, Deadline, StatementDeadlines
+from .deadline import deadline as _deadline
+from .health import CircuitBreaker
+from .health import health as _health
+from .transaction import TransactionRunner
+from .reflection import (
+    load_cached_metadata,
+    make_cache_key,
+    resolve_cache_file,
+    save_cached_metadata,
+)
+
+if TYPE_CHECKING:
+    from sqlgold.ext.buffered_writer import BufferedWriter
+    from sqlgold.ext.counts import RowCounts
+    from sqlgold.ext.explain import PlanStep, QueryPlan, SlowQuery, SlowQueryLog
+    from sqlgold.ext.nplusone import NPlusOneDetector
+    from sqlgold.ext.outbox import Outbox
+    from sqlgold.ext.profiler import SessionProfiler, TransactionProfile
+    from sqlgold.ext.workload import ReplayReport, WorkloadRecorder
 
 sentinel = object()
 
+## Every live DB, so that pools inherited through fork can be discarded
+_live_dbs: "weakref.WeakSet[DB]" = weakref.WeakSet()
+
+
+def _discard_inherited_pools() -> None:
+    """Runs in the child after a fork. The pooled connections belong to the
+    parent, drop them without closing their sockets so the parent's connections
+    keep working and the child opens its own"""
+    for db in list(_live_dbs):
+        if db._engine is None:  ## lazy and never used
+            continue
+        try:
+            db._engine.dispose(close=False)
+        except Exception as e:
+            logging.debug(f"Error discarding the pool of {db} after fork: {e}")
+
+
+if hasattr(os, "register_at_fork"):
+    os.register_at_fork(after_in_child=_discard_inherited_pools)
+
+
+def _find_base(Base: Any) -> Optional[Tuple[str, str]]:
+    """(module, name) of the module attribute holding Base. Bases made with
+    declarative_base() can't be pickled by reference on their own as they
+    claim to live in sqlalchemy, so look in the modules of the mapped classes"""
+    registry = getattr(Base, "registry", None)
+    if registry is None:
+        return None
+    modules = {Base.__module__}
+    modules.update(m.class_.__module__ for m in registry.mappers)
+    for module_name in sorted(modules):
+        module = sys.modules.get(module_name)
+        for name, value in vars(module or {}).items():
+            if value is Base:
+                return module_name, name
+    return None
+
+
+class _DBSessionmakerMixin:
+    """Binds the sessionmaker to the db's engine on the first session, which
+    creates the engine of a lazy db, and gives sessions made with timeout_ms
+    a deadline"""
+
+    _db: "DB"
+
+    def __call__(self, timeout_ms: Optional[float] = None, **local_kw):
+        if self.kw.get("bind") is None:
+            self.configure(bind=self._db.engine)
+        session = super().__call__(**local_kw)
+        if timeout_ms is not None:
+            self._db._statement_deadlines()
+            session.info[DEADLINE_KEY] = Deadline.after(timeout_ms).expires_at
+        return session
+
+
+def _db_sessionmaker(cls: Type[sa_sessionmaker], db: "DB") -> sa_sessionmaker:
+    db_cls = type(f"DB{cls.__name__}", (_DBSessionmakerMixin, cls), {})
+    Session = db_cls()
+    Session._db = db
+    return Session
+
 
 class DB:
     """manager for interfacing with a database through SQAlchemy"""
@@ -32,45 +141,102 @@ class DB:
 
     def __init__(
         self,
-        engine: Engine,
+        engine: Optional[Engine],
         Base: Any = sentinel,
         session: sa_Session = None,
         sessionmaker: Type[sa_sessionmaker] = None,
         session_args: Dict[str, Any] = None,
+        url: Union[str, URL] = None,
+        engine_args: tuple = (),
+        engine_kwargs: Dict[str, Any] = None,
     ):
         """init the DB instance with the given uri
 
         Args:
+            engine (Optional[Engine]): the engine, or None to create it from the
+                url, engine_args and engine_kwargs when it is first used
             url (Union[str, URL]): connection uri to use when creating db
         """
-        self.engine: Engine = engine
+        self._engine: Optional[Engine] = engine
+        self._engine_lock = threading.Lock()
+        ## run with the new engine before a lazy db is used, see create_lazy_db
+        self._pending_setup: List[Callable[[Engine], None]] = []
         self.Base: Any = Base
+        self.alias: Optional[str] = None  ## set when registered with the DBManager
+        self.metrics: Optional[DBMetrics] = None
+        self.profiler: Optional["SessionProfiler"] = None
+        self.nplusone: Optional["NPlusOneDetector"] = None
+        self.breaker: Optional[CircuitBreaker] = None
+        self.deadlines: Optional[StatementDeadlines] = None
+        self.slow_queries: Optional["SlowQueryLog"] = None
+        self.workload_recorder: Optional["WorkloadRecorder"] = None
+        self.outbox: Optional["Outbox"] = None
+        self.row_counts: Optional["RowCounts"] = None
+        ## create_engine arguments, used to create lazy engines and to rebuild
+        ## the engine when unpickled
+        self.engine_args: tuple = engine_args
+        self.engine_kwargs: Dict[str, Any] = engine_kwargs or {}
 
         if Base == sentinel:
             self.Base = DB.default_base
 
-        if not self.engine:
+        if not engine and not url:
             raise IOError("No url connection")
+        self._url: URL = engine.url if engine else sa_make_url(url)
 
-        logging.debug(f"SQLALCHEMY_URL = {self.engine.url}")
+        logging.debug(f"SQLALCHEMY_URL = {self._url}")
+        self._sessionmaker_cls = sessionmaker or DB.default_sessionmaker
         if session is None:
             session_args = {} if not session_args else session_args
-            if sessionmaker is None:
-                Session = DB.default_sessionmaker()
+            Session = _db_sessionmaker(self._sessionmaker_cls, self)
+            if engine is None:
+                Session.configure(**session_args)
             else:
-                Session = sessionmaker()
-            Session.configure(bind=self.engine, **session_args)
+                Session.configure(bind=engine, **session_args)
             self.Session: sa_Session = Session
         else:
             self.Session: sa_Session = session
 
+        if DBOptions.metrics in DB.default_options and engine is not None:
+            self.enable_metrics()
+        _live_dbs.add(self)
+
+    @property
+    def engine(self) -> Engine:
+        """The engine, created on first use for lazy dbs"""
+        if self._engine is None:
+            self._create_lazy_engine()
+        return self._engine
+
+    @engine.setter
+    def engine(self, engine: Engine) -> None:
+        self._engine = engine
+
+    @property
+    def is_lazy(self) -> bool:
+        """Whether the engine is yet to be created"""
+        return self._engine is None
+
+    def _create_lazy_engine(self) -> None:
+        with self._engine_lock:
+            if self._engine is not None:
+                return
+            logging.debug(f"Creating the engine of lazy '{self}'")
+            engine = create_engine(self._url, *self.engine_args, **self.engine_kwargs)
+            for setup in self._pending_setup:
+                setup(engine)
+            self._pending_setup = []
+            self._engine = engine
+        if DBOptions.metrics in DB.default_options and self.metrics is None:
+            self.enable_metrics()
+
     @property
-    def url(self):
-        return self.engine.url
+    def url(self) -> URL:
+        return self._url
 
     @property
     def database(self):
-        return self.engine.url.database
+        return self._url.database
 
     def __repr__(self):
         return f"DB(database={self.url.database})"
@@ -78,6 +244,45 @@ class DB:
     def __str__(self):
         return self.__repr__()
 
+    def __getstate__(self) -> Dict[str, Any]:
+        """Pickle by configuration: the url, create_engine arguments, Base and
+        session arguments. The Base and sessionmaker class must be importable.
+        Metrics, profiling and N+1 detection are not carried over"""
+        if not isinstance(self.Session, sa_sessionmaker):
+            raise TypeError(f"Can't pickle {self}, its Session is not a sessionmaker")
+        session_args = {k: v for k, v in self.Session.kw.items() if k != "bind"}
+        Base = None if self.Base is sentinel else self.Base
+        base_ref = _find_base(Base) if Base is not None else None
+        return {
+            "url": self.url.render_as_string(hide_password=False),
+            "engine_args": self.engine_args,
+            "engine_kwargs": self.engine_kwargs,
+            "Base": None if base_ref else Base,
+            "base_ref": base_ref,
+            "sessionmaker": self._sessionmaker_cls,
+            "session_args": session_args,
+            "alias": self.alias,
+        }
+
+    def __setstate__(self, state: Dict[str, Any]) -> None:
+        """Rebuild the db from the pickled configuration. The engine is created
+        when the db is first used"""
+        Base = state["Base"]
+        if state["base_ref"] is not None:
+            module_name, name = state["base_ref"]
+            Base = getattr(importlib.import_module(module_name), name)
+        DB.__init__(
+            self,
+            None,
+            Base=Base,
+            sessionmaker=state["sessionmaker"],
+            session_args=state["session_args"],
+            url=state["url"],
+            engine_args=state["engine_args"],
+            engine_kwargs=state["engine_kwargs"],
+        )
+        self.alias = state["alias"]
+
     @classmethod
     def create_connection_url(cls, url) -> str:
         """The connection url without the database
@@ -118,6 +323,21 @@ class DB:
             session_args=session_args,
         )
 
+        cls.ensure_database(engine)
+
+        if Base is not None and (
+            create_all or DBOptions.create_all in DB.default_options
+        ):
+            db.create_all()
+        return db
+
+    @classmethod
+    def ensure_database(cls, engine: Engine) -> None:
+        """Create the database of the engine's url if it doesn't exist
+
+        Args:
+            engine (Engine): the engine of the db
+        """
         connection_url = cls.create_connection_url(engine.url)
         database = engine.url.database
 
@@ -131,12 +351,89 @@ class DB:
             )
             s.execute(text(f"USE {quoted_name(database, True)};"))
 
-        if Base is not None and (
+    @classmethod
+    def create_lazy_db(
+        cls,
+        url: Union[str, URL],
+        Base: Any = sentinel,
+        create_all: bool = False,
+        session: sa_Session = None,
+        sessionmaker: Type[sa_sessionmaker] = None,
+        session_args: Dict[str, Any] = None,
+        engine_args: tuple = (),
+        engine_kwargs: Dict[str, Any] = None,
+    ) -> Self:
+        """Create a db whose engine is created, and database ensured and tables
+        created, only when it is first used
+
+        Args:
+            url (Union[str, URL]): database url
+            engine_args (tuple, optional): Arguments passed to sqlalchemy create_engine
+            engine_kwargs (Dict[str, Any], optional): Arguments passed to sqlalchemy
+                create_engine
+
+        Returns:
+            Self: The database instance
+        """
+        db = cls(
+            None,
+            Base=Base,
+            session=session,
+            sessionmaker=sessionmaker,
+            session_args=session_args,
+            url=url,
+            engine_args=engine_args,
+            engine_kwargs=engine_kwargs,
+        )
+        db._pending_setup.append(cls.ensure_database)
+        if db.Base is not None and (
             create_all or DBOptions.create_all in DB.default_options
         ):
-            db.create_all()
+            db._pending_setup.append(
+                lambda engine: db.Base.metadata.create_all(bind=engine)
+            )
         return db
 
+    def warmup(self, n: int = 5, timeout: float = 30) -> int:
+        """Open and pre-ping n pool connections in parallel so that the first
+        requests find warm connections. Creates the engine of a lazy db.
+        Only as many connections as the pool keeps (pool_size) stay open
+
+        Args:
+            n (int, optional): number of connections. Defaults to 5.
+            timeout (float, optional): seconds to wait for the connections.
+                Defaults to 30.
+
+        Returns:
+            int: the number of connections opened
+        """
+        pool = self.engine.pool
+        if not isinstance(pool, QueuePool):
+            ## per-thread or single connection pools, warm this thread's
+            n = min(n, 1)
+        else:
+            n = min(n, pool.size())
+        if n < 1:
+            return 0
+        dialect = self.engine.dialect
+        ## hold every connection until all are open, else the pool hands out
+        ## the same one again
+        barrier = threading.Barrier(n, timeout=timeout)
+
+        def open_connection(_):
+            with self.engine.connect() as connection:
+                dialect.do_ping(connection.connection.dbapi_connection)
+                if n > 1:
+                    barrier.wait()
+
+        if n == 1:
+            open_connection(0)
+        else:
+            with ThreadPoolExecutor(max_workers=n) as executor:
+                list(executor.map(open_connection, range(n), timeout=timeout))
+        logging.debug(f"Warmed up {n} connections of {self}")
+        return n
+
     def create_all(
         self, tables: Optional[_typing_Sequence[Table]] = None, checkfirst: bool = True
     ) -> None:
@@ -185,3 +482,936 @@ class DB:
 
         with self.Session.begin() as session:
             session.execute(text(stmt))
+
+    @classmethod
+    def retryable_error_reason(cls, exc: Exception) -> Optional[str]:
+        """Classify an error raised by a transaction. Dialects extend this with
+        their own deadlock and lock errors
+
+        Args:
+            exc (Exception): the error
+
+        Returns:
+            Optional[str]: the reason it can be retried, or None if it can't
+        """
+        if cls.is_disconnect_error(exc):
+            return "disconnect"
+        return None
+
+    @classmethod
+    def is_disconnect_error(cls, exc: Exception) -> bool:
+        """Whether the error means the connection is no longer usable"""
+        return isinstance(exc, DBAPIError) and exc.connection_invalidated
+
+    @classmethod
+    def is_statement_timeout(cls, exc: Exception) -> bool:
+        """Whether the error is the driver or server aborting a statement that
+        exceeded the time given by _apply_statement_deadline"""
+        return False
+
+    def _apply_statement_deadline(
+        self, connection: Connection, cursor: Any, statement: str, remaining_ms: float
+    ) -> str:
+        """Limit the next statement to remaining_ms, returns the statement to
+        execute. Dialects without a way to do so only get statements that
+        start after their deadline refused"""
+        return statement
+
+    def _clear_statement_deadline(self, dbapi_connection: Any) -> None:
+        """Undo the connection state set by _apply_statement_deadline"""
+
+    def _statement_deadlines(self) -> StatementDeadlines:
+        if self.deadlines is None:
+            if self.is_lazy:  ## outside of the lock, creating the engine takes it
+                self._create_lazy_engine()
+            with self._engine_lock:
+                if self.deadlines is None:
+                    deadlines = StatementDeadlines(self)
+                    deadlines.attach()
+                    self.deadlines = deadlines
+        return self.deadlines
+
+    @contextmanager
+    def deadline(self, timeout_ms: float) -> Iterator[Deadline]:
+        """Give the statements run within the block timeout_ms milliseconds in
+        total, StatementTimeoutError is raised by the statement that runs out
+        of time. Applies to every db with deadlines in use, nested blocks can
+        only shorten the deadline. See sqlgold.engine.deadline
+
+        Args:
+            timeout_ms (float): the time budget of the block
+
+        Yields:
+            Deadline: the deadline, for checking the time left
+        """
+        self._statement_deadlines()
+        with _deadline(timeout_ms) as deadline:
+            yield deadline
+
+    def transaction(
+        self,
+        retries: int = 3,
+        backoff: float = 0.05,
+        max_backoff: float = 2.0,
+        jitter: bool = True,
+        on_retry: Optional[Callable[[BaseException, int, float], None]] = None,
+        retry_ambiguous_commit: bool = False,
+    ) -> TransactionRunner:
+        """A transaction that is retried on deadlocks, lock timeouts and
+        disconnects with jittered exponential backoff.
+        Use as a decorator (the session is passed as the first argument),
+        call run(func, *args), or iterate over its attempts.
+        See sqlgold.engine.transaction
+
+        Args:
+            retries (int, optional): retries after the first attempt. Defaults to 3.
+            backoff (float, optional): base delay in seconds. Defaults to 0.05.
+            max_backoff (float, optional): maximum delay in seconds. Defaults to 2.0.
+            jitter (bool, optional): randomize the delays. Defaults to True.
+            on_retry (Optional[Callable], optional): called with the error, the
+                attempt number and the delay before every retry. Defaults to None.
+            retry_ambiguous_commit (bool, optional): also retry when the
+                connection is lost during COMMIT, when it's unknown whether the
+                transaction committed. Only for idempotent work. Defaults to False.
+
+        Returns:
+            TransactionRunner: the runner
+        """
+        return TransactionRunner(
+            self,
+            retries=retries,
+            backoff=backoff,
+            max_backoff=max_backoff,
+            jitter=jitter,
+            on_retry=on_retry,
+            retry_ambiguous_commit=retry_ambiguous_commit,
+        )
+
+    def buffered_writer(
+        self,
+        model: Any,
+        max_rows: int = 1000,
+        max_latency_ms: float = 100,
+        max_buffer: Optional[int] = None,
+        on_error: Optional[Callable[[Exception, list], None]] = None,
+    ) -> "BufferedWriter":
+        """A thread safe handle that buffers rows and inserts them in batches
+        from a background thread. See sqlgold.ext.buffered_writer
+
+        Args:
+            model (Any): a mapped class or a Table
+            max_rows (int, optional): rows per batch. Defaults to 1000.
+            max_latency_ms (float, optional): longest a row waits before its batch
+                is written. Defaults to 100.
+            max_buffer (Optional[int], optional): rows buffered before writes
+                block. Defaults to 10 * max_rows.
+            on_error (Optional[Callable], optional): called with the error and rows
+                of a failed batch, which isn't retried. Defaults to None (log and
+                drop).
+
+        Returns:
+            BufferedWriter: the writer, close it (or use it as a context manager)
+                to flush the remaining rows
+        """
+        from sqlgold.ext.buffered_writer import BufferedWriter
+
+        return BufferedWriter(
+            self,
+            model,
+            max_rows=max_rows,
+            max_latency_ms=max_latency_ms,
+            max_buffer=max_buffer,
+            on_error=on_error,
+        )
+
+    def parallel_map(
+        self,
+        source: Any,
+        func: Callable[[list], Any],
+        workers: Optional[int] = None,
+        partition_by: Any = None,
+        partitions: Optional[int] = None,
+        strategy: str = "auto",
+        batch_size: int = 1000,
+        reduce: Optional[Callable[[Any, Any], Any]] = None,
+        initial: Any = None,
+        progress: Optional[Callable[[int, int, int], None]] = None,
+        retries: int = 2,
+        mp_context: Optional[str] = None,
+    ) -> Any:
+        """Apply func to the rows of a query in batches, with the key range split
+        into partitions that are read and processed in worker processes.
+        See sqlgold.ext.parallel
+
+        Args:
+            source (Any): a mapped class or a select statement. Statements
+                require the fork start method.
+            func (Callable[[list], Any]): called with every batch of rows
+                (entities when a single entity is selected)
+            workers (Optional[int], optional): worker processes.
+                Defaults to the number of cpus.
+            partition_by (Any, optional): column or attribute name to partition
+                on. Defaults to the primary key.
+            partitions (Optional[int], optional): number of partitions.
+                Defaults to 4 * workers.
+            strategy (str, optional): "minmax", "quantile" or "auto" (minmax for
+                numeric keys). Defaults to "auto".
+            batch_size (int, optional): rows per batch. Defaults to 1000.
+            reduce (Optional[Callable], optional): fold the batch results with
+                reduce(total, result), within each partition and then across them.
+                Defaults to None.
+            initial (Any, optional): start value of the fold, it must be an
+                identity of reduce (0 for addition). Defaults to None.
+            progress (Optional[Callable], optional): called with the finished
+                partitions, the number of partitions and the rows processed.
+                Defaults to None.
+            retries (int, optional): times a failed partition is rerun.
+                Defaults to 2.
+            mp_context (Optional[str], optional): multiprocessing start method.
+                Defaults to fork where available.
+
+        Returns:
+            Any: the folded value if reduce is given, otherwise an iterator
+                over the result of every batch in the order partitions finish
+        """
+        from sqlgold.ext.parallel import ParallelMap
+
+        return ParallelMap(
+            self,
+            source,
+            func,
+            workers=workers,
+            partition_by=partition_by,
+            partitions=partitions,
+            strategy=strategy,
+            batch_size=batch_size,
+            reduce=reduce,
+            initial=initial,
+            progress=progress,
+            retries=retries,
+            mp_context=mp_context,
+        ).run()
+
+    def fetch_arrays(
+        self,
+        stmt: Any,
+        dtypes: Optional[Dict[str, Any]] = None,
+        chunk_size: int = 10000,
+        structured: bool = False,
+    ) -> Any:
+        """Execute a select and return its columns as NumPy arrays, filled from
+        cursor batches without building Row objects. Requires numpy.
+        See sqlgold.ext.arrays
+
+        Args:
+            stmt (Any): the select statement
+            dtypes (Optional[Dict[str, Any]], optional): dtypes by column name,
+                overriding the ones inferred from the column types. Defaults to None.
+            chunk_size (int, optional): rows fetched at a time. Defaults to 10000.
+            structured (bool, optional): return a structured array instead of a
+                dict of arrays. Defaults to False.
+
+        Returns:
+            Any: a dict of column name to array, or a structured array. Columns
+                with NULLs are numpy.ma.MaskedArrays
+        """
+        from sqlgold.ext.arrays import fetch_arrays
+
+        return fetch_arrays(
+            self, stmt, dtypes=dtypes, chunk_size=chunk_size, structured=structured
+        )
+
+    def read(
+        self,
+        stmt: Any,
+        as_: Any = None,
+        params: Optional[Dict[str, Any]] = None,
+    ) -> List[Any]:
+        """Run a read-only query on a Core connection, skipping the Session,
+        autoflush and the identity map. A select of a single mapped class
+        returns instances of a generated __slots__ dataclass.
+        See sqlgold.ext.rows
+
+        Args:
+            stmt (Any): a select, a text() query or a mapped class
+            as_ (Any, optional): tuple, dict or a class to build the rows with.
+                Defaults to the generated row class for a single entity and
+                tuple otherwise.
+            params (Optional[Dict[str, Any]], optional): bound parameters.
+                Defaults to None.
+
+        Returns:
+            List[Any]: the rows
+        """
+        from sqlgold.ext.rows import read
+
+        return read(self, stmt, as_=as_, params=params)
+
+    def copy_to(
+        self,
+        target: "DB",
+        tables: Optional[_typing_Sequence[Any]] = None,
+        where: Optional[Dict[str, Any]] = None,
+        chunk_size: int = 10000,
+        workers: int = 4,
+        resume: bool = True,
+        progress: Optional[Callable[[str, int], None]] = None,
+    ) -> Any:
+        """Copy tables into another db, possibly of another dialect. The schema
+        is created from the Base metadata or by reflection, tables are copied in
+        foreign key order, concurrently where they don't depend on each other,
+        and rows are streamed from a server side cursor into batched inserts.
+        Copies are resumable per table. See sqlgold.ext.copy
+
+        Args:
+            target (DB): the db to copy into
+            tables (Optional[Sequence[Any]], optional): tables, mapped classes or
+                table names. Defaults to every table.
+            where (Optional[Dict[str, Any]], optional): a where clause by table
+                name, an expression or a SQL string. Defaults to None.
+            chunk_size (int, optional): rows per fetch and insert. Defaults to 10000.
+            workers (int, optional): tables copied concurrently. Defaults to 4.
+            resume (bool, optional): skip tables completed by an earlier copy and
+                continue partly copied ones, False empties the target tables
+                first. Defaults to True.
+            progress (Optional[Callable[[str, int], None]], optional): called after
+                every chunk with the table name and its rows copied. Defaults to None.
+
+        Returns:
+            CopyResult: the rows copied by table and the tables skipped
+        """
+        from sqlgold.ext.copy import TableCopier
+
+        return TableCopier(
+            self,
+            target,
+            tables=tables,
+            where=where,
+            chunk_size=chunk_size,
+            workers=workers,
+            resume=resume,
+            progress=progress,
+        ).run()
+
+    def _load_table(self, table: Any) -> Table:
+        """A Table from a Table, mapped class or table name in the Base metadata"""
+        if isinstance(table, Table):
+            return table
+        if isinstance(table, str):
+            if self.Base is None or self.Base is sentinel:
+                raise ValueError(f"No Base is set to look up the table '{table}'")
+            return self.Base.metadata.tables[table]
+        return inspect(table).local_table
+
+    def load_file(
+        self,
+        table: Any,
+        path: str,
+        format: Optional[str] = None,
+        columns: Optional[_typing_Sequence[str]] = None,
+        batch_size: int = 10000,
+        progress: Optional[bulk_load.ProgressCallback] = None,
+        header: bool = True,
+        delimiter: str = ",",
+        encoding: str = "utf-8",
+    ) -> int:
+        """Bulk load a csv or ndjson file, optionally compressed with gzip, bz2
+        or xz, into a table in one transaction. The file is streamed and inserted
+        with executemany in batches. Dialects use faster native loaders.
+
+        Args:
+            table (Any): a Table, a mapped class or the name of a table in the Base
+            path (str): the file
+            format (Optional[str], optional): "csv" or "ndjson".
+                Defaults to inferring it from the suffix.
+            columns (Optional[_typing_Sequence[str]], optional): the columns of
+                the file, in order for csv. Defaults to the csv header, the keys
+                of the first ndjson object, or every column of the table.
+            batch_size (int, optional): rows per executemany. Defaults to 10000.
+            progress (Optional[Callable], optional): called after every batch with
+                the rows loaded, the bytes read and the file size. Defaults to None.
+            header (bool, optional): the csv has a header line. Defaults to True.
+            delimiter (str, optional): csv delimiter. Defaults to ",".
+            encoding (str, optional): text encoding. Defaults to "utf-8".
+
+        Returns:
+            int: the number of rows loaded
+        """
+        table = self._load_table(table)
+        format = format or bulk_load.infer_format(path)
+        if format not in bulk_load.FORMATS:
+            raise ValueError(f"format must be one of {bulk_load.FORMATS}, got {format}")
+        size = os.path.getsize(path)
+        stmt = sa_insert(table)
+        rows = 0
+        with bulk_load.open_text(path, encoding=encoding) as (fp, counter):
+            if format == "csv":
+                batches = bulk_load.read_csv_batches(
+                    fp, table, columns, batch_size, header=header, delimiter=delimiter
+                )
+            else:
+                batches = bulk_load.read_ndjson_batches(fp, table, columns, batch_size)
+            with self.engine.connect() as connection:
+                with self._bulk_load_context(connection, table):
+                    for batch in batches:
+                        connection.execute(stmt, batch)
+                        rows += len(batch)
+                        if progress is not None:
+                            progress(rows, counter.bytes_read, size)
+        logging.debug(f"Loaded {rows} rows from '{path}' into '{table.name}'")
+        return rows
+
+    @contextmanager
+    def _bulk_load_context(
+        self, connection: Connection, table: Table
+    ) -> Iterator[None]:
+        """The load transaction of load_file, committed when the load succeeds.
+        Dialects tune the connection for bulk loading here"""
+        with connection.begin():
+            yield
+
+    def bulk_update(
+        self,
+        table: Any,
+        rows: Iterable[Dict[str, Any]],
+        key: Optional[Union[str, _typing_Sequence[str]]] = None,
+        columns: Optional[_typing_Sequence[str]] = None,
+        batch_size: int = 1000,
+        count_matched: bool = False,
+    ) -> bulk_update.BulkUpdateResult:
+        """Update existing rows by key without loading them, in one transaction.
+        Rows setting the same columns are grouped into one UPDATE executed with
+        executemany, rows already holding the values are not written. Rows with
+        the same key are merged, later values win. See sqlgold.engine.bulk_update
+
+        Args:
+            table (Any): a Table, a mapped class or the name of a table in the Base
+            rows (Iterable[Dict[str, Any]]): dicts of the key and the new values
+                by column key. Rows are grouped in memory.
+            key (Optional[Union[str, Sequence[str]]], optional): the key column or
+                columns. Defaults to the primary key.
+            columns (Optional[Sequence[str]], optional): only update these columns.
+                Defaults to every column given in a row.
+            batch_size (int, optional): rows per executemany. Defaults to 1000.
+            count_matched (bool, optional): also count the rows matched by key,
+                an extra SELECT per batch. Defaults to False.
+
+        Returns:
+            BulkUpdateResult: the rows given, changed and, when counted, matched
+                by key
+        """
+        table = self._load_table(table)
+        keys = bulk_update.key_columns(table, key)
+        n, groups = bulk_update.group_rows(table, rows, keys, columns)
+        result = bulk_update.BulkUpdateResult(rows=n)
+        with self.engine.begin() as connection:
+            for set_columns, group in groups.items():
+                result.add(
+                    *self._bulk_update_group(
+                        connection,
+                        table,
+                        keys,
+                        set_columns,
+                        group,
+                        batch_size,
+                        count_matched,
+                    )
+                )
+        logging.debug(
+            f"Bulk updated '{table.name}': {result.changed} of {n} rows changed"
+        )
+        return result
+
+    def _bulk_update_group(
+        self,
+        connection: Connection,
+        table: Table,
+        keys: _typing_Sequence[str],
+        columns: _typing_Sequence[str],
+        rows: List[Dict[str, Any]],
+        batch_size: int,
+        count_matched: bool = False,
+    ) -> Tuple[Optional[int], int, int]:
+        """Update rows setting the same columns, returns the rows matched (None
+        unless counted), the rows changed and the statements executed"""
+        stmt = bulk_update.update_statement(table, keys, columns)
+        matched = 0 if count_matched else None
+        changed = statements = 0
+        for start in range(0, len(rows), batch_size):
+            batch = rows[start : start + batch_size]
+            if count_matched:
+                matched += connection.execute(
+                    bulk_update.matched_statement(table, keys, batch)
+                ).scalar_one()
+            params = bulk_update.update_params(batch, keys, columns)
+            changed += connection.execute(stmt, params).rowcount
+            statements += 1
+        return matched, changed, statements
+
+    def _approximate_count(self, connection: Connection, table: Table) -> Optional[int]:
+        """The row count of a table from the dialect's table statistics, None
+        when there are none"""
+        return None
+
+    def _open_transaction_ids(self, connection: Connection) -> Optional[Set[Any]]:
+        """Ids of the transactions of other connections still open, None when
+        the dialect can't tell"""
+        return None
+
+    def count(self, model: Any, where: Any = None, mode: str = "exact") -> int:
+        """The number of rows of a table
+
+        Args:
+            model (Any): a mapped class, Table or table name
+            where (Any, optional): a where clause, only for exact counts.
+                Defaults to None.
+            mode (str, optional): "exact" runs SELECT COUNT(*), "approximate"
+                reads the table statistics (information_schema.TABLES on MySQL,
+                sqlite_stat1 on sqlite, falling back to exact without them) and
+                "maintained" reads a counter kept up to date by session flushes,
+                once enable_maintained_counts tracks the table, see
+                sqlgold.ext.counts. Defaults to "exact".
+
+        Returns:
+            int: the number of rows
+
+        Raises:
+            RuntimeError: a maintained count without enable_maintained_counts
+        """
+        from sqlgold.ext.counts import MODES
+
+        if mode not in MODES:
+            raise ValueError(f"mode must be one of {MODES}, got '{mode}'")
+        if where is not None and mode != "exact":
+            raise ValueError(f"A where clause needs an exact count, not {mode}")
+        table = self._load_table(model)
+        if mode == "maintained":
+            if self.row_counts is None:
+                raise RuntimeError(
+                    f"Maintained counts aren't enabled for {self}, "
+                    "call enable_maintained_counts first"
+                )
+            return self.row_counts.count(table)
+        with self.engine.connect() as connection:
+            if mode == "approximate":
+                n = self._approximate_count(connection, table)
+                if n is not None:
+                    return n
+                logging.debug(f"No statistics for '{table.name}', counting exactly")
+            stmt = select(func.count()).select_from(table)
+            if where is not None:
+                stmt = stmt.where(text(where) if isinstance(where, str) else where)
+            return connection.execute(stmt).scalar()
+
+    def enable_maintained_counts(
+        self,
+        *models: Any,
+        shards: int = 8,
+        reconcile_interval: Optional[float] = 300.0,
+    ) -> "RowCounts":
+        """Maintain the row counts of tables from session flushes for
+        count(mode="maintained"). The tables tracked by any process are loaded
+        from the counter table, every process writing to them must enable
+        maintained counts. See sqlgold.ext.counts
+
+        Args:
+            models (Any): mapped classes, Tables or table names to start tracking
+            shards (int, optional): counter rows per table. Defaults to 8.
+            reconcile_interval (Optional[float], optional): seconds between
+                exact recounts correcting the drift of bulk statements, None
+                to only recount on RowCounts.reconcile. Defaults to 300.0.
+
+        Returns:
+            RowCounts: the attached counters
+        """
+        from sqlgold.ext.counts import RowCounts
+
+        self.disable_maintained_counts()
+        self.row_counts = RowCounts(
+            self, shards=shards, reconcile_interval=reconcile_interval
+        )
+        self.row_counts.attach()
+        self.row_counts.track(*(self._load_table(m) for m in models))
+        return self.row_counts
+
+    def disable_maintained_counts(self) -> None:
+        """Stop maintaining row counts, the counter table is kept"""
+        if self.row_counts is not None:
+            self.row_counts.detach()
+            self.row_counts = None
+
+    def health(self, probe: bool = True) -> Dict[str, Any]:
+        """Health of the db: the round trip latency of a trivial query, the
+        pool state and, if enabled, the circuit breaker state.
+        See sqlgold.engine.health
+
+        Args:
+            probe (bool, optional): run the query. Skipped while the circuit
+                breaker is open. Defaults to True.
+
+        Returns:
+            Dict[str, Any]: ok, latency_ms, error, pool and breaker
+        """
+        return _health(self, probe=probe)
+
+    def enable_circuit_breaker(
+        self, failure_threshold: int = 5, reset_timeout: float = 30.0
+    ) -> CircuitBreaker:
+        """Fail connection checkouts fast with CircuitOpenError after
+        failure_threshold consecutive connection failures, for reset_timeout
+        seconds, before letting a trial connection through
+
+        Args:
+            failure_threshold (int, optional): consecutive connection failures
+                that open the breaker. Defaults to 5.
+            reset_timeout (float, optional): seconds before a trial connection.
+                Defaults to 30.0.
+
+        Returns:
+            CircuitBreaker: the attached breaker
+        """
+        self.disable_circuit_breaker()
+        self.breaker = CircuitBreaker(
+            self, failure_threshold=failure_threshold, reset_timeout=reset_timeout
+        )
+        self.breaker.attach()
+        return self.breaker
+
+    def disable_circuit_breaker(self) -> None:
+        """Remove the circuit breaker"""
+        if self.breaker is not None:
+            self.breaker.detach()
+            self.breaker = None
+
+    def enable_metrics(
+        self, registry: Optional[MetricsRegistry] = None
+    ) -> DBMetrics:
+        """Collect metrics for the sessions, transactions and statements of this db.
+        See sqlgold.engine.db_metrics for the metric names.
+        Enabled for every new DB when DBOptions.metrics is in DB.default_options
+
+        Args:
+            registry (Optional[MetricsRegistry], optional): registry to record into.
+                Defaults to the sqlgold.metrics default registry.
+
+        Returns:
+            DBMetrics: the attached metrics collector
+        """
+        if self.metrics is None:
+            self.metrics = DBMetrics(self, registry)
+            self.metrics.attach()
+        return self.metrics
+
+    def disable_metrics(self) -> None:
+        """Stop collecting metrics for this db"""
+        if self.metrics is not None:
+            self.metrics.detach()
+            self.metrics = None
+
+    def enable_profiler(
+        self,
+        sample_rate: float = 1.0,
+        max_records: int = 1000,
+        on_record: Optional[Callable[["TransactionProfile"], None]] = None,
+    ) -> "SessionProfiler":
+        """Profile the work done in each transaction of this db's sessions.
+        See sqlgold.ext.profiler
+
+        Args:
+            sample_rate (float, optional): fraction of transactions to profile.
+                Defaults to 1.0.
+            max_records (int, optional): number of recent profiles kept.
+                Defaults to 1000.
+            on_record (Optional[Callable], optional): called with every finished
+                profile. Defaults to None.
+
+        Returns:
+            SessionProfiler: the attached profiler
+        """
+        from sqlgold.ext.profiler import SessionProfiler
+
+        self.disable_profiler()
+        self.profiler = SessionProfiler(
+            self, sample_rate=sample_rate, max_records=max_records, on_record=on_record
+        )
+        self.profiler.attach()
+        return self.profiler
+
+    def disable_profiler(self) -> None:
+        """Stop profiling this db's sessions"""
+        if self.profiler is not None:
+            self.profiler.detach()
+            self.profiler = None
+
+    def _explain_statement(
+        self, cursor: Any, statement: str, parameters: Any
+    ) -> List["PlanStep"]:
+        """Run the dialect's EXPLAIN for a driver level statement on a DBAPI
+        cursor and parse its output
+
+        Raises:
+            UnsupportedDialectError: the dialect has no EXPLAIN parser
+        """
+        raise UnsupportedDialectError("explain", self.url.get_backend_name())
+
+    def explain(
+        self, stmt: Any, params: Optional[Dict[str, Any]] = None, suggest: bool = True
+    ) -> "QueryPlan":
+        """The query plan of a statement, parsed into steps that read the same on
+        every dialect, with index suggestions for the tables it scans fully.
+        The statement itself is not run. See sqlgold.ext.explain
+
+        Args:
+            stmt (Any): a select, update, delete or text() statement
+            params (Optional[Dict[str, Any]], optional): bound parameters.
+                Defaults to None.
+            suggest (bool, optional): suggest indexes. Defaults to True.
+
+        Returns:
+            QueryPlan: the steps of the plan and the index suggestions
+
+        Raises:
+            UnsupportedDialectError: explain isn't supported on the db's backend
+        """
+        from sqlgold.ext.explain import explain
+
+        return explain(self, stmt, params=params, suggest=suggest)
+
+    def enable_slow_query_log(
+        self,
+        threshold_ms: float = 500,
+        explain: bool = True,
+        max_records: int = 1000,
+        on_capture: Optional[Callable[["SlowQuery"], None]] = None,
+    ) -> "SlowQueryLog":
+        """Capture the statements taking longer than threshold_ms, with their
+        query plan and index suggestions. See sqlgold.ext.explain
+
+        Args:
+            threshold_ms (float, optional): statements taking longer are captured.
+                Defaults to 500.
+            explain (bool, optional): explain captured statements, once per
+                statement fingerprint. Defaults to True.
+            max_records (int, optional): number of recent captures kept.
+                Defaults to 1000.
+            on_capture (Optional[Callable], optional): called with every capture.
+                Defaults to None.
+
+        Returns:
+            SlowQueryLog: the attached log
+        """
+        from sqlgold.ext.explain import SlowQueryLog
+
+        self.disable_slow_query_log()
+        self.slow_queries = SlowQueryLog(
+            self,
+            threshold_ms=threshold_ms,
+            explain=explain,
+            max_records=max_records,
+            on_capture=on_capture,
+        )
+        self.slow_queries.attach()
+        return self.slow_queries
+
+    def disable_slow_query_log(self) -> None:
+        """Stop capturing slow statements"""
+        if self.slow_queries is not None:
+            self.slow_queries.detach()
+            self.slow_queries = None
+
+    def enable_workload_recording(
+        self,
+        path: str,
+        sample_rate: float = 1.0,
+        max_bytes: int = 64 * 1024 * 1024,
+        backups: int = 5,
+    ) -> "WorkloadRecorder":
+        """Record every statement executed, with its parameters and timing, and
+        the session and transaction boundaries to a rotating log, to be replayed
+        with replay_workload. See sqlgold.ext.workload
+
+        Args:
+            path (str): the log file. An existing log is rotated
+            sample_rate (float, optional): fraction of sessions recorded.
+                Defaults to 1.0.
+            max_bytes (int, optional): size a file is rotated at.
+                Defaults to 64 MiB.
+            backups (int, optional): rotated files kept. Defaults to 5.
+
+        Returns:
+            WorkloadRecorder: the attached recorder
+        """
+        from sqlgold.ext.workload import WorkloadRecorder
+
+        self.disable_workload_recording()
+        self.workload_recorder = WorkloadRecorder(
+            self, path, sample_rate=sample_rate, max_bytes=max_bytes, backups=backups
+        )
+        self.workload_recorder.attach()
+        return self.workload_recorder
+
+    def disable_workload_recording(self) -> None:
+        """Stop recording and close the log"""
+        if self.workload_recorder is not None:
+            self.workload_recorder.detach()
+            self.workload_recorder = None
+
+    def replay_workload(
+        self, path: str, speed: Optional[float] = 1.0, concurrency: int = 8
+    ) -> "ReplayReport":
+        """Replay a workload recorded with enable_workload_recording against
+        this db. See sqlgold.ext.workload
+
+        Args:
+            path (str): the log file, its rotated files are replayed first
+            speed (Optional[float], optional): 1 replays at the recorded pace,
+                2 twice as fast, None as fast as possible. Defaults to 1.0.
+            concurrency (int, optional): sessions replayed at the same time.
+                Defaults to 8.
+
+        Returns:
+            ReplayReport: latency distributions, errors and divergent row counts
+        """
+        from sqlgold.ext.workload import WorkloadReplayer
+
+        return WorkloadReplayer(self, path, speed=speed, concurrency=concurrency).run()
+
+    def enable_outbox(
+        self, *models: type, table_name: str = "sqlgold_outbox"
+    ) -> "Outbox":
+        """Write the rows of models inserted, updated or deleted by this db's
+        sessions to an outbox table, in the transaction of the change, for
+        consumers and after commit subscribers. Consumers skip a missing id
+        once its transaction is known to have ended, or on dialects that can't
+        tell after gap_timeout alone, losing the events of a transaction that
+        commits later. See sqlgold.ext.outbox
+
+        Args:
+            models (type): the mapped classes captured, with their subclasses
+            table_name (str, optional): the outbox table, created if missing.
+                Defaults to "sqlgold_outbox".
+
+        Returns:
+            Outbox: the attached outbox, see Outbox.consumer and Outbox.subscribe
+        """
+        from sqlgold.ext.outbox import Outbox
+
+        self.disable_outbox()
+        self.outbox = Outbox(self, models, table_name=table_name)
+        self.outbox.attach()
+        return self.outbox
+
+    def disable_outbox(self) -> None:
+        """Stop capturing changes, the outbox table and its events are kept"""
+        if self.outbox is not None:
+            self.outbox.detach()
+            self.outbox = None
+
+    def enable_nplusone_detection(
+        self, threshold: int = 10, mode: str = "warn"
+    ) -> "NPlusOneDetector":
+        """Detect N+1 query patterns in this db's sessions. See sqlgold.ext.nplusone
+
+        Args:
+            threshold (int, optional): number of times the same statement shape may
+                be issued from the same call site within a transaction. Defaults to 10.
+            mode (str, optional): "warn", "raise" or "log". Defaults to "warn".
+
+        Returns:
+            NPlusOneDetector: the attached detector
+        """
+        from sqlgold.ext.nplusone import NPlusOneDetector
+
+        self.disable_nplusone_detection()
+        self.nplusone = NPlusOneDetector(self, threshold=threshold, mode=mode)
+        self.nplusone.attach()
+        return self.nplusone
+
+    def disable_nplusone_detection(self) -> None:
+        """Stop detecting N+1 query patterns"""
+        if self.nplusone is not None:
+            self.nplusone.detach()
+            self.nplusone = None
+
+    def schema_signature(
+        self, connection: Connection, schema: Optional[str] = None
+    ) -> str:
+        """A cheap value that changes whenever the schema changes.
+        Used to validate the reflection cache. Dialects override this with
+        something cheaper than listing the tables
+
+        Args:
+            connection (Connection): connection to query with
+            schema (Optional[str], optional): schema to check. Defaults to None.
+
+        Returns:
+            str: the schema signature
+        """
+        names = sorted(inspect(connection).get_table_names(schema=schema))
+        return hashlib.sha1("\n".join(names).encode()).hexdigest()
+
+    def reflect(
+        self,
+        cache_path: Optional[str] = None,
+        schema: Optional[str] = None,
+        only: Optional[_typing_Sequence[str]] = None,
+        views: bool = False,
+        alias: Optional[str] = None,
+    ) -> MetaData:
+        """Reflect the tables of the database into a MetaData.
+        If cache_path is given the result is stored there and reused on later
+        calls for as long as the schema signature of the database is unchanged.
+
+        The reflected tables are added to this db's Base. If no Base is set a
+        new declarative base using the reflected metadata is created and
+        registered with the DBManager under the db's alias.
+
+        Args:
+            cache_path (Optional[str], optional): file or directory for the cache.
+                Defaults to None (no caching).
+            schema (Optional[str], optional): schema to reflect. Defaults to None.
+            only (Optional[_typing_Sequence[str]], optional): only reflect these tables.
+                Defaults to None.
+            views (bool, optional): also reflect views. Defaults to False.
+            alias (Optional[str], optional): alias to register the Base under.
+                Defaults to the alias this db was created with.
+
+        Returns:
+            MetaData: the reflected metadata
+        """
+        metadata = None
+        with self.engine.connect() as connection:
+            if cache_path:
+                key = make_cache_key(self.url, schema=schema, only=only, views=views)
+                cache_file = resolve_cache_file(cache_path, key)
+                signature = self.schema_signature(connection, schema=schema)
+                metadata = load_cached_metadata(cache_file, key, signature)
+                if metadata is not None:
+                    logging.debug(f"Loaded schema of '{self}' from '{cache_file}'")
+            if metadata is None:
+                metadata = MetaData()
+                metadata.reflect(
+                    bind=connection, schema=schema, only=only, views=views
+                )
+                if cache_path:
+                    save_cached_metadata(cache_file, key, signature, metadata)
+                    logging.debug(f"Saved schema of '{self}' to '{cache_file}'")
+
+        self._set_reflected_base(metadata, alias)
+        return metadata
+
+    def _set_reflected_base(self, metadata: MetaData, alias: Optional[str] = None):
+        from sqlgold.managers.db_manager import DBManager
+
+        if self.Base is None or self.Base == sentinel:
+            self.Base = sa_declarative_base(metadata=metadata)
+            dbmanager = DBManager.get_manager()
+            if alias is None:
+                alias = dbmanager.get_alias(self)
+            if alias is not None:
+                dbmanager.set_base(alias, self.Base)
+            return
+        base_metadata = self.Base.metadata
+        for table in metadata.sorted_tables:
+            if table.key not in base_metadata.tables:
+                table.to_metadata(base_metadata)
@@ -0,0 +1,134 @@
+"""Metrics collected from the session, transaction and statement lifecycles of a DB
+
+Metric names (all labelled with ``db``, the db alias):
+    sqlgold_transactions_total{outcome}: committed and rolled back transactions
+    sqlgold_transaction_seconds: duration of root session transactions
+    sqlgold_flush_seconds: duration of session flushes
+    sqlgold_statements_total{operation}: executed statements by first keyword
+    sqlgold_statement_seconds{operation}: statement execution latency
+    sqlgold_statement_errors_total{operation}: statements that raised
+"""
+
+import time
+from typing import TYPE_CHECKING, Optional
+
+from sqlgold.engine.extension import DBExtension
+from sqlgold.metrics import MetricsRegistry
+from sqlgold.metrics import registry as default_registry
+
+if TYPE_CHECKING:
+    from sqlgold.engine.db import DB
+
+_TXN_START = "sqlgold_metrics_txn_start"
+_FLUSH_START = "sqlgold_metrics_flush_start"
+_STMT_START = "sqlgold_metrics_stmt_start"
+
+
+def statement_operation(statement: str) -> str:
+    """The lowercase first keyword of a statement, e.g. 'select'"""
+    parts = statement.lstrip(" \n\t(").split(None, 1)
+    return parts[0].lower() if parts else ""
+
+
+class DBMetrics(DBExtension):
+    """Attaches metric collecting event listeners to a DB's Session and engine"""
+
+    def __init__(self, db: "DB", registry: Optional[MetricsRegistry] = None):
+        self.db = db
+        self.registry = registry if registry is not None else default_registry
+        self._listeners = [
+            (db.Session, "after_transaction_create", self._after_transaction_create),
+            (db.Session, "after_transaction_end", self._after_transaction_end),
+            (db.Session, "after_commit", self._after_commit),
+            (db.Session, "after_rollback", self._after_rollback),
+            (db.Session, "before_flush", self._before_flush),
+            (db.Session, "after_flush_postexec", self._after_flush_postexec),
+            (db.engine, "before_cursor_execute", self._before_cursor_execute),
+            (db.engine, "after_cursor_execute", self._after_cursor_execute),
+            (db.engine, "handle_error", self._handle_error),
+        ]
+
+    @property
+    def label(self) -> str:
+        """The db label used for every metric"""
+        return self._label
+
+    ## Session lifecycle
+    def _after_transaction_create(self, session, transaction):
+        if transaction.parent is None:
+            session.info[_TXN_START] = time.perf_counter()
+
+    def _after_transaction_end(self, session, transaction):
+        if transaction.parent is None:
+            start = session.info.pop(_TXN_START, None)
+            if start is not None:
+                self.registry.histogram(
+                    "sqlgold_transaction_seconds",
+                    "Duration of root session transactions",
+                    db=self.label,
+                ).observe(time.perf_counter() - start)
+
+    def _after_commit(self, session):
+        self.registry.counter(
+            "sqlgold_transactions_total",
+            "Session transactions by outcome",
+            db=self.label,
+            outcome="commit",
+        ).inc()
+
+    def _after_rollback(self, session):
+        self.registry.counter(
+            "sqlgold_transactions_total",
+            "Session transactions by outcome",
+            db=self.label,
+            outcome="rollback",
+        ).inc()
+
+    def _before_flush(self, session, flush_context, instances):
+        session.info[_FLUSH_START] = time.perf_counter()
+
+    def _after_flush_postexec(self, session, flush_context):
+        start = session.info.pop(_FLUSH_START, None)
+        if start is not None:
+            self.registry.histogram(
+                "sqlgold_flush_seconds", "Duration of session flushes", db=self.label
+            ).observe(time.perf_counter() - start)
+
+    ## Statement lifecycle
+    def _before_cursor_execute(
+        self, conn, cursor, statement, parameters, context, executemany
+    ):
+        conn.info.setdefault(_STMT_START, []).append(time.perf_counter())
+
+    def _after_cursor_execute(
+        self, conn, cursor, statement, parameters, context, executemany
+    ):
+        elapsed = time.perf_counter() - conn.info[_STMT_START].pop()
+        operation = statement_operation(statement)
+        self.registry.counter(
+            "sqlgold_statements_total",
+            "Executed statements",
+            db=self.label,
+            operation=operation,
+        ).inc()
+        self.registry.histogram(
+            "sqlgold_statement_seconds",
+            "Statement execution latency",
+            db=self.label,
+            operation=operation,
+        ).observe(elapsed)
+
+    def _handle_error(self, exception_context):
+        conn = exception_context.connection
+        if exception_context.execution_context is None or conn is None:
+            return
+        if not conn.info.get(_STMT_START):
+            return
+        conn.info[_STMT_START].pop()
+        statement = exception_context.statement or ""
+        self.registry.counter(
+            "sqlgold_statement_errors_total",
+            "Statements that raised an error",
+            db=self.label,
+            operation=statement_operation(statement),
+        ).inc()
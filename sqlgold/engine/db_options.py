@@ -3,3 +3,4 @@ from enum import Flag, auto
 
 class DBOptions(Flag):
     create_all = auto()
+    metrics = auto()
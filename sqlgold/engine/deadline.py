@@ -0,0 +1,215 @@
+"""Deadlines for the statements of a session or a block of code
+
+A deadline is an absolute point in time. ``db.Session(timeout_ms=...)`` gives
+every statement of the session the time left until the session's deadline,
+``db.deadline(ms)`` does the same for every statement run within the block,
+on any db with deadlines in use. When both apply the earlier one wins.
+
+Before each statement the remaining time is handed to the dialect, which
+enforces it on the server (a MAX_EXECUTION_TIME hint on MySQL) or in the
+driver (a progress handler interrupting the statement on sqlite). A statement
+whose deadline passed before it started is not run at all. Either way
+StatementTimeoutError is raised and the statement's fingerprint is recorded.
+
+Example:
+    with db.Session(timeout_ms=250) as session:
+        session.execute(select(Order).where(Order.status == "open")).all()
+
+    with db.deadline(1000):
+        ...
+    db.deadlines.timed_out_fingerprints()  ## {"SELECT ... WHERE status = ?": 3}
+"""
+
+import logging
+import threading
+import time
+from collections import Counter, deque
+from contextlib import contextmanager
+from contextvars import ContextVar
+from dataclasses import dataclass
+from typing import TYPE_CHECKING, Deque, Dict, Iterator, Optional
+
+from sqlgold.engine.extension import DBExtension
+from sqlgold.exceptions import StatementTimeoutError
+from sqlgold.utils.sql_utils import fingerprint_sql
+
+if TYPE_CHECKING:
+    from sqlgold.engine.db import DB
+
+## session.info key of the session's deadline, set by db.Session(timeout_ms=)
+DEADLINE_KEY = "sqlgold_deadline"
+## connection.info keys: the deadline of the session using the connection and
+## the (ms given, start) of the last statement run with a deadline
+_SESSION_DEADLINE = "sqlgold_session_deadline"
+_STATEMENT_DEADLINE = "sqlgold_statement_deadline"
+_SESSION_CONNECTIONS = "sqlgold_deadline_connections"
+
+## The clock deadlines are measured on, replaceable to test without sleeping
+_clock = time.monotonic
+
+## Deadline of the innermost db.deadline() block, as time.monotonic()
+_deadline: ContextVar[Optional[float]] = ContextVar("sqlgold_deadline", default=None)
+
+
+@dataclass(frozen=True)
+class Deadline:
+    """A point in time, on the time.monotonic() clock"""
+
+    expires_at: float
+
+    @classmethod
+    def after(cls, timeout_ms: float) -> "Deadline":
+        return cls(_clock() + timeout_ms / 1000)
+
+    def remaining_ms(self) -> float:
+        """Milliseconds left, negative once expired"""
+        return (self.expires_at - _clock()) * 1000
+
+    @property
+    def expired(self) -> bool:
+        return self.remaining_ms() <= 0
+
+
+def current_deadline() -> Optional[Deadline]:
+    """The deadline of the innermost enclosing deadline() block, if any"""
+    expires_at = _deadline.get()
+    return None if expires_at is None else Deadline(expires_at)
+
+
+@contextmanager
+def deadline(timeout_ms: float) -> Iterator[Deadline]:
+    """Give the statements run within the block timeout_ms milliseconds.
+    Nested blocks can only shorten the deadline of the enclosing block"""
+    expires_at = Deadline.after(timeout_ms).expires_at
+    outer = _deadline.get()
+    if outer is not None:
+        expires_at = min(expires_at, outer)
+    token = _deadline.set(expires_at)
+    try:
+        yield Deadline(expires_at)
+    finally:
+        _deadline.reset(token)
+
+
+@dataclass
+class TimedOutStatement:
+    fingerprint: str
+    timeout_ms: float  ## the time the statement was given, 0 if none was left
+    elapsed_ms: float
+    at: float  ## wall clock time of the timeout
+
+
+class StatementDeadlines(DBExtension):
+    """Applies session and block deadlines to the statements of a DB and
+    records the statements that ran out of time"""
+
+    _listen_kwargs = {"before_cursor_execute": {"retval": True}}
+
+    def __init__(self, db: "DB", max_records: int = 1000):
+        """
+        Args:
+            db (DB): the db whose statements get deadlines
+            max_records (int, optional): number of recent timeouts kept in
+                ``timeouts``. Defaults to 1000.
+        """
+        self.db = db
+        self.timeouts: Deque[TimedOutStatement] = deque(maxlen=max_records)
+        self._lock = threading.Lock()
+        self._listeners = [
+            (db.Session, "after_begin", self._after_begin),
+            (db.Session, "after_transaction_end", self._after_transaction_end),
+            (db.engine, "before_cursor_execute", self._before_cursor_execute),
+            (db.engine, "handle_error", self._handle_error),
+            (db.engine, "checkin", self._checkin),
+        ]
+
+    def timed_out_fingerprints(self) -> Dict[str, int]:
+        """Number of recorded timeouts by statement fingerprint, most frequent first"""
+        with self._lock:
+            counts = Counter(t.fingerprint for t in self.timeouts)
+        return dict(counts.most_common())
+
+    def _timed_out(
+        self, statement: str, timeout_ms: float, started: float
+    ) -> StatementTimeoutError:
+        fingerprint = fingerprint_sql(statement)
+        record = TimedOutStatement(
+            fingerprint=fingerprint,
+            timeout_ms=timeout_ms,
+            elapsed_ms=(_clock() - started) * 1000,
+            at=time.time(),
+        )
+        with self._lock:
+            self.timeouts.append(record)
+        self._registry.counter(
+            "sqlgold_statement_timeouts_total",
+            "Statements that exceeded their deadline",
+            db=self._label,
+        ).inc()
+        logging.warning(
+            f"Statement on {self.db} exceeded its deadline of {timeout_ms:.0f}ms: "
+            f"{fingerprint}"
+        )
+        return StatementTimeoutError(
+            f"Statement exceeded its deadline of {timeout_ms:.0f}ms: {fingerprint}",
+            fingerprint=fingerprint,
+            timeout_ms=timeout_ms,
+        )
+
+    ## Session events
+    def _after_begin(self, session, transaction, connection):
+        expires_at = session.info.get(DEADLINE_KEY)
+        if expires_at is None:
+            return
+        connection.info[_SESSION_DEADLINE] = expires_at
+        session.info.setdefault(_SESSION_CONNECTIONS, []).append(connection.info)
+
+    def _after_transaction_end(self, session, transaction):
+        if transaction.parent is not None:
+            return
+        for info in session.info.pop(_SESSION_CONNECTIONS, ()):
+            info.pop(_SESSION_DEADLINE, None)
+
+    ## Engine events
+    def _before_cursor_execute(
+        self, conn, cursor, statement, parameters, context, executemany
+    ):
+        expires_at = _deadline.get()
+        session_expires_at = conn.info.get(_SESSION_DEADLINE)
+        if session_expires_at is not None:
+            if expires_at is None or session_expires_at < expires_at:
+                expires_at = session_expires_at
+        if expires_at is None:
+            if conn.info.pop(_STATEMENT_DEADLINE, None) is not None:
+                self.db._clear_statement_deadline(conn.connection.dbapi_connection)
+            return statement, parameters
+
+        now = _clock()
+        remaining_ms = (expires_at - now) * 1000
+        if remaining_ms <= 0:
+            raise self._timed_out(statement, 0, now)
+        conn.info[_STATEMENT_DEADLINE] = (remaining_ms, now)
+        statement = self.db._apply_statement_deadline(
+            conn, cursor, statement, remaining_ms
+        )
+        return statement, parameters
+
+    def _handle_error(self, exception_context):
+        connection = exception_context.connection
+        if connection is None or connection.invalidated:
+            return None
+        state = connection.info.get(_STATEMENT_DEADLINE)
+        if state is None or not self.db.is_statement_timeout(
+            exception_context.original_exception
+        ):
+            return None
+        timeout_ms, started = state
+        return self._timed_out(exception_context.statement or "", timeout_ms, started)
+
+    def _checkin(self, dbapi_connection, connection_record):
+        connection_record.info.pop(_SESSION_DEADLINE, None)
+        if (
+            connection_record.info.pop(_STATEMENT_DEADLINE, None) is not None
+            and dbapi_connection is not None
+        ):
+            self.db._clear_statement_deadline(dbapi_connection)
@@ -0,0 +1,55 @@
+"""Shared plumbing of the objects that hook into a DB's events
+
+Each extension (metrics, deadlines, the circuit breaker, the profilers, the
+write queues...) registers event listeners on the db's Session and engine
+when attached, removes them when detached, and labels its metrics with the
+db's alias.
+"""
+
+from typing import TYPE_CHECKING, Any, Callable, Dict, Sequence, Tuple
+
+from sqlalchemy import event
+
+from sqlgold.metrics import MetricsRegistry
+from sqlgold.metrics import registry as default_registry
+
+if TYPE_CHECKING:
+    from sqlgold.engine.db import DB
+
+
+def db_label(db: "DB") -> str:
+    """The ``db`` label of a db's metrics, its alias"""
+    return db.alias or db.database or str(db.url)
+
+
+def db_registry(db: "DB") -> MetricsRegistry:
+    """The registry of a db's metrics, the default registry unless the db
+    enabled metrics with its own"""
+    return db.metrics.registry if db.metrics else default_registry
+
+
+class DBExtension:
+    """Base of the objects hooking into a DB's events and reporting metrics.
+    Subclasses set ``db`` and list their (target, event name, fn) listeners in
+    ``_listeners``, ``_listen_kwargs`` holds event.listen arguments by event"""
+
+    db: "DB"
+    _listeners: Sequence[Tuple[Any, str, Callable]] = ()
+    _listen_kwargs: Dict[str, Dict[str, Any]] = {}
+
+    @property
+    def _label(self) -> str:
+        return db_label(self.db)
+
+    @property
+    def _registry(self) -> MetricsRegistry:
+        return db_registry(self.db)
+
+    def attach(self) -> None:
+        for target, name, fn in self._listeners:
+            event.listen(target, name, fn, **self._listen_kwargs.get(name, {}))
+
+    def detach(self) -> None:
+        for target, name, fn in self._listeners:
+            if event.contains(target, name, fn):
+                event.remove(target, name, fn)
@@ -0,0 +1,199 @@
+"""Health probes and a circuit breaker for the connections of a DB
+
+The breaker counts consecutive connection failures: new connections that
+fail to open and pooled connections found disconnected. After
+``failure_threshold`` of them it opens and every connection checkout raises
+CircuitOpenError immediately instead of waiting for the connect timeout.
+After ``reset_timeout`` seconds it turns half-open and lets one trial
+connection through; a successful statement or connect closes the breaker,
+a failure opens it again.
+
+Example:
+    db.enable_circuit_breaker(failure_threshold=3, reset_timeout=10)
+    db.health()  ## {"ok": True, "latency_ms": 0.4, "pool": {...}, "breaker": "closed"}
+"""
+
+import logging
+import threading
+import time
+from typing import TYPE_CHECKING, Any, Dict, Optional
+
+from sqlalchemy.pool import QueuePool
+
+from sqlgold.engine.extension import DBExtension
+from sqlgold.exceptions import CircuitOpenError
+
+if TYPE_CHECKING:
+    from sqlgold.engine.db import DB
+
+CLOSED = "closed"
+OPEN = "open"
+HALF_OPEN = "half_open"
+
+
+def pool_status(db: "DB") -> Dict[str, Any]:
+    """Size and usage of the db's connection pool"""
+    if db.is_lazy:
+        return {"class": None, "lazy": True}
+    pool = db.engine.pool
+    status: Dict[str, Any] = {"class": type(pool).__name__}
+    if isinstance(pool, QueuePool):
+        status.update(
+            size=pool.size(),
+            checked_in=pool.checkedin(),
+            checked_out=pool.checkedout(),
+            overflow=pool.overflow(),
+        )
+    return status
+
+
+class CircuitBreaker(DBExtension):
+    """Fails connection checkouts fast after repeated connection failures"""
+
+    def __init__(
+        self, db: "DB", failure_threshold: int = 5, reset_timeout: float = 30.0
+    ):
+        """
+        Args:
+            db (DB): the db to guard
+            failure_threshold (int, optional): consecutive connection failures
+                that open the breaker. Defaults to 5.
+            reset_timeout (float, optional): seconds the breaker stays open
+                before a trial connection is let through. Defaults to 30.0.
+        """
+        if failure_threshold < 1:
+            raise ValueError(f"failure_threshold must be >= 1, got {failure_threshold}")
+        self.db = db
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.state = CLOSED
+        self.failures = 0
+        self.opened_at: Optional[float] = None
+        self.last_error: Optional[str] = None
+        self._trial_started: Optional[float] = None
+        self._lock = threading.Lock()
+        self._listeners = [
+            (db.engine, "do_connect", self._do_connect),
+            (db.engine, "engine_connect", self._engine_connect),
+            (db.engine, "handle_error", self._handle_error),
+            (db.engine, "after_cursor_execute", self._after_cursor_execute),
+        ]
+
+    def to_dict(self) -> Dict[str, Any]:
+        return {
+            "state": self.state,
+            "failures": self.failures,
+            "opened_at": self.opened_at,
+            "last_error": self.last_error,
+        }
+
+    def allow(self) -> bool:
+        """Whether a connection may be used now. Moves an open breaker whose
+        cool-down passed to half-open and admits one trial at a time"""
+        if self.state == CLOSED:
+            return True
+        with self._lock:
+            now = time.monotonic()
+            if self.state == OPEN:
+                if now - self.opened_at < self.reset_timeout:
+                    return False
+                self._transition(HALF_OPEN)
+            if self.state == HALF_OPEN:
+                ## a trial that never reported back doesn't block forever
+                if (
+                    self._trial_started is not None
+                    and now - self._trial_started < self.reset_timeout
+                ):
+                    return False
+                self._trial_started = now
+            return True
+
+    def record_success(self) -> None:
+        if self.state == CLOSED and not self.failures:
+            return
+        with self._lock:
+            self.failures = 0
+            self._trial_started = None
+            if self.state != CLOSED:
+                self._transition(CLOSED)
+
+    def record_failure(self, error: BaseException) -> None:
+        with self._lock:
+            self.failures += 1
+            self.last_error = str(error)
+            self._trial_started = None
+            if self.state == HALF_OPEN or (
+                self.state == CLOSED and self.failures >= self.failure_threshold
+            ):
+                self.opened_at = time.monotonic()
+                self._transition(OPEN)
+
+    def _transition(self, state: str) -> None:
+        logging.warning(f"Circuit breaker of {self.db} is now {state}")
+        self.state = state
+        self._registry.counter(
+            "sqlgold_circuit_breaker_transitions_total",
+            "Circuit breaker state changes",
+            db=self._label,
+            state=state,
+        ).inc()
+
+    def _reject(self) -> CircuitOpenError:
+        self._registry.counter(
+            "sqlgold_circuit_breaker_rejections_total",
+            "Connection checkouts failed fast by an open circuit breaker",
+            db=self._label,
+        ).inc()
+        return CircuitOpenError(
+            f"Circuit breaker of {self.db} is {self.state} after "
+            f"{self.failures} connection failures: {self.last_error}"
+        )
+
+    ## Engine events
+    def _do_connect(self, dialect, conn_rec, cargs, cparams):
+        if not self.allow():
+            raise self._reject()
+        try:
+            connection = dialect.connect(*cargs, **cparams)
+        except Exception as e:
+            self.record_failure(e)
+            raise
+        self.record_success()
+        return connection
+
+    def _engine_connect(self, connection):
+        if not self.allow():
+            connection.close()
+            raise self._reject()
+
+    def _handle_error(self, exception_context):
+        if exception_context.is_disconnect:
+            self.record_failure(exception_context.original_exception)
+
+    def _after_cursor_execute(
+        self, conn, cursor, statement, parameters, context, executemany
+    ):
+        if self.state != CLOSED or self.failures:
+            self.record_success()
+
+
+def health(db: "DB", probe: bool = True) -> Dict[str, Any]:
+    """Round trip latency of a trivial query, the pool state and the breaker
+    state of a db. The probe is skipped while the breaker is open"""
+    result: Dict[str, Any] = {"ok": True, "latency_ms": None, "error": None}
+    breaker = db.breaker
+    if breaker is not None:
+        result["breaker"] = breaker.to_dict()
+        if breaker.state == OPEN:
+            result.update(ok=False, error=breaker.last_error)
+            probe = False
+    if probe:
+        start = time.perf_counter()
+        try:
+            with db.engine.connect() as connection:
+                connection.exec_driver_sql("SELECT 1").scalar()
+            result["latency_ms"] = (time.perf_counter() - start) * 1000
+        except Exception as e:
+            result.update(ok=False, error=str(e))
+    result["pool"] = pool_status(db)
+    return result
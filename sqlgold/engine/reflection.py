@@ -0,0 +1,131 @@
+"""Persistent cache for reflected schemas
+
+Reflecting a schema we don't own can be expensive (on MySQL every table costs
+several information_schema queries). The cache stores the reflected MetaData
+in a local file together with a cheap schema signature computed by the DB,
+so later startups only pay for the signature query.
+
+Note: the cache is a pickle file and should only be read from trusted locations.
+"""
+
+import hashlib
+import logging
+import os
+import pickle
+import tempfile
+from dataclasses import dataclass
+from typing import Optional, Sequence
+
+from sqlalchemy import MetaData
+from sqlalchemy.engine import URL
+
+CACHE_VERSION = 1
+
+
+@dataclass
+class ReflectionCacheEntry:
+    """A cached reflection result"""
+
+    key: str
+    signature: str
+    metadata: MetaData
+    version: int = CACHE_VERSION
+
+
+def make_cache_key(
+    url: URL,
+    schema: Optional[str] = None,
+    only: Optional[Sequence[str]] = None,
+    views: bool = False,
+) -> str:
+    """Make the key identifying a reflection of the given database
+
+    Args:
+        url (URL): database url, the password is never part of the key
+        schema (Optional[str], optional): schema reflected. Defaults to None.
+        only (Optional[Sequence[str]], optional): tables reflected. Defaults to None.
+        views (bool, optional): whether views were reflected. Defaults to False.
+
+    Returns:
+        str: the cache key
+    """
+    only_str = ",".join(sorted(only)) if only else "*"
+    return (
+        f"{url.render_as_string(hide_password=True)}|schema={schema}|"
+        f"only={only_str}|views={views}"
+    )
+
+
+def resolve_cache_file(cache_path: str, key: str) -> str:
+    """Return the file used for caching. If cache_path is a directory
+    the file name is derived from the key so that many databases can share it
+
+    Args:
+        cache_path (str): a file or a directory
+        key (str): the cache key
+
+    Returns:
+        str: path of the cache file
+    """
+    cache_path = os.path.expanduser(cache_path)
+    if os.path.isdir(cache_path):
+        digest = hashlib.sha1(key.encode()).hexdigest()
+        return os.path.join(cache_path, f"sqlgold_reflect_{digest}.pickle")
+    return cache_path
+
+
+def load_cached_metadata(
+    cache_file: str, key: str, signature: str
+) -> Optional[MetaData]:
+    """Load the metadata from the cache file if it is still valid
+
+    Args:
+        cache_file (str): path of the cache file
+        key (str): the expected cache key
+        signature (str): the current schema signature of the database
+
+    Returns:
+        Optional[MetaData]: the cached metadata or None if missing or stale
+    """
+    if not os.path.isfile(cache_file):
+        return None
+    try:
+        with open(cache_file, "rb") as fp:
+            entry = pickle.load(fp)
+    except Exception as e:
+        logging.debug(f"Ignoring unreadable reflection cache '{cache_file}': {e}")
+        return None
+    if (
+        not isinstance(entry, ReflectionCacheEntry)
+        or entry.version != CACHE_VERSION
+        or entry.key != key
+        or entry.signature != signature
+    ):
+        logging.debug(f"Reflection cache '{cache_file}' is stale")
+        return None
+    return entry.metadata
+
+
+def save_cached_metadata(
+    cache_file: str, key: str, signature: str, metadata: MetaData
+) -> None:
+    """Atomically write the metadata to the cache file
+
+    Args:
+        cache_file (str): path of the cache file
+        key (str): the cache key
+        signature (str): the schema signature the metadata was reflected at
+        metadata (MetaData): the reflected metadata
+    """
+    entry = ReflectionCacheEntry(key=key, signature=signature, metadata=metadata)
+    dirname = os.path.dirname(os.path.abspath(cache_file))
+    os.makedirs(dirname, exist_ok=True)
+    fd, tmp_path = tempfile.mkstemp(dir=dirname, suffix=".tmp")
+    try:
+        with os.fdopen(fd, "wb") as fp:
+            pickle.dump(entry, fp, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(tmp_path, cache_file)
+    except BaseException:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
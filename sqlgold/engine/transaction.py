@@ -0,0 +1,221 @@
+"""Transactions that are retried on transient errors
+
+A TransactionRunner runs a unit of work in a new session transaction and, when
+the db classifies the error as retryable (deadlocks, lock wait timeouts,
+disconnects, "database is locked"), rolls back and re-runs it after a jittered
+exponential backoff. Sessions whose connection was lost are invalidated so the
+broken connection is not returned to the pool.
+
+A connection lost during the COMMIT itself leaves the outcome unknown, the
+server may have committed before the connection dropped. Re-running the unit
+of work could then apply it twice, so such errors are raised rather than
+retried unless ``retry_ambiguous_commit`` is set for idempotent work.
+
+Example:
+    @db.transaction(retries=5)
+    def transfer(session, src, dst, amount):
+        ...
+
+    transfer(1, 2, 100)  ## the session is passed in by the runner
+
+    for attempt in db.transaction(retries=5):
+        with attempt as session:
+            ...
+"""
+
+import functools
+import logging
+import random
+import threading
+import time
+from typing import TYPE_CHECKING, Any, Callable, Iterator, Optional
+
+from sqlalchemy.orm import Session
+
+from sqlgold.engine.extension import db_label, db_registry
+
+if TYPE_CHECKING:
+    from sqlgold.engine.db import DB
+
+
+class TransactionAttempt:
+    """A single attempt of a retried transaction, a context manager yielding the
+    session. Retryable errors are suppressed while attempts remain"""
+
+    def __init__(self, runner: "TransactionRunner", attempt: int, retry: bool = True):
+        self.runner = runner
+        self.attempt = attempt
+        self.retry = retry
+        self.session: Optional[Session] = None
+        self.succeeded = False
+        self.error: Optional[BaseException] = None
+
+    def __enter__(self) -> Session:
+        self.session = self.runner.db.Session()
+        self.session.begin()
+        return self.session
+
+    def __exit__(self, exc_type, exc_value, traceback) -> bool:
+        session = self.session
+        commit_error = None
+        try:
+            if exc_value is None:
+                try:
+                    session.commit()
+                    self.succeeded = True
+                except Exception as e:
+                    commit_error = e
+            error = exc_value if exc_value is not None else commit_error
+            if error is not None:
+                self.runner._discard(session, error)
+        finally:
+            session.close()
+
+        if error is None:
+            return False
+        self.error = error
+        if commit_error is not None and not self.runner._can_retry_commit(commit_error):
+            commit_error.add_note(
+                "The connection was lost during COMMIT, the transaction may have "
+                "been committed"
+            )
+            raise commit_error
+        if self.retry and self.runner._should_retry(error, self.attempt):
+            return True  ## suppress the error, the next attempt follows
+        if commit_error is not None:
+            raise commit_error
+        return False
+
+
+class TransactionRunner:
+    """Runs units of work in transactions, retrying on retryable errors"""
+
+    def __init__(
+        self,
+        db: "DB",
+        retries: int = 3,
+        backoff: float = 0.05,
+        max_backoff: float = 2.0,
+        jitter: bool = True,
+        on_retry: Optional[Callable[[BaseException, int, float], None]] = None,
+        retry_ambiguous_commit: bool = False,
+    ):
+        """
+        Args:
+            db (DB): the db to run transactions on
+            retries (int, optional): retries after the first attempt. Defaults to 3.
+            backoff (float, optional): base delay in seconds, doubled every retry.
+                Defaults to 0.05.
+            max_backoff (float, optional): maximum delay in seconds. Defaults to 2.0.
+            jitter (bool, optional): sleep a random time between 0 and the delay
+                ("full jitter") so that contending clients spread out.
+                Defaults to True.
+            on_retry (Optional[Callable], optional): called with the error, the
+                attempt number and the delay before every retry. Defaults to None.
+            retry_ambiguous_commit (bool, optional): also retry when the
+                connection is lost during COMMIT, only safe when the unit of
+                work is idempotent. Defaults to False.
+        """
+        if retries < 0:
+            raise ValueError(f"retries must be >= 0, got {retries}")
+        self.db = db
+        self.retries = retries
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.jitter = jitter
+        self.on_retry = on_retry
+        self.retry_ambiguous_commit = retry_ambiguous_commit
+        self._random = random.Random()
+        self._local = threading.local()
+
+    def delay(self, attempt: int) -> float:
+        """Seconds to wait after the given (0 based) failed attempt"""
+        delay = min(self.max_backoff, self.backoff * (2**attempt))
+        return self._random.uniform(0, delay) if self.jitter else delay
+
+    def run(self, func: Callable[..., Any], *args, **kwargs) -> Any:
+        """Run func(session, *args, **kwargs) in a transaction, retrying on
+        retryable errors. The transaction is committed when func returns
+
+        Returns:
+            Any: the return value of func
+        """
+        for attempt in self.attempts():
+            with attempt as session:
+                result = func(session, *args, **kwargs)
+            if attempt.succeeded:
+                return result
+
+    def attempts(self) -> Iterator[TransactionAttempt]:
+        """Iterate over attempts until one succeeds or the retries run out"""
+        for i in range(self.retries + 1):
+            attempt = TransactionAttempt(self, i)
+            yield attempt
+            if attempt.succeeded or attempt.error is None:
+                return
+            delay = self.delay(i)
+            if self.on_retry is not None:
+                self.on_retry(attempt.error, i, delay)
+            time.sleep(delay)
+
+    def __iter__(self) -> Iterator[TransactionAttempt]:
+        return self.attempts()
+
+    def __call__(self, func: Callable[..., Any]) -> Callable[..., Any]:
+        """Use as a decorator, the session is passed as the first argument"""
+
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            return self.run(func, *args, **kwargs)
+
+        return wrapper
+
+    def __enter__(self) -> Session:
+        """A single attempt without retries, broken connections are still
+        invalidated. Use the decorator, run() or iteration to retry"""
+        attempt = TransactionAttempt(self, 0, retry=False)
+        self._local.__dict__.setdefault("stack", []).append(attempt)
+        return attempt.__enter__()
+
+    def __exit__(self, exc_type, exc_value, traceback) -> bool:
+        attempt = self._local.stack.pop()
+        return attempt.__exit__(exc_type, exc_value, traceback)
+
+    def _discard(self, session: Session, error: Optional[BaseException]) -> None:
+        try:
+            if isinstance(error, Exception) and self.db.is_disconnect_error(error):
+                logging.debug(f"Invalidating the connection of {self.db}: {error}")
+                session.invalidate()
+            else:
+                session.rollback()
+        except Exception as e:
+            logging.debug(f"Error while discarding a failed transaction: {e}")
+
+    def _can_retry_commit(self, error: Exception) -> bool:
+        """Whether a failed COMMIT may be retried, a lost connection leaves it
+        unknown whether the transaction was committed"""
+        return self.retry_ambiguous_commit or not self.db.is_disconnect_error(error)
+
+    def _should_retry(self, error: Optional[BaseException], attempt: int) -> bool:
+        if not isinstance(error, Exception):
+            return False
+        reason = self.db.retryable_error_reason(error)
+        if reason is None:
+            return False
+        registry, label = db_registry(self.db), db_label(self.db)
+        if attempt >= self.retries:
+            registry.counter(
+                "sqlgold_transaction_retries_exhausted_total",
+                "Transactions that failed after using every retry",
+                db=label,
+                reason=reason,
+            ).inc()
+            return False
+        registry.counter(
+            "sqlgold_transaction_retries_total",
+            "Transactions retried after a retryable error",
+            db=label,
+            reason=reason,
+        ).inc()
+        logging.debug(f"Retrying transaction on {self.db} ({reason}): {error}")
+        return True
@@ -1,4 +1,46 @@
+from typing import Optional
 
 
 class ConfigException(Exception):
-    pass
\ No newline at end of file
+    pass
+
+
+class NPlusOneError(AssertionError):
+    """The same statement shape was repeated more than the allowed threshold"""
+
+
+class NPlusOneWarning(UserWarning):
+    """The same statement shape was repeated more than the allowed threshold"""
+
+
+class TooManyQueriesError(AssertionError):
+    """More statements were executed than allowed by assert_max_queries"""
+
+
+class UnsupportedDialectError(ValueError):
+    """The db's backend doesn't support the requested feature"""
+
+    def __init__(self, feature: str, backend: str):
+        super().__init__(f"{feature} is not supported on {backend}")
+        self.feature = feature
+        self.backend = backend
+
+
+class CircuitOpenError(Exception):
+    """The circuit breaker of a db is open, connections fail fast"""
+
+
+## Not a TimeoutError: SQLAlchemy treats those as cancellations and invalidates
+## the connection they were raised on
+class StatementTimeoutError(Exception):
+    """A statement exceeded the deadline of its session or deadline() block"""
+
+    def __init__(
+        self,
+        message: str,
+        fingerprint: Optional[str] = None,
+        timeout_ms: Optional[float] = None,
+    ):
+        super().__init__(message)
+        self.fingerprint = fingerprint
+        self.timeout_ms = timeout_ms
@@ -0,0 +1,163 @@
+"""Columnar fetching of query results into NumPy arrays
+
+Rows are read from the DBAPI cursor with ``fetchmany`` and copied column by
+column into preallocated arrays that grow geometrically, skipping the Row
+objects SQLAlchemy would otherwise build. Dtypes are inferred from the
+SQLAlchemy types of the selected columns and columns containing NULLs are
+returned as masked arrays.
+
+NumPy is an optional dependency: pip install sqlgold[numpy]
+
+Example:
+    arrays = db.fetch_arrays(select(Trade.price, Trade.volume, Trade.at))
+    vwap = (arrays["price"] * arrays["volume"]).sum() / arrays["volume"].sum()
+"""
+
+from typing import TYPE_CHECKING, Any, Callable, Dict, List, Optional
+
+from sqlalchemy import Select, types
+
+if TYPE_CHECKING:
+    import numpy as np
+
+    from sqlgold.engine.db import DB
+
+DEFAULT_CHUNK_SIZE = 10000
+
+## Checked in order, the first matching SQLAlchemy type wins
+_TYPE_DTYPES = (
+    (types.Boolean, "bool"),
+    (types.Integer, "int64"),
+    (types.Float, "float64"),
+    (types.Numeric, "float64"),
+    (types.DateTime, "datetime64[us]"),
+    (types.Date, "datetime64[D]"),
+    (types.Interval, "timedelta64[us]"),
+)
+
+
+def _numpy():
+    try:
+        import numpy
+    except ImportError as e:
+        raise ImportError(
+            "fetch_arrays requires numpy, install it with: pip install sqlgold[numpy]"
+        ) from e
+    return numpy
+
+
+def infer_dtype(sa_type: types.TypeEngine) -> str:
+    """The NumPy dtype for values of a SQLAlchemy type, object if there is none"""
+    for type_, dtype in _TYPE_DTYPES:
+        if isinstance(sa_type, type_):
+            return dtype
+    return "object"
+
+
+class _Column:
+    """A growable array for one column plus its NULL mask"""
+
+    def __init__(self, np, name: str, dtype, capacity: int):
+        self.np = np
+        self.name = name
+        self.dtype = np.dtype(dtype)
+        self.data = np.empty(capacity, dtype=self.dtype)
+        self.mask = np.zeros(capacity, dtype=bool)
+        self.has_nulls = False
+        ## what NULLs are stored as under the mask
+        self.fill = None if self.dtype.kind == "O" else np.zeros((), self.dtype)[()]
+
+    def extend(self, values: List[Any], start: int) -> None:
+        end = start + len(values)
+        if end > len(self.data):
+            capacity = max(end, 2 * len(self.data))
+            self.data = self.np.resize(self.data, capacity)
+            self.mask = self.np.resize(self.mask, capacity)
+        mask = [v is None for v in values]
+        if any(mask):
+            self.has_nulls = True
+            self.mask[start:end] = mask
+            values = [self.fill if v is None else v for v in values]
+        else:
+            self.mask[start:end] = False
+        self.data[start:end] = values
+
+    def finish(self, n: int):
+        data = self.data[:n]
+        if self.has_nulls:
+            return self.np.ma.MaskedArray(data, mask=self.mask[:n])
+        return data
+
+
+def fetch_arrays(
+    db: "DB",
+    stmt: Select,
+    dtypes: Optional[Dict[str, Any]] = None,
+    chunk_size: int = DEFAULT_CHUNK_SIZE,
+    structured: bool = False,
+) -> Any:
+    """Execute a select and return its columns as NumPy arrays
+
+    Args:
+        db (DB): the db to query
+        stmt (Select): the statement
+        dtypes (Optional[Dict[str, Any]], optional): dtypes by column name,
+            overriding the inferred ones. Defaults to None.
+        chunk_size (int, optional): rows fetched from the cursor at a time.
+            Defaults to 10000.
+        structured (bool, optional): return one structured array instead of
+            a dict of arrays. Defaults to False.
+
+    Returns:
+        Any: a dict of column name to array, or a structured array. Columns with
+            NULLs are numpy.ma.MaskedArrays
+    """
+    np = _numpy()
+    dtypes = dtypes or {}
+    with db.engine.connect() as connection:
+        ## the default fetch strategy doesn't read rows ahead of the cursor,
+        ## the buffered one used for streaming does
+        result = connection.execute(stmt.execution_options(stream_results=False))
+        try:
+            names = list(result.keys())
+            dialect = connection.dialect
+            columns: List[_Column] = []
+            processors: List[Optional[Callable]] = []
+            for name, col in zip(names, stmt.selected_columns):
+                dtype = dtypes.get(name) or infer_dtype(col.type)
+                columns.append(_Column(np, name, dtype, chunk_size))
+                if (
+                    isinstance(col.type, types.Numeric)
+                    and columns[-1].dtype.kind == "f"
+                ):
+                    ## numpy converts the driver's floats or Decimals itself
+                    processors.append(None)
+                    continue
+                impl = col.type.dialect_impl(dialect)
+                processors.append(impl.result_processor(dialect, None))
+
+            cursor = result.cursor
+            n = 0
+            while True:
+                rows = cursor.fetchmany(chunk_size)
+                if not rows:
+                    break
+                for column, processor, values in zip(columns, processors, zip(*rows)):
+                    if processor is not None:
+                        values = [processor(v) for v in values]
+                    column.extend(values, n)
+                n += len(rows)
+        finally:
+            result.close()
+
+    arrays = {c.name: c.finish(n) for c in columns}
+    if not structured:
+        return arrays
+    record = np.empty(n, dtype=[(c.name, c.dtype) for c in columns])
+    mask = np.zeros(n, dtype=[(c.name, bool) for c in columns])
+    for c in columns:
+        record[c.name] = c.data[:n]
+        mask[c.name] = c.mask[:n]
+    if any(c.has_nulls for c in columns):
+        return np.ma.MaskedArray(record, mask=mask)
+    return record
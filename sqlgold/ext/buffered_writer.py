@@ -0,0 +1,286 @@
+"""Write-behind buffer that batches rows from many threads into bulk inserts
+
+Producers call ``write`` from any thread. A background thread drains the
+buffer and inserts the rows with one executemany INSERT per batch, flushing
+when ``max_rows`` rows are waiting or the oldest row has waited
+``max_latency_ms``. When the buffer is full ``write`` blocks (backpressure).
+Buffered rows are flushed on ``close`` and at interpreter exit.
+
+A batch that fails to insert is not retried. Its rows are passed to
+``on_error``, or logged and dropped when there is none.
+
+Example:
+    writer = db.buffered_writer(Event, max_rows=500, max_latency_ms=50)
+    writer.write({"kind": "click", "user_id": 3})
+    ...
+    writer.close()
+"""
+
+import atexit
+import logging
+import queue
+import threading
+import time
+from dataclasses import dataclass
+from typing import TYPE_CHECKING, Any, Callable, Dict, List, Optional, Set, Union
+
+from sqlalchemy import Table, insert, inspect
+from sqlalchemy.orm import Mapper
+
+from sqlgold.engine.extension import DBExtension
+
+if TYPE_CHECKING:
+    from sqlgold.engine.db import DB
+
+_FLUSH = object()  ## marker asking the writer thread to flush
+_STOP = object()  ## marker asking the writer thread to flush and exit
+
+_open_writers: Set["BufferedWriter"] = set()
+_open_writers_lock = threading.Lock()
+
+
+class BufferFullError(Exception):
+    """A row could not be buffered before the timeout"""
+
+
+@dataclass
+class WriterStats:
+    rows_written: int = 0
+    batches: int = 0
+    errors: int = 0
+    rows_dropped: int = 0
+
+
+class _FlushRequest:
+    def __init__(self):
+        self.done = threading.Event()
+
+
+def _resolve_table(model: Union[type, Table]) -> Table:
+    if isinstance(model, Table):
+        return model
+    mapper = inspect(model)
+    if not isinstance(mapper, Mapper):
+        raise TypeError(f"{model} is not a Table or a mapped class")
+    return mapper.local_table
+
+
+class BufferedWriter(DBExtension):
+    """Thread safe handle that coalesces rows into batched inserts"""
+
+    def __init__(
+        self,
+        db: "DB",
+        model: Union[type, Table],
+        max_rows: int = 1000,
+        max_latency_ms: float = 100,
+        max_buffer: Optional[int] = None,
+        on_error: Optional[Callable[[Exception, List[Dict[str, Any]]], None]] = None,
+    ):
+        """
+        Args:
+            db (DB): the db to write to
+            model (Union[type, Table]): a mapped class or a Table
+            max_rows (int, optional): rows per batch. Defaults to 1000.
+            max_latency_ms (float, optional): longest a row waits before its
+                batch is written. Defaults to 100.
+            max_buffer (Optional[int], optional): rows buffered before write
+                blocks. Defaults to 10 * max_rows.
+            on_error (Optional[Callable], optional): called with the error and the
+                rows of a batch that failed to insert, which is not retried.
+                Failed rows are logged and dropped otherwise. Defaults to None.
+        """
+        if max_rows < 1:
+            raise ValueError(f"max_rows must be >= 1, got {max_rows}")
+        self.db = db
+        self.table = _resolve_table(model)
+        self.max_rows = max_rows
+        self.max_latency = max_latency_ms / 1000
+        self.on_error = on_error
+        self.stats = WriterStats()
+        self._columns = {c.key for c in self.table.columns}
+        self._stmt = insert(self.table)
+        self._queue: queue.Queue = queue.Queue(maxsize=max_buffer or 10 * max_rows)
+        self._closed = False
+        self._close_lock = threading.Lock()
+        ## close() waits for the writes past the closed check to be queued,
+        ## so none is queued after the stop marker
+        self._writes_done = threading.Condition(self._close_lock)
+        self._writing = 0
+        self._thread = threading.Thread(
+            target=self._run, name=f"sqlgold-writer-{self.table.name}", daemon=True
+        )
+        self._thread.start()
+        with _open_writers_lock:
+            _open_writers.add(self)
+
+    def _to_row(self, row: Any) -> Dict[str, Any]:
+        if isinstance(row, dict):
+            return row
+        ## a mapped instance, take its column attributes that are set
+        state = inspect(row)
+        return {
+            attr.key: attr.loaded_value
+            for attr in state.attrs
+            if attr.key in self._columns and attr.key in state.dict
+        }
+
+    def write(self, row: Any, timeout: Optional[float] = None) -> None:
+        """Buffer a row for insertion. Blocks while the buffer is full
+
+        Args:
+            row (Any): a dict of column values or an instance of the mapped class
+            timeout (Optional[float], optional): seconds to wait for space in the
+                buffer, None waits forever. Defaults to None.
+
+        Raises:
+            BufferFullError: no space became available within the timeout
+            RuntimeError: the writer is closed
+        """
+        row = self._to_row(row)
+        self._start_write()
+        try:
+            self._queue.put(row, timeout=timeout)
+        except queue.Full:
+            raise BufferFullError(
+                f"Buffer of {self} stayed full for {timeout} seconds"
+            ) from None
+        finally:
+            self._end_write()
+
+    def _start_write(self) -> None:
+        with self._close_lock:
+            if self._closed:
+                raise RuntimeError(f"{self} is closed")
+            self._writing += 1
+
+    def _end_write(self) -> None:
+        with self._close_lock:
+            self._writing -= 1
+            if not self._writing:
+                self._writes_done.notify_all()
+
+    def write_many(self, rows: List[Any], timeout: Optional[float] = None) -> None:
+        """Buffer several rows, see write"""
+        for row in rows:
+            self.write(row, timeout=timeout)
+
+    def flush(self, timeout: Optional[float] = None) -> bool:
+        """Write every row buffered before this call
+
+        Args:
+            timeout (Optional[float], optional): seconds to wait. Defaults to None.
+
+        Returns:
+            bool: whether the flush finished within the timeout
+        """
+        request = _FlushRequest()
+        try:
+            self._start_write()
+        except RuntimeError:
+            return True  ## closing flushed the rows
+        try:
+            self._queue.put((_FLUSH, request))
+        finally:
+            self._end_write()
+        return request.done.wait(timeout)
+
+    def close(self, timeout: Optional[float] = None) -> None:
+        """Flush the remaining rows and stop the background thread"""
+        with self._close_lock:
+            if self._closed:
+                return
+            self._closed = True
+            while self._writing:
+                self._writes_done.wait()
+        self._queue.put((_STOP, None))
+        self._thread.join(timeout)
+        with _open_writers_lock:
+            _open_writers.discard(self)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def __repr__(self):
+        return f"BufferedWriter(table={self.table.name}, db={self.db})"
+
+    def _run(self) -> None:
+        batch: List[Dict[str, Any]] = []
+        deadline = None
+        stop = False
+        while not stop:
+            timeout = None if deadline is None else max(0, deadline - time.monotonic())
+            try:
+                item = self._queue.get(timeout=timeout)
+            except queue.Empty:
+                item = None  ## the oldest row has waited max_latency
+
+            requests = []
+            if type(item) is tuple:  ## a marker, rows are always dicts
+                ## everything queued before the marker is part of this flush
+                stop = item[0] is _STOP
+                requests.append(item[1])
+            elif item is not None:
+                batch.append(item)
+                if deadline is None:
+                    deadline = time.monotonic() + self.max_latency
+                if len(batch) < self.max_rows:
+                    continue
+            ## write when full, on a marker, or when the deadline passed
+            while batch:
+                self._insert(batch[: self.max_rows])
+                batch = batch[self.max_rows :]
+            deadline = None
+            for request in requests:
+                if request is not None:
+                    request.done.set()
+
+    def _insert(self, rows: List[Dict[str, Any]]) -> None:
+        start = time.perf_counter()
+        ## executemany needs the same keys in every row
+        groups: Dict[frozenset, List[Dict[str, Any]]] = {}
+        for row in rows:
+            groups.setdefault(frozenset(row), []).append(row)
+        try:
+            with self.db.Session.begin() as session:
+                for group in groups.values():
+                    session.execute(self._stmt, group)
+        except Exception as e:
+            self.stats.errors += 1
+            self.stats.rows_dropped += len(rows)
+            self._registry.counter(
+                "sqlgold_buffered_writer_errors_total",
+                "Failed batch inserts of buffered writers",
+                db=self._label,
+                table=self.table.name,
+            ).inc()
+            if self.on_error is not None:
+                try:
+                    self.on_error(e, rows)
+                except Exception:
+                    logging.exception(f"on_error of {self} raised")
+            else:
+                logging.error(f"{self} dropped {len(rows)} rows: {e}")
+            return
+        self.stats.rows_written += len(rows)
+        self.stats.batches += 1
+        self._registry.histogram(
+            "sqlgold_buffered_writer_batch_seconds",
+            "Time to insert a batch of buffered rows",
+            db=self._label,
+            table=self.table.name,
+        ).observe(time.perf_counter() - start)
+
+
+@atexit.register
+def _close_open_writers():
+    with _open_writers_lock:
+        writers = list(_open_writers)
+    for writer in writers:
+        try:
+            writer.close(timeout=10)
+        except Exception:
+            logging.exception(f"Error closing {writer} at exit")
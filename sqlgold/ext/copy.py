@@ -0,0 +1,371 @@
+"""Streaming copies of tables from one db into another
+
+``db.copy_to(target)`` creates the tables in the target from the db's Base
+metadata, or from reflection when there is no Base, and copies their rows.
+Column types are converted to their generic SQLAlchemy types and server
+defaults dropped when the two dbs use different dialects, so a MySQL schema
+can be created in sqlite.
+
+Tables are copied in layers following their foreign keys, a table only
+starts once the tables it references are done, and the tables of a layer are
+copied concurrently. Foreign keys to the table itself or to a table of the
+same layer (a cycle) are copied as NULL, and set by a second pass over the
+source once the layer is copied, so the target's foreign key checks pass. Rows are streamed from a server side cursor in primary
+key order and inserted with executemany, each chunk in its own transaction.
+
+Copies are resumable per table. Finished tables are recorded in the
+``_sqlgold_copy`` table of the target and skipped by the next copy. A table
+that was partly copied continues after the largest primary key in the
+target when it has a single column primary key, otherwise it is emptied and
+copied again.
+
+Example:
+    prod = create_db("mysql+mysqldb://...", Base=Base)
+    local = create_db("sqlite:///sample.sqlite", Base=None)
+    prod.copy_to(local, where={"orders": Order.created_at >= "2024-01-01"})
+"""
+
+import logging
+import time
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass, field
+from typing import (
+    TYPE_CHECKING,
+    Any,
+    Callable,
+    Dict,
+    List,
+    Optional,
+    Sequence,
+    Set,
+)
+
+from sqlalchemy import (
+    Column,
+    DateTime,
+    MetaData,
+    String,
+    Table,
+    bindparam,
+    delete,
+    func,
+    insert,
+    or_,
+    select,
+    text,
+    update,
+)
+from sqlalchemy.pool import SingletonThreadPool, StaticPool
+
+if TYPE_CHECKING:
+    from sqlgold.engine.db import DB
+
+DEFAULT_CHUNK_SIZE = 10000
+## Table of the target recording the tables that were copied completely
+STATE_TABLE = "_sqlgold_copy"
+
+## progress(table name, rows copied so far by this copy)
+ProgressCallback = Callable[[str, int], None]
+
+
+@dataclass
+class CopyResult:
+    rows: Dict[str, int] = field(default_factory=dict)  ## rows copied by table
+    skipped: List[str] = field(default_factory=list)  ## copied by an earlier run
+    seconds: float = 0.0
+
+
+def _state_table(metadata: MetaData) -> Table:
+    return Table(
+        STATE_TABLE,
+        metadata,
+        Column("table_name", String(255), primary_key=True),
+        Column("completed_at", DateTime),
+    )
+
+
+def dependency_layers(tables: Sequence[Table]) -> List[List[Table]]:
+    """Split tables into layers, every table referenced by a table of a layer
+    is in an earlier layer. Tables in a cycle of foreign keys go last"""
+    selected = set(tables)
+    depends: Dict[Table, Set[Table]] = {
+        t: {
+            fk.column.table
+            for fk in t.foreign_keys
+            if fk.column.table in selected and fk.column.table is not t
+        }
+        for t in tables
+    }
+    layers: List[List[Table]] = []
+    done: Set[Table] = set()
+    remaining = list(tables)
+    while remaining:
+        layer = [t for t in remaining if depends[t] <= done]
+        if not layer:
+            logging.warning(
+                "Foreign keys between "
+                f"{sorted(t.name for t in remaining)} form a cycle, copying them last"
+            )
+            layer = remaining
+        layers.append(layer)
+        done.update(layer)
+        remaining = [t for t in remaining if t not in done]
+    return layers
+
+
+def _single_connection(db: "DB") -> bool:
+    """In-memory sqlite dbs have one database per connection or per thread"""
+    return isinstance(db.engine.pool, (SingletonThreadPool, StaticPool))
+
+
+class TableCopier:
+    """Copies the tables of a db into another db"""
+
+    def __init__(
+        self,
+        source: "DB",
+        target: "DB",
+        tables: Optional[Sequence[Any]] = None,
+        where: Optional[Dict[str, Any]] = None,
+        chunk_size: int = DEFAULT_CHUNK_SIZE,
+        workers: int = 4,
+        resume: bool = True,
+        progress: Optional[ProgressCallback] = None,
+    ):
+        """
+        Args:
+            source (DB): the db to copy from
+            target (DB): the db to copy into
+            tables (Optional[Sequence[Any]], optional): tables, mapped classes or
+                table names. Defaults to every table.
+            where (Optional[Dict[str, Any]], optional): a where clause by table
+                name, a SQLAlchemy expression or a SQL string. Defaults to None.
+            chunk_size (int, optional): rows per fetch and insert. Defaults to 10000.
+            workers (int, optional): tables copied concurrently. Defaults to 4.
+            resume (bool, optional): skip tables completed by an earlier copy and
+                continue partly copied ones. False empties the target tables
+                first. Defaults to True.
+            progress (Optional[ProgressCallback], optional): called after every
+                chunk with the table name and its rows copied. Defaults to None.
+        """
+        if chunk_size < 1:
+            raise ValueError(f"chunk_size must be >= 1, got {chunk_size}")
+        self.source = source
+        self.target = target
+        self.where = where or {}
+        self.chunk_size = chunk_size
+        self.workers = max(1, workers)
+        if _single_connection(source) or _single_connection(target):
+            self.workers = 1
+        self.resume = resume
+        self.progress = progress
+        self.tables = self._source_tables(tables)
+        unknown = set(self.where) - {t.name for t in self.tables}
+        if unknown:
+            raise ValueError(f"where given for tables not copied: {sorted(unknown)}")
+        self.target_metadata = MetaData()
+        self.target_tables = self._target_tables()
+        self.state = _state_table(self.target_metadata)
+        self.layers = dependency_layers(self.tables)
+        self.deferred = self._deferred_columns()
+
+    def _source_tables(self, tables: Optional[Sequence[Any]]) -> List[Table]:
+        Base = self.source.Base
+        if Base is not None and isinstance(getattr(Base, "metadata", None), MetaData):
+            metadata = Base.metadata
+        else:
+            metadata = MetaData()
+            names = None
+            if tables is not None:
+                names = [t if isinstance(t, str) else t.name for t in tables]
+            with self.source.engine.connect() as connection:
+                metadata.reflect(bind=connection, only=names)
+        if tables is None:
+            ## ordered by dependency_layers, which also handles cycles
+            return [t for t in metadata.tables.values() if t.name != STATE_TABLE]
+        selected = []
+        for t in tables:
+            if isinstance(t, str):
+                if t not in metadata.tables:
+                    raise ValueError(f"Unknown table '{t}' in {self.source}")
+                selected.append(metadata.tables[t])
+            else:
+                selected.append(self.source._load_table(t))
+        return selected
+
+    def _target_tables(self) -> Dict[str, Table]:
+        same_dialect = (
+            self.source.engine.dialect.name == self.target.engine.dialect.name
+        )
+        tables = {}
+        for table in self.tables:
+            copy = table.to_metadata(self.target_metadata)
+            if not same_dialect:
+                for column in copy.columns:
+                    try:
+                        column.type = column.type.as_generic()
+                    except NotImplementedError:
+                        pass
+                    column.server_default = None
+                    column.server_onupdate = None
+            tables[table.name] = copy
+        ## foreign keys to tables that aren't copied can't be created
+        for copy in tables.values():
+            for constraint in list(copy.foreign_key_constraints):
+                referred = constraint.elements[0].target_fullname.rsplit(".", 1)[0]
+                if referred not in self.target_metadata.tables:
+                    copy.constraints.discard(constraint)
+                    for fk in constraint.elements:
+                        fk.parent.foreign_keys.discard(fk)
+                        copy.foreign_keys.discard(fk)
+        return tables
+
+    def _deferred_columns(self) -> Dict[str, List[str]]:
+        """The foreign key columns of each table that reference a table of its
+        own layer, copied as NULL and set once the layer is copied"""
+        deferred = {}
+        for layer in self.layers:
+            names = {t.name for t in layer}
+            for table in layer:
+                target = self.target_tables[table.name]
+                columns = set()
+                for fk in target.foreign_keys:
+                    if fk.column.table.name not in names:
+                        continue
+                    if fk.parent.nullable and target.primary_key.columns:
+                        columns.add(fk.parent.key)
+                    else:
+                        logging.warning(
+                            f"Can't defer the foreign key {fk.parent} to "
+                            f"{fk.column}, it's copied as is"
+                        )
+                if columns:
+                    deferred[table.name] = sorted(columns)
+        return deferred
+
+    def run(self) -> CopyResult:
+        start = time.perf_counter()
+        self.target_metadata.create_all(self.target.engine, checkfirst=True)
+        result = CopyResult()
+        done = self._completed()
+        if not self.resume:
+            self._clear()
+            done = set()
+        for layer in self.layers:
+            todo = []
+            for table in layer:
+                if table.name in done:
+                    result.skipped.append(table.name)
+                else:
+                    todo.append(table)
+            if self.workers == 1 or len(todo) <= 1:
+                counts = [self._copy_table(t) for t in todo]
+            else:
+                with ThreadPoolExecutor(min(self.workers, len(todo))) as executor:
+                    counts = list(executor.map(self._copy_table, todo))
+            result.rows.update(zip((t.name for t in todo), counts))
+            for table in todo:
+                if table.name in self.deferred:
+                    self._set_deferred(table)
+                    self._completed_table(table)
+        result.seconds = time.perf_counter() - start
+        logging.info(
+            f"Copied {sum(result.rows.values())} rows of {len(result.rows)} tables "
+            f"from {self.source} to {self.target} in {result.seconds:.1f}s"
+        )
+        return result
+
+    def _completed(self) -> Set[str]:
+        with self.target.engine.connect() as connection:
+            return set(connection.execute(select(self.state.c.table_name)).scalars())
+
+    def _clear(self) -> None:
+        """Empty the target tables, referencing tables first"""
+        with self.target.engine.begin() as connection:
+            for table in reversed([t for layer in self.layers for t in layer]):
+                connection.execute(delete(self.target_tables[table.name]))
+            connection.execute(delete(self.state))
+
+    def _source_query(self, table: Table, after: Any = None):
+        stmt = select(table)
+        where = self.where.get(table.name)
+        if where is not None:
+            stmt = stmt.where(text(where) if isinstance(where, str) else where)
+        pk = list(table.primary_key.columns)
+        if after is not None:
+            stmt = stmt.where(pk[0] > after)
+        if pk:
+            stmt = stmt.order_by(*pk)
+        return stmt
+
+    def _resume_point(self, table: Table) -> Any:
+        """The largest primary key copied so far, None to copy from the start"""
+        target = self.target_tables[table.name]
+        pk = list(target.primary_key.columns)
+        with self.target.engine.begin() as connection:
+            if len(pk) == 1:
+                return connection.execute(select(func.max(pk[0]))).scalar()
+            if connection.execute(select(func.count()).select_from(target)).scalar():
+                logging.info(f"Copying '{table.name}' again from the start")
+                connection.execute(delete(target))
+        return None
+
+    def _copy_table(self, table: Table) -> int:
+        target = self.target_tables[table.name]
+        after = self._resume_point(table) if self.resume else None
+        keys = [c.key for c in target.columns]
+        deferred = self.deferred.get(table.name, ())
+        stmt = insert(target)
+        rows = 0
+        with self.source.engine.connect() as source:
+            result = source.execution_options(
+                stream_results=True, yield_per=self.chunk_size
+            ).execute(self._source_query(table, after))
+            for chunk in result.partitions():
+                values = [dict(zip(keys, row)) for row in chunk]
+                for row in values:
+                    row.update(dict.fromkeys(deferred))
+                with self.target.engine.begin() as connection:
+                    connection.execute(stmt, values)
+                rows += len(chunk)
+                if self.progress is not None:
+                    self.progress(table.name, rows)
+        if not deferred:
+            self._completed_table(table)
+        logging.debug(f"Copied {rows} rows of '{table.name}' to {self.target}")
+        return rows
+
+    def _set_deferred(self, table: Table) -> None:
+        """Set the foreign keys copied as NULL from the source, by primary key.
+        Goes over every row, rows copied by an earlier run included"""
+        target = self.target_tables[table.name]
+        columns = self.deferred[table.name]
+        pk = list(target.primary_key.columns)
+        stmt = (
+            update(target)
+            .where(*(c == bindparam(f"pk_{c.key}") for c in pk))
+            .values({name: bindparam(f"fk_{name}") for name in columns})
+        )
+        keys = [f"pk_{c.key}" for c in pk] + [f"fk_{name}" for name in columns]
+        query = (
+            self._source_query(table)
+            .with_only_columns(
+                *(table.c[c.key] for c in pk), *(table.c[name] for name in columns)
+            )
+            .where(or_(*(table.c[name].is_not(None) for name in columns)))
+        )
+        with self.source.engine.connect() as source:
+            result = source.execution_options(
+                stream_results=True, yield_per=self.chunk_size
+            ).execute(query)
+            for chunk in result.partitions():
+                with self.target.engine.begin() as connection:
+                    connection.execute(stmt, [dict(zip(keys, row)) for row in chunk])
+
+    def _completed_table(self, table: Table) -> None:
+        with self.target.engine.begin() as connection:
+            connection.execute(
+                insert(self.state).values(
+                    table_name=table.name, completed_at=func.current_timestamp()
+                )
+            )
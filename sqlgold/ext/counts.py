@@ -0,0 +1,256 @@
+"""Row counts maintained from session flushes
+
+``db.count(Model, mode="maintained")`` reads the row count of a table from a
+counter table instead of scanning it. The rows a session flush inserts into or
+deletes from a tracked table are added to its counter in the transaction of
+the flush, so the count commits or rolls back with the change.
+
+Each table's counter is split over ``shards`` rows and a flush updates one at
+random, so concurrent writers don't queue on a single row lock. A count sums
+the shards of the table.
+
+Which tables are tracked is kept in the counter table itself: a table is
+tracked once it has counter rows. Every process writing to a tracked table
+has to call ``db.enable_maintained_counts()``, which loads the tracked tables,
+or its flushes aren't counted. The tracked tables are reloaded with every
+reconciliation, so tables that other processes start tracking are picked up.
+
+Bulk ORM and Core statements (``session.execute(insert(Model), rows)``,
+``connection.execute(delete(table))``) don't go through the flush and make
+the counters drift. Counters are reconciled, set from an exact COUNT(*), when
+a table is first tracked, every ``reconcile_interval`` seconds from a
+background thread, and on ``reconcile()``.
+
+Example:
+    db.enable_maintained_counts(Order)  ## in every process writing orders
+    db.count(Order, mode="maintained")
+    db.count(Order, mode="approximate")  ## from the table statistics
+    db.count(Order, where=Order.status == "new")  ## exact
+"""
+
+import datetime
+import logging
+import random
+import threading
+from collections import Counter
+from typing import TYPE_CHECKING, Dict, Iterable, List, Optional
+
+from sqlalchemy import (
+    BigInteger,
+    Column,
+    DateTime,
+    Integer,
+    MetaData,
+    String,
+    Table,
+    bindparam,
+    case,
+    func,
+    insert,
+    inspect,
+    select,
+    table as sql_table,
+    update,
+)
+from sqlalchemy.orm import Session
+from sqlgold.engine.extension import DBExtension
+
+if TYPE_CHECKING:
+    from sqlgold.engine.db import DB
+
+MODES = ("exact", "approximate", "maintained")
+COUNTS_TABLE = "sqlgold_row_counts"
+
+
+def _counts_table(metadata: MetaData) -> Table:
+    return Table(
+        COUNTS_TABLE,
+        metadata,
+        Column("table_name", String(255), primary_key=True),
+        Column("shard", Integer, primary_key=True, autoincrement=False),
+        Column("count", BigInteger, nullable=False),
+        Column("reconciled_at", DateTime),
+    )
+
+
+class RowCounts(DBExtension):
+    """Keeps the row counts of tables in a counter table"""
+
+    def __init__(
+        self,
+        db: "DB",
+        shards: int = 8,
+        reconcile_interval: Optional[float] = 300.0,
+    ):
+        """
+        Args:
+            db (DB): the db whose sessions are counted
+            shards (int, optional): counter rows per table. Defaults to 8.
+            reconcile_interval (Optional[float], optional): seconds between
+                reconciliations of the tracked tables, None to only reconcile
+                on demand. Defaults to 300.0.
+        """
+        if shards < 1:
+            raise ValueError(f"shards must be >= 1, got {shards}")
+        self.db = db
+        self.shards = shards
+        self.reconcile_interval = reconcile_interval
+        self.metadata = MetaData()
+        self.table = _counts_table(self.metadata)
+        self.tables: Dict[str, Table] = {}  ## tracked tables by name
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._thread: Optional[threading.Thread] = None
+        self._listeners = [(db.Session, "after_flush", self._after_flush)]
+
+    def attach(self) -> None:
+        self.metadata.create_all(self.db.engine, checkfirst=True)
+        self.load_tracked()
+        super().attach()
+        if self.reconcile_interval is not None:
+            self._stop.clear()
+            self._thread = threading.Thread(
+                target=self._run, name="sqlgold-row-counts", daemon=True
+            )
+            self._thread.start()
+
+    def detach(self) -> None:
+        super().detach()
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+
+    def track(self, *tables: Table) -> None:
+        """Maintain the counts of tables, reconciling the new ones"""
+        new = []
+        with self._lock:
+            for table in tables:
+                if table.name not in self.tables:
+                    self.tables[table.name] = table
+                    new.append(table)
+        if new:
+            self.reconcile(new)
+
+    def load_tracked(self) -> List[str]:
+        """Track the tables that have counters, started by any process.
+        Returns the names of the tables added"""
+        with self.db.engine.connect() as connection:
+            names = connection.execute(
+                select(self.table.c.table_name).distinct()
+            ).scalars()
+            with self._lock:
+                added = [name for name in names if name not in self.tables]
+                for name in added:
+                    self.tables[name] = self._resolve(name)
+        return added
+
+    def _resolve(self, name: str) -> Table:
+        Base = self.db.Base
+        metadata = getattr(Base, "metadata", None)
+        if metadata is not None and name in metadata.tables:
+            return metadata.tables[name]
+        return sql_table(name)  ## enough to count the rows
+
+    def count(self, table: Table) -> int:
+        """The maintained count of a table
+
+        Raises:
+            ValueError: the table isn't tracked
+        """
+        if table.name not in self.tables and table.name not in self.load_tracked():
+            raise ValueError(
+                f"The row count of '{table.name}' isn't maintained, "
+                "pass it to enable_maintained_counts"
+            )
+        with self.db.engine.connect() as connection:
+            return connection.execute(
+                select(func.coalesce(func.sum(self.table.c.count), 0)).where(
+                    self.table.c.table_name == table.name
+                )
+            ).scalar()
+
+    def reconcile(self, tables: Optional[Iterable[Table]] = None) -> Dict[str, int]:
+        """Set the counters of tables, by default the tracked ones, from an
+        exact count. Returns the drift corrected by table"""
+        if tables is None:
+            with self._lock:
+                tables = list(self.tables.values())
+        c = self.table.c
+        drift = {}
+        for table in tables:
+            mine = c.table_name == table.name
+            with self.db.engine.begin() as connection:
+                ## flushes updating the counters wait until the exact count is
+                ## stored, their rows aren't in it
+                shards = dict(
+                    connection.execute(
+                        select(c.shard, c.count).where(mine).with_for_update()
+                    ).all()
+                )
+                exact = connection.execute(
+                    select(func.count()).select_from(table)
+                ).scalar()
+                now = datetime.datetime.now()
+                missing = [i for i in range(self.shards) if i not in shards]
+                if missing:
+                    connection.execute(
+                        insert(self.table),
+                        [
+                            {"table_name": table.name, "shard": i, "count": 0}
+                            for i in missing
+                        ],
+                    )
+                connection.execute(
+                    update(self.table)
+                    .where(mine)
+                    .values(
+                        count=case((c.shard == 0, exact), else_=0), reconciled_at=now
+                    )
+                )
+            kept = sum(shards.values())
+            drift[table.name] = exact - kept
+            if shards and kept != exact:
+                logging.info(
+                    f"Row count of '{table.name}' drifted by {exact - kept} in {self.db}"
+                )
+        return drift
+
+    def _run(self) -> None:
+        while not self._stop.wait(self.reconcile_interval):
+            try:
+                self.load_tracked()
+                self.reconcile()
+            except Exception:
+                logging.exception(f"Reconciling the row counts of {self.db} failed")
+
+    def _after_flush(self, session: Session, flush_context) -> None:
+        if not self.tables:
+            return
+        deltas: Counter = Counter()
+        for objects, sign in ((session.new, 1), (session.deleted, -1)):
+            for obj in objects:
+                for table in inspect(obj).mapper.tables:
+                    if table.name in self.tables:
+                        deltas[table.name] += sign
+        deltas = {name: n for name, n in deltas.items() if n}
+        if not deltas:
+            return
+        c = self.table.c
+        stmt = (
+            update(self.table)
+            .where(c.table_name == bindparam("p_table_name"))
+            .where(c.shard == bindparam("p_shard"))
+            .values(count=c.count + bindparam("p_delta"))
+        )
+        session.connection().execute(
+            stmt,
+            [
+                {
+                    "p_table_name": name,
+                    "p_shard": random.randrange(self.shards),
+                    "p_delta": n,
+                }
+                for name, n in deltas.items()
+            ],
+        )
@@ -0,0 +1,501 @@
+"""Query plans, slow statement capture and an index advisor
+
+``db.explain(stmt)`` runs the dialect's EXPLAIN (``EXPLAIN QUERY PLAN`` on
+sqlite) for a statement and parses the output into PlanSteps that read the
+same on every dialect: the table, how it is accessed (a full scan, a full
+index scan, an index lookup or a temporary sort), the index used and, where
+the database estimates it, the rows examined.
+
+The advisor looks at the tables a plan scans fully and the columns the
+statement's WHERE and JOIN clauses compare on those tables. When none of the
+table's Index objects, primary key or unique constraints starts with one of
+those columns it suggests an index: equality columns first, then join columns,
+then range columns.
+
+``db.enable_slow_query_log(threshold_ms)`` captures the statements taking
+longer than the threshold, with their plan and suggestions. Each statement
+shape is explained once, on the connection that ran it.
+
+Example:
+    plan = db.explain(select(Order).where(Order.status == "open"))
+    print(plan)
+    ## SCAN orders (full_scan)
+    ## suggest: CREATE INDEX ix_orders_status ON orders (status)
+
+    log = db.enable_slow_query_log(threshold_ms=200)
+    ...
+    log.suggestions()
+"""
+
+import logging
+import re
+import threading
+import time
+from collections import deque
+from dataclasses import dataclass, field
+from typing import (
+    TYPE_CHECKING,
+    Any,
+    Callable,
+    Deque,
+    Dict,
+    List,
+    Optional,
+    Sequence,
+    Tuple,
+)
+
+from sqlalchemy import Connection, Table, UniqueConstraint, event
+from sqlalchemy.sql import Alias, ClauseElement, Join, visitors
+from sqlalchemy.sql import operators
+from sqlalchemy.sql.dml import DMLWhereBase, UpdateBase
+from sqlalchemy.sql.elements import BinaryExpression, ColumnClause
+from sqlalchemy.sql.selectable import Select
+
+from sqlgold.engine.extension import DBExtension
+from sqlgold.utils.sql_utils import fingerprint_sql
+
+if TYPE_CHECKING:
+    from sqlgold.engine.db import DB
+
+## How a plan step reads its table
+FULL_SCAN = "full_scan"  ## every row of the table
+INDEX_SCAN = "index_scan"  ## every entry of an index
+INDEX_LOOKUP = "index_lookup"  ## an index lookup or range
+TEMP = "temp"  ## a temporary table or sort
+OTHER = "other"
+
+_START_KEY = "sqlgold_slow_query_start"
+_ANONYMOUS = re.compile(r"_\d+$")
+## Statements worth explaining, others have no interesting plan or can't be
+_EXPLAINABLE = re.compile(r"^\s*(SELECT|WITH|UPDATE|DELETE)\b", re.IGNORECASE)
+
+
+@dataclass
+class PlanStep:
+    access: str
+    table: Optional[str] = None  ## the table or its alias in the statement
+    index: Optional[str] = None
+    rows: Optional[float] = None  ## estimated rows examined, None if not estimated
+    detail: str = ""  ## the database's own description
+
+
+@dataclass(frozen=True)
+class IndexSuggestion:
+    table: str
+    columns: Tuple[str, ...]
+    reason: str
+    ddl: str
+
+
+@dataclass
+class QueryPlan:
+    statement: str
+    steps: List[PlanStep]
+    suggestions: List[IndexSuggestion] = field(default_factory=list)
+
+    @property
+    def full_scans(self) -> List[PlanStep]:
+        return [s for s in self.steps if s.access == FULL_SCAN]
+
+    def __str__(self) -> str:
+        lines = []
+        for s in self.steps:
+            rows = "" if s.rows is None else f", ~{s.rows:.0f} rows"
+            index = "" if s.index is None else f" using {s.index}"
+            lines.append(f"{s.table or '-'} ({s.access}{index}{rows}): {s.detail}")
+        lines += [f"suggest: {s.ddl}" for s in self.suggestions]
+        return "\n".join(lines)
+
+
+## Parsing
+_SQLITE_STEP = re.compile(
+    r"^(SCAN|SEARCH)(?: TABLE)? (\S+)(?: AS \S+)?(?: USING (.*?))?(?: \((.*)\))?$"
+)
+_SQLITE_INDEX = re.compile(r"INDEX (\S+)$")
+
+_MYSQL_ACCESS = {"ALL": FULL_SCAN, "index": INDEX_SCAN}
+
+
+def parse_sqlite_plan(rows: Sequence[Sequence[Any]]) -> List[PlanStep]:
+    """Steps from the (id, parent, notused, detail) rows of EXPLAIN QUERY PLAN"""
+    steps = []
+    for row in rows:
+        detail = row[-1]
+        if detail.startswith("USE TEMP B-TREE"):
+            steps.append(PlanStep(TEMP, detail=detail))
+            continue
+        m = _SQLITE_STEP.match(detail)
+        if (
+            m is None
+            or m.group(2).startswith("(")
+            or detail.startswith("SCAN CONSTANT")
+        ):
+            steps.append(PlanStep(OTHER, detail=detail))
+            continue
+        kind, table, using = m.group(1), m.group(2), m.group(3) or ""
+        index_match = _SQLITE_INDEX.search(using)
+        index = index_match.group(1) if index_match else None
+        if "PRIMARY KEY" in using:
+            index = "PRIMARY"
+        if using.startswith("AUTOMATIC"):
+            ## an index built for this query by reading the whole table
+            access = FULL_SCAN
+        elif kind == "SEARCH":
+            access = INDEX_LOOKUP
+        elif index is not None:
+            access = INDEX_SCAN
+        else:
+            access = FULL_SCAN
+        steps.append(PlanStep(access, table=table, index=index, detail=detail))
+    return steps
+
+
+def parse_mysql_plan(rows: Sequence[Dict[str, Any]]) -> List[PlanStep]:
+    """Steps from the rows of a traditional MySQL EXPLAIN, as dicts"""
+    steps = []
+    for row in rows:
+        type_ = row.get("type")
+        extra = row.get("Extra") or ""
+        access = _MYSQL_ACCESS.get(type_, INDEX_LOOKUP if type_ else OTHER)
+        estimate = row.get("rows")
+        steps.append(
+            PlanStep(
+                access,
+                table=row.get("table"),
+                index=row.get("key"),
+                rows=None if estimate is None else float(estimate),
+                detail=f"type={type_} {extra}".strip(),
+            )
+        )
+        if "Using temporary" in extra or "Using filesort" in extra:
+            steps.append(PlanStep(TEMP, table=row.get("table"), detail=extra))
+    return steps
+
+
+## Rendering
+class _Rendered(Exception):
+    def __init__(self, statement: str, parameters: Any):
+        self.statement = statement
+        self.parameters = parameters
+
+
+def _capture(conn, cursor, statement, parameters, context, executemany):
+    raise _Rendered(statement, parameters)
+
+
+def render(connection: Connection, stmt: Any, params: Any = None) -> Tuple[str, Any]:
+    """The statement and parameters as the driver would receive them, without
+    running the statement"""
+    event.listen(connection, "before_cursor_execute", _capture, retval=True)
+    try:
+        connection.execute(stmt, params)
+    except _Rendered as rendered:
+        return rendered.statement, rendered.parameters
+    finally:
+        event.remove(connection, "before_cursor_execute", _capture)
+    raise RuntimeError(f"{stmt} was executed without a cursor")
+
+
+## Advising
+_EQUALITY = {operators.eq, operators.in_op, operators.is_}
+_RANGE = {
+    operators.lt,
+    operators.le,
+    operators.gt,
+    operators.ge,
+    operators.between_op,
+    operators.like_op,
+    operators.startswith_op,
+}
+
+
+def _base_table(selectable: Any) -> Any:
+    selectable = selectable._deannotate()
+    while isinstance(selectable, Alias):
+        selectable = selectable.element._deannotate()
+    return selectable
+
+
+def _statement_tables(stmt: ClauseElement) -> Dict[str, Table]:
+    """The tables of a statement by the name the plan shows, their alias or name"""
+    if isinstance(stmt, UpdateBase):
+        froms = [stmt.table]
+    elif isinstance(stmt, Select):
+        froms = list(stmt.get_final_froms())
+    else:
+        return {}
+    names = {}
+    while froms:
+        selectable = froms.pop()
+        if isinstance(selectable, Join):
+            froms += [selectable.left, selectable.right]
+            continue
+        table = _base_table(selectable)
+        if isinstance(table, Table):
+            names[selectable.name] = table
+            ## anonymous aliases are named <table>_<n> when compiled
+            names.setdefault(table.name, table)
+    return names
+
+
+def _clauses(stmt: ClauseElement) -> List[ClauseElement]:
+    """The WHERE clause and JOIN conditions of a statement"""
+    clauses = []
+    if isinstance(stmt, (Select, DMLWhereBase)) and stmt.whereclause is not None:
+        clauses.append(stmt.whereclause)
+    if isinstance(stmt, Select):
+        froms = list(stmt.get_final_froms())
+        while froms:
+            selectable = froms.pop()
+            if isinstance(selectable, Join):
+                clauses.append(selectable.onclause)
+                froms += [selectable.left, selectable.right]
+    return clauses
+
+
+def predicate_columns(stmt: ClauseElement) -> Dict[Table, Dict[str, List[str]]]:
+    """Column names compared in the WHERE and JOIN clauses, by table and by
+    kind of comparison: eq, join and range"""
+    found: Dict[Table, Dict[str, List[str]]] = {}
+
+    def add(column: ColumnClause, kind: str) -> None:
+        table = _base_table(column.table)
+        if not isinstance(table, Table):
+            return
+        names = found.setdefault(table, {"eq": [], "join": [], "range": []})[kind]
+        if column.name not in names:
+            names.append(column.name)
+
+    for clause in _clauses(stmt):
+        for element in visitors.iterate(clause):
+            if not isinstance(element, BinaryExpression):
+                continue
+            left, right = element.left, element.right
+            left_column = isinstance(left, ColumnClause) and left.table is not None
+            right_column = isinstance(right, ColumnClause) and right.table is not None
+            if left_column and right_column:
+                add(left, "join")
+                add(right, "join")
+            elif left_column or right_column:
+                column = left if left_column else right
+                if element.operator in _EQUALITY:
+                    add(column, "eq")
+                elif element.operator in _RANGE:
+                    add(column, "range")
+    return found
+
+
+def _leading_columns(table: Table) -> set:
+    """The first column of every index of the table in its metadata"""
+    leading = {list(ix.columns)[0].name for ix in table.indexes if ix.columns}
+    if table.primary_key.columns:
+        leading.add(list(table.primary_key.columns)[0].name)
+    for constraint in table.constraints:
+        if isinstance(constraint, UniqueConstraint) and constraint.columns:
+            leading.add(list(constraint.columns)[0].name)
+    return leading
+
+
+def advise(
+    stmt: ClauseElement, plan: QueryPlan, dialect: Any, max_columns: int = 3
+) -> List[IndexSuggestion]:
+    """Suggest indexes for the tables the plan scans fully
+
+    Args:
+        stmt (ClauseElement): the statement the plan is of
+        plan (QueryPlan): its plan
+        dialect (Any): the dialect to write the CREATE INDEX for
+        max_columns (int, optional): most columns per index. Defaults to 3.
+
+    Returns:
+        List[IndexSuggestion]: one suggestion per fully scanned table at most
+    """
+    names = _statement_tables(stmt)
+    columns = predicate_columns(stmt)
+    preparer = dialect.identifier_preparer
+    suggestions = []
+    seen = set()
+    for step in plan.full_scans:
+        name = step.table or ""
+        table = names.get(name)
+        if table is None:
+            table = names.get(_ANONYMOUS.sub("", name))
+        if table is None or table in seen or table not in columns:
+            continue
+        seen.add(table)
+        found = columns[table]
+        candidates: List[str] = []
+        for name in found["eq"] + found["join"] + found["range"]:
+            if name not in candidates:
+                candidates.append(name)
+        if not candidates or _leading_columns(table) & set(candidates):
+            continue
+        candidates = candidates[:max_columns]
+        name = f"ix_{table.name}_{'_'.join(candidates)}"
+        ddl = (
+            f"CREATE INDEX {preparer.quote(name)} ON {preparer.format_table(table)} "
+            f"({', '.join(preparer.quote(c) for c in candidates)})"
+        )
+        kinds = [k for k in ("eq", "join", "range") if found[k]]
+        suggestions.append(
+            IndexSuggestion(
+                table=table.name,
+                columns=tuple(candidates),
+                reason=f"full scan of {step.table} filtered on "
+                f"{', '.join(kinds)} columns {', '.join(candidates)}",
+                ddl=ddl,
+            )
+        )
+    return suggestions
+
+
+def explain(db: "DB", stmt: Any, params: Any = None, suggest: bool = True) -> QueryPlan:
+    """Explain a statement, see DB.explain"""
+    with db.engine.connect() as connection:
+        statement, parameters = render(connection, stmt, params)
+        cursor = connection.connection.cursor()
+        try:
+            steps = db._explain_statement(cursor, statement, parameters)
+        finally:
+            cursor.close()
+        dialect = connection.dialect
+    plan = QueryPlan(statement=statement, steps=steps)
+    if suggest and isinstance(stmt, ClauseElement):
+        plan.suggestions = advise(stmt, plan, dialect)
+    return plan
+
+
+## Slow statements
+@dataclass
+class SlowQuery:
+    fingerprint: str
+    statement: str
+    elapsed_ms: float
+    at: float  ## wall clock time the statement finished
+    plan: Optional[QueryPlan] = None
+
+
+class SlowQueryLog(DBExtension):
+    """Captures the statements of a DB that take longer than a threshold"""
+
+    def __init__(
+        self,
+        db: "DB",
+        threshold_ms: float = 500,
+        explain: bool = True,
+        max_records: int = 1000,
+        on_capture: Optional[Callable[[SlowQuery], None]] = None,
+    ):
+        """
+        Args:
+            db (DB): the db whose statements are timed
+            threshold_ms (float, optional): statements taking longer are
+                captured. Defaults to 500.
+            explain (bool, optional): explain captured statements and suggest
+                indexes, once per statement fingerprint. Defaults to True.
+            max_records (int, optional): number of recent captures kept in
+                ``queries``, and of plans cached. Defaults to 1000.
+            on_capture (Optional[Callable], optional): called with every
+                capture. Defaults to None.
+        """
+        self.db = db
+        self.threshold_ms = threshold_ms
+        self.explain = explain
+        self.max_records = max_records
+        self.on_capture = on_capture
+        self.queries: Deque[SlowQuery] = deque(maxlen=max_records)
+        self._plans: Dict[str, Optional[QueryPlan]] = {}
+        self._lock = threading.Lock()
+        self._listeners = [
+            (db.engine, "before_cursor_execute", self._before_cursor_execute),
+            (db.engine, "after_cursor_execute", self._after_cursor_execute),
+        ]
+
+    def summary(self) -> Dict[str, Dict[str, Any]]:
+        """Captures by fingerprint, slowest total time first"""
+        with self._lock:
+            queries = list(self.queries)
+        summary: Dict[str, Dict[str, Any]] = {}
+        for q in queries:
+            s = summary.setdefault(
+                q.fingerprint,
+                {"count": 0, "total_ms": 0.0, "max_ms": 0.0, "plan": q.plan},
+            )
+            s["count"] += 1
+            s["total_ms"] += q.elapsed_ms
+            s["max_ms"] = max(s["max_ms"], q.elapsed_ms)
+        return dict(sorted(summary.items(), key=lambda kv: -kv[1]["total_ms"]))
+
+    def suggestions(self) -> List[IndexSuggestion]:
+        """The distinct index suggestions for the captured statements"""
+        with self._lock:
+            plans = [p for p in self._plans.values() if p is not None]
+        unique: Dict[Tuple[str, Tuple[str, ...]], IndexSuggestion] = {}
+        for plan in plans:
+            for s in plan.suggestions:
+                unique.setdefault((s.table, s.columns), s)
+        return list(unique.values())
+
+    def _before_cursor_execute(
+        self, conn, cursor, statement, parameters, context, executemany
+    ):
+        conn.info[_START_KEY] = time.perf_counter()
+
+    def _after_cursor_execute(
+        self, conn, cursor, statement, parameters, context, executemany
+    ):
+        start = conn.info.pop(_START_KEY, None)
+        if start is None:
+            return
+        elapsed_ms = (time.perf_counter() - start) * 1000
+        if elapsed_ms < self.threshold_ms:
+            return
+        fingerprint = fingerprint_sql(statement)
+        plan = None
+        if self.explain and not executemany and _EXPLAINABLE.match(statement):
+            plan = self._plan(conn, statement, parameters, context, fingerprint)
+        query = SlowQuery(
+            fingerprint=fingerprint,
+            statement=statement,
+            elapsed_ms=elapsed_ms,
+            at=time.time(),
+            plan=plan,
+        )
+        with self._lock:
+            self.queries.append(query)
+        self._registry.counter(
+            "sqlgold_slow_queries_total",
+            "Statements slower than the slow query threshold",
+            db=self._label,
+        ).inc()
+        logging.warning(
+            f"Slow statement on {self.db} took {elapsed_ms:.0f}ms: {fingerprint}"
+        )
+        if self.on_capture is not None:
+            self.on_capture(query)
+
+    def _plan(self, conn, statement, parameters, context, fingerprint):
+        with self._lock:
+            if fingerprint in self._plans:
+                return self._plans[fingerprint]
+        plan = None
+        ## a streaming cursor still holds the connection
+        if not context.execution_options.get("stream_results"):
+            try:
+                cursor = conn.connection.dbapi_connection.cursor()
+                try:
+                    steps = self.db._explain_statement(cursor, statement, parameters)
+                finally:
+                    cursor.close()
+                plan = QueryPlan(statement=statement, steps=steps)
+                compiled = getattr(context, "compiled", None)
+                if compiled is not None:
+                    plan.suggestions = advise(compiled.statement, plan, conn.dialect)
+            except Exception as e:
+                logging.debug(f"Couldn't explain a slow statement on {self.db}: {e}")
+        with self._lock:
+            if len(self._plans) >= self.max_records:
+                self._plans.clear()
+            self._plans[fingerprint] = plan
+        return plan
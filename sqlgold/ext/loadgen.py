@@ -0,0 +1,545 @@
+"""A synthetic load generator for the tables of a DB
+
+A mix of operations runs against the tables of the db's Base, or of the
+reflected schema when there is no Base, from worker threads or processes:
+
+- ``read``: select a row by primary key
+- ``scan``: select ``scan_rows`` rows from a primary key on, in key order
+- ``insert``: insert a row of generated values
+- ``update``: set a generated value in a column of a row selected by primary key
+
+Reads, scans and updates need a single column integer primary key, the keys
+are drawn between the smallest and largest key of the table when the run
+starts. Each operation picks a table at random among those it can run on.
+
+Without a ``rate`` every worker runs operations back to back (closed loop).
+With a rate, operations are scheduled at fixed intervals spread over the
+workers (open loop) and latencies are measured from the scheduled time, so a
+database falling behind shows in the latencies rather than in a lower rate.
+Operations during the ``warmup`` are run but not measured.
+
+Example:
+    report = run_load(db, mix={"read": 70, "insert": 20, "update": 10}, workers=8, duration=30)
+    print(report.to_text())
+
+See ``python -m sqlgold.load --help`` for the command line.
+"""
+
+import datetime
+import decimal
+import logging
+import multiprocessing
+import os
+import pickle
+import random
+import string
+import time
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from dataclasses import asdict, dataclass, field
+from typing import TYPE_CHECKING, Any, Callable, Dict, List, Optional, Sequence, Tuple
+
+from sqlalchemy import Column, MetaData, Table, func, insert, select, update
+
+from sqlgold.metrics import Histogram
+
+if TYPE_CHECKING:
+    from sqlgold.engine.db import DB
+
+OPERATIONS = ("read", "scan", "insert", "update")
+DEFAULT_MIX = {"read": 70, "scan": 10, "insert": 10, "update": 10}
+
+## Operations that need a single column integer primary key
+_KEYED = ("read", "scan", "update")
+
+
+def parse_mix(mix: Any) -> Dict[str, float]:
+    """Operation weights from a dict or a "read=70,insert=30" string"""
+    if isinstance(mix, str):
+        weights = {}
+        for part in mix.split(","):
+            name, sep, weight = part.partition("=")
+            if not sep:
+                raise ValueError(f"Expected operation=weight in the mix, got '{part}'")
+            weights[name.strip()] = float(weight)
+        mix = weights
+    unknown = set(mix) - set(OPERATIONS)
+    if unknown:
+        raise ValueError(f"Unknown operations {sorted(unknown)}, use {OPERATIONS}")
+    mix = {op: float(w) for op, w in mix.items() if float(w) > 0}
+    if not mix:
+        raise ValueError("The mix has no operation with a positive weight")
+    return mix
+
+
+## Generated values
+def _random_string(length: int) -> str:
+    return "".join(random.choices(string.ascii_letters, k=length))
+
+
+def _value_generator(column: Column) -> Optional[Callable[[], Any]]:
+    """A function generating values for a column, None for unsupported types"""
+    try:
+        python_type = column.type.python_type
+    except NotImplementedError:
+        return None
+    if python_type is bool:
+        return lambda: random.random() < 0.5
+    if python_type is int:
+        return lambda: random.randint(0, 1_000_000)
+    if python_type is float:
+        return lambda: random.uniform(0, 1000)
+    if python_type is decimal.Decimal:
+        scale = getattr(column.type, "scale", None) or 2
+        precision = getattr(column.type, "precision", None) or 10
+        upper = 10 ** min(precision - scale, 6) - 1
+        return lambda: round(decimal.Decimal(random.uniform(0, upper)), scale)
+    if python_type is str:
+        length = min(getattr(column.type, "length", None) or 16, 16)
+        return lambda: _random_string(length)
+    if python_type is bytes:
+        length = min(getattr(column.type, "length", None) or 16, 16)
+        return lambda: os.urandom(length)
+    if python_type is datetime.datetime:
+        return lambda: datetime.datetime.now() - datetime.timedelta(
+            seconds=random.randint(0, 86400 * 365)
+        )
+    if python_type is datetime.date:
+        return lambda: datetime.date.today() - datetime.timedelta(
+            days=random.randint(0, 365)
+        )
+    return None
+
+
+@dataclass
+class LoadTarget:
+    """A table and what the operations need to run on it"""
+
+    table: Table
+    key: Optional[Column] = None  ## single column integer primary key
+    lower: Optional[int] = None  ## key range when the run started
+    upper: Optional[int] = None
+    ## column key to generator for inserts, None when a required column can't
+    ## be generated
+    generators: Optional[Dict[str, Callable[[], Any]]] = None
+    ## columns set by updates
+    updatable: List[str] = field(default_factory=list)
+    ## foreign key columns, filled with keys of the referenced target
+    references: Dict[str, str] = field(default_factory=dict)
+
+    def supports(self, op: str) -> bool:
+        if op in _KEYED:
+            if self.key is None or self.lower is None:
+                return False
+            return op != "update" or bool(self.updatable)
+        return self.generators is not None
+
+    def random_key(self) -> int:
+        return random.randint(self.lower, self.upper)
+
+
+def _int_key(table: Table) -> Optional[Column]:
+    pk = list(table.primary_key.columns)
+    if len(pk) != 1:
+        return None
+    try:
+        return pk[0] if pk[0].type.python_type is int else None
+    except NotImplementedError:
+        return None
+
+
+def _make_target(table: Table) -> LoadTarget:
+    target = LoadTarget(table, key=_int_key(table))
+    generators: Optional[Dict[str, Callable[[], Any]]] = {}
+    for column in table.columns:
+        fks = list(column.foreign_keys)
+        if fks:
+            target.references[column.key] = fks[0].column.table.name
+        if column is table.autoincrement_column:
+            continue
+        generator = _value_generator(column)
+        if generator is None:
+            required = not column.nullable and (
+                column.default is None and column.server_default is None
+            )
+            if required and column.key not in target.references:
+                logging.info(
+                    f"Not inserting into '{table.name}', can't generate values "
+                    f"for its column '{column.key}' ({column.type})"
+                )
+                generators = None
+                break
+            continue
+        if generators is not None:
+            generators[column.key] = generator
+        if not column.primary_key and not fks:
+            target.updatable.append(column.key)
+    target.generators = generators
+    return target
+
+
+def load_tables(db: "DB", tables: Optional[Sequence[str]] = None) -> List[Table]:
+    """The tables of the db's Base, or reflected when it has none"""
+    Base = db.Base
+    if Base is not None and isinstance(getattr(Base, "metadata", None), MetaData):
+        metadata = Base.metadata
+    else:
+        metadata = MetaData()
+        with db.engine.connect() as connection:
+            metadata.reflect(bind=connection, only=tables)
+    if tables is None:
+        return list(metadata.sorted_tables)
+    unknown = set(tables) - set(metadata.tables)
+    if unknown:
+        raise ValueError(f"Unknown tables {sorted(unknown)} in {db}")
+    return [t for t in metadata.sorted_tables if t.name in tables]
+
+
+def load_targets(db: "DB", tables: Optional[Sequence[str]] = None) -> List[LoadTarget]:
+    """The targets of the tables with their current key ranges"""
+    targets = [_make_target(t) for t in load_tables(db, tables)]
+    _refresh_ranges(db, targets)
+    return targets
+
+
+def _refresh_ranges(db: "DB", targets: Sequence[LoadTarget]) -> None:
+    with db.engine.connect() as connection:
+        for target in targets:
+            if target.key is not None:
+                target.lower, target.upper = connection.execute(
+                    select(func.min(target.key), func.max(target.key))
+                ).one()
+
+
+def _row(target: LoadTarget, by_name: Dict[str, LoadTarget], next_key: int) -> dict:
+    row = {k: generate() for k, generate in target.generators.items()}
+    if target.key is not None and target.key is not target.table.autoincrement_column:
+        row[target.key.key] = next_key
+    for column, referenced in target.references.items():
+        other = by_name.get(referenced)
+        if other is not None and other.lower is not None:
+            row[column] = other.random_key()
+        elif target.table.c[column].nullable:
+            row[column] = None
+    return row
+
+
+def populate(db: "DB", targets: Sequence[LoadTarget], rows: int) -> int:
+    """Insert generated rows into the targets holding fewer than ``rows``,
+    referenced tables first. Returns the rows inserted"""
+    by_name = {t.table.name: t for t in targets}
+    inserted = 0
+    for target in targets:
+        if target.generators is None:
+            continue
+        with db.engine.begin() as connection:
+            have = connection.execute(
+                select(func.count()).select_from(target.table)
+            ).scalar()
+            start = (target.upper or 0) + 1
+            batch = [_row(target, by_name, start + i) for i in range(rows - have)]
+            if batch:
+                connection.execute(insert(target.table), batch)
+                inserted += len(batch)
+        _refresh_ranges(db, [target])
+    return inserted
+
+
+## Running
+@dataclass
+class OperationReport:
+    count: int = 0
+    errors: int = 0
+    ops_per_sec: float = 0.0
+    mean_ms: float = 0.0
+    p50_ms: float = 0.0
+    p95_ms: float = 0.0
+    p99_ms: float = 0.0
+    max_ms: float = 0.0
+
+    @classmethod
+    def from_histogram(
+        cls, histogram: Histogram, errors: int, seconds: float
+    ) -> "OperationReport":
+        n = histogram.count
+        return cls(
+            count=n,
+            errors=errors,
+            ops_per_sec=n / seconds if seconds else 0.0,
+            mean_ms=histogram.sum / n * 1000 if n else 0.0,
+            p50_ms=histogram.quantile(0.5) * 1000,
+            p95_ms=histogram.quantile(0.95) * 1000,
+            p99_ms=histogram.quantile(0.99) * 1000,
+            max_ms=histogram.max * 1000,
+        )
+
+
+@dataclass
+class LoadReport:
+    seconds: float  ## measured, the warmup excluded
+    workers: int
+    processes: bool
+    rate: Optional[float]  ## target operations per second, None for closed loop
+    operations: Dict[str, OperationReport] = field(default_factory=dict)
+    total: OperationReport = field(default_factory=OperationReport)
+
+    def to_dict(self) -> Dict[str, Any]:
+        return asdict(self)
+
+    def to_text(self) -> str:
+        mode = f"open loop at {self.rate:g} ops/s" if self.rate else "closed loop"
+        kind = "processes" if self.processes else "threads"
+        lines = [
+            f"{self.seconds:.1f}s, {self.workers} {kind}, {mode}",
+            f"{'operation':<10} {'count':>9} {'errors':>7} {'ops/s':>10} "
+            f"{'p50 ms':>9} {'p95 ms':>9} {'p99 ms':>9} {'max ms':>9}",
+        ]
+        for name, r in [*self.operations.items(), ("total", self.total)]:
+            lines.append(
+                f"{name:<10} {r.count:>9} {r.errors:>7} {r.ops_per_sec:>10.1f} "
+                f"{r.p50_ms:>9.2f} {r.p95_ms:>9.2f} {r.p99_ms:>9.2f} {r.max_ms:>9.2f}"
+            )
+        return "\n".join(lines)
+
+
+@dataclass
+class _Settings:
+    mix: Dict[str, float]
+    workers: int
+    rate: Optional[float]
+    warmup: float
+    duration: float
+    scan_rows: int
+
+
+def _run_operation(
+    db: "DB",
+    op: str,
+    target: LoadTarget,
+    by_name: Dict[str, LoadTarget],
+    next_key: Callable[[LoadTarget], int],
+    scan_rows: int,
+) -> None:
+    table = target.table
+    if op == "read":
+        with db.engine.connect() as connection:
+            connection.execute(
+                select(table).where(target.key == target.random_key())
+            ).all()
+    elif op == "scan":
+        with db.engine.connect() as connection:
+            connection.execute(
+                select(table)
+                .where(target.key >= target.random_key())
+                .order_by(target.key)
+                .limit(scan_rows)
+            ).all()
+    elif op == "insert":
+        with db.engine.begin() as connection:
+            connection.execute(
+                insert(table).values(_row(target, by_name, next_key(target)))
+            )
+    elif op == "update":
+        column = random.choice(target.updatable)
+        with db.engine.begin() as connection:
+            connection.execute(
+                update(table)
+                .where(target.key == target.random_key())
+                .values({column: target.generators[column]()})
+            )
+
+
+def _run_worker(
+    db: "DB",
+    targets: List[LoadTarget],
+    settings: _Settings,
+    index: int,
+    start_at: float,
+) -> Dict[str, Tuple[Dict[str, Any], int]]:
+    """Run operations until the end of the run.
+    Returns the latency histogram (as a dict) and the errors by operation"""
+    by_name = {t.table.name: t for t in targets}
+    choices = {op: [t for t in targets if t.supports(op)] for op in settings.mix}
+    ops = list(settings.mix)
+    weights = [settings.mix[op] for op in ops]
+    histograms = {op: Histogram(op) for op in ops}
+    errors = {op: 0 for op in ops}
+    ## primary keys of inserted rows, unique over the workers
+    inserted = {t.table.name: 0 for t in targets}
+
+    def next_key(target: LoadTarget) -> int:
+        n = inserted[target.table.name]
+        inserted[target.table.name] = n + 1
+        return (target.upper or 0) + 1 + index + n * settings.workers
+
+    ## times are wall clock so that processes share them
+    measure_from = start_at + settings.warmup
+    end = measure_from + settings.duration
+    interval = settings.workers / settings.rate if settings.rate else 0.0
+    due = start_at + index * interval / settings.workers
+    delay = start_at - time.time()
+    if delay > 0:
+        time.sleep(delay)
+    while True:
+        if interval:
+            delay = due - time.time()
+            if delay > 0:
+                time.sleep(delay)
+            began = due
+            due += interval
+        else:
+            began = time.time()
+        if began >= end:
+            break
+        op = random.choices(ops, weights)[0]
+        target = random.choice(choices[op])
+        ok = True
+        try:
+            _run_operation(db, op, target, by_name, next_key, settings.scan_rows)
+        except Exception as e:
+            ok = False
+            logging.debug(f"{op} on '{target.table.name}' failed: {e}")
+        if began >= measure_from:
+            if ok:
+                histograms[op].observe(time.time() - began)
+            else:
+                errors[op] += 1
+    return {op: (histograms[op].to_dict(), errors[op]) for op in ops}
+
+
+def _run_worker_process(db_state: bytes, tables, ranges, settings, index, start_at):
+    db = pickle.loads(db_state)
+    targets = [_make_target(t) for t in load_tables(db, tables)]
+    for target in targets:
+        target.lower, target.upper = ranges[target.table.name]
+    try:
+        return _run_worker(db, targets, settings, index, start_at)
+    finally:
+        db.engine.dispose()
+
+
+class LoadGenerator:
+    """Runs a mix of operations against the tables of a db"""
+
+    def __init__(
+        self,
+        db: "DB",
+        mix: Any = None,
+        tables: Optional[Sequence[str]] = None,
+        workers: int = 4,
+        processes: bool = False,
+        rate: Optional[float] = None,
+        warmup: float = 5.0,
+        duration: float = 30.0,
+        scan_rows: int = 100,
+        populate_rows: int = 0,
+        mp_context: Optional[str] = None,
+    ):
+        """
+        Args:
+            db (DB): the db to load
+            mix (Any, optional): operation weights, a dict or a
+                "read=70,insert=30" string. Defaults to DEFAULT_MIX.
+            tables (Optional[Sequence[str]], optional): table names.
+                Defaults to every table.
+            workers (int, optional): threads or processes. Defaults to 4.
+            processes (bool, optional): run the workers in processes.
+                Defaults to False.
+            rate (Optional[float], optional): target operations per second over
+                all workers, None runs operations back to back. Defaults to None.
+            warmup (float, optional): seconds run before measuring. Defaults to 5.0.
+            duration (float, optional): seconds measured. Defaults to 30.0.
+            scan_rows (int, optional): rows per scan. Defaults to 100.
+            populate_rows (int, optional): fill tables holding fewer rows with
+                generated rows before the run. Defaults to 0.
+            mp_context (Optional[str], optional): multiprocessing start method.
+                Defaults to fork where available.
+        """
+        if workers < 1:
+            raise ValueError(f"workers must be >= 1, got {workers}")
+        if rate is not None and rate <= 0:
+            raise ValueError(f"rate must be > 0 or None, got {rate}")
+        self.db = db
+        self.tables = list(tables) if tables is not None else None
+        self.processes = processes
+        self.populate_rows = populate_rows
+        if mp_context is None:
+            methods = multiprocessing.get_all_start_methods()
+            mp_context = "fork" if "fork" in methods else "spawn"
+        self.mp_context = mp_context
+        self.settings = _Settings(
+            mix=parse_mix(DEFAULT_MIX if mix is None else mix),
+            workers=workers,
+            rate=rate,
+            warmup=warmup,
+            duration=duration,
+            scan_rows=scan_rows,
+        )
+
+    def _check_mix(self, targets: List[LoadTarget]) -> None:
+        mix = self.settings.mix
+        for op in list(mix):
+            if not any(t.supports(op) for t in targets):
+                logging.warning(f"No table supports '{op}', leaving it out of the mix")
+                del mix[op]
+        if not mix:
+            raise ValueError(
+                f"None of the operations can run on the tables of {self.db}"
+            )
+
+    def run(self) -> LoadReport:
+        targets = load_targets(self.db, self.tables)
+        if self.populate_rows:
+            populate(self.db, targets, self.populate_rows)
+        self._check_mix(targets)
+        s = self.settings
+        start_at = time.time() + 0.1
+        if self.processes:
+            ranges = {t.table.name: (t.lower, t.upper) for t in targets}
+            tables = [t.table.name for t in targets]
+            with ProcessPoolExecutor(
+                s.workers, mp_context=multiprocessing.get_context(self.mp_context)
+            ) as executor:
+                futures = [
+                    executor.submit(
+                        _run_worker_process,
+                        pickle.dumps(self.db),
+                        tables,
+                        ranges,
+                        s,
+                        i,
+                        start_at + 1.0,  ## processes take longer to start
+                    )
+                    for i in range(s.workers)
+                ]
+                results = [f.result() for f in futures]
+        else:
+            with ThreadPoolExecutor(s.workers, thread_name_prefix="sqlgold-load") as ex:
+                futures = [
+                    ex.submit(_run_worker, self.db, targets, s, i, start_at)
+                    for i in range(s.workers)
+                ]
+                results = [f.result() for f in futures]
+        return self._report(results)
+
+    def _report(self, results) -> LoadReport:
+        s = self.settings
+        report = LoadReport(s.duration, s.workers, self.processes, s.rate)
+        total, total_errors = Histogram("total"), 0
+        for op in s.mix:
+            histogram, errors = Histogram(op), 0
+            for result in results:
+                state, n = result[op]
+                histogram.merge(Histogram.from_dict(state))
+                errors += n
+            report.operations[op] = OperationReport.from_histogram(
+                histogram, errors, s.duration
+            )
+            total.merge(histogram)
+            total_errors += errors
+        report.total = OperationReport.from_histogram(total, total_errors, s.duration)
+        return report
+
+
+def run_load(db: "DB", **kwargs) -> LoadReport:
+    """Run a LoadGenerator, see LoadGenerator for the arguments"""
+    return LoadGenerator(db, **kwargs).run()
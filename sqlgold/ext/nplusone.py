@@ -0,0 +1,274 @@
+"""N+1 query detection for sessions created by DB.Session
+
+The detector watches every statement executed through the db's sessions and
+groups them by statement shape and the call site in user code. When the same
+shape is issued from the same place more than ``threshold`` times within one
+transaction it warns (or raises), naming the relationship that was lazy
+loaded and the loader option that would avoid the repeated queries.
+
+Example:
+    db.enable_nplusone_detection(threshold=5)
+
+    with assert_max_queries(3, db):
+        ...
+"""
+
+import logging
+import os
+import site
+import sys
+import sysconfig
+import threading
+import warnings
+from collections import OrderedDict
+from contextlib import contextmanager
+from dataclasses import dataclass, field
+from typing import TYPE_CHECKING, Dict, Iterator, List, Optional, Tuple
+
+import sqlalchemy
+from sqlalchemy import event
+from sqlalchemy.orm import ORMExecuteState
+
+import sqlgold
+from sqlgold.engine.extension import DBExtension
+from sqlgold.exceptions import NPlusOneError, NPlusOneWarning, TooManyQueriesError
+from sqlgold.utils.sql_utils import fingerprint_sql
+
+if TYPE_CHECKING:
+    from sqlgold.engine.db import DB
+
+_TRACKER_KEY = "sqlgold_nplusone"
+_SKIP_PREFIXES = (
+    os.path.dirname(sqlalchemy.__file__) + os.sep,
+    os.path.dirname(sqlgold.__file__) + os.sep,
+)
+_STDLIB = os.path.dirname(contextmanager.__code__.co_filename) + os.sep
+## site-packages is usually inside the stdlib dir, installed apps aren't skipped
+_SITE_PACKAGES = tuple(
+    {
+        os.path.join(path, "")
+        for path in (
+            *getattr(site, "getsitepackages", lambda: [])(),
+            site.getusersitepackages(),
+            sysconfig.get_paths()["purelib"],
+            sysconfig.get_paths()["platlib"],
+        )
+    }
+)
+
+MODES = ("warn", "raise", "log")
+
+
+@dataclass
+class NPlusOneReport:
+    """A statement shape that was repeated more than the threshold"""
+
+    sql: str
+    count: int
+    call_site: str
+    relationship: Optional[str] = None  ## e.g. "User.addresses"
+    suggestion: Optional[str] = None  ## e.g. "selectinload(User.addresses)"
+
+    def __str__(self):
+        msg = (
+            f"Possible N+1 query: statement repeated {self.count} times "
+            f"from {self.call_site}: {self.sql}"
+        )
+        if self.relationship:
+            msg += (
+                f"\nLazy loaded relationship '{self.relationship}', "
+                f"consider .options({self.suggestion})"
+            )
+        return msg
+
+
+@dataclass
+class _SessionTracker:
+    counts: Dict[Tuple, int] = field(default_factory=dict)
+    reported: set = field(default_factory=set)
+
+
+def _skipped(filename: str) -> bool:
+    if filename.startswith(_SKIP_PREFIXES):
+        return True
+    return filename.startswith(_STDLIB) and not filename.startswith(_SITE_PACKAGES)
+
+
+def call_site() -> str:
+    """The first frame outside of sqlalchemy, sqlgold and the stdlib as
+    'file:line in func'"""
+    frame = sys._getframe(1)
+    while frame is not None:
+        filename = frame.f_code.co_filename
+        if not _skipped(filename):
+            return f"{filename}:{frame.f_lineno} in {frame.f_code.co_name}"
+        frame = frame.f_back
+    return "<unknown>"
+
+
+class NPlusOneDetector(DBExtension):
+    """Detects repeated statements in the sessions of a DB"""
+
+    def __init__(
+        self,
+        db: "DB",
+        threshold: int = 10,
+        mode: str = "warn",
+        max_shapes: int = 1000,
+    ):
+        """
+        Args:
+            db (DB): the db to watch
+            threshold (int, optional): number of repetitions allowed. Defaults to 10.
+            mode (str, optional): "warn" issues a NPlusOneWarning, "raise" raises
+                NPlusOneError and "log" logs a warning. Defaults to "warn".
+            max_shapes (int, optional): statement shapes cached, least recently
+                used first out. Defaults to 1000.
+        """
+        if mode not in MODES:
+            raise ValueError(f"mode must be one of {MODES}, got '{mode}'")
+        self.db = db
+        self.threshold = threshold
+        self.mode = mode
+        self.max_shapes = max_shapes
+        self.reports: List[NPlusOneReport] = []
+        ## sql -> shape, the compiled sql of a statement is cached by sqlalchemy
+        self._shapes: "OrderedDict[str, str]" = OrderedDict()
+        self._lock = threading.Lock()
+        self._listeners = [
+            (db.Session, "do_orm_execute", self._do_orm_execute),
+            (db.Session, "after_transaction_end", self._after_transaction_end),
+            (db.engine, "before_cursor_execute", self._before_cursor_execute),
+        ]
+
+    def _shape(self, sql: str) -> str:
+        with self._lock:
+            shape = self._shapes.get(sql)
+            if shape is not None:
+                self._shapes.move_to_end(sql)
+                return shape
+        shape = fingerprint_sql(sql)
+        with self._lock:
+            self._shapes[sql] = shape
+            while len(self._shapes) > self.max_shapes:
+                self._shapes.popitem(last=False)
+        return shape
+
+    def _do_orm_execute(self, state: ORMExecuteState):
+        session = state.session
+        tracker = session.info.get(_TRACKER_KEY)
+        if tracker is None:
+            tracker = session.info[_TRACKER_KEY] = _SessionTracker()
+
+        relationship = None
+        if state.is_relationship_load and state.loader_strategy_path:
+            relationship = state.loader_strategy_path[-1]
+        ## counted when the statement is executed, with its compiled sql
+        state.update_execution_options(
+            **{_TRACKER_KEY: (tracker, relationship, call_site())}
+        )
+
+    def _before_cursor_execute(
+        self, conn, cursor, statement, parameters, context, executemany
+    ):
+        tracked = context.execution_options.get(_TRACKER_KEY)
+        if tracked is None:
+            return
+        tracker, relationship, site = tracked
+        shape = self._shape(statement)
+        key = (shape, site)
+        count = tracker.counts.get(key, 0) + 1
+        tracker.counts[key] = count
+        if count <= self.threshold or key in tracker.reported:
+            return
+        tracker.reported.add(key)
+
+        report = NPlusOneReport(sql=shape, count=count, call_site=site)
+        if relationship is not None:
+            name = f"{relationship.parent.class_.__name__}.{relationship.key}"
+            loader = "selectinload" if relationship.uselist else "joinedload"
+            report.relationship = name
+            report.suggestion = f"{loader}({name})"
+        self._report(report)
+
+    def _report(self, report: NPlusOneReport):
+        with self._lock:
+            self.reports.append(report)
+        if self.mode == "raise":
+            raise NPlusOneError(str(report))
+        if self.mode == "warn":
+            warnings.warn(str(report), NPlusOneWarning, stacklevel=2)
+        else:
+            logging.warning(str(report))
+
+    def _after_transaction_end(self, session, transaction):
+        if transaction.parent is None:
+            session.info.pop(_TRACKER_KEY, None)
+
+
+class QueryCounter:
+    """Statements executed on an engine while counting"""
+
+    def __init__(self):
+        self.statements: List[str] = []
+
+    @property
+    def count(self) -> int:
+        return len(self.statements)
+
+    def _after_cursor_execute(
+        self, conn, cursor, statement, parameters, context, executemany
+    ):
+        self.statements.append(statement)
+
+
+@contextmanager
+def count_queries(db: Optional["DB"] = None) -> Iterator[QueryCounter]:
+    """Count the statements executed on the db's engine within the block
+
+    Args:
+        db (Optional[DB], optional): the db. Defaults to the DBManager's main database.
+
+    Yields:
+        QueryCounter: the counter, with the statements executed so far
+    """
+    if db is None:
+        from sqlgold.managers.db_manager import DBManager
+
+        db = DBManager.get_manager().get_main_database()
+    counter = QueryCounter()
+    event.listen(db.engine, "after_cursor_execute", counter._after_cursor_execute)
+    try:
+        yield counter
+    finally:
+        event.remove(db.engine, "after_cursor_execute", counter._after_cursor_execute)
+
+
+@contextmanager
+def assert_max_queries(n: int, db: Optional["DB"] = None) -> Iterator[QueryCounter]:
+    """Fail if more than n statements are executed on the db within the block
+
+    Example:
+        with assert_max_queries(2, db):
+            users = session.scalars(select(User).options(selectinload(User.addresses)))
+            [u.addresses for u in users]
+
+    Args:
+        n (int): maximum number of statements
+        db (Optional[DB], optional): the db. Defaults to the DBManager's main database.
+
+    Raises:
+        TooManyQueriesError: more than n statements were executed
+
+    Yields:
+        QueryCounter: the counter, with the statements executed so far
+    """
+    with count_queries(db) as counter:
+        yield counter
+    if counter.count > n:
+        statements = "\n".join(
+            f"  {i}: {fingerprint_sql(s)}" for i, s in enumerate(counter.statements, 1)
+        )
+        raise TooManyQueriesError(
+            f"Expected at most {n} queries, {counter.count} were executed:\n{statements}"
+        )
@@ -0,0 +1,491 @@
+"""A transactional outbox of the rows changed through the sessions of a DB
+
+Rows of the opted-in models inserted, updated or deleted by a session flush
+are written to an outbox table in the transaction of the flush, so they are
+committed or rolled back together with the change. Consumers read the outbox
+in id order from a cursor stored per consumer name instead of polling the
+tables. Delivery is at least once: a consumer that stops before acknowledging
+a batch gets it again. Subscribers are called in the process with the events
+of a transaction once it commits.
+
+Ids are assigned when rows are inserted, not when their transactions commit,
+so a consumer can see id 11 before id 10 commits. A consumer stops at a
+missing id for at least ``gap_timeout`` seconds and until every transaction
+of another connection that was open when it first saw the gap has ended (from
+information_schema.innodb_trx on MySQL, sqlite serializes writers). The id is
+then known to have been rolled back and is skipped. Where the open
+transactions can't be listed (other dialects, MySQL without the PROCESS
+privilege) the id is skipped after ``gap_timeout`` alone, and a transaction
+that commits later than that loses its events. Skipped ids are logged, at
+WARNING when unverified, and counted in ``sqlgold_outbox_skipped_ids_total``.
+
+Only changes made through the unit of work are captured, not bulk ORM or
+Core statements like ``session.execute(update(Model))``. Values are stored as
+json: datetimes as ISO 8601 strings, decimals as strings and bytes as base64.
+
+Example:
+    outbox = db.enable_outbox(Order, Customer)
+    outbox.subscribe(lambda events: cache.invalidate(e.key for e in events))
+
+    consumer = outbox.consumer("search-indexer", batch_size=500)
+    for batch in consumer.batches():
+        index(batch)
+        consumer.ack()
+"""
+
+import base64
+import datetime
+import decimal
+import json
+import logging
+import threading
+import time
+import uuid
+from dataclasses import dataclass
+from typing import (
+    TYPE_CHECKING,
+    Any,
+    Callable,
+    Dict,
+    Iterator,
+    List,
+    Optional,
+    Sequence,
+    Set,
+    Tuple,
+)
+
+from sqlalchemy import (
+    BigInteger,
+    Column,
+    DateTime,
+    Integer,
+    MetaData,
+    String,
+    Table,
+    Text,
+    delete,
+    func,
+    insert,
+    inspect,
+    select,
+    update,
+)
+from sqlalchemy.orm import Mapper, Session, SessionTransaction
+
+from sqlgold.engine.extension import DBExtension, db_label, db_registry
+
+if TYPE_CHECKING:
+    from sqlgold.engine.db import DB
+
+INSERT = "insert"
+UPDATE = "update"
+DELETE = "delete"
+
+DEFAULT_TABLE = "sqlgold_outbox"
+
+## session.info key of the events waiting for their transaction to commit
+_PENDING_KEY = "sqlgold_outbox_pending"
+
+Subscriber = Callable[[List["OutboxEvent"]], None]
+
+
+@dataclass
+class OutboxEvent:
+    id: Optional[int]  ## None for subscribers when the driver can't return ids
+    table: str
+    op: str  ## insert, update or delete
+    key: Dict[str, Any]  ## primary key by column name
+    data: Dict[str, Any]  ## the loaded column values by column name
+    changed: Optional[List[str]]  ## columns changed by an update
+    created_at: datetime.datetime
+
+
+def _json_default(value: Any) -> Any:
+    if isinstance(value, (datetime.datetime, datetime.date, datetime.time)):
+        return value.isoformat()
+    if isinstance(value, (decimal.Decimal, uuid.UUID)):
+        return str(value)
+    if isinstance(value, (bytes, bytearray, memoryview)):
+        return base64.b64encode(bytes(value)).decode()
+    if isinstance(value, datetime.timedelta):
+        return value.total_seconds()
+    raise TypeError(f"Can't write a value of type {type(value).__name__}")
+
+
+def _dumps(value: Any) -> Optional[str]:
+    if value is None:
+        return None
+    return json.dumps(value, default=_json_default, separators=(",", ":"))
+
+
+def _tables(metadata: MetaData, name: str) -> Tuple[Table, Table]:
+    outbox = Table(
+        name,
+        metadata,
+        Column(
+            "id",
+            BigInteger().with_variant(Integer, "sqlite"),
+            primary_key=True,
+            autoincrement=True,
+        ),
+        Column("table_name", String(255), nullable=False),
+        Column("op", String(6), nullable=False),
+        Column("key", Text, nullable=False),
+        Column("data", Text, nullable=False),
+        Column("changed", Text),
+        Column("created_at", DateTime, nullable=False),
+        ## ids aren't reused after purge deletes the last events
+        sqlite_autoincrement=True,
+    )
+    consumers = Table(
+        f"{name}_consumer",
+        metadata,
+        Column("name", String(255), primary_key=True),
+        Column("position", BigInteger, nullable=False),
+        Column("updated_at", DateTime, nullable=False),
+    )
+    return outbox, consumers
+
+
+def _event(row: Any) -> OutboxEvent:
+    return OutboxEvent(
+        row.id,
+        row.table_name,
+        row.op,
+        json.loads(row.key),
+        json.loads(row.data),
+        json.loads(row.changed) if row.changed is not None else None,
+        row.created_at,
+    )
+
+
+def _now() -> datetime.datetime:
+    return datetime.datetime.now(datetime.timezone.utc).replace(tzinfo=None)
+
+
+class Outbox(DBExtension):
+    """Captures the changed rows of models into an outbox table"""
+
+    def __init__(
+        self, db: "DB", models: Sequence[type], table_name: str = DEFAULT_TABLE
+    ):
+        """
+        Args:
+            db (DB): the db whose sessions are captured
+            models (Sequence[type]): the mapped classes captured, with subclasses
+            table_name (str, optional): the outbox table, consumer positions are
+                kept in <table_name>_consumer. Defaults to "sqlgold_outbox".
+        """
+        if not models:
+            raise ValueError("Pass the mapped classes to capture")
+        for model in models:
+            if not isinstance(inspect(model, raiseerr=False), Mapper):
+                raise TypeError(f"{model} is not a mapped class")
+        self.db = db
+        self.models = tuple(models)
+        self.metadata = MetaData()
+        self.table, self.consumers = _tables(self.metadata, table_name)
+        self._subscribers: List[Subscriber] = []
+        self._lock = threading.Lock()
+        self._listeners = [
+            (db.Session, "after_flush", self._after_flush),
+            (db.Session, "after_commit", self._after_commit),
+            (db.Session, "after_soft_rollback", self._after_soft_rollback),
+        ]
+
+    def attach(self) -> None:
+        self.metadata.create_all(self.db.engine, checkfirst=True)
+        super().attach()
+
+    def subscribe(self, fn: Subscriber) -> None:
+        """Call fn with the events of every transaction after it commits.
+        Exceptions raised by fn are logged"""
+        with self._lock:
+            self._subscribers.append(fn)
+
+    def unsubscribe(self, fn: Subscriber) -> None:
+        with self._lock:
+            if fn in self._subscribers:
+                self._subscribers.remove(fn)
+
+    def consumer(
+        self, name: str, batch_size: int = 100, gap_timeout: float = 5.0
+    ) -> "OutboxConsumer":
+        """A consumer reading the outbox from the position acknowledged last
+        under name, see OutboxConsumer"""
+        return OutboxConsumer(
+            self, name, batch_size=batch_size, gap_timeout=gap_timeout
+        )
+
+    def drop_consumer(self, name: str) -> None:
+        """Forget a consumer and its position, purge stops waiting for it"""
+        with self.db.engine.begin() as connection:
+            connection.execute(
+                delete(self.consumers).where(self.consumers.c.name == name)
+            )
+
+    def purge(self) -> int:
+        """Delete the events acknowledged by every consumer, consumers are
+        registered when first created. Returns the number of events deleted"""
+        with self.db.engine.begin() as connection:
+            position = connection.execute(
+                select(func.min(self.consumers.c.position))
+            ).scalar()
+            if position is None:
+                return 0
+            return connection.execute(
+                delete(self.table).where(self.table.c.id <= position)
+            ).rowcount
+
+    ## Capture
+    def _rows(self, session: Session) -> List[Dict[str, Any]]:
+        now = _now()
+        rows = []
+        for op, objects in (
+            (INSERT, session.new),
+            (UPDATE, session.dirty),
+            (DELETE, session.deleted),
+        ):
+            for obj in objects:
+                if not isinstance(obj, self.models):
+                    continue
+                row = self._row(op, obj, now)
+                if row is not None:
+                    rows.append(row)
+        return rows
+
+    def _row(self, op: str, obj: Any, now: datetime.datetime) -> Optional[dict]:
+        state = inspect(obj)
+        mapper = state.mapper
+        ## only loaded values, reading expired attributes would query the db
+        loaded = state.dict
+        data, changed = {}, []
+        for prop in mapper.column_attrs:
+            name = prop.columns[0].name
+            if prop.key in loaded:
+                data[name] = loaded[prop.key]
+            if op == UPDATE and state.attrs[prop.key].history.has_changes():
+                changed.append(name)
+        if op == UPDATE and not changed:
+            return None  ## only relationships changed
+        key = {
+            c.name: loaded.get(mapper.get_property_by_column(c).key)
+            for c in mapper.primary_key
+        }
+        return {
+            "table_name": mapper.local_table.name,
+            "op": op,
+            "key": _dumps(key),
+            "data": _dumps(data),
+            "changed": _dumps(changed) if op == UPDATE else None,
+            "created_at": now,
+        }
+
+    def _after_flush(self, session: Session, flush_context) -> None:
+        rows = self._rows(session)
+        if not rows:
+            return
+        connection = session.connection()
+        stmt = insert(self.table)
+        if connection.dialect.insert_executemany_returning_sort_by_parameter_order:
+            ids = connection.execute(
+                stmt.returning(self.table.c.id, sort_by_parameter_order=True), rows
+            ).scalars()
+        else:
+            connection.execute(stmt, rows)
+            ids = [None] * len(rows)
+        events = [
+            OutboxEvent(
+                id,
+                row["table_name"],
+                row["op"],
+                json.loads(row["key"]),
+                json.loads(row["data"]),
+                json.loads(row["changed"]) if row["changed"] is not None else None,
+                row["created_at"],
+            )
+            for id, row in zip(ids, rows)
+        ]
+        transaction = session.get_transaction()
+        nested = session.get_nested_transaction()
+        pending = session.info.setdefault(_PENDING_KEY, [])
+        pending.append((nested or transaction, events))
+
+    def _after_soft_rollback(
+        self, session: Session, previous_transaction: SessionTransaction
+    ) -> None:
+        """Drop the events of the transaction rolled back and of its savepoints"""
+        pending = session.info.get(_PENDING_KEY)
+        if not pending:
+            return
+
+        def rolled_back(transaction: Optional[SessionTransaction]) -> bool:
+            while transaction is not None:
+                if transaction is previous_transaction:
+                    return True
+                transaction = transaction.parent
+            return False
+
+        session.info[_PENDING_KEY] = [p for p in pending if not rolled_back(p[0])]
+
+    def _after_commit(self, session: Session) -> None:
+        if session.in_nested_transaction():
+            return  ## a savepoint was released, wait for the transaction
+        pending = session.info.pop(_PENDING_KEY, None)
+        if not pending:
+            return
+        events = [e for __, batch in pending for e in batch]
+        with self._lock:
+            subscribers = list(self._subscribers)
+        for fn in subscribers:
+            try:
+                fn(events)
+            except Exception:
+                logging.exception(f"Outbox subscriber {fn} of {self.db} failed")
+
+
+class OutboxConsumer:
+    """Reads the outbox in id order from the last acknowledged position
+
+    ``poll`` returns the next batch after the events already returned, ``ack``
+    stores the position of the last event returned. A new consumer with the
+    same name continues from the stored position, so events returned but not
+    acknowledged are delivered again.
+    """
+
+    def __init__(
+        self,
+        outbox: Outbox,
+        name: str,
+        batch_size: int = 100,
+        gap_timeout: float = 5.0,
+    ):
+        """
+        Args:
+            outbox (Outbox): the outbox
+            name (str): the consumer, its position is stored under this name
+            batch_size (int, optional): events per poll. Defaults to 100.
+            gap_timeout (float, optional): least seconds to wait for a missing
+                id to commit before skipping it, see the module docstring.
+                Defaults to 5.0.
+        """
+        if batch_size < 1:
+            raise ValueError(f"batch_size must be >= 1, got {batch_size}")
+        self.outbox = outbox
+        self.name = name
+        self.batch_size = batch_size
+        self.gap_timeout = gap_timeout
+        self.acked = self._stored_position()
+        self.position = self.acked  ## id of the last event returned
+        ## missing id to when it was first seen and the transactions open then
+        self._gaps: Dict[int, Tuple[float, Optional[Set[Any]]]] = {}
+
+    def _stored_position(self) -> int:
+        """The acknowledged position, registering the consumer at 0 when new so
+        that purge keeps the events it hasn't read"""
+        consumers = self.outbox.consumers
+        with self.outbox.db.engine.begin() as connection:
+            position = connection.execute(
+                select(consumers.c.position).where(consumers.c.name == self.name)
+            ).scalar()
+            if position is None:
+                position = 0
+                connection.execute(
+                    insert(consumers).values(
+                        name=self.name, position=position, updated_at=_now()
+                    )
+                )
+        return position
+
+    def poll(self, limit: Optional[int] = None) -> List[OutboxEvent]:
+        """The next events after the ones already returned, at most limit
+        (batch_size by default). Stops at a missing id that may still commit"""
+        table = self.outbox.table
+        with self.outbox.db.engine.connect() as connection:
+            rows = connection.execute(
+                select(table)
+                .where(table.c.id > self.position)
+                .order_by(table.c.id)
+                .limit(limit or self.batch_size)
+            ).all()
+        events = []
+        expected = self.position + 1
+        now = time.monotonic()
+        open_now: Optional[Set[Any]] = None
+        for row in rows:
+            if row.id != expected:
+                if expected not in self._gaps:
+                    self._gaps[expected] = (now, self._open_transactions())
+                first_seen, in_flight = self._gaps[expected]
+                if now - first_seen < self.gap_timeout:
+                    break
+                if in_flight is not None:
+                    open_now = self._open_transactions()
+                    if open_now is not None and in_flight & open_now:
+                        break  ## the transaction holding the id may still commit
+                self._skip(
+                    expected, row.id - 1, in_flight is not None and open_now is not None
+                )
+            events.append(_event(row))
+            expected = row.id + 1
+        if events:
+            self.position = events[-1].id
+            self._gaps = {i: g for i, g in self._gaps.items() if i > self.position}
+        return events
+
+    def _open_transactions(self) -> Optional[Set[Any]]:
+        with self.outbox.db.engine.connect() as connection:
+            return self.outbox.db._open_transaction_ids(connection)
+
+    def _skip(self, first: int, last: int, verified: bool) -> None:
+        db = self.outbox.db
+        message = f"Outbox consumer '{self.name}' skipping ids {first}..{last}"
+        if verified:
+            logging.info(f"{message}, rolled back")
+        else:
+            logging.warning(
+                f"{message} after {self.gap_timeout}s, {db} can't tell whether "
+                "they are still to commit"
+            )
+        db_registry(db).counter(
+            "sqlgold_outbox_skipped_ids_total",
+            "Missing outbox ids skipped by consumers",
+            db=db_label(db),
+            consumer=self.name,
+        ).inc(last - first + 1)
+
+    def ack(self, position: Optional[int] = None) -> None:
+        """Store the position, the last event returned by default. The events
+        up to it aren't delivered to this consumer name again"""
+        position = self.position if position is None else position
+        if position <= self.acked:
+            return
+        consumers = self.outbox.consumers
+        with self.outbox.db.engine.begin() as connection:
+            connection.execute(
+                update(consumers)
+                .where(consumers.c.name == self.name)
+                .values(position=position, updated_at=_now())
+            )
+        self.acked = position
+
+    def rewind(self) -> None:
+        """Deliver the events after the acknowledged position again"""
+        self.position = self.acked
+        self._gaps.clear()
+
+    def batches(
+        self,
+        poll_interval: float = 1.0,
+        stop: Optional[threading.Event] = None,
+    ) -> Iterator[List[OutboxEvent]]:
+        """Yield batches as they arrive until stop is set, waiting poll_interval
+        seconds when the outbox has nothing new. Acknowledge with ack"""
+        stop = stop or threading.Event()
+        while not stop.is_set():
+            batch = self.poll()
+            if batch:
+                yield batch
+            else:
+                stop.wait(poll_interval)
@@ -0,0 +1,340 @@
+"""Partitioned table scans processed by a pool of worker processes
+
+The key range of a query is split into partitions, from the min/max of the key
+for numeric keys or from quantiles otherwise. Rows with a NULL key are read
+with the first partition. Each partition is read in
+a worker process with its own engine, rebuilt from the pickled configuration of
+the DB, and ``func`` is applied to each streamed batch of rows. Results are
+either folded with ``reduce`` or yielded batch by batch as partitions finish.
+
+Example:
+    def total(batch):
+        return sum(order.amount for order in batch)
+
+    revenue = db.parallel_map(Order, total, workers=8, reduce=operator.add, initial=0)
+"""
+
+import logging
+import multiprocessing
+import os
+import pickle
+from concurrent.futures import FIRST_COMPLETED, Future, ProcessPoolExecutor, wait
+from concurrent.futures.process import BrokenProcessPool
+from dataclasses import dataclass
+from numbers import Number
+from typing import TYPE_CHECKING, Any, Callable, Dict, Iterator, List, Optional, Union
+
+from sqlalchemy import Select, func, inspect, or_, select
+from sqlalchemy.sql import ColumnElement
+
+if TYPE_CHECKING:
+    from sqlgold.engine.db import DB
+
+STRATEGIES = ("auto", "minmax", "quantile")
+
+## State of a worker process, set once by _init_worker
+_worker: Dict[str, Any] = {}
+
+
+@dataclass
+class Partition:
+    """Rows with lower <= key < upper, None is unbounded. The first
+    partition also has the rows with a NULL key"""
+
+    index: int
+    lower: Any = None
+    upper: Any = None
+
+
+def _as_statement(source: Any) -> Select:
+    if isinstance(source, Select):
+        return source
+    return select(source)
+
+
+def _resolve_key(stmt: Select, partition_by: Union[None, str, ColumnElement]):
+    """The column to partition on, defaults to the primary key of the entity"""
+    if partition_by is not None and not isinstance(partition_by, str):
+        return partition_by
+    entity = stmt.column_descriptions[0].get("entity")
+    if partition_by is None:
+        if entity is None:
+            raise ValueError(
+                "partition_by is required for statements without an entity"
+            )
+        pk = inspect(entity).primary_key
+        if len(pk) != 1:
+            raise ValueError(
+                f"{entity.__name__} has a composite primary key, set partition_by"
+            )
+        return getattr(entity, inspect(entity).get_property_by_column(pk[0]).key)
+    if entity is not None and hasattr(entity, partition_by):
+        return getattr(entity, partition_by)
+    return stmt.selected_columns[partition_by]
+
+
+def _key_name(key) -> str:
+    name = getattr(key, "key", None)
+    if name is None:
+        raise ValueError(f"Can't send the partition key {key} to worker processes")
+    return name
+
+
+def _bounds(db: "DB", stmt: Select, key, n: int, strategy: str) -> List[Any]:
+    """n - 1 increasing boundaries splitting the key range"""
+    base = stmt.order_by(None).limit(None).offset(None)
+    with db.Session() as session:
+        if strategy in ("auto", "minmax"):
+            lo, hi = session.execute(
+                base.with_only_columns(func.min(key), func.max(key))
+            ).one()
+            if lo is None:
+                return []
+            if isinstance(lo, Number) and isinstance(hi, Number):
+                step = (hi - lo) / n
+                bounds = [lo + step * i for i in range(1, n)]
+                if isinstance(lo, int):
+                    bounds = [int(b) for b in bounds]
+                return sorted(set(b for b in bounds if lo < b <= hi))
+            if strategy == "minmax":
+                raise ValueError(f"minmax partitioning needs a numeric key, got {lo!r}")
+        ## quantiles: the key at every count / n rows. The server numbers the
+        ## rows in key order and only returns the n - 1 boundaries
+        base = base.where(key.is_not(None))
+        count = session.scalar(select(func.count()).select_from(base.subquery()))
+        positions = sorted(set(i * count // n + 1 for i in range(1, n)))
+        ranked = base.with_only_columns(
+            key.label("key"), func.row_number().over(order_by=key).label("position")
+        ).subquery()
+        keys = session.scalars(
+            select(ranked.c.key)
+            .where(ranked.c.position.in_(positions))
+            .order_by(ranked.c.position)
+        )
+        bounds = []
+        for bound in keys:
+            if not bounds or bound > bounds[-1]:
+                bounds.append(bound)
+        return bounds
+
+
+def make_partitions(
+    db: "DB",
+    source: Any,
+    partitions: int,
+    partition_by: Union[None, str, ColumnElement] = None,
+    strategy: str = "auto",
+) -> List[Partition]:
+    """Split the key range of a query into at most ``partitions`` ranges
+
+    Args:
+        db (DB): the db to query the key range from
+        source (Any): a mapped class or a select statement
+        partitions (int): number of partitions wanted
+        partition_by (Union[None, str, ColumnElement], optional): the key.
+            Defaults to the primary key.
+        strategy (str, optional): "minmax" splits min..max evenly, "quantile"
+            takes the key every count / partitions rows and "auto" uses minmax
+            for numeric keys. Quantiles number the rows with a ROW_NUMBER()
+            window on the server (sqlite 3.25+, MySQL 8), which scans the key
+            but only returns the boundaries. Defaults to "auto".
+
+    Returns:
+        List[Partition]: partitions covering every key
+    """
+    if strategy not in STRATEGIES:
+        raise ValueError(f"strategy must be one of {STRATEGIES}, got '{strategy}'")
+    stmt = _as_statement(source)
+    key = _resolve_key(stmt, partition_by)
+    bounds = _bounds(db, stmt, key, max(1, partitions), strategy)
+    edges = [None, *bounds, None]
+    return [Partition(i, edges[i], edges[i + 1]) for i in range(len(edges) - 1)]
+
+
+def _init_worker(
+    db_state: bytes, source, partition_by, func, reduce, initial, batch_size
+):
+    db = pickle.loads(db_state)
+    stmt = _as_statement(source)
+    _worker.update(
+        db=db,
+        stmt=stmt,
+        key=_resolve_key(stmt, partition_by),
+        func=func,
+        reduce=reduce,
+        initial=initial,
+        batch_size=batch_size,
+    )
+
+
+def _run_partition(partition: Partition):
+    """Apply func to the batches of one partition.
+    Returns (results, rows), results is the folded value when reducing"""
+    w = _worker
+    stmt, key = w["stmt"], w["key"]
+    if partition.lower is None:
+        if partition.upper is not None:
+            ## the first partition, with the NULL keys
+            stmt = stmt.where(or_(key < partition.upper, key.is_(None)))
+    else:
+        stmt = stmt.where(key >= partition.lower)
+        if partition.upper is not None:
+            stmt = stmt.where(key < partition.upper)
+    stmt = stmt.execution_options(yield_per=w["batch_size"])
+
+    reduce = w["reduce"]
+    results = w["initial"] if reduce is not None else []
+    rows = 0
+    with w["db"].Session() as session:
+        result = session.execute(stmt)
+        if len(stmt.column_descriptions) == 1:
+            result = result.scalars()
+        for batch in result.partitions():
+            rows += len(batch)
+            value = w["func"](batch)
+            if reduce is not None:
+                results = reduce(results, value)
+            else:
+                results.append(value)
+        session.rollback()
+    return results, rows
+
+
+class ParallelMap:
+    """Runs func over the partitions of a query in a process pool"""
+
+    def __init__(
+        self,
+        db: "DB",
+        source: Any,
+        func: Callable[[list], Any],
+        workers: Optional[int] = None,
+        partition_by: Union[None, str, ColumnElement] = None,
+        partitions: Optional[int] = None,
+        strategy: str = "auto",
+        batch_size: int = 1000,
+        reduce: Optional[Callable[[Any, Any], Any]] = None,
+        initial: Any = None,
+        progress: Optional[Callable[[int, int, int], None]] = None,
+        retries: int = 2,
+        mp_context: Optional[str] = None,
+    ):
+        self.db = db
+        self.source = source
+        self.func = func
+        self.workers = workers or os.cpu_count() or 1
+        self.partition_by = partition_by
+        self.num_partitions = partitions or self.workers * 4
+        self.strategy = strategy
+        self.batch_size = batch_size
+        self.reduce = reduce
+        self.initial = initial
+        self.progress = progress
+        self.retries = retries
+        if mp_context is None:
+            methods = multiprocessing.get_all_start_methods()
+            mp_context = "fork" if "fork" in methods else "spawn"
+        self.mp_context = mp_context
+        self.rows = 0
+
+    def _worker_args(self) -> tuple:
+        source, partition_by = self.source, self.partition_by
+        if self.mp_context != "fork":
+            ## sent to the workers by pickle, statements and columns can't be
+            if isinstance(source, Select):
+                raise ValueError(
+                    "Select statements can only be sent to workers started with "
+                    "fork, pass a mapped class or use mp_context='fork'"
+                )
+            if partition_by is not None and not isinstance(partition_by, str):
+                partition_by = _key_name(partition_by)
+        return (
+            pickle.dumps(self.db),
+            source,
+            partition_by,
+            self.func,
+            self.reduce,
+            self.initial,
+            self.batch_size,
+        )
+
+    def results(self) -> Iterator[Any]:
+        """Iterate over the results of each partition as partitions finish.
+        The partitions are computed before the iterator is returned"""
+        initargs = self._worker_args()
+        partitions = make_partitions(
+            self.db, self.source, self.num_partitions, self.partition_by, self.strategy
+        )
+        return self._results(partitions, initargs)
+
+    def _executor(self, partitions: int, initargs: tuple) -> ProcessPoolExecutor:
+        return ProcessPoolExecutor(
+            max_workers=min(self.workers, partitions),
+            mp_context=multiprocessing.get_context(self.mp_context),
+            initializer=_init_worker,
+            initargs=initargs,
+        )
+
+    def _results(self, partitions: List[Partition], initargs: tuple) -> Iterator[Any]:
+        attempts = {p.index: 0 for p in partitions}
+        done = 0
+        todo = list(partitions)
+        pending: Dict[Future, Partition] = {}
+        executor = None
+        try:
+            while todo or pending:
+                if todo:
+                    if executor is None:
+                        executor = self._executor(len(todo) + len(pending), initargs)
+                    for partition in todo:
+                        pending[executor.submit(_run_partition, partition)] = partition
+                    todo = []
+                finished, __ = wait(pending, return_when=FIRST_COMPLETED)
+                broken = False
+                for future in finished:
+                    partition = pending.pop(future)
+                    try:
+                        results, rows = future.result()
+                    except Exception as e:
+                        broken = broken or isinstance(e, BrokenProcessPool)
+                        attempts[partition.index] += 1
+                        if attempts[partition.index] > self.retries:
+                            e.add_note(
+                                f"Partition {partition.index} "
+                                f"[{partition.lower}, {partition.upper}) failed "
+                                f"{attempts[partition.index]} times"
+                            )
+                            raise
+                        logging.warning(
+                            f"Retrying partition {partition.index} of {self.db}: {e}"
+                        )
+                        todo.append(partition)
+                        continue
+                    done += 1
+                    self.rows += rows
+                    if self.progress is not None:
+                        self.progress(done, len(partitions), self.rows)
+                    yield results
+                if broken:
+                    ## a worker died and took the pool down, the partitions
+                    ## still pending run again in a new pool
+                    logging.warning(f"A worker of {self.db} died, restarting the pool")
+                    todo.extend(pending.values())
+                    pending = {}
+                    executor.shutdown(wait=False)
+                    executor = None
+        finally:
+            for future in pending:
+                future.cancel()
+            if executor is not None:
+                executor.shutdown()
+
+    def run(self) -> Any:
+        """The folded result when reducing, otherwise an iterator over the
+        results of every batch in the order partitions finish"""
+        if self.reduce is None:
+            return (value for results in self.results() for value in results)
+        total = self.initial
+        for result in self.results():
+            total = self.reduce(total, result)
+        return total
@@ -0,0 +1,280 @@
+"""Per-transaction profiling of the work done by DB sessions
+
+The profiler listens to the session and engine events of a DB and produces a
+TransactionProfile for every sampled root transaction: flush count and time,
+autoflushes, objects inserted/updated/deleted, statements and rows, and how
+long the connection was held. With a sample rate below 1 only that fraction
+of transactions pays for the bookkeeping so it can run in production.
+
+Flushes that happen while an ORM statement executes are counted as
+autoflushes, Core statements executed through the session (``text()``) are
+not ORM executions and their autoflushes count as plain flushes. Statements
+are attributed to a transaction through the Connection it checked out, which
+is discarded when the connection returns to the pool.
+
+Example:
+    profiler = db.enable_profiler(sample_rate=0.05)
+    ...
+    print(profiler.summary())
+"""
+
+import random
+import threading
+import time
+import weakref
+from collections import deque
+from dataclasses import dataclass, field, fields
+from typing import TYPE_CHECKING, Any, Callable, Deque, Dict, List, Optional
+
+from sqlalchemy import Connection
+from sqlalchemy.orm import ORMExecuteState
+
+from sqlgold.engine.extension import DBExtension
+from sqlgold.metrics import Histogram
+
+if TYPE_CHECKING:
+    from sqlgold.engine.db import DB
+
+_PROFILE_KEY = "sqlgold_profile"
+_STMT_START = "sqlgold_profile_stmt_start"
+
+
+@dataclass
+class TransactionProfile:
+    """The work done within one root session transaction. Times are seconds"""
+
+    db: str
+    started_at: float  ## wall clock time the transaction started
+    outcome: str = "none"  ## commit, rollback or none (closed without using the db)
+    duration: float = 0.0
+    connection_held: float = 0.0
+    flushes: int = 0
+    autoflushes: int = 0
+    flush_time: float = 0.0
+    inserted: int = 0
+    updated: int = 0
+    deleted: int = 0
+    statements: int = 0
+    rows: int = 0  ## rows affected as reported by the driver
+    statement_time: float = 0.0
+    _start: float = field(default=0.0, repr=False)
+    _connected_at: Optional[float] = field(default=None, repr=False)
+    _flush_start: Optional[float] = field(default=None, repr=False)
+    _executing: int = field(default=0, repr=False)  ## ORM statements executing
+    _connections: List[Connection] = field(default_factory=list, repr=False)
+
+    def to_dict(self) -> Dict[str, Any]:
+        return {
+            f.name: getattr(self, f.name)
+            for f in fields(self)
+            if not f.name.startswith("_")
+        }
+
+
+_SUMMED = (
+    "flushes",
+    "autoflushes",
+    "inserted",
+    "updated",
+    "deleted",
+    "statements",
+    "rows",
+)
+_TIMED = ("duration", "connection_held", "flush_time", "statement_time")
+
+
+class SessionProfiler(DBExtension):
+    """Collects TransactionProfiles for the sessions of a DB"""
+
+    def __init__(
+        self,
+        db: "DB",
+        sample_rate: float = 1.0,
+        max_records: int = 1000,
+        on_record: Optional[Callable[[TransactionProfile], None]] = None,
+    ):
+        """
+        Args:
+            db (DB): the db to profile
+            sample_rate (float, optional): fraction of transactions to profile.
+                Defaults to 1.0.
+            max_records (int, optional): number of recent profiles kept in
+                ``records``. Defaults to 1000.
+            on_record (Optional[Callable], optional): called with every finished
+                TransactionProfile. Defaults to None.
+        """
+        if not 0 <= sample_rate <= 1:
+            raise ValueError(f"sample_rate must be in [0, 1], got {sample_rate}")
+        self.db = db
+        self.sample_rate = sample_rate
+        self.on_record = on_record
+        self.records: Deque[TransactionProfile] = deque(maxlen=max_records)
+        self._random = random.Random()
+        self._lock = threading.Lock()
+        self._totals: Dict[str, int] = {}
+        self._outcomes: Dict[str, int] = {}
+        self._histograms: Dict[str, Histogram] = {}
+        ## the profile of the transaction a checked out Connection belongs to
+        self._profiles: "weakref.WeakKeyDictionary[Connection, TransactionProfile]" = (
+            weakref.WeakKeyDictionary()
+        )
+        self.reset()
+        self._listeners = [
+            (db.Session, "after_transaction_create", self._after_transaction_create),
+            (db.Session, "after_begin", self._after_begin),
+            (db.Session, "do_orm_execute", self._do_orm_execute),
+            (db.Session, "before_flush", self._before_flush),
+            (db.Session, "after_flush", self._after_flush),
+            (db.Session, "after_flush_postexec", self._after_flush_postexec),
+            (db.Session, "after_commit", self._after_commit),
+            (db.Session, "after_rollback", self._after_rollback),
+            (db.Session, "after_transaction_end", self._after_transaction_end),
+            (db.engine, "before_cursor_execute", self._before_cursor_execute),
+            (db.engine, "after_cursor_execute", self._after_cursor_execute),
+        ]
+
+    def reset(self) -> None:
+        """Forget every record and aggregate"""
+        with self._lock:
+            self.records.clear()
+            self._totals = {k: 0 for k in _SUMMED}
+            self._outcomes = {}
+            self._histograms = {k: Histogram(k) for k in _TIMED}
+            self._num_transactions = 0
+
+    def summary(self) -> Dict[str, Any]:
+        """Aggregated totals over every sampled transaction since the last reset
+
+        Returns:
+            Dict[str, Any]: counts, totals, per transaction means, and
+                p50/p95/p99/max of the timings
+        """
+        with self._lock:
+            n = self._num_transactions
+            totals = dict(self._totals)
+            outcomes = dict(self._outcomes)
+        return {
+            "db": self._label,
+            "sample_rate": self.sample_rate,
+            "transactions": n,
+            "outcomes": outcomes,
+            "totals": totals,
+            "mean": {k: (v / n if n else 0.0) for k, v in totals.items()},
+            "timings": {k: h.snapshot() for k, h in self._histograms.items()},
+        }
+
+    def _record(self, profile: TransactionProfile) -> None:
+        with self._lock:
+            self._num_transactions += 1
+            for k in _SUMMED:
+                self._totals[k] += getattr(profile, k)
+            outcome = profile.outcome
+            self._outcomes[outcome] = self._outcomes.get(outcome, 0) + 1
+            self.records.append(profile)
+        for k in _TIMED:
+            self._histograms[k].observe(getattr(profile, k))
+        if self.on_record is not None:
+            self.on_record(profile)
+
+    ## Session events
+    def _after_transaction_create(self, session, transaction):
+        if transaction.parent is not None:
+            return
+        if self.sample_rate < 1 and self._random.random() >= self.sample_rate:
+            return
+        session.info[_PROFILE_KEY] = TransactionProfile(
+            db=self._label, started_at=time.time(), _start=time.perf_counter()
+        )
+
+    def _after_begin(self, session, transaction, connection):
+        profile = session.info.get(_PROFILE_KEY)
+        if profile is None:
+            return
+        if profile._connected_at is None:
+            profile._connected_at = time.perf_counter()
+        ## not the DBAPI connection's info, it outlives the checkout and another
+        ## thread may check it out before this transaction has ended
+        with self._lock:
+            self._profiles[connection] = profile
+        profile._connections.append(connection)
+
+    def _do_orm_execute(self, state: ORMExecuteState):
+        profile = state.session.info.get(_PROFILE_KEY)
+        if profile is None:
+            return None
+        ## the statement autoflushes before it executes
+        profile._executing += 1
+        try:
+            return state.invoke_statement()
+        finally:
+            profile._executing -= 1
+
+    def _before_flush(self, session, flush_context, instances):
+        profile = session.info.get(_PROFILE_KEY)
+        if profile is None:
+            return
+        profile.flushes += 1
+        if profile._executing:
+            profile.autoflushes += 1
+        profile._flush_start = time.perf_counter()
+
+    def _after_flush(self, session, flush_context):
+        profile = session.info.get(_PROFILE_KEY)
+        if profile is None:
+            return
+        profile.inserted += len(session.new)
+        profile.updated += sum(1 for o in session.dirty if session.is_modified(o))
+        profile.deleted += len(session.deleted)
+
+    def _after_flush_postexec(self, session, flush_context):
+        profile = session.info.get(_PROFILE_KEY)
+        if profile is None or profile._flush_start is None:
+            return
+        profile.flush_time += time.perf_counter() - profile._flush_start
+        profile._flush_start = None
+
+    def _after_commit(self, session):
+        profile = session.info.get(_PROFILE_KEY)
+        if profile is not None:
+            profile.outcome = "commit"
+
+    def _after_rollback(self, session):
+        profile = session.info.get(_PROFILE_KEY)
+        if profile is not None:
+            profile.outcome = "rollback"
+
+    def _after_transaction_end(self, session, transaction):
+        if transaction.parent is not None:
+            return
+        profile = session.info.pop(_PROFILE_KEY, None)
+        if profile is None:
+            return
+        now = time.perf_counter()
+        profile.duration = now - profile._start
+        if profile._connected_at is not None:
+            profile.connection_held = now - profile._connected_at
+        with self._lock:
+            for connection in profile._connections:
+                if self._profiles.get(connection) is profile:
+                    del self._profiles[connection]
+        profile._connections = []
+        self._record(profile)
+
+    ## Engine events
+    def _before_cursor_execute(
+        self, conn, cursor, statement, parameters, context, executemany
+    ):
+        if conn in self._profiles:
+            conn.info.setdefault(_STMT_START, []).append(time.perf_counter())
+
+    def _after_cursor_execute(
+        self, conn, cursor, statement, parameters, context, executemany
+    ):
+        profile = self._profiles.get(conn)
+        starts = conn.info.get(_STMT_START)
+        if profile is None or not starts:
+            return
+        profile.statement_time += time.perf_counter() - starts.pop()
+        profile.statements += 1
+        if cursor.rowcount > 0:
+            profile.rows += cursor.rowcount
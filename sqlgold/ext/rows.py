@@ -0,0 +1,154 @@
+"""Read-only queries returning lightweight rows
+
+``db.read`` runs a select on a Core connection: no Session, no autoflush, no
+identity map and no change tracking. A select of a single mapped class is
+rewritten to select the class's columns, and every row becomes an instance of
+a ``__slots__`` dataclass generated from those columns, which takes a fraction
+of the memory of an ORM instance and is created with a plain positional call.
+Rows can also be returned as tuples, dicts or instances of your own dataclass.
+
+Pending changes of open sessions are not flushed first, read sees what is
+committed (or what the connection's transaction sees).
+
+Example:
+    users = db.read(select(User).where(User.active))  ## [UserRow(id=1, ...)]
+    names = db.read(select(User.id, User.name), as_=dict)
+"""
+
+import dataclasses
+import threading
+from operator import itemgetter
+from typing import TYPE_CHECKING, Any, Callable, Dict, List, Optional, Union
+
+from sqlalchemy import Select, inspect, select
+from sqlalchemy.sql import TextClause
+
+if TYPE_CHECKING:
+    from sqlgold.engine.db import DB
+
+_row_classes: Dict[type, type] = {}
+_row_classes_lock = threading.Lock()
+
+
+def _python_type(column_property) -> Any:
+    try:
+        return column_property.columns[0].type.python_type
+    except (NotImplementedError, AttributeError):
+        return Any
+
+
+def row_class(cls: type) -> type:
+    """The ``__slots__`` dataclass with a field per column attribute of a
+    mapped class, in mapper order. Generated once per class
+
+    Args:
+        cls (type): a mapped class
+
+    Returns:
+        type: a dataclass named ``<cls>Row``
+    """
+    row_cls = _row_classes.get(cls)
+    if row_cls is not None:
+        return row_cls
+    with _row_classes_lock:
+        row_cls = _row_classes.get(cls)
+        if row_cls is None:
+            mapper = inspect(cls)
+            fields = [(p.key, _python_type(p)) for p in mapper.column_attrs]
+            row_cls = dataclasses.make_dataclass(
+                f"{cls.__name__}Row", fields, slots=True, eq=True
+            )
+            row_cls.__module__ = cls.__module__
+            _row_classes[cls] = row_cls
+    return row_cls
+
+
+def _single_entity(stmt: Select) -> Any:
+    """The mapped class or alias if stmt selects exactly one entity. Raises
+    if an entity is selected together with other things"""
+    descriptions = stmt.column_descriptions
+    entities = []
+    for d in descriptions:
+        insp = inspect(d["expr"], raiseerr=False)
+        if getattr(insp, "is_mapper", False) or getattr(
+            insp, "is_aliased_class", False
+        ):
+            entities.append(d["expr"])
+    if not entities:
+        return None
+    if len(descriptions) > 1:
+        raise ValueError(
+            "read() can only turn a select of a single entity into rows, "
+            "select columns when combining several"
+        )
+    return entities[0]
+
+
+def _converter(as_: Any, keys: List[str]) -> Callable[[Any], Any]:
+    """A function making one output row from a Row"""
+    if as_ is tuple:
+        return tuple
+    if as_ is dict:
+        return lambda row: dict(zip(keys, row))
+    if dataclasses.is_dataclass(as_):
+        names = [f.name for f in dataclasses.fields(as_) if f.init]
+        missing = [name for name in names if name not in keys]
+        if missing:
+            raise ValueError(f"{as_.__name__} fields {missing} are not selected")
+        if names == keys:
+            return lambda row: as_(*row)
+        if len(names) == 1:
+            index = keys.index(names[0])
+            return lambda row: as_(row[index])
+        getter = itemgetter(*(keys.index(name) for name in names))
+        return lambda row: as_(*getter(row))
+    if callable(as_):
+        return lambda row: as_(**dict(zip(keys, row)))
+    raise TypeError(f"as_ must be tuple, dict or a class, got {as_!r}")
+
+
+def read(
+    db: "DB",
+    stmt: Union[Select, TextClause, type],
+    as_: Any = None,
+    params: Optional[Dict[str, Any]] = None,
+) -> List[Any]:
+    """Run a read-only select on a Core connection and return light rows
+
+    Args:
+        db (DB): the db to query
+        stmt (Union[Select, TextClause, type]): a select, a text() query or
+            a mapped class to read all of
+        as_ (Any, optional): tuple, dict, a dataclass (fields are matched to
+            the selected columns by name) or any class taking the columns as
+            keyword arguments. Defaults to the generated row class for a
+            select of a single entity and tuple otherwise.
+        params (Optional[Dict[str, Any]], optional): bound parameters.
+            Defaults to None.
+
+    Returns:
+        List[Any]: the rows
+    """
+    if isinstance(stmt, type):
+        stmt = select(stmt)
+    if not isinstance(stmt, (Select, TextClause)):
+        raise TypeError(f"read() takes a select or text() query, got {type(stmt)}")
+
+    entity = _single_entity(stmt) if isinstance(stmt, Select) else None
+    if entity is not None:
+        mapper = inspect(entity).mapper
+        keys = [p.key for p in mapper.column_attrs]
+        stmt = stmt.with_only_columns(
+            *(getattr(entity, key) for key in keys), maintain_column_froms=True
+        )
+        if as_ is None:
+            as_ = row_class(mapper.class_)
+    elif as_ is None:
+        as_ = tuple
+
+    with db.engine.connect() as connection:
+        result = connection.execute(stmt, params)
+        if entity is None:
+            keys = list(result.keys())
+        convert = _converter(as_, keys)
+        return [convert(row) for row in result]
@@ -0,0 +1,259 @@
+"""In-memory sqlite dbs checkpointed to a file
+
+The working database lives in memory, on a single connection which the
+sessions of the db take turns on through a pool of one. At startup the file,
+if it exists, is loaded with sqlite's online backup API. A background thread
+then copies the database back to the file every ``interval`` seconds, and once
+more when the checkpointer is closed or the process exits.
+
+Checkpoints are incremental. The live database is first copied into an
+in-memory snapshot, ``pages`` pages per backup step, handing the connection
+back to the sessions between steps so writers wait for one step at most.
+sqlite restarts that copy when the database is written to mid-copy, so after
+a restart it is finished without letting go of the connection, at memory
+speed. The snapshot is then written to the file ``pages`` at a time
+without holding anyone up. The file is updated in a journaled transaction,
+so a crash during a checkpoint leaves the previous checkpoint intact.
+
+Example:
+    db = Sqlite3DB.create_memory_db("cache.sqlite", Base=Base, create_all=True)
+    ...
+    db.checkpointer.stats()  ## {"checkpoints": 12, "last_seconds": 0.03, ...}
+"""
+
+import atexit
+import logging
+import os
+import sqlite3
+import threading
+import time
+from contextlib import closing
+from typing import TYPE_CHECKING, Any, Dict, Optional, Set
+
+from sqlalchemy import Engine
+from sqlalchemy.pool import QueuePool
+
+from sqlgold.engine.extension import DBExtension
+
+if TYPE_CHECKING:
+    from sqlgold.dialects.sqlite3 import Sqlite3DB
+
+_open_checkpointers: Set["MemoryCheckpointer"] = set()
+_open_checkpointers_lock = threading.Lock()
+
+
+class CheckpointPool(QueuePool):
+    """A QueuePool the checkpointer can jump. QueuePool isn't fair, a thread
+    returning the connection usually takes it again before a waiting thread
+    wakes up, so a busy session would starve the checkpointer"""
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self._gate = threading.Condition()
+        self._priority: Optional[int] = None  ## thread let through the gate
+        self._gate_waiting = 0
+
+    def _do_get(self):
+        me = threading.get_ident()
+        with self._gate:
+            self._gate_waiting += 1
+            try:
+                while self._priority is not None and self._priority != me:
+                    self._gate.wait()
+            finally:
+                self._gate_waiting -= 1
+                self._gate.notify_all()
+        return super()._do_get()
+
+    def prioritize(self) -> None:
+        """Hold new checkouts by other threads until yield_priority()"""
+        with self._gate:
+            self._priority = threading.get_ident()
+
+    def yield_priority(self, timeout: float = 0) -> None:
+        """Let the threads waiting at the gate through, waiting up to timeout
+        seconds for them to pass"""
+        with self._gate:
+            self._priority = None
+            self._gate.notify_all()
+            if timeout:
+                self._gate.wait_for(lambda: self._gate_waiting == 0, timeout)
+
+
+def load_file(engine: Engine, path: str) -> None:
+    """Copy a database file into the engine's in-memory database"""
+    with closing(sqlite3.connect(path)) as source:
+        connection = engine.raw_connection()
+        try:
+            source.backup(connection.driver_connection)
+        finally:
+            connection.close()
+
+
+class MemoryCheckpointer(DBExtension):
+    """Periodically copies the in-memory database of a db to a file"""
+
+    def __init__(
+        self,
+        db: "Sqlite3DB",
+        path: str,
+        interval: Optional[float] = 60.0,
+        pages: int = 1024,
+    ):
+        """
+        Args:
+            db (Sqlite3DB): an in-memory db on a single connection pool
+            path (str): the file to checkpoint to
+            interval (Optional[float], optional): seconds between checkpoints,
+                None only checkpoints on close. Defaults to 60.0.
+            pages (int, optional): pages copied per backup step. Defaults to 1024.
+        """
+        if pages < 1:
+            raise ValueError(f"pages must be >= 1, got {pages}")
+        self.db = db
+        self.path = os.path.abspath(path)
+        self.interval = interval
+        self.pages = pages
+        self.checkpoints = 0
+        self.last_seconds: Optional[float] = None
+        self.last_snapshot_seconds: Optional[float] = None
+        self.last_checkpoint_at: Optional[float] = None
+        self._last_changes: Optional[int] = None
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._closed = False
+        self._thread: Optional[threading.Thread] = None
+        if interval is not None:
+            self._thread = threading.Thread(
+                target=self._run, name="sqlgold-checkpoint", daemon=True
+            )
+            self._thread.start()
+        with _open_checkpointers_lock:
+            _open_checkpointers.add(self)
+
+    @property
+    def _label(self) -> str:
+        return self.db.alias or self.path
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "path": self.path,
+            "checkpoints": self.checkpoints,
+            "last_seconds": self.last_seconds,
+            "last_snapshot_seconds": self.last_snapshot_seconds,
+            "last_checkpoint_at": self.last_checkpoint_at,
+        }
+
+    def checkpoint(self, force: bool = False) -> bool:
+        """Copy the database to the file now
+
+        Args:
+            force (bool, optional): checkpoint even if nothing changed since
+                the last one. Defaults to False.
+
+        Returns:
+            bool: whether a checkpoint was written
+        """
+        with self._lock:
+            start = time.perf_counter()
+            snapshot = sqlite3.connect(":memory:")
+            try:
+                changes = self._snapshot(snapshot, force)
+                if changes is None:
+                    return False
+                snapshot_seconds = time.perf_counter() - start
+                ## nothing else uses the snapshot, no step can be disturbed
+                with closing(sqlite3.connect(self.path)) as target:
+                    snapshot.backup(target, pages=self.pages)
+            finally:
+                snapshot.close()
+            seconds = time.perf_counter() - start
+
+            self._last_changes = changes
+            self.checkpoints += 1
+            self.last_seconds = seconds
+            self.last_snapshot_seconds = snapshot_seconds
+            self.last_checkpoint_at = time.time()
+        self._registry.histogram(
+            "sqlgold_sqlite_checkpoint_seconds",
+            "Duration of in-memory sqlite checkpoints",
+            db=self._label,
+        ).observe(seconds)
+        self._registry.histogram(
+            "sqlgold_sqlite_checkpoint_snapshot_seconds",
+            "Time in-memory sqlite checkpoints spent copying the live database",
+            db=self._label,
+        ).observe(snapshot_seconds)
+        logging.debug(f"Checkpointed {self.db} to '{self.path}' in {seconds:.3f}s")
+        return True
+
+    def _snapshot(self, snapshot: sqlite3.Connection, force: bool) -> Optional[int]:
+        """Copy the live database into snapshot, pages at a time, handing the
+        connection back to the sessions between steps. sqlite restarts the
+        copy of an in-memory database whenever it is written to, so after a
+        restart the copy is finished without letting go of the connection.
+        Returns the change count copied, None if nothing changed"""
+        engine = self.db.engine
+        pool = engine.pool
+        prioritized = isinstance(pool, CheckpointPool)
+
+        def take():
+            if prioritized:
+                pool.prioritize()
+            return engine.raw_connection()
+
+        held = [take()]
+        try:
+            source = held[0].driver_connection
+            if not force and source.total_changes == self._last_changes:
+                return None
+            state = {"remaining": None, "exclusive": False}
+
+            def between_steps(status, remaining, total):
+                if state["exclusive"] or remaining == 0:
+                    return
+                if state["remaining"] is not None and remaining >= state["remaining"]:
+                    state["exclusive"] = True  ## restarted by a write
+                    return
+                state["remaining"] = remaining
+                held[0].close()
+                if prioritized:
+                    pool.yield_priority(timeout=1.0)
+                held[0] = take()
+
+            source.backup(snapshot, pages=self.pages, progress=between_steps)
+            return source.total_changes
+        finally:
+            held[0].close()
+            if prioritized:
+                pool.yield_priority()
+
+    def _run(self) -> None:
+        while not self._stop.wait(self.interval):
+            try:
+                self.checkpoint()
+            except Exception:
+                logging.exception(f"Checkpoint of {self.db} to '{self.path}' failed")
+
+    def close(self, timeout: Optional[float] = None) -> None:
+        """Stop the timer and write a last checkpoint"""
+        if self._closed:
+            return
+        self._closed = True
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join(timeout)
+        with _open_checkpointers_lock:
+            _open_checkpointers.discard(self)
+        self.checkpoint()
+
+
+@atexit.register
+def _close_open_checkpointers():
+    with _open_checkpointers_lock:
+        checkpointers = list(_open_checkpointers)
+    for checkpointer in checkpointers:
+        try:
+            checkpointer.close(timeout=10)
+        except Exception:
+            logging.exception(f"Error checkpointing {checkpointer.db} at exit")
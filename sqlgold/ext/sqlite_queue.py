@@ -0,0 +1,453 @@
+"""A single writer with group commit for file backed sqlite dbs
+
+sqlite allows one writer at a time. Threads writing through their own
+connections collide on the database lock ("database is locked") and every
+small transaction pays for its own fsync. With the write queue enabled:
+
+- transactions begun explicitly (``db.Session.begin()``, ``session.begin()``)
+  run entirely on the one writer connection, so their reads are isolated from
+  the other writers and read-modify-write is safe
+- autobegun sessions read through a pool of read-only connections, which WAL
+  mode lets run concurrently with the writer. Their first write (a flush or
+  an INSERT/UPDATE/DELETE) queues for the writer and the rest of the
+  transaction runs on it. Reads before the first write aren't isolated, a
+  concurrent transaction can change the rows read before they're written
+- the writer stays in an open transaction and each session's transaction runs
+  in a SAVEPOINT within it. Committing releases the SAVEPOINT and hands the
+  writer to the next queued transaction. The real COMMIT is issued once for
+  the group when nobody is queued, ``max_batch`` transactions are pending or
+  the oldest has waited ``max_delay_ms``. Each session's commit() returns once
+  its group is durable and raises if the group's COMMIT failed; a transaction
+  that fails or rolls back only rolls back its own SAVEPOINT
+- when ``max_delay_ms`` runs out while a later transaction holds the writer,
+  a timer COMMITs the group under it and reopens its SAVEPOINTs, as long as
+  it hasn't written yet. A transaction that has written holds its group's
+  COMMIT until it ends, keep write transactions short
+
+The Session API doesn't change, db.Session() makes routing sessions.
+
+Example:
+    db.enable_write_queue(readers=8)
+    with db.Session.begin() as session:  ## from many threads
+        session.add(Event(...))
+"""
+
+import logging
+import os
+import re
+import threading
+import time
+from typing import TYPE_CHECKING, Any, Callable, Dict, List, Optional
+
+from sqlalchemy import Connection, Engine, create_engine, event
+from sqlalchemy.orm import SessionTransactionOrigin
+from sqlalchemy.sql import TextClause
+from sqlalchemy.sql.dml import UpdateBase
+
+from sqlgold.engine.extension import DBExtension
+
+if TYPE_CHECKING:
+    from sqlgold.dialects.sqlite3 import Sqlite3DB
+
+## session.info key set while the session's transaction holds the writer
+_WRITER_KEY = "sqlgold_sqlite_writer"
+_WRITE_SQL = re.compile(
+    r"^\s*(INSERT|UPDATE|DELETE|REPLACE|CREATE|DROP|ALTER)\b", re.IGNORECASE
+)
+_SAVEPOINT_SQL = re.compile(
+    r"^\s*(SAVEPOINT|RELEASE SAVEPOINT|ROLLBACK TO SAVEPOINT)\s+(\w+)", re.IGNORECASE
+)
+
+
+def _is_write(clause: Any) -> bool:
+    if isinstance(clause, UpdateBase):
+        return True
+    return isinstance(clause, TextClause) and bool(_WRITE_SQL.match(clause.text))
+
+
+class _Ticket:
+    """A committed transaction waiting for its group's COMMIT"""
+
+    def __init__(self):
+        self.done = threading.Event()
+        self.error: Optional[BaseException] = None
+
+
+class _QueuedSessionMixin:
+    """Explicitly begun transactions go to the writer connection. Otherwise
+    reads go to the read-only pool, writes and everything after them in the
+    transaction to the writer"""
+
+    _write_queue: "SqliteWriteQueue"
+
+    def __init__(self, *args, **kwargs):
+        ## the writer's transaction outlives each session's
+        kwargs.setdefault("join_transaction_mode", "create_savepoint")
+        super().__init__(*args, **kwargs)
+
+    def get_bind(self, mapper=None, clause=None, **kwargs):
+        if (
+            self.info.get(_WRITER_KEY)
+            or self._flushing
+            or _is_write(clause)
+            or self._begun_explicitly()
+        ):
+            return self._write_queue._writer_for(self)
+        return self._write_queue.reader_engine
+
+    def _begun_explicitly(self) -> bool:
+        transaction = self.get_transaction()
+        return (
+            transaction is not None
+            and transaction.origin is SessionTransactionOrigin.BEGIN
+        )
+
+
+class SqliteWriteQueue(DBExtension):
+    """Serializes the write transactions of a Sqlite3DB on one connection and
+    commits them in groups"""
+
+    def __init__(
+        self,
+        db: "Sqlite3DB",
+        readers: int = 4,
+        max_batch: int = 64,
+        max_delay_ms: float = 10,
+    ):
+        """
+        Args:
+            db (Sqlite3DB): a file backed sqlite db
+            readers (int, optional): size of the read-only connection pool.
+                Defaults to 4.
+            max_batch (int, optional): most transactions committed together.
+                Defaults to 64.
+            max_delay_ms (float, optional): longest a committed transaction
+                waits for more to join its group, unless the transaction
+                holding the writer has written. Defaults to 10.
+        """
+        path = db.database
+        if not path or path == ":memory:" or path.startswith("file:"):
+            raise ValueError(f"The write queue needs a file backed db, got {db.url}")
+        if max_batch < 1:
+            raise ValueError(f"max_batch must be >= 1, got {max_batch}")
+        self.db = db
+        self.max_batch = max_batch
+        self.max_delay_ms = max_delay_ms
+        path = os.path.abspath(path)
+
+        self.writer_engine = create_engine(
+            f"sqlite:///{path}", connect_args={"check_same_thread": False}
+        )
+        ## pysqlite's own transaction handling breaks SAVEPOINTs, take over
+        ## and take the write lock when the transaction starts
+        event.listen(self.writer_engine, "connect", self._on_connect)
+        event.listen(self.writer_engine, "begin", self._on_begin)
+        ## the timer COMMITs between the holder's statements
+        event.listen(self.writer_engine, "before_cursor_execute", self._before_execute)
+        event.listen(self.writer_engine, "after_cursor_execute", self._after_execute)
+        event.listen(self.writer_engine, "handle_error", self._on_error)
+        self._connection: Connection = self.writer_engine.connect()
+
+        self.reader_engine: Engine = create_engine(
+            f"sqlite:///file:{path}?mode=ro&uri=true",
+            pool_size=readers,
+            max_overflow=0,
+        )
+
+        self._cond = threading.Condition()
+        self._busy = False
+        self._holder: Optional[int] = None
+        self._waiting = 0
+        self._batch: List[_Ticket] = []
+        self._batch_started = 0.0
+        self._timer: Optional[threading.Timer] = None
+        self._committing = False
+        ## the holder's statements, whether it has written and its open
+        ## SAVEPOINTs, as sqlite sees them
+        self._exec_lock = threading.RLock()
+        self._executing = threading.local()
+        self._holder_wrote = False
+        self._savepoints: List[str] = []
+        self.commits = 0
+        self.transactions = 0
+        self._original_class: Optional[type] = None
+        self._listeners: List[tuple] = []
+
+    @staticmethod
+    def _on_connect(dbapi_connection, connection_record):
+        dbapi_connection.isolation_level = None
+        ## readers no longer block the writer or the other way around
+        dbapi_connection.execute("PRAGMA journal_mode=WAL")
+
+    @staticmethod
+    def _on_begin(connection):
+        connection.exec_driver_sql("BEGIN IMMEDIATE")
+
+    def _before_execute(self, conn, cursor, statement, parameters, context, many):
+        self._exec_lock.acquire()
+        self._executing.depth = getattr(self._executing, "depth", 0) + 1
+        if _WRITE_SQL.match(statement):
+            self._holder_wrote = True
+
+    def _after_execute(self, conn, cursor, statement, parameters, context, many):
+        match = _SAVEPOINT_SQL.match(statement)
+        if match:
+            command, name = match.group(1).upper(), match.group(2)
+            if command == "SAVEPOINT":
+                self._savepoints.append(name)
+            elif name in self._savepoints:
+                ## RELEASE ends the savepoint, ROLLBACK TO keeps it open
+                i = len(self._savepoints) - 1 - self._savepoints[::-1].index(name)
+                del self._savepoints[i if command.startswith("RELEASE") else i + 1 :]
+        self._end_execute()
+
+    def _on_error(self, exception_context):
+        self._end_execute()
+
+    def _end_execute(self) -> None:
+        depth = getattr(self._executing, "depth", 0)
+        if depth:
+            self._executing.depth = depth - 1
+            self._exec_lock.release()
+
+    def attach(self) -> None:
+        """Make db.Session create routing sessions"""
+        Session = self.db.Session
+        self._original_class = Session.class_
+        Session.class_ = type(
+            f"Queued{Session.class_.__name__}",
+            (_QueuedSessionMixin, Session.class_),
+            {"_write_queue": self},
+        )
+        self._listeners = [
+            (Session, "after_commit", self._after_commit),
+            (Session, "after_transaction_end", self._after_transaction_end),
+        ]
+        super().attach()
+
+    def detach(self) -> None:
+        """Restore db.Session and close the connections. Open transactions
+        are rolled back"""
+        super().detach()
+        with self._cond:
+            if self._timer is not None:
+                self._timer.cancel()
+                self._timer = None
+        if self._original_class is not None:
+            self.db.Session.class_ = self._original_class
+            self._original_class = None
+        self._connection.close()
+        self.writer_engine.dispose()
+        self.reader_engine.dispose()
+
+    def stats(self) -> Dict[str, Any]:
+        """Number of COMMITs and of transactions they committed"""
+        return {
+            "commits": self.commits,
+            "transactions": self.transactions,
+            "mean_batch": self.transactions / self.commits if self.commits else 0.0,
+            "waiting": self._waiting,
+        }
+
+    def run(self, func: Callable[..., Any], *args, **kwargs) -> Any:
+        """Run func(connection, *args, **kwargs) as a write transaction on the
+        writer connection, returns once its group is committed
+
+        Returns:
+            Any: what func returned
+        """
+        self._acquire()
+        try:
+            self._begin()
+            savepoint = self._connection.begin_nested()
+            try:
+                result = func(self._connection, *args, **kwargs)
+                savepoint.commit()
+            except BaseException:
+                savepoint.rollback()
+                raise
+        except BaseException:
+            self._release(commit=False)
+            raise
+        self._release(commit=True)
+        return result
+
+    ## The writer
+    def _writer_for(self, session) -> Connection:
+        if not session.info.get(_WRITER_KEY):
+            self._acquire()
+            try:
+                self._begin()
+            except BaseException:
+                self._release(commit=False)
+                raise
+            session.info[_WRITER_KEY] = True
+        return self._connection
+
+    def _begin(self) -> None:
+        """Open the group's transaction, the sessions' SAVEPOINTs run in it"""
+        if not self._connection.in_transaction():
+            self._connection.begin()
+
+    def _acquire(self) -> None:
+        me = threading.get_ident()
+        with self._cond:
+            if self._busy and self._holder == me:
+                raise RuntimeError(
+                    f"This thread already has a write transaction open on {self.db}, "
+                    "a second one would wait for it forever"
+                )
+            self._waiting += 1
+            try:
+                while self._busy:
+                    self._cond.wait()
+            finally:
+                self._waiting -= 1
+            self._busy = True
+            self._holder = me
+            self._holder_wrote = False
+
+    def _release(self, commit: bool) -> None:
+        """Hand the writer to the next transaction, or COMMIT the group first"""
+        ticket = None
+        with self._cond:
+            while self._committing:
+                self._cond.wait()
+            if commit:
+                ticket = _Ticket()
+                if not self._batch:
+                    self._batch_started = time.monotonic()
+                self._batch.append(ticket)
+            ## with nobody queued the group's transaction ends, even if empty,
+            ## so the write lock isn't kept from other processes
+            waited = (time.monotonic() - self._batch_started) * 1000
+            flush = self._waiting == 0 or (
+                bool(self._batch)
+                and (len(self._batch) >= self.max_batch or waited >= self.max_delay_ms)
+            )
+            if flush:
+                batch = self._take_batch()
+            else:
+                if self._batch and self._timer is None:
+                    self._timer = threading.Timer(
+                        (self.max_delay_ms - waited) / 1000,
+                        self._commit_due,
+                        args=(self._batch,),
+                    )
+                    self._timer.daemon = True
+                    self._timer.start()
+                self._busy = False
+                self._holder = None
+                self._cond.notify()
+        if flush:
+            try:
+                self._commit_batch(batch)
+            finally:
+                with self._cond:
+                    self._busy = False
+                    self._holder = None
+                    self._cond.notify()
+        if ticket is not None:
+            ticket.done.wait()
+            if ticket.error is not None:
+                raise ticket.error
+
+    def _take_batch(self) -> List[_Ticket]:
+        batch, self._batch = self._batch, []
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+        return batch
+
+    def _commit_due(self, batch: List[_Ticket]) -> None:
+        """Timer: COMMIT a group that waited max_delay_ms for the writer"""
+        with self._exec_lock, self._cond:
+            if self._batch is not batch or self._committing:
+                return  ## already committed or being committed
+            if self._busy and self._holder_wrote:
+                return  ## its COMMIT would include the holder's writes
+            held = self._busy
+            batch = self._take_batch()
+            self._committing = True
+            self._busy = True
+        try:
+            if held:
+                self._commit_under_holder(batch)
+            else:
+                self._commit_batch(batch)
+        finally:
+            with self._cond:
+                self._committing = False
+                if not held:
+                    self._busy = False
+                    self._holder = None
+                self._cond.notify_all()
+
+    def _commit_under_holder(self, batch: List[_Ticket]) -> None:
+        """COMMIT the group while a transaction that has only read holds the
+        writer, then reopen its transaction and SAVEPOINTs. Called with the
+        holder's statements locked out"""
+        dbapi_connection = self._connection.connection.driver_connection
+        error = None
+        try:
+            dbapi_connection.execute("COMMIT")
+        except Exception as e:
+            error = e
+            if dbapi_connection.in_transaction:
+                dbapi_connection.execute("ROLLBACK")
+        self._finish_batch(batch, error)
+        try:
+            dbapi_connection.execute("BEGIN IMMEDIATE")
+            for name in self._savepoints:
+                dbapi_connection.execute(f"SAVEPOINT {name}")
+        except Exception as e:
+            logging.error(
+                f"Reopening the transaction on the writer of {self.db} failed: {e}"
+            )
+            ## its next statement fails instead of running outside a transaction
+            self._connection.invalidate(e)
+
+    def _commit_batch(self, batch: List[_Ticket]) -> None:
+        error = None
+        try:
+            if self._connection.in_transaction():
+                self._connection.commit()
+        except Exception as e:
+            error = e
+            try:
+                self._connection.rollback()
+            except Exception as e2:
+                logging.warning(f"Error rolling back the writer of {self.db}: {e2}")
+        self._savepoints.clear()
+        self._finish_batch(batch, error)
+
+    def _finish_batch(self, batch: List[_Ticket], error: Optional[Exception]) -> None:
+        if error is not None:
+            logging.error(f"Group commit of {len(batch)} transactions failed: {error}")
+        elif batch:
+            self.commits += 1
+            self.transactions += len(batch)
+            self._registry.counter(
+                "sqlgold_sqlite_group_commits_total",
+                "COMMITs issued by the sqlite write queue",
+                db=self._label,
+            ).inc()
+            self._registry.counter(
+                "sqlgold_sqlite_group_committed_transactions_total",
+                "Transactions committed by the sqlite write queue",
+                db=self._label,
+            ).inc(len(batch))
+        for ticket in batch:
+            ticket.error = error
+            ticket.done.set()
+
+    ## Session events
+    def _after_commit(self, session):
+        if session.in_nested_transaction() or not session.info.pop(_WRITER_KEY, None):
+            return
+        self._release(commit=True)
+
+    def _after_transaction_end(self, session, transaction):
+        ## rolled back or closed without committing
+        if transaction.parent is None and session.info.pop(_WRITER_KEY, None):
+            self._release(commit=False)
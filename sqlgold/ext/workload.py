@@ -0,0 +1,688 @@
+"""Recording the statements of a DB and replaying them against another
+
+The recorder writes every statement a DB executes, with its parameters, its
+duration and the rows it affected, to a local log, along with the
+boundaries of sessions (a connection checkout, which is what a Session's
+transaction or an ``engine.connect()`` block holds) and transactions. With a
+sample rate below 1 only that fraction of sessions is recorded, whole.
+
+The log is newline delimited json, one array per record. The text of a
+statement is written once per file and referenced by id afterwards. Files
+rotate at ``max_bytes``, keeping ``backups`` older files as ``path.1`` (the
+most recent), ``path.2``, ... Every file starts with a header and can be read
+on its own.
+
+The replayer runs the recorded sessions against another db, each session on
+its own connection and ``concurrency`` sessions at a time, at the recorded
+pace, ``speed`` times faster, or as fast as possible. Parameters are converted
+when the two drivers use different paramstyles, so a MySQL recording can be
+replayed on a sqlite copy. The log is read ahead of the replay by at most
+``read_ahead`` seconds of recorded time, and at most ``max_pending`` events
+wait for a running session. Sessions waiting for a free connection (more
+sessions were open while recording than ``concurrency``) buffer their events
+until they start. It reports latency distributions next to the
+recorded ones and the statements whose row counts differ from the recording
+(where the source driver reported a row count: DML everywhere, SELECTs on
+MySQL).
+
+Example:
+    recorder = db.enable_workload_recording("/var/tmp/orders.workload", sample_rate=0.1)
+    ...
+    db.disable_workload_recording()
+
+    report = staging_db.replay_workload("/var/tmp/orders.workload", speed=2, concurrency=16)
+    report.latency["p99"], report.divergent
+"""
+
+import base64
+import collections
+import datetime
+import decimal
+import glob
+import json
+import logging
+import os
+import random
+import re
+import threading
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass, field
+from typing import (
+    IO,
+    TYPE_CHECKING,
+    Any,
+    Callable,
+    Dict,
+    Iterator,
+    List,
+    Optional,
+    Tuple,
+)
+
+from sqlalchemy import Connection
+
+from sqlgold.engine.extension import DBExtension
+from sqlgold.metrics import Histogram
+from sqlgold.utils.sql_utils import fingerprint_sql
+
+if TYPE_CHECKING:
+    from sqlgold.engine.db import DB
+
+LOG_VERSION = 1
+
+## Record types, the first element of every record
+HEADER = "H"  ## [H, version, started (epoch seconds), dialect, paramstyle]
+STATEMENT = "S"  ## [S, statement id, sql]
+QUERY = "Q"  ## [Q, t, session, statement id, parameters, elapsed, rowcount, many]
+BEGIN = "B"  ## [B, t, session]
+COMMIT = "C"  ## [C, t, session]
+ROLLBACK = "R"  ## [R, t, session]
+END = "E"  ## [E, t, session], the connection was returned to the pool
+
+## connection.info keys
+_SESSION_KEY = "sqlgold_workload_session"
+_START_KEY = "sqlgold_workload_start"
+
+
+## Parameter values json can't represent
+def _encode(value: Any) -> Any:
+    if isinstance(value, datetime.datetime):
+        return {"$dt": value.isoformat()}
+    if isinstance(value, datetime.date):
+        return {"$date": value.isoformat()}
+    if isinstance(value, datetime.time):
+        return {"$time": value.isoformat()}
+    if isinstance(value, datetime.timedelta):
+        return {"$td": value.total_seconds()}
+    if isinstance(value, decimal.Decimal):
+        return {"$dec": str(value)}
+    if isinstance(value, (bytes, bytearray, memoryview)):
+        return {"$b": base64.b64encode(bytes(value)).decode()}
+    if isinstance(value, uuid.UUID):
+        return str(value)
+    raise TypeError(f"Can't record a parameter of type {type(value).__name__}")
+
+
+_DECODERS: Dict[str, Callable[[Any], Any]] = {
+    "$dt": datetime.datetime.fromisoformat,
+    "$date": datetime.date.fromisoformat,
+    "$time": datetime.time.fromisoformat,
+    "$td": lambda v: datetime.timedelta(seconds=v),
+    "$dec": decimal.Decimal,
+    "$b": base64.b64decode,
+}
+
+
+def _decode(d: Dict[str, Any]) -> Any:
+    if len(d) == 1:
+        key, value = next(iter(d.items()))
+        decoder = _DECODERS.get(key)
+        if decoder is not None:
+            return decoder(value)
+    return d
+
+
+def _parameters(value: Any, executemany: bool) -> Any:
+    """Recorded parameters back in the shape the driver takes"""
+    if executemany:
+        return [tuple(p) if isinstance(p, list) else p for p in value]
+    return tuple(value) if isinstance(value, list) else value
+
+
+## Paramstyles
+_PARAM_TOKEN = re.compile(
+    r"'(?:[^'\\]|\\.|'')*'"  ## string literals, kept
+    r"|\"(?:[^\"\\]|\\.|\"\")*\""
+    r"|`[^`]*`"
+    r"|%\((\w+)\)s"  ## pyformat
+    r"|%s"  ## format
+    r"|%%"
+    r"|\?"  ## qmark
+    r"|(?<![:\w]):(\w+)"  ## named
+)
+_PERCENT_STYLES = ("format", "pyformat")
+
+
+class ParamstyleConverter:
+    """Rewrites a statement from one DBAPI paramstyle to another, and its
+    parameters along with it"""
+
+    def __init__(self, statement: str, source: str, target: str):
+        self.target = target
+        self.keys: List[Any] = []  ## source parameter of every placeholder
+        source_percent = source in _PERCENT_STYLES
+        target_percent = target in _PERCENT_STYLES
+        parts = []
+        position = 0
+        last = 0
+        for m in _PARAM_TOKEN.finditer(statement):
+            token = m.group(0)
+            parts.append(self._literal(statement[last : m.start()], target_percent))
+            last = m.end()
+            if token[0] in "'\"`":
+                ## the driver interpolates % within literals too
+                if source_percent:
+                    token = token.replace("%%", "%")
+                parts.append(self._literal(token, target_percent))
+            elif token == "%%":
+                parts.append("%%" if target_percent else "%")
+            elif token == "?" and source == "qmark" or token == "%s" and source_percent:
+                parts.append(self._placeholder(position))
+                position += 1
+            elif m.group(1) is not None and source == "pyformat":
+                parts.append(self._placeholder(m.group(1)))
+            elif m.group(2) is not None and source == "named":
+                parts.append(self._placeholder(m.group(2)))
+            else:
+                parts.append(self._literal(token, target_percent))
+        parts.append(self._literal(statement[last:], target_percent))
+        self.statement = "".join(parts)
+
+    @staticmethod
+    def _literal(text: str, target_percent: bool) -> str:
+        return text.replace("%", "%%") if target_percent else text
+
+    def _placeholder(self, key: Any) -> str:
+        self.keys.append(key)
+        name = key if isinstance(key, str) else f"p{key}"
+        if self.target == "qmark":
+            return "?"
+        if self.target == "format":
+            return "%s"
+        if self.target == "pyformat":
+            return f"%({name})s"
+        if self.target == "named":
+            return f":{name}"
+        raise ValueError(f"Unsupported paramstyle {self.target}")
+
+    def parameters(self, params: Any) -> Any:
+        if params is None:
+            return None
+        values = [params[k] for k in self.keys]
+        if self.target in ("qmark", "format"):
+            return tuple(values)
+        names = [k if isinstance(k, str) else f"p{k}" for k in self.keys]
+        return dict(zip(names, values))
+
+
+## Recording
+class WorkloadRecorder(DBExtension):
+    """Writes the statements and session boundaries of a DB to a log"""
+
+    def __init__(
+        self,
+        db: "DB",
+        path: str,
+        sample_rate: float = 1.0,
+        max_bytes: int = 64 * 1024 * 1024,
+        backups: int = 5,
+    ):
+        """
+        Args:
+            db (DB): the db to record
+            path (str): the log file. An existing log is rotated
+            sample_rate (float, optional): fraction of sessions recorded.
+                Defaults to 1.0.
+            max_bytes (int, optional): size a file is rotated at.
+                Defaults to 64 MiB.
+            backups (int, optional): rotated files kept. Defaults to 5.
+        """
+        if not 0 < sample_rate <= 1:
+            raise ValueError(f"sample_rate must be in (0, 1], got {sample_rate}")
+        self.db = db
+        self.path = os.path.abspath(path)
+        self.sample_rate = sample_rate
+        self.max_bytes = max_bytes
+        self.backups = backups
+        self.sessions = 0
+        self.statements = 0
+        self.dropped = 0  ## statements whose parameters couldn't be recorded
+        self._lock = threading.Lock()
+        self._next_session = 0
+        self._statement_ids: Dict[str, int] = {}
+        self._started = time.time()
+        self._fp: Optional[IO[str]] = None
+        self._bytes = 0
+        self._listeners = [
+            (db.engine, "checkout", self._checkout),
+            (db.engine, "checkin", self._checkin),
+            (db.engine, "begin", self._begin),
+            (db.engine, "commit", self._commit),
+            (db.engine, "rollback", self._rollback),
+            (db.engine, "before_cursor_execute", self._before_cursor_execute),
+            (db.engine, "after_cursor_execute", self._after_cursor_execute),
+        ]
+
+    def attach(self) -> None:
+        with self._lock:
+            if os.path.exists(self.path):
+                self._rotate_files()
+            self._open()
+        super().attach()
+
+    def detach(self) -> None:
+        super().detach()
+        with self._lock:
+            if self._fp is not None:
+                self._fp.close()
+                self._fp = None
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "path": self.path,
+            "sessions": self.sessions,
+            "statements": self.statements,
+            "dropped": self.dropped,
+        }
+
+    ## Files
+    def _open(self) -> None:
+        self._fp = open(self.path, "w", encoding="utf-8")
+        self._bytes = 0
+        self._statement_ids = {}
+        dialect = self.db.engine.dialect
+        self._write_line(
+            [HEADER, LOG_VERSION, self._started, dialect.name, dialect.paramstyle]
+        )
+
+    def _rotate_files(self) -> None:
+        for i in range(self.backups, 0, -1):
+            source = self.path if i == 1 else f"{self.path}.{i - 1}"
+            if os.path.exists(source):
+                if i == self.backups and os.path.exists(f"{self.path}.{i}"):
+                    os.remove(f"{self.path}.{i}")
+                os.replace(source, f"{self.path}.{i}")
+        if self.backups == 0 and os.path.exists(self.path):
+            os.remove(self.path)
+
+    def _write_line(self, record: list) -> None:
+        line = json.dumps(record, default=_encode, separators=(",", ":")) + "\n"
+        self._fp.write(line)
+        self._bytes += len(line)
+
+    def _write(self, record: list, statement: Optional[str] = None) -> None:
+        with self._lock:
+            if self._fp is None:
+                return
+            if statement is not None:
+                sid = self._statement_ids.get(statement)
+                if sid is None:
+                    sid = self._statement_ids[statement] = len(self._statement_ids)
+                    self._write_line([STATEMENT, sid, statement])
+                record[3] = sid
+            self._write_line(record)
+            if self._bytes >= self.max_bytes:
+                self._fp.close()
+                self._rotate_files()
+                self._open()
+
+    def _t(self) -> float:
+        return round(time.time() - self._started, 6)
+
+    ## Events
+    def _checkout(self, dbapi_connection, connection_record, connection_proxy):
+        if self.sample_rate < 1 and random.random() >= self.sample_rate:
+            connection_record.info[_SESSION_KEY] = None
+            return
+        with self._lock:
+            session = self._next_session
+            self._next_session += 1
+            self.sessions += 1
+        connection_record.info[_SESSION_KEY] = session
+
+    def _checkin(self, dbapi_connection, connection_record):
+        session = connection_record.info.pop(_SESSION_KEY, None)
+        if session is not None:
+            self._write([END, self._t(), session])
+
+    def _boundary(self, kind: str, conn: Connection) -> None:
+        session = conn.info.get(_SESSION_KEY)
+        if session is not None:
+            self._write([kind, self._t(), session])
+
+    def _begin(self, conn):
+        self._boundary(BEGIN, conn)
+
+    def _commit(self, conn):
+        self._boundary(COMMIT, conn)
+
+    def _rollback(self, conn):
+        self._boundary(ROLLBACK, conn)
+
+    def _before_cursor_execute(
+        self, conn, cursor, statement, parameters, context, executemany
+    ):
+        if conn.info.get(_SESSION_KEY) is not None:
+            conn.info[_START_KEY] = time.perf_counter()
+
+    def _after_cursor_execute(
+        self, conn, cursor, statement, parameters, context, executemany
+    ):
+        session = conn.info.get(_SESSION_KEY)
+        start = conn.info.pop(_START_KEY, None)
+        if session is None or start is None:
+            return
+        elapsed = round(time.perf_counter() - start, 6)
+        rowcount = cursor.rowcount if cursor.rowcount is not None else -1
+        record = [
+            QUERY,
+            self._t(),
+            session,
+            None,
+            parameters,
+            elapsed,
+            rowcount,
+            1 if executemany else 0,
+        ]
+        try:
+            self._write(record, statement)
+        except TypeError as e:
+            self.dropped += 1
+            logging.debug(f"Not recording a statement on {self.db}: {e}")
+            return
+        self.statements += 1
+
+
+## Reading
+def workload_files(path: str) -> List[str]:
+    """The files of a log, oldest first"""
+    backups = []
+    for name in glob.glob(glob.escape(path) + ".*"):
+        suffix = name[len(path) + 1 :]
+        if suffix.isdigit():
+            backups.append((int(suffix), name))
+    files = [name for __, name in sorted(backups, reverse=True)]
+    if os.path.exists(path):
+        files.append(path)
+    return files
+
+
+@dataclass
+class WorkloadEvent:
+    kind: str
+    at: float  ## epoch seconds
+    session: Tuple[float, int]  ## (recording started, session number)
+    statement: Optional[str] = None
+    paramstyle: Optional[str] = None
+    parameters: Any = None
+    elapsed: float = 0.0
+    rowcount: int = -1
+    executemany: bool = False
+
+
+def read_workload(path: str) -> Iterator[WorkloadEvent]:
+    """The events of a log and its rotated files, in order"""
+    for name in workload_files(path):
+        statements: Dict[int, str] = {}
+        started, paramstyle = 0.0, None
+        with open(name, encoding="utf-8") as fp:
+            for line in fp:
+                if not line.strip():
+                    continue
+                try:
+                    record = json.loads(line, object_hook=_decode)
+                except json.JSONDecodeError:
+                    logging.warning(f"Skipping a truncated record in '{name}'")
+                    continue
+                kind = record[0]
+                if kind == HEADER:
+                    started, paramstyle = record[2], record[4]
+                elif kind == STATEMENT:
+                    statements[record[1]] = record[2]
+                elif kind == QUERY:
+                    yield WorkloadEvent(
+                        kind,
+                        started + record[1],
+                        (started, record[2]),
+                        statement=statements[record[3]],
+                        paramstyle=paramstyle,
+                        parameters=_parameters(record[4], bool(record[7])),
+                        elapsed=record[5],
+                        rowcount=record[6],
+                        executemany=bool(record[7]),
+                    )
+                else:
+                    yield WorkloadEvent(kind, started + record[1], (started, record[2]))
+
+
+## Replaying
+@dataclass
+class Divergence:
+    fingerprint: str
+    recorded_rows: int
+    replayed_rows: int
+
+
+@dataclass
+class ReplayReport:
+    sessions: int = 0
+    statements: int = 0
+    errors: int = 0
+    divergent: int = 0  ## statements returning or affecting another number of rows
+    seconds: float = 0.0
+    latency: Dict[str, float] = field(default_factory=dict)  ## replayed, seconds
+    recorded_latency: Dict[str, float] = field(default_factory=dict)
+    by_fingerprint: Dict[str, Dict[str, Any]] = field(default_factory=dict)
+    divergences: List[Divergence] = field(default_factory=list)  ## the first ones
+    error_samples: List[str] = field(default_factory=list)
+
+
+class _Stats:
+    def __init__(self):
+        self.replayed = Histogram("replayed")
+        self.recorded = Histogram("recorded")
+        self.errors = 0
+        self.divergent = 0
+
+
+class _SessionEvents:
+    """The pending events of a replayed session. Once the session runs, the
+    reader blocks while max_pending events are pending. A session waiting for
+    a connection can't consume its events, blocking on it could deadlock the
+    sessions that run, so it buffers them until it starts"""
+
+    def __init__(self, max_pending: int):
+        self.max_pending = max_pending
+        self._events: "collections.deque[Optional[WorkloadEvent]]" = collections.deque()
+        self._running = False
+        self._cond = threading.Condition()
+
+    def start(self) -> None:
+        with self._cond:
+            self._running = True
+
+    def put(self, e: Optional[WorkloadEvent]) -> None:
+        with self._cond:
+            while self._running and len(self._events) >= self.max_pending:
+                self._cond.wait()
+            self._events.append(e)
+            self._cond.notify_all()
+
+    def get(self) -> Optional[WorkloadEvent]:
+        with self._cond:
+            while not self._events:
+                self._cond.wait()
+            e = self._events.popleft()
+            self._cond.notify_all()
+            return e
+
+
+class WorkloadReplayer:
+    """Replays a recorded workload against a DB"""
+
+    def __init__(
+        self,
+        db: "DB",
+        path: str,
+        speed: Optional[float] = 1.0,
+        concurrency: int = 8,
+        max_samples: int = 100,
+        max_pending: int = 1000,
+        read_ahead: float = 1.0,
+    ):
+        """
+        Args:
+            db (DB): the db to replay against
+            path (str): the log
+            speed (Optional[float], optional): 1 replays at the recorded pace,
+                2 twice as fast, None as fast as possible. Defaults to 1.0.
+            concurrency (int, optional): sessions replayed at the same time.
+                Defaults to 8.
+            max_samples (int, optional): divergences and errors kept in the
+                report. Defaults to 100.
+            max_pending (int, optional): events read ahead for a running
+                session. Defaults to 1000.
+            read_ahead (float, optional): seconds of replay time the log is
+                read ahead when paced. Defaults to 1.0.
+        """
+        if speed is not None and speed <= 0:
+            raise ValueError(f"speed must be > 0 or None, got {speed}")
+        self.db = db
+        self.path = path
+        self.speed = speed
+        self.concurrency = max(1, concurrency)
+        self.max_samples = max_samples
+        self.max_pending = max(1, max_pending)
+        self.read_ahead = read_ahead
+        self.paramstyle = db.engine.dialect.paramstyle
+        self._converters: Dict[Tuple[str, str], Optional[ParamstyleConverter]] = {}
+        self._stats: Dict[str, _Stats] = {}
+        self._report = ReplayReport()
+        self._lock = threading.Lock()
+        self._first_at: Optional[float] = None
+        self._started = 0.0
+
+    def run(self) -> ReplayReport:
+        self._started = time.monotonic()
+        sessions: Dict[Tuple[float, int], _SessionEvents] = {}
+        with ThreadPoolExecutor(
+            self.concurrency, thread_name_prefix="sqlgold-replay"
+        ) as executor:
+            for e in read_workload(self.path):
+                if self._first_at is None:
+                    self._first_at = e.at
+                ## don't read further ahead than the pace needs
+                self._wait_until(e.at, ahead=self.read_ahead)
+                events = sessions.get(e.session)
+                if events is None:
+                    if e.kind == END:
+                        continue
+                    events = sessions[e.session] = _SessionEvents(self.max_pending)
+                    executor.submit(self._run_session, events)
+                    self._report.sessions += 1
+                events.put(e)
+                if e.kind == END:
+                    events.put(None)
+                    del sessions[e.session]
+            for events in sessions.values():  ## sessions open when recording stopped
+                events.put(None)
+        return self._finish()
+
+    def _finish(self) -> ReplayReport:
+        report = self._report
+        report.seconds = time.monotonic() - self._started
+        replayed, recorded = Histogram("replayed"), Histogram("recorded")
+        for fingerprint, stats in sorted(
+            self._stats.items(), key=lambda kv: -kv[1].replayed.sum
+        ):
+            replayed.merge(stats.replayed)
+            recorded.merge(stats.recorded)
+            report.by_fingerprint[fingerprint] = {
+                "count": stats.recorded.count,
+                "errors": stats.errors,
+                "divergent": stats.divergent,
+                "latency": stats.replayed.snapshot(),
+                "recorded_latency": stats.recorded.snapshot(),
+            }
+        report.latency = replayed.snapshot()
+        report.recorded_latency = recorded.snapshot()
+        logging.info(
+            f"Replayed {report.statements} statements of {report.sessions} sessions "
+            f"on {self.db} in {report.seconds:.1f}s, {report.errors} errors, "
+            f"{report.divergent} divergent row counts"
+        )
+        return report
+
+    def _wait_until(self, at: float, ahead: float = 0.0) -> None:
+        if self.speed is None:
+            return
+        due = self._started + (at - self._first_at) / self.speed
+        delay = due - ahead - time.monotonic()
+        if delay > 0:
+            time.sleep(delay)
+
+    def _convert(self, e: WorkloadEvent) -> Tuple[str, Any]:
+        if e.paramstyle == self.paramstyle or e.paramstyle is None:
+            return e.statement, e.parameters
+        key = (e.statement, e.paramstyle)
+        converter = self._converters.get(key)
+        if converter is None:
+            converter = ParamstyleConverter(e.statement, e.paramstyle, self.paramstyle)
+            self._converters[key] = converter
+        if e.executemany:
+            return converter.statement, [converter.parameters(p) for p in e.parameters]
+        return converter.statement, converter.parameters(e.parameters)
+
+    def _run_session(self, events: _SessionEvents) -> None:
+        events.start()
+        try:
+            with self.db.engine.connect() as connection:
+                while True:
+                    e = events.get()
+                    if e is None:
+                        break
+                    self._wait_until(e.at)
+                    if e.kind == QUERY:
+                        self._execute(connection, e)
+                    elif e.kind == BEGIN and not connection.in_transaction():
+                        connection.begin()
+                    elif e.kind == COMMIT and connection.in_transaction():
+                        connection.commit()
+                    elif e.kind == ROLLBACK and connection.in_transaction():
+                        connection.rollback()
+        except Exception as e:
+            logging.exception(f"Replaying a session on {self.db} failed")
+            with self._lock:
+                self._report.errors += 1
+                if len(self._report.error_samples) < self.max_samples:
+                    self._report.error_samples.append(repr(e))
+            ## drain the session so the reader doesn't keep it
+            while events.get() is not None:
+                pass
+
+    def _execute(self, connection: Connection, e: WorkloadEvent) -> None:
+        fingerprint = fingerprint_sql(e.statement)
+        statement, parameters = self._convert(e)
+        error = None
+        rows = -1
+        start = time.perf_counter()
+        try:
+            result = connection.exec_driver_sql(statement, parameters)
+            rows = len(result.fetchall()) if result.returns_rows else result.rowcount
+        except Exception as ex:
+            error = ex
+            if connection.in_transaction():
+                connection.rollback()
+        elapsed = time.perf_counter() - start
+        divergent = error is None and e.rowcount >= 0 and rows != e.rowcount
+        with self._lock:
+            stats = self._stats.get(fingerprint)
+            if stats is None:
+                stats = self._stats[fingerprint] = _Stats()
+            report = self._report
+            report.statements += 1
+            stats.recorded.observe(e.elapsed)
+            if error is not None:
+                stats.errors += 1
+                report.errors += 1
+                if len(report.error_samples) < self.max_samples:
+                    report.error_samples.append(f"{fingerprint}: {error}")
+                return
+            stats.replayed.observe(elapsed)
+            if divergent:
+                stats.divergent += 1
+                report.divergent += 1
+                if len(report.divergences) < self.max_samples:
+                    report.divergences.append(Divergence(fingerprint, e.rowcount, rows))
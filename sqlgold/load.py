@@ -0,0 +1,146 @@
+"""Run a synthetic load against a database
+
+Examples:
+    python -m sqlgold.load sqlite:///orders.sqlite --populate 10000 --duration 30
+    python -m sqlgold.load mysql --base myapp.models:Base --mix read=80,update=20 --workers 16 --processes
+    python -m sqlgold.load --config-section load.orders --rate 500 --json report.json
+
+The database is a url or a config.toml section, as for create_db. Options can
+also be set in a config.toml section given with --config-section, command line
+options override them::
+
+    [load.orders]
+    db = "sqlite3.orders"  # a section or a url
+    base = "myapp.models:Base"
+    tables = ["orders", "order_line"]
+    mix = {read = 70, scan = 10, insert = 10, update = 10}
+    workers = 8
+    rate = 500
+    warmup = 5
+    duration = 60
+"""
+
+import argparse
+import importlib
+import json
+import sys
+from typing import Any, Dict
+
+from sqlgold.config import cfg
+from sqlgold.engine import create_db
+from sqlgold.ext.loadgen import DEFAULT_MIX, LoadGenerator
+
+## Option defaults, when set neither on the command line nor in the section
+DEFAULTS: Dict[str, Any] = {
+    "db": None,
+    "base": None,
+    "tables": None,
+    "mix": DEFAULT_MIX,
+    "workers": 4,
+    "processes": False,
+    "rate": None,
+    "warmup": 5.0,
+    "duration": 30.0,
+    "scan_rows": 100,
+    "populate": 0,
+}
+
+
+def _import_base(ref: str) -> Any:
+    module_name, sep, name = ref.partition(":")
+    if not sep:
+        raise ValueError(f"Expected module:Base, got '{ref}'")
+    return getattr(importlib.import_module(module_name), name)
+
+
+def _section(path: str) -> Dict[str, Any]:
+    d = cfg
+    for s in path.split("."):
+        d = d[s]
+    return dict(d)
+
+
+def _parser() -> argparse.ArgumentParser:
+    parser = argparse.ArgumentParser(
+        prog="python -m sqlgold.load",
+        description=__doc__.splitlines()[0],
+        formatter_class=argparse.RawDescriptionHelpFormatter,
+        epilog="\n".join(__doc__.splitlines()[1:]),
+    )
+    ## defaults are None so that the config section can fill them in
+    parser.add_argument("db", nargs="?", help="a url or a config.toml section")
+    parser.add_argument("--config-section", help="config.toml section of options")
+    parser.add_argument("--base", help="declarative Base as module:name")
+    parser.add_argument("--tables", help="comma separated table names")
+    parser.add_argument("--mix", help="operation weights, e.g. read=70,insert=30")
+    parser.add_argument("--workers", type=int, help="threads or processes")
+    parser.add_argument(
+        "--processes", action="store_true", default=None, help="use processes"
+    )
+    parser.add_argument(
+        "--rate", type=float, help="target operations per second, closed loop if unset"
+    )
+    parser.add_argument("--warmup", type=float, help="seconds before measuring")
+    parser.add_argument("--duration", type=float, help="seconds measured")
+    parser.add_argument("--scan-rows", type=int, help="rows per scan")
+    parser.add_argument(
+        "--populate", type=int, help="fill tables holding fewer rows before the run"
+    )
+    parser.add_argument(
+        "--json", help="write the report as json to a file, - for stdout"
+    )
+    return parser
+
+
+def options(argv=None) -> Dict[str, Any]:
+    """The load options from the command line, the config section and the
+    defaults, in that order"""
+    args = vars(_parser().parse_args(argv))
+    section = args.pop("config_section")
+    report = args.pop("json")
+    merged = dict(DEFAULTS)
+    if section:
+        values = _section(section)
+        unknown = set(values) - set(DEFAULTS)
+        if unknown:
+            raise ValueError(f"Unknown options {sorted(unknown)} in [{section}]")
+        merged.update(values)
+    merged.update({k: v for k, v in args.items() if v is not None})
+    if isinstance(merged["tables"], str):
+        merged["tables"] = [t.strip() for t in merged["tables"].split(",")]
+    merged["json"] = report
+    return merged
+
+
+def main(argv=None) -> int:
+    opts = options(argv)
+    Base = _import_base(opts["base"]) if opts["base"] else None
+    db = create_db(opts["db"], Base=Base, create_all=Base is not None)
+    try:
+        report = LoadGenerator(
+            db,
+            mix=opts["mix"],
+            tables=opts["tables"],
+            workers=opts["workers"],
+            processes=opts["processes"],
+            rate=opts["rate"],
+            warmup=opts["warmup"],
+            duration=opts["duration"],
+            scan_rows=opts["scan_rows"],
+            populate_rows=opts["populate"],
+        ).run()
+    finally:
+        db.engine.dispose()
+    if opts["json"] == "-":
+        json.dump(report.to_dict(), sys.stdout, indent=2)
+        print()
+    else:
+        print(report.to_text())
+        if opts["json"]:
+            with open(opts["json"], "w") as fp:
+                json.dump(report.to_dict(), fp, indent=2)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
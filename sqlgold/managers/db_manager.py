@@ -1,11 +1,14 @@
 from __future__ import annotations
 
 from dataclasses import dataclass, field
-from typing import TYPE_CHECKING, Any, ClassVar, Dict, Self
+from typing import TYPE_CHECKING, Any, ClassVar, Dict, Optional, Self
 
 
 from sqlgold.engine.db import DB, sentinel
 
+if TYPE_CHECKING:
+    from sqlgold.managers.tenant_manager import TenantDBManager
+
 
 @dataclass
 class DBManager:
@@ -15,6 +18,7 @@ class DBManager:
 
     main_base: str = None
     bases: Dict[str, Any] = field(default_factory=dict)
+    tenant_managers: Dict[str, TenantDBManager] = field(default_factory=dict)
 
     def set_base(self, key: str, Base: Any):
         self.bases[key] = Base
@@ -47,10 +51,62 @@ class DBManager:
             db (DB): database instance
         """
         self.databases[database_alias] = db
+        if db.alias is None:
+            db.alias = database_alias
 
     def get_database(self, database_alias: str):
         return self.databases[database_alias]
 
+    def get_alias(self, db: DB) -> Optional[str]:
+        """Return the alias a database was registered under
+
+        Args:
+            db (DB): database instance
+
+        Returns:
+            Optional[str]: the alias or None if the db is not registered
+        """
+        for alias, registered in self.databases.items():
+            if registered is db:
+                return alias
+        return None
+
+    def health(self, probe: bool = True) -> Dict[str, Dict[str, Any]]:
+        """The health of every registered database, see DB.health
+
+        Args:
+            probe (bool, optional): run a query against each database, otherwise
+                only report the pool and circuit breaker states. Defaults to True.
+
+        Returns:
+            Dict[str, Dict[str, Any]]: health by alias
+        """
+        return {
+            alias: db.health(probe=probe) for alias, db in self.databases.items()
+        }
+
+    def set_tenant_manager(self, alias: str, manager: TenantDBManager):
+        """Register a per-tenant db cache under an alias
+
+        Args:
+            alias (str): alias for the tenant dbs
+            manager (TenantDBManager): the tenant db cache
+        """
+        self.tenant_managers[alias] = manager
+
+    def get_tenant_database(self, alias: str, tenant: str) -> DB:
+        """The db of a tenant from the tenant manager registered under alias,
+        created if it isn't cached
+
+        Args:
+            alias (str): alias of the tenant manager
+            tenant (str): the tenant name
+
+        Returns:
+            DB: the tenant's db
+        """
+        return self.tenant_managers[alias].get(tenant)
+
     def get_main_database(self) -> DB:
         """Returns the database set as main
 
@@ -0,0 +1,243 @@
+"""A bounded cache of per-tenant DBs
+
+For one database per tenant, TenantDBManager creates DBs on demand from a
+url or config template with ``{tenant}`` substituted, keeps at most
+``max_size`` of them in LRU order and evicts DBs idle for longer than
+``idle_ttl`` seconds. Evicted DBs have their pools disposed, closing their
+connections, and are recreated transparently on the next lookup. Pools are
+disposed after the cache lock is released, so a slow server doesn't hold up
+the lookups of other tenants.
+
+Idle DBs are only evicted by lookups and ``evict_idle()``. Without lookups
+their connections stay open, call ``evict_idle()`` periodically to close them.
+
+Example:
+    tenants = TenantDBManager("mysql+pymysql://app:pw@db/tenant_{tenant}", Base=Base)
+    with tenants.get("acme").Session() as session:
+        ...
+"""
+
+import logging
+import re
+import threading
+import time
+from collections import OrderedDict
+from dataclasses import dataclass
+from typing import Any, Dict, List, Optional, Tuple, Union
+
+from sqlgold import metrics
+from sqlgold.engine.db import DB, sentinel
+from sqlgold.metrics import MetricsRegistry
+
+## Tenant names end up in urls and database names
+TENANT_PATTERN = re.compile(r"^[A-Za-z0-9_\-]+$")
+
+
+@dataclass
+class _Entry:
+    db: DB
+    last_used: float
+
+
+class TenantDBManager:
+    """Thread safe LRU of DBs keyed by tenant"""
+
+    def __init__(
+        self,
+        template: Union[str, Dict],
+        Base: Any = sentinel,
+        max_size: int = 32,
+        idle_ttl: Optional[float] = 300,
+        create_all: bool = False,
+        lazy: bool = False,
+        name: str = "tenants",
+        registry: Optional[MetricsRegistry] = None,
+        **kwargs,
+    ):
+        """
+        Args:
+            template (Union[str, Dict]): a url or a dict of config options (see
+                create_db) where "{tenant}" is replaced by the tenant name
+            Base (Any, optional): the Base of every tenant db. Defaults to
+                DB.default_base.
+            max_size (int, optional): most dbs kept open. Defaults to 32.
+            idle_ttl (Optional[float], optional): seconds a db may go unused
+                before it is evicted by the next lookup or evict_idle(), None
+                never expires. Defaults to 300.
+            create_all (bool, optional): create the tables of new tenant dbs.
+                Defaults to False.
+            lazy (bool, optional): create tenant dbs lazily. Defaults to False.
+            name (str, optional): label of the metrics. Defaults to "tenants".
+            registry (Optional[MetricsRegistry], optional): registry for the
+                hit/miss/eviction counters. Defaults to the default registry.
+            kwargs: Arguments passed to sqlalchemy create_engine
+        """
+        if max_size < 1:
+            raise ValueError(f"max_size must be >= 1, got {max_size}")
+        self.template = template
+        self.Base = Base
+        self.max_size = max_size
+        self.idle_ttl = idle_ttl
+        self.create_all = create_all
+        self.lazy = lazy
+        self.name = name
+        self.engine_kwargs = kwargs
+        self.registry = registry or metrics.registry
+        self._dbs: "OrderedDict[str, _Entry]" = OrderedDict()
+        self._creating: Dict[str, threading.Event] = {}
+        self._lock = threading.Lock()
+
+    def _counter(self, name: str, documentation: str, **labels) -> metrics.Counter:
+        return self.registry.counter(name, documentation, manager=self.name, **labels)
+
+    def config_for(self, tenant: str) -> Union[str, Dict]:
+        """The url or config of a tenant, the template with the name substituted"""
+        if not TENANT_PATTERN.match(tenant):
+            raise ValueError(f"Invalid tenant name '{tenant}'")
+        if isinstance(self.template, dict):
+            return {
+                k: v.format(tenant=tenant) if isinstance(v, str) else v
+                for k, v in self.template.items()
+            }
+        return self.template.format(tenant=tenant)
+
+    def _create(self, tenant: str) -> DB:
+        from sqlgold.engine.create import DBFactory
+
+        ## not registered with the DBManager, which would keep it alive forever
+        db = DBFactory._create_db(
+            self.config_for(tenant),
+            Base=self.Base,
+            create_all=self.create_all,
+            lazy=self.lazy,
+            **self.engine_kwargs,
+        )
+        db.alias = f"{self.name}:{tenant}"
+        return db
+
+    def get(self, tenant: str) -> DB:
+        """The db of a tenant, created if it isn't cached
+
+        Args:
+            tenant (str): the tenant name
+
+        Returns:
+            DB: the tenant's db
+        """
+        while True:
+            created = False
+            with self._lock:
+                now = time.monotonic()
+                evicted = self._evict_idle(now)
+                entry = self._dbs.get(tenant)
+                if entry is not None:
+                    entry.last_used = now
+                    self._dbs.move_to_end(tenant)
+                else:
+                    creating = self._creating.get(tenant)
+                    if creating is None:
+                        creating = self._creating[tenant] = threading.Event()
+                        created = True
+            self._dispose(evicted)
+            if entry is not None:
+                self._counter(
+                    "sqlgold_tenant_cache_hits_total", "Tenant db cache hits"
+                ).inc()
+                return entry.db
+            if created:
+                break
+            ## another thread is creating this tenant's db
+            creating.wait()
+
+        self._counter(
+            "sqlgold_tenant_cache_misses_total", "Tenant db cache misses"
+        ).inc()
+        evicted = []
+        try:
+            db = self._create(tenant)
+            with self._lock:
+                self._dbs[tenant] = _Entry(db, time.monotonic())
+                while len(self._dbs) > self.max_size:
+                    __, entry = self._dbs.popitem(last=False)
+                    evicted.append((entry.db, "size"))
+            return db
+        finally:
+            with self._lock:
+                self._creating.pop(tenant).set()
+            self._dispose(evicted)
+
+    def __getitem__(self, tenant: str) -> DB:
+        return self.get(tenant)
+
+    def __contains__(self, tenant: str) -> bool:
+        return tenant in self._dbs
+
+    def __len__(self) -> int:
+        return len(self._dbs)
+
+    def evict(self, tenant: str) -> bool:
+        """Dispose a tenant's db, returns whether it was cached"""
+        with self._lock:
+            entry = self._dbs.pop(tenant, None)
+        if entry is not None:
+            self._dispose([(entry.db, "manual")])
+        return entry is not None
+
+    def evict_idle(self) -> None:
+        """Dispose the dbs that have been idle for longer than idle_ttl"""
+        with self._lock:
+            evicted = self._evict_idle(time.monotonic())
+        self._dispose(evicted)
+
+    def clear(self) -> None:
+        """Dispose every cached db"""
+        with self._lock:
+            entries = list(self._dbs.values())
+            self._dbs.clear()
+        self._dispose([(entry.db, "manual") for entry in entries])
+
+    def stats(self) -> Dict[str, Any]:
+        """Cache size and hit, miss and eviction counts"""
+        counts = {}
+        for name in ("hits", "misses", "evictions"):
+            metric_name = (
+                "sqlgold_tenant_evictions_total"
+                if name == "evictions"
+                else f"sqlgold_tenant_cache_{name}_total"
+            )
+            counts[name] = sum(
+                c.value
+                for c in self.registry.collect(metric_name)
+                if ("manager", self.name) in c.labels
+            )
+        return {"size": len(self._dbs), "max_size": self.max_size, **counts}
+
+    def _evict_idle(self, now: float) -> List[Tuple[DB, str]]:
+        """Remove the dbs idle for longer than idle_ttl, called with the lock
+        held. Returns them to be disposed once it is released"""
+        evicted = []
+        if self.idle_ttl is None:
+            return evicted
+        ## LRU order is last use order, the idle dbs are at the front
+        while self._dbs:
+            tenant, entry = next(iter(self._dbs.items()))
+            if now - entry.last_used < self.idle_ttl:
+                break
+            del self._dbs[tenant]
+            evicted.append((entry.db, "idle"))
+        return evicted
+
+    def _dispose(self, evicted: List[Tuple[DB, str]]) -> None:
+        """Close the pools of evicted dbs, without holding the lock"""
+        for db, reason in evicted:
+            self._counter(
+                "sqlgold_tenant_evictions_total", "Tenant dbs evicted", reason=reason
+            ).inc()
+            if db.is_lazy:
+                continue
+            try:
+                ## checked out connections are closed when they are returned
+                db.engine.dispose()
+            except Exception as e:
+                logging.warning(f"Error disposing the pool of {db}: {e}")
+            logging.debug(f"Evicted {db} ({reason})")
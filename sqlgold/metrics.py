@@ -0,0 +1,384 @@
+"""Metrics for sqlgold: counters, timers and latency histograms
+
+All metrics are thread safe and use a fixed amount of memory. Metrics are
+identified by a name and a set of labels (e.g. db alias and operation) and
+can be exported in the Prometheus text format or as a json snapshot.
+
+Example:
+    from sqlgold import metrics
+
+    metrics.counter("jobs_total", db="main").inc()
+
+    with metrics.timer("load_seconds", db="main", operation="load"):
+        ...
+
+    @metrics.timer("handler_seconds", operation="handler")
+    def handler():
+        ...
+
+    metrics.registry.write_json("/tmp/sqlgold_metrics.json")
+"""
+
+import contextvars
+import functools
+import json
+import math
+import os
+import tempfile
+import threading
+import time
+from typing import Any, Callable, Dict, List, Optional, Tuple
+
+LabelsKey = Tuple[Tuple[str, str], ...]
+
+## Histogram buckets are geometric, BUCKETS_PER_OCTAVE buckets for every doubling
+## of the value. 8 per octave keeps quantile estimates within ~4.5% of the truth
+BUCKETS_PER_OCTAVE = 8
+HISTOGRAM_MIN = 1e-6  ## values at or below go into the first bucket
+HISTOGRAM_OCTAVES = 40  ## 1e-6 * 2**40 ~ 12 days, anything larger is clamped
+_NUM_BUCKETS = BUCKETS_PER_OCTAVE * HISTOGRAM_OCTAVES + 1
+_LOG_BASE = math.log(2) / BUCKETS_PER_OCTAVE
+
+DEFAULT_QUANTILES = (0.5, 0.95, 0.99)
+
+
+def _labels_key(labels: Dict[str, Any]) -> LabelsKey:
+    return tuple(sorted((k, str(v)) for k, v in labels.items()))
+
+
+class Counter:
+    """A monotonically increasing count"""
+
+    def __init__(self, name: str, labels: LabelsKey = ()):
+        self.name = name
+        self.labels = labels
+        self._value = 0
+        self._lock = threading.Lock()
+
+    def inc(self, amount: float = 1) -> None:
+        with self._lock:
+            self._value += amount
+
+    @property
+    def value(self) -> float:
+        return self._value
+
+    def reset(self) -> None:
+        with self._lock:
+            self._value = 0
+
+    def snapshot(self) -> Dict[str, Any]:
+        return {"value": self._value}
+
+
+class Histogram:
+    """A fixed memory histogram with geometric buckets.
+    Tracks count, sum, min and max exactly and estimates quantiles from the buckets.
+    """
+
+    def __init__(self, name: str, labels: LabelsKey = ()):
+        self.name = name
+        self.labels = labels
+        self._buckets: List[int] = [0] * _NUM_BUCKETS
+        self._count = 0
+        self._sum = 0.0
+        self._min = math.inf
+        self._max = -math.inf
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def _bucket_index(value: float) -> int:
+        if value <= HISTOGRAM_MIN:
+            return 0
+        index = int(math.log(value / HISTOGRAM_MIN) / _LOG_BASE) + 1
+        return min(index, _NUM_BUCKETS - 1)
+
+    @staticmethod
+    def _bucket_upper_bound(index: int) -> float:
+        return HISTOGRAM_MIN * math.exp(index * _LOG_BASE)
+
+    def observe(self, value: float) -> None:
+        """Record a value"""
+        index = self._bucket_index(value)
+        with self._lock:
+            self._buckets[index] += 1
+            self._count += 1
+            self._sum += value
+            if value < self._min:
+                self._min = value
+            if value > self._max:
+                self._max = value
+
+    def merge(self, other: "Histogram") -> None:
+        """Add the observations of another histogram to this one"""
+        with other._lock:
+            buckets = list(other._buckets)
+            count, total = other._count, other._sum
+            omin, omax = other._min, other._max
+        with self._lock:
+            for i, n in enumerate(buckets):
+                if n:
+                    self._buckets[i] += n
+            self._count += count
+            self._sum += total
+            self._min = min(self._min, omin)
+            self._max = max(self._max, omax)
+
+    @property
+    def count(self) -> int:
+        return self._count
+
+    @property
+    def sum(self) -> float:
+        return self._sum
+
+    @property
+    def max(self) -> float:
+        return self._max if self._count else 0.0
+
+    @property
+    def min(self) -> float:
+        return self._min if self._count else 0.0
+
+    def quantile(self, q: float) -> float:
+        """Estimate the q quantile (0 <= q <= 1)
+
+        Returns:
+            float: the estimate, always within [min, max]
+        """
+        with self._lock:
+            if not self._count:
+                return 0.0
+            rank = q * self._count
+            seen = 0
+            for i, n in enumerate(self._buckets):
+                seen += n
+                if n and seen >= rank:
+                    value = self._bucket_upper_bound(i)
+                    return max(self._min, min(value, self._max))
+            return self._max
+
+    def reset(self) -> None:
+        with self._lock:
+            self._buckets = [0] * _NUM_BUCKETS
+            self._count = 0
+            self._sum = 0.0
+            self._min = math.inf
+            self._max = -math.inf
+
+    def snapshot(self) -> Dict[str, Any]:
+        return {
+            "count": self.count,
+            "sum": self.sum,
+            "min": self.min,
+            "max": self.max,
+            **{f"p{round(q * 100)}": self.quantile(q) for q in DEFAULT_QUANTILES},
+        }
+
+    def to_dict(self) -> Dict[str, Any]:
+        """The full state (including buckets) for shipping between processes"""
+        with self._lock:
+            return {
+                "buckets": {i: n for i, n in enumerate(self._buckets) if n},
+                "count": self._count,
+                "sum": self._sum,
+                "min": self._min if self._count else None,
+                "max": self._max if self._count else None,
+            }
+
+    @classmethod
+    def from_dict(cls, d: Dict[str, Any], name: str = "", labels: LabelsKey = ()):
+        h = cls(name, labels)
+        for i, n in d["buckets"].items():
+            h._buckets[int(i)] = n
+        h._count = d["count"]
+        h._sum = d["sum"]
+        if d["count"]:
+            h._min, h._max = d["min"], d["max"]
+        return h
+
+
+_timer_starts: contextvars.ContextVar[Tuple[float, ...]] = contextvars.ContextVar(
+    "sqlgold_timer_starts", default=()
+)
+
+
+class Timer:
+    """Times a block or function into a histogram (in seconds).
+    The start times live in a ContextVar so a single Timer can be used
+    concurrently from many threads and asyncio tasks, and can be nested.
+    """
+
+    def __init__(self, histogram: Histogram):
+        self.histogram = histogram
+
+    def __enter__(self):
+        _timer_starts.set(_timer_starts.get() + (time.perf_counter(),))
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        starts = _timer_starts.get()
+        _timer_starts.set(starts[:-1])
+        self.histogram.observe(time.perf_counter() - starts[-1])
+
+    def __call__(self, func: Callable) -> Callable:
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            with self:
+                return func(*args, **kwargs)
+
+        return wrapper
+
+
+class MetricsRegistry:
+    """Holds every metric by name and labels"""
+
+    def __init__(self):
+        self._metrics: Dict[Tuple[str, LabelsKey], Any] = {}
+        self._types: Dict[str, type] = {}
+        self._help: Dict[str, str] = {}
+        self._lock = threading.Lock()
+
+    def _get(self, cls: type, name: str, help: str, labels: Dict[str, Any]):
+        key = (name, _labels_key(labels))
+        metric = self._metrics.get(key)
+        if metric is not None:
+            return metric
+        with self._lock:
+            metric = self._metrics.get(key)
+            if metric is None:
+                registered = self._types.setdefault(name, cls)
+                if registered is not cls:
+                    raise ValueError(
+                        f"Metric '{name}' is a {registered.__name__}, not a {cls.__name__}"
+                    )
+                if help:
+                    self._help[name] = help
+                metric = cls(name, key[1])
+                self._metrics[key] = metric
+            return metric
+
+    def counter(self, name: str, help: str = "", **labels) -> Counter:
+        """Get or create a counter"""
+        return self._get(Counter, name, help, labels)
+
+    def histogram(self, name: str, help: str = "", **labels) -> Histogram:
+        """Get or create a histogram"""
+        return self._get(Histogram, name, help, labels)
+
+    def timer(self, name: str, help: str = "", **labels) -> Timer:
+        """A timer (context manager or decorator) recording into a histogram"""
+        return Timer(self.histogram(name, help, **labels))
+
+    def collect(self, name: Optional[str] = None) -> List[Any]:
+        """Return the metrics, optionally only those with the given name"""
+        with self._lock:
+            metrics = list(self._metrics.values())
+        if name is not None:
+            metrics = [m for m in metrics if m.name == name]
+        return metrics
+
+    def reset(self) -> None:
+        """Zero every metric, keeping the metric objects"""
+        for metric in self.collect():
+            metric.reset()
+
+    def clear(self) -> None:
+        """Remove every metric"""
+        with self._lock:
+            self._metrics.clear()
+            self._types.clear()
+            self._help.clear()
+
+    def snapshot(self) -> Dict[str, Any]:
+        """A json serializable snapshot of every metric"""
+        out: Dict[str, Any] = {"timestamp": time.time(), "metrics": {}}
+        for metric in self.collect():
+            entry = {"labels": dict(metric.labels), **metric.snapshot()}
+            out["metrics"].setdefault(metric.name, {"type": "", "values": []})
+            out["metrics"][metric.name]["type"] = (
+                "counter" if isinstance(metric, Counter) else "histogram"
+            )
+            out["metrics"][metric.name]["values"].append(entry)
+        return out
+
+    def to_prometheus(self) -> str:
+        """Render every metric in the Prometheus text exposition format.
+        Histograms are exported as summaries with p50/p95/p99 quantiles
+        and an additional ``<name>_max`` gauge.
+        """
+        by_name: Dict[str, List[Any]] = {}
+        for metric in self.collect():
+            by_name.setdefault(metric.name, []).append(metric)
+
+        lines = []
+        for name in sorted(by_name):
+            metrics = by_name[name]
+            if name in self._help:
+                lines.append(f"# HELP {name} {self._help[name]}")
+            if isinstance(metrics[0], Counter):
+                lines.append(f"# TYPE {name} counter")
+                for m in metrics:
+                    lines.append(f"{name}{_prom_labels(m.labels)} {m.value}")
+                continue
+            lines.append(f"# TYPE {name} summary")
+            for m in metrics:
+                for q in DEFAULT_QUANTILES:
+                    labels = _prom_labels(m.labels + (("quantile", str(q)),))
+                    lines.append(f"{name}{labels} {m.quantile(q)}")
+                lines.append(f"{name}_sum{_prom_labels(m.labels)} {m.sum}")
+                lines.append(f"{name}_count{_prom_labels(m.labels)} {m.count}")
+            lines.append(f"# TYPE {name}_max gauge")
+            for m in metrics:
+                lines.append(f"{name}_max{_prom_labels(m.labels)} {m.max}")
+        return "\n".join(lines) + "\n"
+
+    def write_json(self, path: str) -> None:
+        """Atomically write a json snapshot to a file"""
+        _atomic_write(path, json.dumps(self.snapshot(), indent=2))
+
+    def write_prometheus(self, path: str) -> None:
+        """Atomically write the Prometheus text format to a file,
+        e.g. for the node_exporter textfile collector"""
+        _atomic_write(path, self.to_prometheus())
+
+
+def _prom_labels(labels: LabelsKey) -> str:
+    if not labels:
+        return ""
+    escaped = (
+        (k, v.replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"'))
+        for k, v in labels
+    )
+    return "{" + ",".join(f'{k}="{v}"' for k, v in escaped) + "}"
+
+
+def _atomic_write(path: str, content: str) -> None:
+    dirname = os.path.dirname(os.path.abspath(path))
+    fd, tmp_path = tempfile.mkstemp(dir=dirname, suffix=".tmp")
+    try:
+        with os.fdopen(fd, "w") as fp:
+            fp.write(content)
+        os.replace(tmp_path, path)
+    except BaseException:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
+
+
+registry = MetricsRegistry()  ## the default registry
+
+
+def counter(name: str, help: str = "", **labels) -> Counter:
+    """Get or create a counter in the default registry"""
+    return registry.counter(name, help, **labels)
+
+
+def histogram(name: str, help: str = "", **labels) -> Histogram:
+    """Get or create a histogram in the default registry"""
+    return registry.histogram(name, help, **labels)
+
+
+def timer(name: str, help: str = "", **labels) -> Timer:
+    """A timer recording into a histogram in the default registry"""
+    return registry.timer(name, help, **labels)
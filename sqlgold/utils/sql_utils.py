@@ -0,0 +1,33 @@
+"""Helpers for working with SQL strings"""
+
+import re
+
+_STRING_LITERAL = re.compile(r"'(?:[^']|'')*'")
+_NUMBER_LITERAL = re.compile(r"(?<![\w.])-?\d+(?:\.\d+)?(?:[eE][-+]?\d+)?\b")
+_PLACEHOLDER = re.compile(r"%\(\w+\)s|%s|:\w+|\?")
+_IN_LIST = re.compile(r"\(\s*\?(?:\s*,\s*\?)+\s*\)")
+_VALUES_LIST = re.compile(r"(VALUES\s*\([^)]*\))(?:\s*,\s*\([^)]*\))+", re.IGNORECASE)
+_WHITESPACE = re.compile(r"\s+")
+
+
+def fingerprint_sql(sql: str) -> str:
+    """Normalize a SQL string into its shape so that statements that only differ
+    by literal values, bind parameter names, IN list lengths or the number of
+    VALUES rows compare equal
+
+    Example:
+        fingerprint_sql("SELECT * FROM t WHERE id IN (1, 2, 3) AND name = 'x'")
+        # 'SELECT * FROM t WHERE id IN (?+) AND name = ?'
+
+    Args:
+        sql (str): the sql string
+
+    Returns:
+        str: the normalized sql
+    """
+    sql = _STRING_LITERAL.sub("?", sql)
+    sql = _PLACEHOLDER.sub("?", sql)
+    sql = _NUMBER_LITERAL.sub("?", sql)
+    sql = _VALUES_LIST.sub(r"\1", sql)
+    sql = _IN_LIST.sub("(?+)", sql)
+    return _WHITESPACE.sub(" ", sql).strip()
@@ -3,14 +3,17 @@ import atexit
 import inspect
 import logging
 import os
+import tempfile
 import uuid
 from contextlib import contextmanager
-from typing import Any, Dict, Union
+from typing import Any, Dict, Iterator, Union
 
 from sqlgold.config import Config
 from sqlgold.config import cfg as default_cfg
 from sqlgold.config import make_attr_dict, read_config_dir
 from sqlgold.engine.create import create_db
+from sqlgold.ext.nplusone import assert_max_queries as assert_max_queries
+from sqlgold.ext.nplusone import count_queries as count_queries
 
 cfg = {"not_set":True}
 
@@ -138,6 +141,7 @@ def create_test_db(
     drop: bool = True,
     suffix: str = "",
     random_suffix: bool = False,
+    nplusone_threshold: int = None,
     **kwargs
 ):
     """Create a temporary db for testing. This db will by default be dropped/deleted
@@ -157,6 +161,9 @@ def create_test_db(
         drop (bool, optional): _description_. Defaults to True.
         suffix (str, optional): _description_. Defaults to "".
         random_suffix (bool, optional): _description_. Defaults to False.
+        nplusone_threshold (int, optional): if set raise NPlusOneError when the same
+            statement is repeated more than this many times in a transaction.
+            Defaults to None.
 
     Yields:
         DB: A db instance for testing
@@ -177,6 +184,9 @@ def create_test_db(
     else:
         db = create_db(url, **kwargs)
 
+    if nplusone_threshold is not None:
+        db.enable_nplusone_detection(threshold=nplusone_threshold, mode="raise")
+
     url_str = db.engine.url
     if drop:
         _ensure_dropped_test_dbs[url_str] = db
@@ -184,11 +194,37 @@ def create_test_db(
         db.create_all()
         yield db
     finally:
+        if nplusone_threshold is not None:
+            db.disable_nplusone_detection()
         if drop:
             db.drop_db()
             _ensure_dropped_test_dbs.pop(url_str, None)
 
 
+@contextmanager
+def create_sqlite_test_db(filename: str = "test.sqlite", **kwargs) -> Iterator[Any]:
+    """Create a file backed sqlite db in a temporary directory for testing, for
+    tests that need more than an in-memory db: several connections or
+    processes, WAL mode, files next to the db. The engine is disposed and the
+    directory deleted when out of scope.
+
+    Args:
+        filename (str, optional): path of the db file in the temporary directory.
+            Defaults to "test.sqlite".
+        **kwargs: passed to create_db, e.g. Base, create_all or alias
+
+    Yields:
+        DB: A db instance for testing, its file is db.database
+    """
+    with tempfile.TemporaryDirectory() as tmpdir:
+        db = create_db(f"sqlite:///{os.path.join(tmpdir, filename)}", **kwargs)
+        try:
+            yield db
+        finally:
+            if not db.is_lazy:
+                db.engine.dispose()
+
+
 @atexit.register
 def cleanup():
     for db in _ensure_dropped_test_dbs.values():
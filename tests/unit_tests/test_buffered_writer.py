@@ -0,0 +1,123 @@
+"""Unit tests for DB.buffered_writer"""
+
+import threading
+import time
+import unittest
+
+from sqlalchemy import func, select
+from sqlalchemy.orm import Mapped, declarative_base, mapped_column
+
+from sqlgold.ext.buffered_writer import BufferFullError
+from sqlgold.metrics import MetricsRegistry
+from sqlgold.utils.test_db_utils import create_sqlite_test_db
+
+Base = declarative_base()
+
+
+class Event(Base):
+    __tablename__ = "event"
+
+    id: Mapped[int] = mapped_column(primary_key=True)
+    kind: Mapped[str]
+
+
+class TestBufferedWriter(unittest.TestCase):
+    def setUp(self):
+        self.db = self.enterContext(
+            create_sqlite_test_db("events.sqlite", Base=Base, create_all=True)
+        )
+
+    def count(self) -> int:
+        with self.db.Session() as s:
+            return s.scalar(select(func.count()).select_from(Event))
+
+    def test_threads_are_batched(self):
+        writer = self.db.buffered_writer(Event, max_rows=100, max_latency_ms=1000)
+
+        def produce(start):
+            for i in range(start, start + 250):
+                writer.write({"id": i, "kind": "click"})
+
+        threads = [threading.Thread(target=produce, args=(i * 250,)) for i in range(4)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        writer.close()
+
+        self.assertEqual(self.count(), 1000)
+        self.assertEqual(writer.stats.rows_written, 1000)
+        self.assertLessEqual(writer.stats.batches, 20)
+        with self.assertRaises(RuntimeError):
+            writer.write({"id": 1000, "kind": "click"})
+
+    def test_close_while_writing(self):
+        writer = self.db.buffered_writer(Event, max_rows=50)
+        accepted = []
+
+        def produce(start):
+            for i in range(start, start + 2000):
+                try:
+                    writer.write({"id": i, "kind": "click"})
+                except RuntimeError:
+                    return
+                accepted.append(i)
+
+        threads = [threading.Thread(target=produce, args=(i * 2000,)) for i in range(4)]
+        for t in threads:
+            t.start()
+        time.sleep(0.02)
+        writer.close()
+        for t in threads:
+            t.join()
+        ## every write that returned was inserted
+        self.assertEqual(self.count(), len(accepted))
+        self.assertEqual(writer.stats.rows_written, len(accepted))
+
+    def test_latency_and_flush(self):
+        with self.db.buffered_writer(Event, max_rows=1000, max_latency_ms=20) as writer:
+            writer.write(Event(id=1, kind="view"))
+            time.sleep(0.2)
+            self.assertEqual(self.count(), 1)
+            writer.write_many([{"id": 2, "kind": "view"}, {"id": 3, "kind": "view"}])
+            self.assertTrue(writer.flush(timeout=5))
+            self.assertEqual(self.count(), 3)
+
+    def test_errors_and_backpressure(self):
+        failed = []
+        writer = self.db.buffered_writer(
+            Event, max_rows=10, on_error=lambda e, rows: failed.extend(rows)
+        )
+        writer.write({"id": 1, "kind": "a"})
+        writer.write({"id": 1, "kind": "duplicate"})
+        writer.flush()
+        self.assertEqual(len(failed), 2)
+        self.assertEqual(writer.stats.errors, 1)
+
+        ## a writer thread stuck in an insert lets the buffer fill up
+        blocked = threading.Event()
+        writer.on_error = None
+        real_insert = writer._insert
+        writer._insert = lambda rows: (blocked.wait(5), real_insert(rows))
+        small = self.db.buffered_writer(Event, max_rows=1, max_buffer=2)
+        small._insert = writer._insert
+        with self.assertRaises(BufferFullError):
+            for i in range(10):
+                small.write({"id": 100 + i, "kind": "b"}, timeout=0.05)
+        blocked.set()
+        small.close()
+        writer.close()
+
+    def test_metrics_go_to_the_db_registry(self):
+        registry = self.db.enable_metrics(MetricsRegistry()).registry
+        with self.db.buffered_writer(Event) as writer:
+            writer.write({"id": 1, "kind": "a"})
+        self.db.disable_metrics()
+        batches = registry.histogram(
+            "sqlgold_buffered_writer_batch_seconds", db=self.db.alias, table="event"
+        )
+        self.assertEqual(batches.count, 1)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,145 @@
+"""Unit tests for DB.bulk_update"""
+
+import unittest
+
+from sqlalchemy import insert, select
+from sqlalchemy.dialects import mysql
+from sqlalchemy.orm import Mapped, declarative_base, mapped_column
+
+from sqlgold import create_db
+from sqlgold.dialects.mysql import staged_update_sql
+
+Base = declarative_base()
+
+
+class Product(Base):
+    __tablename__ = "product"
+
+    id: Mapped[int] = mapped_column(primary_key=True)
+    name: Mapped[str]
+    price: Mapped[float | None]
+    stock: Mapped[int] = mapped_column(default=0)
+
+
+class Price(Base):
+    __tablename__ = "price"
+
+    region: Mapped[str] = mapped_column(primary_key=True)
+    sku: Mapped[str] = mapped_column(primary_key=True)
+    amount: Mapped[float]
+
+
+class TestBulkUpdate(unittest.TestCase):
+    def setUp(self):
+        self.db = create_db("sqlite:///:memory:", Base=Base, create_all=True)
+        with self.db.Session.begin() as session:
+            session.execute(
+                insert(Product),
+                [
+                    {"id": i, "name": f"p{i}", "price": float(i), "stock": i}
+                    for i in range(100)
+                ],
+            )
+
+    def tearDown(self):
+        self.db.engine.dispose()
+
+    def products(self):
+        with self.db.Session() as session:
+            rows = session.execute(select(Product.id, Product.price, Product.stock))
+            return {id: (price, stock) for id, price, stock in rows}
+
+    def test_groups_and_counts(self):
+        rows = [{"id": i, "price": i * 2.0} for i in range(10)]
+        rows += [{"id": i, "price": None, "stock": 0} for i in range(10, 20)]
+        rows += [{"id": 1000, "price": 1.0}]  ## no such product
+        result = self.db.bulk_update(Product, rows, batch_size=4, count_matched=True)
+
+        self.assertEqual(result.rows, 21)
+        self.assertEqual(result.matched, 20)
+        ## id 0 already has the price 0.0
+        self.assertEqual(result.changed, 19)
+        ## 11 price rows in batches of 4, 10 price and stock rows
+        self.assertEqual(result.statements, 3 + 3)
+
+        products = self.products()
+        self.assertEqual(products[3], (6.0, 3))
+        self.assertEqual(products[15], (None, 0))
+        self.assertEqual(products[50], (50.0, 50))
+
+        ## a second run changes nothing
+        result = self.db.bulk_update(Product, rows, count_matched=True)
+        self.assertEqual((result.matched, result.changed), (20, 0))
+        ## not counted by default
+        self.assertIsNone(self.db.bulk_update(Product, rows).matched)
+
+    def test_columns_and_key(self):
+        rows = [{"name": "p5", "price": 9.0, "stock": 9}]
+        result = self.db.bulk_update("product", rows, key="name", columns=["stock"])
+        self.assertEqual(result.changed, 1)
+        self.assertEqual(self.products()[5], (5.0, 9))
+
+    def test_composite_key(self):
+        with self.db.Session.begin() as session:
+            session.add_all(
+                [
+                    Price(region="eu", sku="a", amount=1.0),
+                    Price(region="us", sku="a", amount=2.0),
+                ]
+            )
+        result = self.db.bulk_update(
+            Price,
+            [
+                {"region": "us", "sku": "a", "amount": 3.0},
+                {"region": "us", "sku": "b", "amount": 1.0},
+            ],
+            count_matched=True,
+        )
+        self.assertEqual((result.matched, result.changed), (1, 1))
+        with self.db.Session() as session:
+            amounts = dict(session.execute(select(Price.region, Price.amount)).all())
+        self.assertEqual(amounts, {"eu": 1.0, "us": 3.0})
+
+    def test_duplicate_keys(self):
+        rows = [
+            {"id": 1, "price": 10.0},
+            {"id": 2, "price": 20.0},
+            {"id": 1, "price": 11.0, "stock": 0},
+            {"id": 2, "stock": 5},
+        ]
+        result = self.db.bulk_update(Product, rows)
+        ## later values win, each key is updated once
+        self.assertEqual((result.rows, result.changed), (4, 2))
+        self.assertEqual(result.statements, 1)
+        products = self.products()
+        self.assertEqual(products[1], (11.0, 0))
+        self.assertEqual(products[2], (20.0, 5))
+
+    def test_errors(self):
+        with self.assertRaises(ValueError):
+            self.db.bulk_update(Product, [{"price": 1.0}])
+        with self.assertRaises(ValueError):
+            self.db.bulk_update(Product, [{"id": 1, "colour": "red"}])
+        with self.assertRaises(ValueError):
+            self.db.bulk_update(Product, [{"id": 1}], key="sku")
+
+    def test_mysql_staged_update_sql(self):
+        table = Product.__table__
+        stage = table.to_metadata(table.metadata.__class__(), name="stage")
+        update, matched = staged_update_sql(
+            mysql.dialect(), table, stage, ["id"], ["price", "stock"]
+        )
+        join = "ON t.id = s.id"
+        self.assertEqual(
+            update,
+            f"UPDATE product AS t JOIN stage AS s {join} "
+            "SET t.price = s.price, t.stock = s.stock "
+            "WHERE NOT (t.price <=> s.price) OR NOT (t.stock <=> s.stock)",
+        )
+        self.assertEqual(
+            matched, f"SELECT COUNT(*) FROM product AS t JOIN stage AS s {join}"
+        )
+
+
+if __name__ == "__main__":
+    unittest.main()
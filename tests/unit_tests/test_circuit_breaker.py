@@ -0,0 +1,86 @@
+"""Unit tests for DB.health and the circuit breaker"""
+
+import os
+import time
+import unittest
+
+from sqlalchemy import text
+from sqlalchemy.exc import OperationalError
+
+from sqlgold.engine.health import CLOSED, HALF_OPEN, OPEN
+from sqlgold.exceptions import CircuitOpenError
+from sqlgold.managers.db_manager import DBManager
+from sqlgold.metrics import MetricsRegistry
+from sqlgold.utils.test_db_utils import create_sqlite_test_db
+
+
+class TestCircuitBreaker(unittest.TestCase):
+    def setUp(self):
+        ## the directory doesn't exist yet so connecting fails
+        self.db = self.enterContext(
+            create_sqlite_test_db(
+                "missing/breaker.sqlite", Base=None, alias="breaker_db"
+            )
+        )
+        self.dir = os.path.dirname(self.db.database)
+        self.registry = MetricsRegistry()
+        self.db.enable_metrics(self.registry)
+
+    def tearDown(self):
+        self.db.disable_metrics()
+        self.db.disable_circuit_breaker()
+
+    def query(self):
+        with self.db.Session() as s:
+            return s.execute(text("SELECT 1")).scalar()
+
+    def test_opens_fails_fast_and_recovers(self):
+        breaker = self.db.enable_circuit_breaker(failure_threshold=2, reset_timeout=0.1)
+        for __ in range(2):
+            with self.assertRaises(OperationalError):
+                self.query()
+        self.assertEqual(breaker.state, OPEN)
+
+        with self.assertRaises(CircuitOpenError):
+            self.query()
+        health = self.db.health()
+        self.assertFalse(health["ok"])
+        self.assertEqual(health["breaker"]["state"], OPEN)
+        self.assertIsNone(health["latency_ms"])
+
+        ## a failed trial opens it again
+        time.sleep(0.15)
+        with self.assertRaises(OperationalError):
+            self.query()
+        self.assertEqual(breaker.state, OPEN)
+
+        os.makedirs(self.dir)
+        time.sleep(0.15)
+        self.assertTrue(breaker.allow())
+        self.assertEqual(breaker.state, HALF_OPEN)
+        self.assertFalse(breaker.allow())  ## one trial at a time
+        ## the trial above never finished, another is let through after reset_timeout
+        time.sleep(0.15)
+        self.assertEqual(self.query(), 1)
+        self.assertEqual(breaker.state, CLOSED)
+
+        rejections = self.registry.counter(
+            "sqlgold_circuit_breaker_rejections_total", db="breaker_db"
+        )
+        self.assertEqual(rejections.value, 1)
+        opened = self.registry.counter(
+            "sqlgold_circuit_breaker_transitions_total", db="breaker_db", state=OPEN
+        )
+        self.assertEqual(opened.value, 2)
+
+    def test_health_by_alias(self):
+        os.makedirs(self.dir)
+        health = DBManager.get_manager().health()["breaker_db"]
+        self.assertTrue(health["ok"])
+        self.assertGreater(health["latency_ms"], 0)
+        self.assertEqual(health["pool"]["checked_in"], 1)
+        self.assertNotIn("breaker", health)
+
+
+if __name__ == "__main__":
+    unittest.main()
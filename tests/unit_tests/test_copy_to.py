@@ -0,0 +1,208 @@
+"""Unit tests for DB.copy_to"""
+
+import unittest
+
+from typing import Optional
+
+from sqlalchemy import ForeignKey, event, func, insert, inspect, select, text
+from sqlalchemy.orm import Mapped, declarative_base, mapped_column
+
+from sqlgold import create_db
+from sqlgold.ext.copy import STATE_TABLE, dependency_layers
+from sqlgold.utils.test_db_utils import create_sqlite_test_db
+
+Base = declarative_base()
+
+
+class Author(Base):
+    __tablename__ = "author"
+
+    id: Mapped[int] = mapped_column(primary_key=True)
+    name: Mapped[str]
+
+
+class Book(Base):
+    __tablename__ = "book"
+
+    id: Mapped[int] = mapped_column(primary_key=True)
+    title: Mapped[str]
+    author_id: Mapped[int] = mapped_column(ForeignKey("author.id"))
+
+
+class Review(Base):
+    __tablename__ = "review"
+
+    id: Mapped[int] = mapped_column(primary_key=True)
+    book_id: Mapped[int] = mapped_column(ForeignKey("book.id"))
+    stars: Mapped[int]
+
+
+class Tag(Base):
+    __tablename__ = "tag"
+
+    name: Mapped[str] = mapped_column(primary_key=True)
+    kind: Mapped[str] = mapped_column(primary_key=True)
+
+
+TreeBase = declarative_base()
+
+
+class Node(TreeBase):
+    __tablename__ = "node"
+
+    id: Mapped[int] = mapped_column(primary_key=True)
+    parent_id: Mapped[Optional[int]] = mapped_column(ForeignKey("node.id"))
+    owner_id: Mapped[Optional[int]] = mapped_column(ForeignKey("owner.id"))
+
+
+class Owner(TreeBase):
+    __tablename__ = "owner"
+
+    id: Mapped[int] = mapped_column(primary_key=True)
+    root_id: Mapped[Optional[int]] = mapped_column(ForeignKey("node.id"))
+
+
+class Interrupted(Exception):
+    pass
+
+
+class TestCopyTo(unittest.TestCase):
+    def setUp(self):
+        self.source = self.enterContext(
+            create_sqlite_test_db("source.sqlite", Base=Base, create_all=True)
+        )
+        self.target = self.enterContext(
+            create_sqlite_test_db("target.sqlite", Base=None)
+        )
+        with self.source.Session.begin() as session:
+            session.execute(
+                insert(Author), [{"id": i, "name": f"a{i}"} for i in range(10)]
+            )
+            session.execute(
+                insert(Book),
+                [{"id": i, "title": f"b{i}", "author_id": i % 10} for i in range(95)],
+            )
+            session.execute(
+                insert(Review),
+                [{"id": i, "book_id": i % 95, "stars": i % 5} for i in range(200)],
+            )
+            session.execute(
+                insert(Tag), [{"name": f"t{i}", "kind": f"k{i % 3}"} for i in range(30)]
+            )
+
+    def count(self, table: str) -> int:
+        with self.target.engine.connect() as connection:
+            return connection.execute(text(f"SELECT count(*) FROM {table}")).scalar()
+
+    def test_copy_everything(self):
+        result = self.source.copy_to(self.target, chunk_size=20)
+        self.assertEqual(
+            result.rows, {"author": 10, "tag": 30, "book": 95, "review": 200}
+        )
+        self.assertEqual(self.count("review"), 200)
+        self.assertIn("book", inspect(self.target.engine).get_table_names())
+
+        ## a second copy skips the completed tables
+        result = self.source.copy_to(self.target)
+        self.assertEqual(result.rows, {})
+        self.assertEqual(sorted(result.skipped), ["author", "book", "review", "tag"])
+
+        ## or starts over
+        result = self.source.copy_to(self.target, resume=False)
+        self.assertEqual(result.rows["review"], 200)
+        self.assertEqual(self.count("review"), 200)
+
+    def test_subset_with_where(self):
+        result = self.source.copy_to(
+            self.target,
+            tables=[Book, "review"],
+            where={"book": Book.author_id < 2, "review": "stars = 4"},
+        )
+        self.assertEqual(result.rows, {"book": 20, "review": 40})
+        ## the foreign key to the author table, which wasn't copied, is dropped
+        fks = inspect(self.target.engine).get_foreign_keys("book")
+        self.assertEqual(fks, [])
+
+    def test_resume_after_interruption(self):
+        def interrupt(table, rows):
+            if table == "review" and rows >= 60:
+                raise Interrupted()
+
+        with self.assertRaises(Interrupted):
+            self.source.copy_to(self.target, chunk_size=30, progress=interrupt)
+        self.assertEqual(self.count("review"), 60)
+
+        copied = {}
+        result = self.source.copy_to(
+            self.target,
+            chunk_size=30,
+            progress=lambda table, rows: copied.__setitem__(table, rows),
+        )
+        self.assertEqual(result.rows, {"review": 140})
+        self.assertEqual(self.count("review"), 200)
+        with self.target.engine.connect() as connection:
+            done = connection.execute(
+                text(f"SELECT count(*) FROM {STATE_TABLE}")
+            ).scalar()
+        self.assertEqual(done, 4)
+
+    def test_reflected_source(self):
+        source = create_db(str(self.source.url), Base=None)
+        result = source.copy_to(self.target, tables=["author", "book"], workers=1)
+        self.assertEqual(result.rows, {"author": 10, "book": 95})
+        source.engine.dispose()
+
+    def test_memory_target(self):
+        target = create_db("sqlite://", Base=None)
+        result = self.source.copy_to(target, workers=8)
+        self.assertEqual(sum(result.rows.values()), 335)
+        with target.engine.connect() as connection:
+            self.assertEqual(
+                connection.execute(select(func.count()).select_from(Book)).scalar(),
+                95,
+            )
+
+    def test_self_reference_and_cycle_with_foreign_keys_on(self):
+        source = self.enterContext(
+            create_sqlite_test_db("tree.sqlite", Base=TreeBase, create_all=True)
+        )
+        target = self.enterContext(create_sqlite_test_db("tree_copy.sqlite", Base=None))
+
+        @event.listens_for(target.engine, "connect")
+        def foreign_keys_on(dbapi_connection, connection_record):
+            dbapi_connection.execute("PRAGMA foreign_keys = ON")
+
+        ## children come before their parents in primary key order
+        nodes = [
+            {"id": i, "parent_id": i + 1 if i < 49 else None, "owner_id": i % 5}
+            for i in range(50)
+        ]
+        owners = [{"id": i, "root_id": 49} for i in range(5)]
+        with source.Session.begin() as session:
+            session.execute(insert(Node), nodes)
+            session.execute(insert(Owner), owners)
+
+        result = source.copy_to(target, chunk_size=7)
+        self.assertEqual(result.rows, {"node": 50, "owner": 5})
+        with target.engine.connect() as connection:
+            self.assertEqual(
+                [dict(r._mapping) for r in connection.execute(select(Node))], nodes
+            )
+            self.assertEqual(
+                [dict(r._mapping) for r in connection.execute(select(Owner))], owners
+            )
+            self.assertEqual(
+                connection.exec_driver_sql("PRAGMA foreign_key_check").all(), []
+            )
+
+    def test_dependency_layers(self):
+        tables = [Base.metadata.tables[n] for n in ("review", "tag", "book", "author")]
+        layers = dependency_layers(tables)
+        self.assertEqual(
+            [sorted(t.name for t in layer) for layer in layers],
+            [["author", "tag"], ["book"], ["review"]],
+        )
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,136 @@
+"""Unit tests for DB.count"""
+
+import time
+import unittest
+
+from sqlalchemy import ForeignKey, delete, insert, text
+from sqlalchemy.orm import Mapped, declarative_base, mapped_column
+
+from sqlgold import create_db
+from sqlgold.ext.counts import COUNTS_TABLE
+from sqlgold.utils.test_db_utils import create_sqlite_test_db
+
+Base = declarative_base()
+
+
+class Customer(Base):
+    __tablename__ = "customer"
+
+    id: Mapped[int] = mapped_column(primary_key=True)
+    country: Mapped[str] = mapped_column(index=True)
+
+
+class Order(Base):
+    __tablename__ = "orders"
+
+    id: Mapped[int] = mapped_column(primary_key=True)
+    customer_id: Mapped[int] = mapped_column(ForeignKey("customer.id"))
+
+
+class TestCount(unittest.TestCase):
+    def setUp(self):
+        self.db = self.enterContext(
+            create_sqlite_test_db("count.sqlite", Base=Base, create_all=True)
+        )
+        with self.db.Session.begin() as session:
+            session.execute(
+                insert(Customer),
+                [{"id": i, "country": "NL" if i % 4 else "BE"} for i in range(100)],
+            )
+
+    def tearDown(self):
+        self.db.disable_maintained_counts()
+
+    def test_exact(self):
+        self.assertEqual(self.db.count(Customer), 100)
+        self.assertEqual(self.db.count("customer"), 100)
+        self.assertEqual(self.db.count(Customer, where=Customer.country == "BE"), 25)
+        self.assertEqual(self.db.count(Customer, where="country = 'NL'"), 75)
+        with self.assertRaises(ValueError):
+            self.db.count(Customer, mode="guess")
+        with self.assertRaises(ValueError):
+            self.db.count(Customer, where=Customer.id > 1, mode="approximate")
+
+    def test_approximate(self):
+        ## no statistics yet, counted exactly
+        self.assertEqual(self.db.count(Customer, mode="approximate"), 100)
+        with self.db.engine.begin() as connection:
+            connection.execute(text("ANALYZE"))
+            connection.execute(delete(Customer.__table__).where(Customer.id >= 50))
+        ## the statistics are as of ANALYZE
+        self.assertEqual(self.db.count(Customer, mode="approximate"), 100)
+        self.assertEqual(self.db.count(Customer), 50)
+
+    def test_maintained(self):
+        with self.assertRaises(RuntimeError):
+            self.db.count(Customer, mode="maintained")
+        self.db.enable_maintained_counts(Customer)
+        self.assertEqual(self.db.count(Customer, mode="maintained"), 100)
+        with self.db.Session.begin() as session:
+            session.add_all(
+                [Customer(id=100, country="DE"), Order(id=1, customer_id=1)]
+            )
+        with self.db.Session.begin() as session:
+            session.delete(session.get(Customer, 0))
+            session.delete(session.get(Customer, 1))
+        with self.db.Session() as session:
+            session.add(Customer(id=101, country="DE"))
+            session.flush()
+            session.rollback()
+        self.assertEqual(self.db.count(Customer, mode="maintained"), 99)
+
+        ## the counter is split over shard rows
+        with self.db.engine.connect() as connection:
+            shards = connection.execute(
+                text(
+                    f"SELECT count(*) FROM {COUNTS_TABLE} WHERE table_name = 'customer'"
+                )
+            ).scalar()
+        self.assertEqual(shards, self.db.row_counts.shards)
+        self.assertNotIn("orders", self.db.row_counts.tables)
+        with self.assertRaises(ValueError):
+            self.db.count(Order, mode="maintained")
+
+    def test_tracked_across_processes(self):
+        self.db.enable_maintained_counts(Customer, reconcile_interval=None)
+        ## another process writing to the db, it tracks what the first one does
+        other = create_db(str(self.db.url), Base=Base)
+        try:
+            other.enable_maintained_counts(reconcile_interval=None)
+            self.assertIn("customer", other.row_counts.tables)
+            with other.Session.begin() as session:
+                session.add(Customer(id=100, country="DE"))
+            self.assertEqual(self.db.count(Customer, mode="maintained"), 101)
+
+            ## tables tracked later are picked up when counting
+            self.db.enable_maintained_counts(Customer, Order, reconcile_interval=None)
+            self.assertEqual(other.count(Order, mode="maintained"), 0)
+        finally:
+            other.disable_maintained_counts()
+            other.engine.dispose()
+
+    def test_reconcile(self):
+        counts = self.db.enable_maintained_counts(
+            Customer, shards=2, reconcile_interval=None
+        )
+        with self.db.Session.begin() as session:
+            ## bulk statements don't go through the flush
+            session.execute(insert(Customer), [{"id": 200, "country": "FR"}])
+        self.assertEqual(self.db.count(Customer, mode="maintained"), 100)
+        self.assertEqual(counts.reconcile(), {"customer": 1})
+        self.assertEqual(self.db.count(Customer, mode="maintained"), 101)
+        self.assertEqual(counts.reconcile(), {"customer": 0})
+
+    def test_reconcile_thread(self):
+        self.db.enable_maintained_counts(Customer, reconcile_interval=0.05)
+        with self.db.engine.begin() as connection:
+            connection.execute(delete(Customer.__table__))
+        for __ in range(100):
+            if self.db.count(Customer, mode="maintained") == 0:
+                break
+            time.sleep(0.02)
+        self.assertEqual(self.db.count(Customer, mode="maintained"), 0)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,134 @@
+"""Unit tests for session deadlines and statement timeouts"""
+
+import time
+import unittest
+from types import SimpleNamespace
+from unittest import mock
+
+from sqlalchemy import text
+
+from sqlgold.dialects.mysql import MysqlDB
+from sqlgold.dialects.sqlite3 import Sqlite3DB
+from sqlgold.engine import deadline
+from sqlgold.exceptions import StatementTimeoutError
+from sqlgold.metrics import MetricsRegistry
+from sqlgold.utils.test_db_utils import create_sqlite_test_db
+
+## Counts forever, only an interrupt ends it
+ENDLESS = text(
+    "WITH RECURSIVE r(i) AS (SELECT 1 UNION ALL SELECT i + 1 FROM r) "
+    "SELECT count(*) FROM r"
+)
+## Takes a few milliseconds
+SHORT = text(
+    "WITH RECURSIVE r(i) AS (SELECT 1 UNION ALL SELECT i + 1 FROM r WHERE i < 20000) "
+    "SELECT count(*) FROM r"
+)
+
+
+class TestDeadlines(unittest.TestCase):
+    def setUp(self):
+        self.db = self.enterContext(
+            create_sqlite_test_db("deadlines.sqlite", Base=None, alias="deadline_db")
+        )
+        self.registry = MetricsRegistry()
+        self.db.enable_metrics(self.registry)
+
+    def tearDown(self):
+        self.db.disable_metrics()
+        if self.db.deadlines is not None:
+            self.db.deadlines.detach()
+
+    def test_session_timeout_interrupts_statement(self):
+        self.assertIsInstance(self.db, Sqlite3DB)
+        start = time.monotonic()
+        with self.db.Session(timeout_ms=100) as session:
+            with self.assertRaises(StatementTimeoutError) as cm:
+                session.execute(ENDLESS).scalar()
+            self.assertLess(time.monotonic() - start, 2)
+            session.rollback()
+
+        self.assertIn("WITH RECURSIVE", cm.exception.fingerprint)
+        self.assertGreater(cm.exception.timeout_ms, 0)
+        fingerprints = self.db.deadlines.timed_out_fingerprints()
+        self.assertEqual(fingerprints, {cm.exception.fingerprint: 1})
+        counters = self.registry.collect("sqlgold_statement_timeouts_total")
+        self.assertEqual(sum(c.value for c in counters), 1)
+
+        ## the connection was not invalidated and has no handler left
+        with self.db.Session() as session:
+            self.assertEqual(session.execute(SHORT).scalar(), 20000)
+
+    def test_session_budget_spans_statements(self):
+        now = [1000.0]
+        with mock.patch.object(deadline, "_clock", lambda: now[0]):
+            with self.db.Session(timeout_ms=50) as session:
+                self.assertEqual(session.execute(text("SELECT 1")).scalar(), 1)
+                now[0] += 0.06
+                with self.assertRaises(StatementTimeoutError) as cm:
+                    session.execute(text("SELECT 2"))
+            with self.db.deadline(50) as block:
+                now[0] += 0.06
+                self.assertAlmostEqual(block.remaining_ms(), -10)
+                self.assertTrue(block.expired)
+        self.assertEqual(cm.exception.timeout_ms, 0)
+
+    def test_deadline_block(self):
+        with self.db.deadline(100) as deadline:
+            self.assertGreater(deadline.remaining_ms(), 0)
+            with self.db.engine.connect() as connection:
+                with self.assertRaises(StatementTimeoutError):
+                    connection.execute(ENDLESS).scalar()
+        ## outside of the block nothing is limited
+        with self.db.engine.connect() as connection:
+            self.assertEqual(connection.execute(SHORT).scalar(), 20000)
+
+    def test_nested_deadlines_only_shorten(self):
+        with self.db.deadline(50) as outer:
+            with self.db.deadline(10000) as inner:
+                self.assertEqual(inner.expires_at, outer.expires_at)
+            with self.db.deadline(10) as inner:
+                self.assertLess(inner.expires_at, outer.expires_at)
+
+    def test_earliest_of_session_and_block_wins(self):
+        with self.db.deadline(10000):
+            with self.db.Session(timeout_ms=50) as session:
+                with self.assertRaises(StatementTimeoutError) as cm:
+                    session.execute(ENDLESS).scalar()
+        self.assertLessEqual(cm.exception.timeout_ms, 50)
+
+    def test_no_deadline_no_listeners(self):
+        with self.db.Session() as session:
+            session.execute(text("SELECT 1"))
+        self.assertIsNone(self.db.deadlines)
+
+
+class TestMysqlDeadlineHints(unittest.TestCase):
+    def apply(self, statement, is_mariadb=False):
+        connection = SimpleNamespace(dialect=SimpleNamespace(is_mariadb=is_mariadb))
+        return MysqlDB._apply_statement_deadline(
+            None, connection, None, statement, 1500.7
+        )
+
+    def test_mysql_hints_selects(self):
+        self.assertEqual(
+            self.apply("SELECT id FROM t WHERE x = %s"),
+            "SELECT /*+ MAX_EXECUTION_TIME(1500) */ id FROM t WHERE x = %s",
+        )
+        self.assertEqual(self.apply("UPDATE t SET x = 1"), "UPDATE t SET x = 1")
+
+    def test_mariadb_limits_statements(self):
+        self.assertEqual(
+            self.apply("UPDATE t SET x = 1", is_mariadb=True),
+            "SET STATEMENT max_statement_time=1.501 FOR UPDATE t SET x = 1",
+        )
+        insert = "INSERT INTO t (x) VALUES (%s)"
+        self.assertEqual(self.apply(insert, is_mariadb=True), insert)
+
+    def test_timeout_errors(self):
+        self.assertTrue(MysqlDB.is_statement_timeout(Exception(3024, "timeout")))
+        self.assertFalse(MysqlDB.is_statement_timeout(Exception(1205, "lock")))
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,169 @@
+"""Unit tests for DB.explain, the index advisor and the slow query log"""
+
+import time
+import unittest
+
+from sqlalchemy import ForeignKey, Index, event, select, text, update
+from sqlalchemy.orm import Mapped, aliased, declarative_base, mapped_column
+
+from sqlgold import create_db
+from sqlgold.engine.db import DB
+from sqlgold.exceptions import UnsupportedDialectError
+from sqlgold.ext.explain import (
+    FULL_SCAN,
+    INDEX_LOOKUP,
+    INDEX_SCAN,
+    TEMP,
+    parse_mysql_plan,
+)
+from sqlgold.metrics import MetricsRegistry
+
+Base = declarative_base()
+
+
+class Customer(Base):
+    __tablename__ = "customer"
+
+    id: Mapped[int] = mapped_column(primary_key=True)
+    email: Mapped[str] = mapped_column(unique=True)
+    country: Mapped[str]
+    created: Mapped[int]
+
+
+class Order(Base):
+    __tablename__ = "orders"
+    __table_args__ = (Index("ix_orders_status", "status"),)
+
+    id: Mapped[int] = mapped_column(primary_key=True)
+    customer_id: Mapped[int] = mapped_column(ForeignKey("customer.id"))
+    status: Mapped[str]
+    total: Mapped[float]
+
+
+class TestExplain(unittest.TestCase):
+    def setUp(self):
+        self.db = create_db("sqlite:///:memory:", Base=Base, create_all=True)
+
+    def tearDown(self):
+        self.db.disable_slow_query_log()
+        self.db.engine.dispose()
+
+    def test_full_scan_and_suggestion(self):
+        plan = self.db.explain(
+            select(Customer).where(Customer.country == "NL", Customer.created > 5)
+        )
+        self.assertEqual([s.access for s in plan.steps], [FULL_SCAN])
+        self.assertEqual(plan.steps[0].table, "customer")
+        [suggestion] = plan.suggestions
+        self.assertEqual(suggestion.columns, ("country", "created"))
+        self.assertEqual(
+            suggestion.ddl,
+            "CREATE INDEX ix_customer_country_created ON customer (country, created)",
+        )
+
+    def test_index_use(self):
+        plan = self.db.explain(select(Order).where(Order.status == "open"))
+        self.assertEqual(plan.steps[0].access, INDEX_LOOKUP)
+        self.assertEqual(plan.steps[0].index, "ix_orders_status")
+        self.assertEqual(plan.suggestions, [])
+
+        plan = self.db.explain(select(Customer.id).where(Customer.email == "x"))
+        self.assertEqual(plan.steps[0].access, INDEX_LOOKUP)
+        self.assertEqual(plan.suggestions, [])
+
+        ## the statement is only explained, not run
+        plan = self.db.explain(select(Order.status).order_by(Order.status))
+        self.assertEqual(plan.steps[0].access, INDEX_SCAN)
+
+    def test_join_and_sort(self):
+        stmt = (
+            select(Order)
+            .join(Customer)
+            .where(Customer.country == "NL")
+            .order_by(Order.total)
+        )
+        plan = self.db.explain(stmt)
+        self.assertIn(TEMP, [s.access for s in plan.steps])
+        tables = {s.table for s in plan.full_scans}
+        suggested = {s.table: s.columns for s in plan.suggestions}
+        for table in tables:
+            self.assertIn(table, suggested)
+        if "orders" in suggested:
+            self.assertEqual(suggested["orders"], ("customer_id",))
+
+    def test_alias_text_and_update(self):
+        customer = aliased(Customer)
+        plan = self.db.explain(select(customer).where(customer.country == "NL"))
+        self.assertEqual(plan.suggestions[0].columns, ("country",))
+
+        plan = self.db.explain(
+            text("SELECT * FROM customer WHERE country = :c"), {"c": "NL"}
+        )
+        self.assertEqual(plan.full_scans[0].table, "customer")
+        self.assertEqual(plan.suggestions, [])
+
+        plan = self.db.explain(
+            update(Customer).where(Customer.created < 3).values(country="X")
+        )
+        self.assertEqual(plan.suggestions[0].columns, ("created",))
+
+    def test_slow_query_log(self):
+        registry = MetricsRegistry()
+        self.db.enable_metrics(registry)
+        captured = []
+        log = self.db.enable_slow_query_log(threshold_ms=20, on_capture=captured.append)
+
+        ## make every statement on customer slow
+        @event.listens_for(self.db.engine, "before_cursor_execute")
+        def slow(conn, cursor, statement, parameters, context, executemany):
+            if "FROM customer" in statement:
+                time.sleep(0.03)
+
+        with self.db.Session() as session:
+            for country in ("NL", "DE"):
+                session.execute(select(Customer).where(Customer.country == country))
+            session.execute(select(Order).where(Order.status == "open"))
+
+        self.assertEqual(len(captured), 2)
+        self.assertGreaterEqual(captured[0].elapsed_ms, 20)
+        self.assertIs(captured[0].plan, captured[1].plan)
+        self.assertEqual(captured[0].plan.full_scans[0].table, "customer")
+        [(fingerprint, summary)] = log.summary().items()
+        self.assertEqual(summary["count"], 2)
+        self.assertEqual([s.columns for s in log.suggestions()], [("country",)])
+        counters = registry.collect("sqlgold_slow_queries_total")
+        self.assertEqual(sum(c.value for c in counters), 2)
+
+        event.remove(self.db.engine, "before_cursor_execute", slow)
+        self.db.disable_metrics()
+
+    def test_parse_mysql_plan(self):
+        rows = [
+            {
+                "table": "c",
+                "type": "ALL",
+                "key": None,
+                "rows": 1000,
+                "Extra": "Using where; Using filesort",
+            },
+            {"table": "o", "type": "ref", "key": "ix_o_c", "rows": 3, "Extra": None},
+            {"table": "x", "type": "index", "key": "PRIMARY", "rows": 10},
+        ]
+        steps = parse_mysql_plan(rows)
+        self.assertEqual(
+            [(s.table, s.access) for s in steps],
+            [("c", FULL_SCAN), ("c", TEMP), ("o", INDEX_LOOKUP), ("x", INDEX_SCAN)],
+        )
+        self.assertEqual(steps[0].rows, 1000.0)
+        self.assertEqual(steps[2].index, "ix_o_c")
+
+    def test_unsupported_dialect(self):
+        ## the base DB has no EXPLAIN parser
+        with self.assertRaises(UnsupportedDialectError) as raised:
+            DB._explain_statement(self.db, None, "SELECT 1", ())
+        self.assertEqual(raised.exception.backend, "sqlite")
+        self.assertIsInstance(raised.exception, ValueError)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,83 @@
+"""Unit tests for DB.fetch_arrays"""
+import datetime
+import unittest
+from decimal import Decimal
+
+from sqlalchemy import Numeric, insert, select
+from sqlalchemy.orm import Mapped, declarative_base, mapped_column
+
+from sqlgold import create_db
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+Base = declarative_base()
+
+
+class Trade(Base):
+    __tablename__ = "trade"
+
+    id: Mapped[int] = mapped_column(primary_key=True)
+    symbol: Mapped[str]
+    price: Mapped[Decimal] = mapped_column(Numeric(10, 2))
+    volume: Mapped[float | None]
+    at: Mapped[datetime.datetime]
+
+
+START = datetime.datetime(2024, 1, 1)
+
+
+@unittest.skipIf(np is None, "requires numpy")
+class TestFetchArrays(unittest.TestCase):
+    def setUp(self):
+        self.db = create_db("sqlite:///:memory:", Base=Base, create_all=True)
+        rows = [
+            {
+                "id": i,
+                "symbol": f"S{i % 3}",
+                "price": Decimal(i) / 4,
+                "volume": None if i % 10 == 0 else float(i),
+                "at": START + datetime.timedelta(minutes=i),
+            }
+            for i in range(250)
+        ]
+        with self.db.Session.begin() as s:
+            s.execute(insert(Trade), rows)
+
+    def test_columns(self):
+        arrays = self.db.fetch_arrays(select(Trade).order_by(Trade.id), chunk_size=16)
+        self.assertEqual(list(arrays), ["id", "symbol", "price", "volume", "at"])
+        self.assertEqual(arrays["id"].dtype, np.int64)
+        np.testing.assert_array_equal(arrays["id"], np.arange(250))
+        self.assertEqual(arrays["price"].dtype, np.float64)
+        self.assertAlmostEqual(arrays["price"][5], 1.25)
+        self.assertEqual(arrays["symbol"][4], "S1")
+        self.assertEqual(arrays["at"].dtype, np.dtype("datetime64[us]"))
+        self.assertEqual(arrays["at"][3], np.datetime64("2024-01-01T00:03"))
+
+        volume = arrays["volume"]
+        self.assertIsInstance(volume, np.ma.MaskedArray)
+        self.assertEqual(volume.mask.sum(), 25)
+        self.assertEqual(volume.sum(), sum(i for i in range(250) if i % 10))
+        self.assertNotIsInstance(arrays["id"], np.ma.MaskedArray)
+
+    def test_dtypes_and_structured(self):
+        stmt = select(Trade.id, Trade.volume).where(Trade.id < 20)
+        record = self.db.fetch_arrays(
+            stmt, dtypes={"id": "int32"}, chunk_size=7, structured=True
+        )
+        self.assertEqual(record.dtype.names, ("id", "volume"))
+        self.assertEqual(record.dtype["id"], np.int32)
+        self.assertEqual(len(record), 20)
+        self.assertTrue(record.mask["volume"][10])
+        self.assertFalse(record.mask["id"].any())
+
+    def test_empty(self):
+        arrays = self.db.fetch_arrays(select(Trade.id).where(Trade.id < 0))
+        self.assertEqual(len(arrays["id"]), 0)
+
+
+if __name__ == "__main__":
+    unittest.main()
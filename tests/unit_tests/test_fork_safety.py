@@ -0,0 +1,84 @@
+"""Unit tests for using DBs across fork and in worker processes"""
+
+import multiprocessing
+import os
+import pickle
+import unittest
+
+from sqlalchemy import func, select
+from sqlalchemy.orm import Mapped, declarative_base, mapped_column
+
+from sqlgold.dialects.sqlite3 import Sqlite3DB
+from sqlgold.utils.test_db_utils import create_sqlite_test_db
+
+Base = declarative_base()
+
+
+class TClass(Base):
+    __tablename__ = "tclass"
+
+    id: Mapped[int] = mapped_column(primary_key=True)
+
+
+def insert_ids(db, ids):
+    with db.Session.begin() as s:
+        s.add_all([TClass(id=i) for i in ids])
+    return len(ids)
+
+
+def child_pool_state(db, queue):
+    ## the parent's pooled connection must not be reused by the child
+    checked_in = db.engine.pool.checkedin()
+    insert_ids(db, [100])
+    queue.put(checked_in)
+
+
+@unittest.skipUnless(hasattr(os, "fork"), "requires fork")
+class TestForkSafety(unittest.TestCase):
+    def setUp(self):
+        self.db = self.enterContext(
+            create_sqlite_test_db(
+                "fork.sqlite", Base=Base, create_all=True, pool_pre_ping=True
+            )
+        )
+        self.ctx = multiprocessing.get_context("fork")
+
+    def count(self) -> int:
+        with self.db.Session() as s:
+            return s.scalar(select(func.count()).select_from(TClass))
+
+    def test_pickle_by_configuration(self):
+        copy = pickle.loads(pickle.dumps(self.db))
+        self.assertIsInstance(copy, Sqlite3DB)
+        self.assertIsNot(copy.engine, self.db.engine)
+        self.assertEqual(str(copy.url), str(self.db.url))
+        self.assertIs(copy.Base, Base)
+        self.assertEqual(copy.engine_kwargs, {"pool_pre_ping": True})
+        self.assertEqual(copy.alias, self.db.alias)
+        insert_ids(copy, [1])
+        self.assertEqual(self.count(), 1)
+
+    def test_fork_discards_inherited_pool(self):
+        self.assertEqual(self.count(), 0)  ## leaves a connection in the pool
+        self.assertEqual(self.db.engine.pool.checkedin(), 1)
+        queue = self.ctx.Queue()
+        p = self.ctx.Process(target=child_pool_state, args=(self.db, queue))
+        p.start()
+        checked_in = queue.get(timeout=30)
+        p.join(30)
+        self.assertEqual(p.exitcode, 0)
+        self.assertEqual(checked_in, 0)
+        ## the parent's connection still works
+        self.assertEqual(self.count(), 1)
+
+    def test_worker_pool(self):
+        with self.ctx.Pool(4) as pool:
+            results = pool.starmap(
+                insert_ids, [(self.db, range(i * 10, i * 10 + 10)) for i in range(8)]
+            )
+        self.assertEqual(sum(results), 80)
+        self.assertEqual(self.count(), 80)
+
+
+if __name__ == "__main__":
+    unittest.main()
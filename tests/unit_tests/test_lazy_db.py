@@ -0,0 +1,80 @@
+"""Unit tests for lazy dbs and DB.warmup"""
+
+import os
+import pickle
+import threading
+import unittest
+
+from sqlalchemy import select
+from sqlalchemy.orm import Mapped, declarative_base, mapped_column
+
+from sqlgold import create_db
+from sqlgold.dialects.sqlite3 import Sqlite3DB
+from sqlgold.utils.test_db_utils import create_sqlite_test_db
+
+Base = declarative_base()
+
+
+class TClass(Base):
+    __tablename__ = "tclass"
+
+    id: Mapped[int] = mapped_column(primary_key=True)
+
+
+class TestLazyDB(unittest.TestCase):
+    def create(self, **kwargs) -> Sqlite3DB:
+        return self.enterContext(
+            create_sqlite_test_db("lazy.sqlite", Base=Base, lazy=True, **kwargs)
+        )
+
+    def test_lazy_until_first_session(self):
+        db = self.create(create_all=True, pool_size=3)
+        self.assertIsInstance(db, Sqlite3DB)
+        self.assertTrue(db.is_lazy)
+        self.assertEqual(os.path.basename(db.database), "lazy.sqlite")
+        self.assertFalse(os.path.exists(db.database))
+        self.assertTrue(db.is_lazy)  ## repr and url don't connect
+
+        copy = pickle.loads(pickle.dumps(db))
+        self.assertTrue(copy.is_lazy)
+
+        with db.Session.begin() as s:
+            s.add(TClass(id=1))
+        self.assertFalse(db.is_lazy)
+        self.assertEqual(db.engine.pool.size(), 3)
+        with copy.Session() as s:
+            self.assertEqual(s.scalars(select(TClass.id)).all(), [1])
+        copy.engine.dispose()
+
+    def test_concurrent_first_use(self):
+        db = self.create(create_all=True)
+        engines = []
+        barrier = threading.Barrier(8)
+
+        def use():
+            barrier.wait()
+            with db.Session() as s:
+                s.scalars(select(TClass)).all()
+            engines.append(db.engine)
+
+        threads = [threading.Thread(target=use) for __ in range(8)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        self.assertEqual(len(engines), 8)
+        self.assertEqual(len(set(map(id, engines))), 1)
+
+    def test_warmup(self):
+        db = self.create(pool_size=4)
+        self.assertEqual(db.warmup(3), 3)
+        self.assertEqual(db.engine.pool.checkedin(), 3)
+        self.assertEqual(db.warmup(10), 4)  ## capped at the pool size
+        self.assertEqual(db.engine.pool.checkedin(), 4)
+
+        memory = create_db("sqlite:///:memory:", Base=Base)
+        self.assertEqual(memory.warmup(5), 1)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,136 @@
+"""Unit tests for the load generator and python -m sqlgold.load"""
+
+import datetime
+import decimal
+import io
+import json
+import os
+import unittest
+from contextlib import redirect_stdout
+
+from sqlalchemy import ForeignKey, Numeric, func, select
+from sqlalchemy.orm import Mapped, declarative_base, mapped_column
+
+from sqlgold import load
+from sqlgold.config import cfg, set_database_config
+from sqlgold.ext.loadgen import load_targets, parse_mix, populate, run_load
+from sqlgold.utils.test_db_utils import create_sqlite_test_db
+
+Base = declarative_base()
+
+
+class Customer(Base):
+    __tablename__ = "customer"
+
+    id: Mapped[int] = mapped_column(primary_key=True)
+    name: Mapped[str]
+
+
+class Order(Base):
+    __tablename__ = "orders"
+
+    id: Mapped[int] = mapped_column(primary_key=True)
+    customer_id: Mapped[int] = mapped_column(ForeignKey("customer.id"))
+    total: Mapped[decimal.Decimal] = mapped_column(Numeric(10, 2))
+    created_at: Mapped[datetime.datetime]
+
+
+class TestLoad(unittest.TestCase):
+    def setUp(self):
+        self.db = self.enterContext(
+            create_sqlite_test_db("load.sqlite", Base=Base, create_all=True)
+        )
+        self.url = str(self.db.url)
+        self.dir = os.path.dirname(self.db.database)
+
+    def test_parse_mix(self):
+        self.assertEqual(parse_mix("read=3, insert=1"), {"read": 3.0, "insert": 1.0})
+        self.assertEqual(parse_mix({"read": 1, "scan": 0}), {"read": 1.0})
+        with self.assertRaises(ValueError):
+            parse_mix("delete=1")
+        with self.assertRaises(ValueError):
+            parse_mix("read")
+
+    def test_populate(self):
+        targets = load_targets(self.db)
+        self.assertEqual([t.table.name for t in targets], ["customer", "orders"])
+        self.assertFalse(targets[0].supports("read"))  ## empty
+        self.assertEqual(populate(self.db, targets, 50), 100)
+        self.assertEqual((targets[1].lower, targets[1].upper), (1, 50))
+        self.assertTrue(
+            all(t.supports(op) for t in targets for op in ("read", "update"))
+        )
+        self.assertEqual(targets[1].updatable, ["total", "created_at"])
+        with self.db.engine.connect() as connection:
+            orphans = connection.execute(
+                select(func.count())
+                .select_from(Order)
+                .where(Order.customer_id.not_in(select(Customer.id)))
+            ).scalar()
+        self.assertEqual(orphans, 0)
+
+    def test_closed_loop(self):
+        report = run_load(
+            self.db, workers=2, warmup=0.1, duration=0.5, populate_rows=100
+        )
+        self.assertEqual(set(report.operations), {"read", "scan", "insert", "update"})
+        self.assertGreater(report.total.count, 10)
+        self.assertEqual(
+            report.total.count, sum(r.count for r in report.operations.values())
+        )
+        read = report.operations["read"]
+        self.assertLessEqual(read.p50_ms, read.p99_ms)
+        self.assertIn("read", report.to_text())
+        with self.db.engine.connect() as connection:
+            orders = connection.execute(
+                select(func.count()).select_from(Order)
+            ).scalar()
+        self.assertGreater(orders, 100)
+
+    def test_open_loop(self):
+        populate(self.db, load_targets(self.db), 20)
+        report = run_load(
+            self.db, mix="read=1", workers=2, rate=100, warmup=0, duration=0.5
+        )
+        self.assertAlmostEqual(report.total.count, 50, delta=5)
+        self.assertEqual(list(report.operations), ["read"])
+
+    def test_mix_without_tables(self):
+        ## the tables are empty, there is nothing to read
+        with self.assertRaises(ValueError):
+            run_load(self.db, mix="read=1", warmup=0, duration=0.1)
+
+    def test_command_line(self):
+        saved = dict(cfg)
+        set_database_config(
+            {"load": {"orders": {"db": self.url, "populate": 20, "mix": {"read": 1}}}}
+        )
+        path = os.path.join(self.dir, "report.json")
+        try:
+            out = io.StringIO()
+            with redirect_stdout(out):
+                load.main(
+                    [
+                        "--config-section",
+                        "load.orders",
+                        "--workers",
+                        "1",
+                        "--warmup",
+                        "0",
+                        "--duration",
+                        "0.2",
+                        "--json",
+                        path,
+                    ]
+                )
+        finally:
+            set_database_config(saved)
+        self.assertIn("closed loop", out.getvalue())
+        with open(path) as fp:
+            report = json.load(fp)
+        self.assertEqual(report["workers"], 1)
+        self.assertGreater(report["operations"]["read"]["count"], 0)
+
+
+if __name__ == "__main__":
+    unittest.main()
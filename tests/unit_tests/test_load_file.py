@@ -0,0 +1,150 @@
+"""Unit tests for DB.load_file"""
+
+import bz2
+import csv
+import datetime
+import gzip
+import json
+import os
+import unittest
+
+from sqlalchemy import Index, event, func, select
+from sqlalchemy.orm import Mapped, declarative_base, mapped_column
+
+from sqlgold.dialects.mysql import mysql_charset
+from sqlgold.utils.test_db_utils import create_sqlite_test_db
+
+Base = declarative_base()
+
+
+class Reading(Base):
+    __tablename__ = "reading"
+    __table_args__ = (Index("ix_reading_sensor", "sensor"),)
+
+    id: Mapped[int] = mapped_column(primary_key=True)
+    sensor: Mapped[str]
+    value: Mapped[float | None]
+    at: Mapped[datetime.datetime]
+
+
+START = datetime.datetime(2024, 1, 1)
+N = 2500
+
+
+def records():
+    for i in range(N):
+        yield {
+            "id": i,
+            "sensor": f"s{i % 7}",
+            "value": None if i % 100 == 0 else i / 2,
+            "at": (START + datetime.timedelta(seconds=i)).isoformat(),
+        }
+
+
+class TestLoadFile(unittest.TestCase):
+    def setUp(self):
+        self.db = self.enterContext(
+            create_sqlite_test_db("load.sqlite", Base=Base, create_all=True)
+        )
+        self.dir = os.path.dirname(self.db.database)
+
+    def write_csv(self, name, opener=open):
+        path = os.path.join(self.dir, name)
+        with opener(path, "wt", newline="") as fp:
+            writer = csv.DictWriter(fp, ["id", "sensor", "value", "at"])
+            writer.writeheader()
+            for r in records():
+                writer.writerow(
+                    {**r, "value": "" if r["value"] is None else r["value"]}
+                )
+        return path
+
+    def check_loaded(self):
+        with self.db.Session() as s:
+            self.assertEqual(s.scalar(select(func.count()).select_from(Reading)), N)
+            row = s.get(Reading, 201)
+            self.assertEqual(row.sensor, "s5")
+            self.assertEqual(row.value, 100.5)
+            self.assertEqual(row.at, START + datetime.timedelta(seconds=201))
+            self.assertIsNone(s.get(Reading, 300).value)
+        with self.db.engine.connect() as c:
+            indexes = c.exec_driver_sql("PRAGMA index_list(reading)").all()
+            self.assertIn("ix_reading_sensor", [r[1] for r in indexes])
+            self.assertEqual(c.exec_driver_sql("PRAGMA synchronous").scalar(), 2)
+
+    def test_csv_gzip_with_progress(self):
+        path = self.write_csv("readings.csv.gz", gzip.open)
+        calls = []
+        rows = self.db.load_file(
+            Reading, path, batch_size=1000, progress=lambda *a: calls.append(a)
+        )
+        self.assertEqual(rows, N)
+        self.assertEqual([c[0] for c in calls], [1000, 2000, 2500])
+        self.assertEqual(calls[-1][1], calls[-1][2])  ## read the whole file
+        self.check_loaded()
+
+    def test_indexes_kept_for_readers(self):
+        path = self.write_csv("readings.csv")
+        seen = []
+
+        def progress(rows, read, size):
+            with self.db.engine.connect() as c:
+                indexes = c.exec_driver_sql("PRAGMA index_list(reading)").all()
+                seen.append([r[1] for r in indexes])
+
+        self.db.load_file(Reading, path, batch_size=1000, progress=progress)
+        self.assertEqual(seen, [["ix_reading_sensor"]] * 3)
+        self.check_loaded()
+
+    def test_ndjson_bz2(self):
+        path = os.path.join(self.dir, "readings.jsonl.bz2")
+        with bz2.open(path, "wt") as fp:
+            for r in records():
+                fp.write(json.dumps(r) + "\n")
+        self.assertEqual(self.db.load_file("reading", path), N)
+        self.check_loaded()
+
+    def test_failed_load_rolls_back(self):
+        path = self.write_csv("readings.csv")
+        with open(path, "a") as fp:
+            fp.write("1,duplicate,1.0,2024-01-01T00:00:00\n")
+        with self.assertRaises(Exception):
+            self.db.load_file(Reading.__table__, path)
+        with self.db.Session() as s:
+            self.assertEqual(s.scalar(select(func.count()).select_from(Reading)), 0)
+        with self.db.engine.connect() as c:
+            indexes = c.exec_driver_sql("PRAGMA index_list(reading)").all()
+            self.assertIn("ix_reading_sensor", [r[1] for r in indexes])
+            self.assertEqual(c.exec_driver_sql("PRAGMA synchronous").scalar(), 2)
+
+    def test_engine_beginning_its_own_transactions(self):
+        ## the pysqlite recipe: no driver transactions, BEGIN from a listener
+        engine = self.db.engine
+        engine.dispose()
+
+        @event.listens_for(engine, "connect")
+        def connect(dbapi_connection, connection_record):
+            dbapi_connection.isolation_level = None
+
+        @event.listens_for(engine, "begin")
+        def begin(connection):
+            connection.exec_driver_sql("BEGIN")
+
+        path = self.write_csv("readings.csv")
+        with engine.connect() as connection:
+            with self.db._bulk_load_context(connection, Reading.__table__):
+                self.assertTrue(connection.connection.driver_connection.in_transaction)
+            self.assertFalse(connection.in_transaction())
+            self.assertFalse(connection.connection.driver_connection.in_transaction)
+        self.assertEqual(self.db.load_file(Reading, path), N)
+        self.check_loaded()
+
+    def test_mysql_charset(self):
+        self.assertEqual(mysql_charset("UTF-8"), "utf8mb4")
+        self.assertEqual(mysql_charset("iso-8859-1"), "latin1")
+        with self.assertRaises(ValueError):
+            mysql_charset("latin1 FIELDS TERMINATED BY ';'")
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,96 @@
+"""Unit tests for in-memory sqlite dbs checkpointed to a file"""
+
+import os
+import sqlite3
+import tempfile
+import threading
+import time
+import unittest
+
+from sqlalchemy import Column, Integer, String, func, select
+from sqlalchemy.orm import declarative_base
+
+from sqlgold.dialects.sqlite3 import Sqlite3DB
+from sqlgold.metrics import MetricsRegistry
+
+Base = declarative_base()
+
+
+class Entry(Base):
+    __tablename__ = "entries"
+    id = Column(Integer, primary_key=True)
+    value = Column(String(500))
+
+
+def file_count(path: str) -> int:
+    with sqlite3.connect(path) as connection:
+        return connection.execute("SELECT count(*) FROM entries").fetchone()[0]
+
+
+class TestMemoryCheckpoints(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.tmpdir.name, "cache.sqlite")
+        self.dbs = []
+
+    def tearDown(self):
+        for db in self.dbs:
+            db.checkpointer.close()
+            db.engine.dispose()
+        self.tmpdir.cleanup()
+
+    def create(self, **kwargs) -> Sqlite3DB:
+        db = Sqlite3DB.create_memory_db(self.path, Base=Base, create_all=True, **kwargs)
+        self.dbs.append(db)
+        return db
+
+    def add(self, db: Sqlite3DB, n: int) -> None:
+        with db.Session.begin() as session:
+            session.add_all(Entry(value="x" * 400) for __ in range(n))
+
+    def test_checkpoint_and_reload(self):
+        db = self.create(checkpoint_interval=None, pages_per_step=2)
+        self.add(db, 100)
+        self.assertFalse(os.path.exists(self.path))
+        self.assertTrue(db.checkpointer.checkpoint())
+        self.assertEqual(file_count(self.path), 100)
+        ## nothing changed
+        self.assertFalse(db.checkpointer.checkpoint())
+
+        self.add(db, 10)
+        db.checkpointer.close()
+        self.assertEqual(file_count(self.path), 110)
+
+        reloaded = self.create(checkpoint_interval=None)
+        with reloaded.Session() as session:
+            self.assertEqual(session.scalar(select(func.count(Entry.id))), 110)
+
+    def test_timer_checkpoints_under_writes(self):
+        db = self.create(checkpoint_interval=0.05, pages_per_step=4)
+        registry = MetricsRegistry()
+        db.enable_metrics(registry)
+        self.add(db, 200)
+        stop = threading.Event()
+
+        def write():
+            while not stop.is_set():
+                self.add(db, 1)
+
+        writer = threading.Thread(target=write)
+        writer.start()
+        time.sleep(0.5)
+        stop.set()
+        writer.join()
+        db.disable_metrics()
+
+        self.assertGreaterEqual(db.checkpointer.checkpoints, 2)
+        histograms = registry.collect("sqlgold_sqlite_checkpoint_seconds")
+        self.assertGreaterEqual(sum(h.count for h in histograms), 2)
+        db.checkpointer.close()
+        with db.Session() as session:
+            count = session.scalar(select(func.count(Entry.id)))
+        self.assertEqual(file_count(self.path), count)
+
+
+if __name__ == "__main__":
+    unittest.main()
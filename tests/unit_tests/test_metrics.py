@@ -0,0 +1,117 @@
+"""Unit tests for sqlgold.metrics and DB metrics"""
+import json
+import os
+import tempfile
+import threading
+import unittest
+
+from sqlalchemy import select
+from sqlalchemy.orm import Mapped, declarative_base, mapped_column
+
+from sqlgold import create_db
+from sqlgold.metrics import Histogram, MetricsRegistry
+
+Base = declarative_base()
+
+
+class TClass(Base):
+    __tablename__ = "tclass"
+
+    id: Mapped[int] = mapped_column(primary_key=True)
+
+
+class TestMetrics(unittest.TestCase):
+    def test_counter_threads(self):
+        registry = MetricsRegistry()
+
+        def work():
+            for __ in range(1000):
+                registry.counter("hits", db="a").inc()
+
+        threads = [threading.Thread(target=work) for __ in range(8)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        self.assertEqual(registry.counter("hits", db="a").value, 8000)
+        self.assertEqual(registry.counter("hits", db="b").value, 0)
+
+    def test_histogram_quantiles(self):
+        h = Histogram("latency")
+        for i in range(1, 1001):
+            h.observe(i / 1000)
+        self.assertEqual(h.count, 1000)
+        self.assertAlmostEqual(h.max, 1.0)
+        self.assertAlmostEqual(h.quantile(0.5), 0.5, delta=0.5 * 0.1)
+        self.assertAlmostEqual(h.quantile(0.99), 0.99, delta=0.99 * 0.1)
+
+        merged = Histogram.from_dict(h.to_dict())
+        merged.merge(h)
+        self.assertEqual(merged.count, 2000)
+        self.assertAlmostEqual(merged.quantile(0.5), h.quantile(0.5))
+
+    def test_timer_nested_and_decorator(self):
+        registry = MetricsRegistry()
+        timer = registry.timer("op_seconds", operation="op")
+
+        @timer
+        def op():
+            with timer:
+                pass
+
+        op()
+        self.assertEqual(registry.histogram("op_seconds", operation="op").count, 2)
+
+    def test_exporters(self):
+        registry = MetricsRegistry()
+        registry.counter("queries_total", "All queries", db="main").inc(3)
+        registry.histogram("query_seconds", db="main").observe(0.25)
+        text = registry.to_prometheus()
+        self.assertIn("# HELP queries_total All queries", text)
+        self.assertIn('queries_total{db="main"} 3', text)
+        self.assertIn('query_seconds{db="main",quantile="0.99"}', text)
+        self.assertIn('query_seconds_count{db="main"} 1', text)
+
+        with tempfile.TemporaryDirectory() as tmpdir:
+            path = os.path.join(tmpdir, "metrics.json")
+            registry.write_json(path)
+            with open(path) as fp:
+                snapshot = json.load(fp)
+        values = snapshot["metrics"]["query_seconds"]["values"]
+        self.assertEqual(values[0]["labels"], {"db": "main"})
+        self.assertEqual(values[0]["count"], 1)
+
+    def test_db_metrics(self):
+        registry = MetricsRegistry()
+        db = create_db(
+            "sqlite:///:memory:", Base=Base, create_all=True, alias="metrics_db"
+        )
+        db.enable_metrics(registry)
+        with db.Session.begin() as s:
+            s.add(TClass(id=1))
+        with db.Session() as s:
+            s.scalars(select(TClass)).all()
+            s.rollback()
+
+        commits = registry.counter(
+            "sqlgold_transactions_total", db="metrics_db", outcome="commit"
+        )
+        self.assertEqual(commits.value, 1)
+        txns = registry.histogram("sqlgold_transaction_seconds", db="metrics_db")
+        self.assertEqual(txns.count, 2)
+        self.assertEqual(
+            registry.histogram("sqlgold_flush_seconds", db="metrics_db").count, 1
+        )
+        selects = registry.counter(
+            "sqlgold_statements_total", db="metrics_db", operation="select"
+        )
+        self.assertEqual(selects.value, 1)
+
+        db.disable_metrics()
+        with db.Session() as s:
+            s.scalars(select(TClass)).all()
+        self.assertEqual(selects.value, 1)
+
+
+if __name__ == "__main__":
+    unittest.main()
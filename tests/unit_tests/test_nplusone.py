@@ -0,0 +1,114 @@
+"""Unit tests for N+1 query detection and assert_max_queries"""
+import os
+import unittest
+import warnings
+from typing import List
+
+from sqlalchemy import ForeignKey, select
+from sqlalchemy.orm import Mapped, declarative_base, mapped_column, relationship
+from sqlalchemy.orm import selectinload
+
+from sqlgold import create_db
+from sqlgold.exceptions import NPlusOneError, NPlusOneWarning, TooManyQueriesError
+from sqlgold.ext import nplusone
+from sqlgold.utils.test_db_utils import assert_max_queries, create_test_db
+
+Base = declarative_base()
+
+
+class Parent(Base):
+    __tablename__ = "parent"
+
+    id: Mapped[int] = mapped_column(primary_key=True)
+    children: Mapped[List["Child"]] = relationship(back_populates="parent")
+
+
+class Child(Base):
+    __tablename__ = "child"
+
+    id: Mapped[int] = mapped_column(primary_key=True)
+    parent_id: Mapped[int] = mapped_column(ForeignKey("parent.id"))
+    parent: Mapped[Parent] = relationship(back_populates="children")
+
+
+def populate(db, n=5):
+    with db.Session.begin() as s:
+        s.add_all(Parent(id=i, children=[Child(id=i)]) for i in range(n))
+
+
+class TestNPlusOne(unittest.TestCase):
+    def test_warns_with_relationship(self):
+        db = create_db("sqlite:///:memory:", Base=Base, create_all=True)
+        populate(db)
+        detector = db.enable_nplusone_detection(threshold=3)
+        with warnings.catch_warnings(record=True) as caught:
+            warnings.simplefilter("always")
+            with db.Session() as s:
+                for parent in s.scalars(select(Parent)):
+                    parent.children
+        self.assertEqual(len(detector.reports), 1)
+        report = detector.reports[0]
+        self.assertEqual(report.relationship, "Parent.children")
+        self.assertEqual(report.suggestion, "selectinload(Parent.children)")
+        self.assertIn("test_nplusone.py", report.call_site)
+        self.assertEqual(
+            [w.category for w in caught if w.category is NPlusOneWarning],
+            [NPlusOneWarning],
+        )
+
+    def test_eager_loading_is_not_reported(self):
+        db = create_db("sqlite:///:memory:", Base=Base, create_all=True)
+        populate(db)
+        detector = db.enable_nplusone_detection(threshold=3, mode="raise")
+        with db.Session() as s:
+            stmt = select(Parent).options(selectinload(Parent.children))
+            for parent in s.scalars(stmt):
+                parent.children
+        self.assertEqual(detector.reports, [])
+
+    def test_create_test_db_raises(self):
+        with create_test_db(
+            url="sqlite:///:memory:", Base=Base, nplusone_threshold=2
+        ) as db:
+            populate(db)
+            with db.Session() as s:
+                with self.assertRaises(NPlusOneError) as cm:
+                    for child in s.scalars(select(Child)):
+                        child.parent
+                self.assertIn("joinedload(Child.parent)", str(cm.exception))
+
+    def test_shapes_are_bounded(self):
+        db = create_db("sqlite:///:memory:", Base=Base, create_all=True)
+        detector = db.enable_nplusone_detection()
+        detector.max_shapes = 2
+        with db.Session() as s:
+            for i in range(5):
+                s.execute(select(Parent).where(Parent.id.in_(range(i + 1)))).all()
+        self.assertEqual(len(detector._shapes), 2)
+
+    def test_installed_apps_are_call_sites(self):
+        stdlib = nplusone._STDLIB
+        self.assertTrue(nplusone._skipped(os.path.join(stdlib, "contextlib.py")))
+        for site_packages in nplusone._SITE_PACKAGES:
+            self.assertFalse(
+                nplusone._skipped(os.path.join(site_packages, "app", "views.py"))
+            )
+        self.assertTrue(nplusone._skipped(nplusone.__file__))
+
+    def test_assert_max_queries(self):
+        db = create_db("sqlite:///:memory:", Base=Base, create_all=True)
+        populate(db)
+        with db.Session() as s:
+            with assert_max_queries(2, db) as counter:
+                stmt = select(Parent).options(selectinload(Parent.children))
+                [p.children for p in s.scalars(stmt)]
+            self.assertEqual(counter.count, 2)
+
+        with db.Session() as s:
+            with self.assertRaises(TooManyQueriesError):
+                with assert_max_queries(2, db):
+                    [p.children for p in s.scalars(select(Parent))]
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,236 @@
+"""Unit tests for the transactional outbox"""
+
+import datetime
+import decimal
+import threading
+import unittest
+
+from sqlalchemy import Numeric, delete, func, insert, select
+from sqlalchemy.orm import Mapped, declarative_base, mapped_column
+
+from sqlgold.utils.test_db_utils import create_sqlite_test_db
+
+Base = declarative_base()
+
+
+class Order(Base):
+    __tablename__ = "orders"
+
+    id: Mapped[int] = mapped_column(primary_key=True)
+    status: Mapped[str]
+    total: Mapped[decimal.Decimal] = mapped_column(Numeric(10, 2))
+    created_at: Mapped[datetime.datetime]
+
+
+class Note(Base):
+    __tablename__ = "note"
+
+    id: Mapped[int] = mapped_column(primary_key=True)
+    text: Mapped[str]
+
+
+def _order(id, status="new"):
+    return Order(
+        id=id,
+        status=status,
+        total=decimal.Decimal("9.50"),
+        created_at=datetime.datetime(2024, 1, 1),
+    )
+
+
+class TestOutbox(unittest.TestCase):
+    def setUp(self):
+        self.db = self.enterContext(
+            create_sqlite_test_db("outbox.sqlite", Base=Base, create_all=True)
+        )
+        self.outbox = self.db.enable_outbox(Order)
+
+    def tearDown(self):
+        self.db.disable_outbox()
+
+    def _count(self):
+        with self.db.engine.connect() as connection:
+            return connection.execute(
+                select(func.count()).select_from(self.outbox.table)
+            ).scalar()
+
+    def test_capture(self):
+        with self.db.Session.begin() as session:
+            session.add_all([_order(1), _order(2), Note(id=1, text="skipped")])
+        with self.db.Session.begin() as session:
+            session.get(Order, 1).status = "paid"
+            session.delete(session.get(Order, 2))
+            session.get(Note, 1).text = "skipped too"
+
+        events = self.outbox.consumer("test").poll()
+        self.assertEqual(
+            [(e.id, e.op, e.key) for e in events],
+            [
+                (1, "insert", {"id": 1}),
+                (2, "insert", {"id": 2}),
+                (3, "update", {"id": 1}),
+                (4, "delete", {"id": 2}),
+            ],
+        )
+        self.assertEqual(
+            events[0].data,
+            {
+                "id": 1,
+                "status": "new",
+                "total": "9.50",
+                "created_at": "2024-01-01T00:00:00",
+            },
+        )
+        self.assertEqual(events[2].changed, ["status"])
+        self.assertEqual(events[2].data["status"], "paid")
+        self.assertEqual(events[0].table, "orders")
+
+    def test_atomic_with_the_transaction(self):
+        with self.db.Session() as session:
+            session.add(_order(1))
+            session.flush()
+            self.assertEqual(self._count(), 0)  ## not committed
+            session.rollback()
+        self.assertEqual(self._count(), 0)
+
+        ## bulk statements aren't captured
+        with self.db.Session.begin() as session:
+            session.execute(
+                insert(Order),
+                [
+                    {
+                        "id": 5,
+                        "status": "x",
+                        "total": 1,
+                        "created_at": datetime.datetime.now(),
+                    }
+                ],
+            )
+        self.assertEqual(self._count(), 0)
+
+    def test_subscribers(self):
+        received = []
+        self.outbox.subscribe(received.append)
+        self.outbox.subscribe(lambda events: 1 / 0)  ## logged, not raised
+
+        with self.db.Session() as session:
+            session.add(_order(1))
+            session.flush()
+            with session.begin_nested():
+                session.add(_order(2))
+            nested = session.begin_nested()
+            session.add(_order(3))
+            session.flush()
+            nested.rollback()
+            self.assertEqual(received, [])
+            session.commit()
+        self.assertEqual(len(received), 1)
+        self.assertEqual([e.key["id"] for e in received[0]], [1, 2])
+        self.assertEqual([e.id for e in received[0]], [1, 2])
+
+        with self.db.Session() as session:
+            session.add(_order(4))
+            session.flush()
+            session.rollback()
+        self.assertEqual(len(received), 1)
+
+    def test_consumer_resumes_from_ack(self):
+        for i in range(5):
+            with self.db.Session.begin() as session:
+                session.add(_order(i))
+
+        consumer = self.outbox.consumer("indexer", batch_size=2)
+        self.assertEqual([e.id for e in consumer.poll()], [1, 2])
+        consumer.ack()
+        self.assertEqual([e.id for e in consumer.poll()], [3, 4])
+
+        ## not acknowledged, delivered again
+        consumer = self.outbox.consumer("indexer", batch_size=2)
+        self.assertEqual([e.id for e in consumer.poll()], [3, 4])
+        consumer.ack()
+        self.assertEqual([e.id for e in consumer.poll(limit=10)], [5])
+        self.assertEqual(consumer.poll(), [])
+        consumer.rewind()
+        self.assertEqual([e.id for e in consumer.poll()], [5])
+
+        ## other consumers have their own position
+        self.assertEqual(len(self.outbox.consumer("other").poll(limit=10)), 5)
+
+        self.assertEqual(self.outbox.purge(), 0)  ## "other" acknowledged nothing
+        other = self.outbox.consumer("other")
+        other.poll()
+        other.ack(3)
+        self.assertEqual(self.outbox.purge(), 3)
+        self.assertEqual(self._count(), 2)
+        self.outbox.drop_consumer("other")
+        self.assertEqual(self.outbox.purge(), 1)  ## "indexer" acknowledged 4
+
+    def test_gaps(self):
+        with self.db.Session.begin() as session:
+            session.add(_order(1))
+        ## an id taken by a transaction that hasn't committed yet
+        with self.db.engine.begin() as connection:
+            connection.execute(
+                insert(self.outbox.table).values(
+                    id=3,
+                    table_name="orders",
+                    op="insert",
+                    key="{}",
+                    data="{}",
+                    created_at=datetime.datetime.now(),
+                )
+            )
+        consumer = self.outbox.consumer("gaps", gap_timeout=60)
+        self.assertEqual([e.id for e in consumer.poll()], [1])
+        self.assertEqual(consumer.poll(), [])  ## waiting for id 2
+
+        registry = self.db.enable_metrics().registry
+        consumer.gap_timeout = 0
+        self.assertEqual([e.id for e in consumer.poll()], [3])
+        skipped = registry.counter(
+            "sqlgold_outbox_skipped_ids_total",
+            db=self.db.alias,
+            consumer="gaps",
+        )
+        self.assertEqual(skipped.value, 1)
+
+        ## new ids continue after the largest, even after purging
+        consumer.ack()
+        self.assertEqual(self.outbox.purge(), 2)
+        with self.db.Session.begin() as session:
+            session.add(_order(2))
+        self.assertEqual([e.id for e in consumer.poll()], [4])
+
+    def test_gap_waits_for_open_transactions(self):
+        with self.db.Session.begin() as session:
+            session.add_all([_order(1), _order(2)])
+        with self.db.engine.begin() as connection:
+            connection.execute(
+                delete(self.outbox.table).where(self.outbox.table.c.id == 1)
+            )
+        open_ids = {"trx-1"}
+        self.db._open_transaction_ids = lambda connection: set(open_ids)
+        consumer = self.outbox.consumer("open", gap_timeout=0)
+        ## the transaction open when the gap was seen may still commit id 1
+        self.assertEqual(consumer.poll(), [])
+        self.assertEqual(consumer.poll(), [])
+        open_ids.clear()
+        self.assertEqual([e.id for e in consumer.poll()], [2])
+
+    def test_batches(self):
+        with self.db.Session.begin() as session:
+            session.add_all([_order(i) for i in range(3)])
+        stop = threading.Event()
+        consumer = self.outbox.consumer("batches", batch_size=2)
+        seen = []
+        for batch in consumer.batches(poll_interval=0.01, stop=stop):
+            seen.extend(e.id for e in batch)
+            consumer.ack()
+            if len(seen) == 3:
+                stop.set()
+        self.assertEqual(seen, [1, 2, 3])
+        self.assertEqual(self.outbox.consumer("batches").acked, 3)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,161 @@
+"""Unit tests for DB.parallel_map"""
+
+import operator
+import os
+import tempfile
+import unittest
+from typing import Optional
+
+from sqlalchemy import insert, select
+from sqlalchemy.orm import Mapped, declarative_base, mapped_column
+
+from sqlgold.ext.parallel import make_partitions
+from sqlgold.utils.test_db_utils import create_sqlite_test_db
+
+Base = declarative_base()
+
+
+class Item(Base):
+    __tablename__ = "item"
+
+    id: Mapped[int] = mapped_column(primary_key=True)
+    name: Mapped[str]
+    value: Mapped[int]
+    grp: Mapped[Optional[int]]
+
+
+def total_value(batch):
+    return sum(item.value for item in batch)
+
+
+def batch_size(batch):
+    return len(batch)
+
+
+FAILURES = os.path.join(tempfile.gettempdir(), f"sqlgold_parallel_{os.getpid()}")
+
+
+def fail_once(batch):
+    ## fails the first time any worker sees the batch with id 0
+    if any(item.id == 0 for item in batch) and not os.path.exists(FAILURES):
+        open(FAILURES, "w").close()
+        raise RuntimeError("transient")
+    return len(batch)
+
+
+def die_once(batch):
+    ## kills the worker the first time any worker sees the batch with id 0
+    if any(item.id == 0 for item in batch) and not os.path.exists(FAILURES):
+        open(FAILURES, "w").close()
+        os._exit(1)
+    return len(batch)
+
+
+class TestParallelMap(unittest.TestCase):
+    def setUp(self):
+        self.db = self.enterContext(
+            create_sqlite_test_db("parallel.sqlite", Base=Base, create_all=True)
+        )
+        with self.db.Session.begin() as s:
+            s.execute(
+                insert(Item),
+                [
+                    {
+                        "id": i,
+                        "name": f"n{i:04}",
+                        "value": i,
+                        "grp": None if i % 10 == 0 else i % 7,
+                    }
+                    for i in range(1000)
+                ],
+            )
+
+    def tearDown(self):
+        if os.path.exists(FAILURES):
+            os.remove(FAILURES)
+
+    def test_partitions_cover_keys(self):
+        for strategy, key in (("minmax", None), ("quantile", None), ("auto", "name")):
+            parts = make_partitions(self.db, Item, 4, key, strategy)
+            self.assertEqual(len(parts), 4)
+            self.assertIsNone(parts[0].lower)
+            self.assertIsNone(parts[-1].upper)
+            for a, b in zip(parts, parts[1:]):
+                self.assertEqual(a.upper, b.lower)
+
+    def test_null_keys(self):
+        for strategy in ("minmax", "quantile"):
+            total = self.db.parallel_map(
+                Item,
+                batch_size,
+                workers=2,
+                partition_by="grp",
+                strategy=strategy,
+                reduce=operator.add,
+                initial=0,
+            )
+            self.assertEqual(total, 1000)
+        parts = make_partitions(self.db, Item, 4, "grp", "quantile")
+        self.assertTrue(all(p.lower is not None for p in parts[1:]))
+
+    def test_reduce(self):
+        seen = []
+        total = self.db.parallel_map(
+            Item,
+            total_value,
+            workers=2,
+            batch_size=100,
+            reduce=operator.add,
+            initial=0,
+            progress=lambda done, n, rows: seen.append((done, n, rows)),
+        )
+        self.assertEqual(total, sum(range(1000)))
+        self.assertEqual(seen[-1], (8, 8, 1000))
+
+    def test_iterator_statement_and_spawn(self):
+        stmt = select(Item).where(Item.value >= 500)
+        sizes = list(self.db.parallel_map(stmt, batch_size, workers=2, batch_size=50))
+        self.assertEqual(sum(sizes), 500)
+        self.assertTrue(all(size <= 50 for size in sizes))
+
+        total = self.db.parallel_map(
+            Item,
+            batch_size,
+            workers=2,
+            partition_by="name",
+            reduce=operator.add,
+            initial=0,
+            mp_context="spawn",
+        )
+        self.assertEqual(total, 1000)
+        with self.assertRaises(ValueError):
+            self.db.parallel_map(stmt, batch_size, mp_context="spawn")
+
+    def test_partition_retry(self):
+        total = self.db.parallel_map(
+            Item, fail_once, workers=2, reduce=operator.add, initial=0, retries=1
+        )
+        self.assertEqual(total, 1000)
+
+    def test_dead_worker(self):
+        seen = []
+        total = self.db.parallel_map(
+            Item,
+            die_once,
+            workers=2,
+            reduce=operator.add,
+            initial=0,
+            retries=1,
+            mp_context="fork",
+            progress=lambda done, n, rows: seen.append(done),
+        )
+        self.assertEqual(total, 1000)
+        self.assertEqual(seen, list(range(1, 9)))
+
+    def test_quantile_bounds(self):
+        parts = make_partitions(self.db, Item, 4, "value", "quantile")
+        self.assertEqual([p.upper for p in parts], [250, 500, 750, None])
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,110 @@
+"""Unit tests for the session profiler"""
+import unittest
+
+from sqlalchemy import event, select, text
+from sqlalchemy.orm import Mapped, declarative_base, mapped_column
+
+from sqlgold import create_db
+from sqlgold.ext.profiler import _PROFILE_KEY
+
+Base = declarative_base()
+
+
+class TClass(Base):
+    __tablename__ = "tclass"
+
+    id: Mapped[int] = mapped_column(primary_key=True)
+    name: Mapped[str] = mapped_column(default="")
+
+
+class TestProfiler(unittest.TestCase):
+    def setUp(self):
+        self.db = create_db(
+            "sqlite:///:memory:", Base=Base, create_all=True, alias="profiler_db"
+        )
+
+    def test_transaction_profile(self):
+        profiler = self.db.enable_profiler()
+        with self.db.Session.begin() as s:
+            s.add_all([TClass(id=1), TClass(id=2), TClass(id=3)])
+            ## autoflush before the select
+            objs = s.scalars(select(TClass).order_by(TClass.id)).all()
+            objs[0].name = "changed"
+            s.delete(objs[1])
+
+        self.assertEqual(len(profiler.records), 1)
+        profile = profiler.records[0]
+        self.assertEqual(profile.outcome, "commit")
+        self.assertEqual(profile.flushes, 2)
+        self.assertEqual(profile.autoflushes, 1)
+        self.assertEqual(profile.inserted, 3)
+        self.assertEqual(profile.updated, 1)
+        self.assertEqual(profile.deleted, 1)
+        self.assertGreaterEqual(profile.statements, 4)
+        self.assertGreaterEqual(profile.rows, 5)
+        self.assertGreater(profile.connection_held, 0)
+        self.assertGreaterEqual(profile.duration, profile.connection_held)
+        self.assertEqual(profile.to_dict()["db"], "profiler_db")
+
+        summary = profiler.summary()
+        self.assertEqual(summary["transactions"], 1)
+        self.assertEqual(summary["outcomes"], {"commit": 1})
+        self.assertEqual(summary["totals"]["inserted"], 3)
+        self.assertEqual(summary["timings"]["duration"]["count"], 1)
+
+    def test_autoflush_only_during_orm_execution(self):
+        profiler = self.db.enable_profiler()
+        with self.db.Session.begin() as s:
+            s.add(TClass(id=1))
+            s.flush()
+            s.add(TClass(id=2))
+            s.get(TClass, 3)  ## autoflushes
+        profile = profiler.records[0]
+        self.assertEqual((profile.flushes, profile.autoflushes), (2, 1))
+
+    def test_returned_connection_is_not_attributed(self):
+        profiler = self.db.enable_profiler()
+        counted = []
+
+        def other_checkout(session, transaction):
+            ## the session's connection is back in the pool, the memory db
+            ## hands the same DBAPI connection to the next checkout
+            if transaction.parent is not None:
+                return
+            profile = session.info[_PROFILE_KEY]
+            before = profile.statements
+            with self.db.engine.connect() as connection:
+                connection.execute(text("SELECT 1"))
+            counted.append(profile.statements - before)
+
+        ## runs before the profiler's own listener
+        event.listen(
+            self.db.Session, "after_transaction_end", other_checkout, insert=True
+        )
+        try:
+            with self.db.Session.begin() as s:
+                s.add(TClass(id=1))
+        finally:
+            event.remove(self.db.Session, "after_transaction_end", other_checkout)
+        self.assertEqual(counted, [0])
+        self.assertEqual(profiler.records[0].statements, 1)
+
+    def test_sampling(self):
+        profiler = self.db.enable_profiler(sample_rate=0.0)
+        for i in range(10):
+            with self.db.Session.begin() as s:
+                s.add(TClass(id=i))
+        self.assertEqual(profiler.summary()["transactions"], 0)
+
+        profiler = self.db.enable_profiler(sample_rate=0.5)
+        for i in range(10, 210):
+            with self.db.Session.begin() as s:
+                s.add(TClass(id=i))
+        self.assertTrue(0 < profiler.summary()["transactions"] < 200)
+
+        self.db.disable_profiler()
+        self.assertIsNone(self.db.profiler)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,123 @@
+"""Unit tests for DB.read"""
+
+import dataclasses
+import unittest
+
+from sqlalchemy import ForeignKey, insert, select, text
+from sqlalchemy.orm import Mapped, aliased, declarative_base, mapped_column
+
+from sqlgold import create_db
+from sqlgold.ext.rows import row_class
+
+Base = declarative_base()
+
+
+class Author(Base):
+    __tablename__ = "author"
+
+    id: Mapped[int] = mapped_column(primary_key=True)
+    name: Mapped[str]
+    email_address: Mapped[str | None] = mapped_column("email")
+
+
+class Book(Base):
+    __tablename__ = "book"
+
+    id: Mapped[int] = mapped_column(primary_key=True)
+    title: Mapped[str]
+    author_id: Mapped[int] = mapped_column(ForeignKey("author.id"))
+
+
+@dataclasses.dataclass
+class Title:
+    title: str
+    id: int
+
+
+class TestRead(unittest.TestCase):
+    def setUp(self):
+        self.db = create_db("sqlite:///:memory:", Base=Base, create_all=True)
+        with self.db.Session.begin() as session:
+            session.execute(
+                insert(Author),
+                [
+                    {"id": 1, "name": "a", "email_address": "a@x"},
+                    {"id": 2, "name": "b", "email_address": None},
+                ],
+            )
+            session.execute(
+                insert(Book),
+                [
+                    {"id": i, "title": f"t{i}", "author_id": 1 + i % 2}
+                    for i in range(10)
+                ],
+            )
+
+    def tearDown(self):
+        self.db.engine.dispose()
+
+    def test_entity_rows(self):
+        rows = self.db.read(select(Author).order_by(Author.id))
+        AuthorRow = row_class(Author)
+        self.assertEqual(rows, [AuthorRow(1, "a", "a@x"), AuthorRow(2, "b", None)])
+        self.assertEqual(rows[0].email_address, "a@x")
+        self.assertFalse(hasattr(rows[0], "__dict__"))
+        self.assertIs(row_class(Author), AuthorRow)
+
+        ## a mapped class reads everything
+        self.assertEqual(len(self.db.read(Book)), 10)
+
+    def test_where_join_and_alias(self):
+        stmt = (
+            select(Book)
+            .join(Author)
+            .where(Author.name == "b")
+            .order_by(Book.id.desc())
+            .limit(2)
+        )
+        self.assertEqual([b.id for b in self.db.read(stmt)], [9, 7])
+
+        book = aliased(Book)
+        rows = self.db.read(select(book).where(book.title == "t3"))
+        self.assertEqual(rows[0].author_id, 2)
+
+    def test_as_tuple_dict_and_dataclass(self):
+        stmt = select(Book.id, Book.title).where(Book.id < 2).order_by(Book.id)
+        self.assertEqual(self.db.read(stmt), [(0, "t0"), (1, "t1")])
+        self.assertEqual(
+            self.db.read(stmt, as_=dict),
+            [{"id": 0, "title": "t0"}, {"id": 1, "title": "t1"}],
+        )
+        ## dataclass fields are matched by name, not position
+        self.assertEqual(self.db.read(stmt, as_=Title)[1], Title("t1", 1))
+
+        rows = self.db.read(select(Author).where(Author.id == 1), as_=dict)
+        self.assertEqual(rows, [{"id": 1, "name": "a", "email_address": "a@x"}])
+
+    def test_text_with_params(self):
+        rows = self.db.read(
+            text("SELECT title FROM book WHERE id = :id"), params={"id": 4}
+        )
+        self.assertEqual(rows, [("t4",)])
+
+    def test_errors(self):
+        with self.assertRaises(ValueError):
+            self.db.read(select(Book, Author.name).join(Author))
+
+        @dataclasses.dataclass
+        class Missing:
+            isbn: str
+
+        with self.assertRaises(ValueError):
+            self.db.read(select(Book.id), as_=Missing)
+
+    def test_no_identity_map_or_autoflush(self):
+        with self.db.Session() as session:
+            session.add(Author(id=3, name="pending"))
+            ## read doesn't flush the pending author
+            self.assertEqual(len(self.db.read(Author)), 2)
+            session.rollback()
+
+
+if __name__ == "__main__":
+    unittest.main()
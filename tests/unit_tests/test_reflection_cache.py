@@ -0,0 +1,101 @@
+"""Unit tests for DB.reflect and the reflection cache"""
+
+import os
+import unittest
+from unittest import mock
+
+from sqlalchemy import MetaData
+from sqlalchemy.orm import Mapped, declarative_base, mapped_column
+
+from sqlgold import create_db
+from sqlgold.dialects.mysql import MysqlDB
+from sqlgold.managers.db_manager import DBManager
+from sqlgold.utils.test_db_utils import create_sqlite_test_db
+
+
+class TestReflectionCache(unittest.TestCase):
+    def setUp(self):
+        db = self.enterContext(
+            create_sqlite_test_db("reflect.db", Base=None, alias="reflect_setup")
+        )
+        self.url = str(db.url)
+        self.dir = os.path.dirname(db.database)
+        with db.engine.begin() as conn:
+            conn.exec_driver_sql(
+                "CREATE TABLE author (id INTEGER PRIMARY KEY, name TEXT)"
+            )
+            conn.exec_driver_sql(
+                "CREATE TABLE book (id INTEGER PRIMARY KEY, "
+                "author_id INTEGER REFERENCES author(id), title TEXT)"
+            )
+
+    def test_reflect_no_cache(self):
+        db = create_db(self.url, Base=None, alias="reflect_no_cache")
+        metadata = db.reflect()
+        self.assertEqual(set(metadata.tables), {"author", "book"})
+        self.assertIs(db.Base.metadata, metadata)
+        self.assertIs(DBManager.get_manager().get_base("reflect_no_cache"), db.Base)
+
+    def test_reflect_uses_cache(self):
+        cache_dir = self.dir
+        db = create_db(self.url, Base=None, alias="reflect_cache")
+        metadata = db.reflect(cache_path=cache_dir)
+        self.assertEqual(set(metadata.tables), {"author", "book"})
+        cache_files = [f for f in os.listdir(cache_dir) if f.endswith(".pickle")]
+        self.assertEqual(len(cache_files), 1)
+
+        db2 = create_db(self.url, Base=None, alias="reflect_cache2")
+        with mock.patch.object(MetaData, "reflect") as reflect:
+            metadata = db2.reflect(cache_path=cache_dir)
+            reflect.assert_not_called()
+        self.assertEqual(set(metadata.tables), {"author", "book"})
+        fks = metadata.tables["book"].foreign_keys
+        self.assertEqual([fk.target_fullname for fk in fks], ["author.id"])
+
+    def test_reflect_cache_invalidated_by_schema_change(self):
+        cache_file = os.path.join(self.dir, "schema.cache")
+        db = create_db(self.url, Base=None, alias="reflect_invalidate")
+        db.reflect(cache_path=cache_file)
+        with db.engine.begin() as conn:
+            conn.exec_driver_sql("CREATE TABLE publisher (id INTEGER PRIMARY KEY)")
+
+        db2 = create_db(self.url, Base=None, alias="reflect_invalidate2")
+        metadata = db2.reflect(cache_path=cache_file)
+        self.assertIn("publisher", metadata.tables)
+
+    def test_reflect_merges_into_existing_base(self):
+        Base = declarative_base()
+
+        class Review(Base):
+            __tablename__ = "review"
+
+            id: Mapped[int] = mapped_column(primary_key=True)
+
+        db = create_db(self.url, Base=Base, alias="reflect_merge")
+        db.reflect()
+        self.assertIs(db.Base, Base)
+        self.assertEqual(set(Base.metadata.tables), {"author", "book", "review"})
+
+
+class TestMysqlSchemaSignature(unittest.TestCase):
+    def signature(self, count, folded, schema=None):
+        connection = mock.Mock()
+        connection.execute.return_value.one.return_value = (count, folded)
+        signature = MysqlDB.schema_signature(None, connection, schema=schema)
+        return signature, connection.execute.call_args
+
+    def test_aggregated_on_the_server(self):
+        signature, (args, __) = self.signature(12, 987654321, schema="app")
+        stmt, params = args
+        self.assertEqual(params, {"schema": "app"})
+        sql = str(stmt)
+        self.assertTrue(sql.startswith("SELECT COUNT(*), BIT_XOR("))
+        for table in ("COLUMNS", "STATISTICS", "KEY_COLUMN_USAGE"):
+            self.assertIn(f"information_schema.{table}", sql)
+        self.assertEqual(signature, self.signature(12, 987654321)[0])
+        self.assertNotEqual(signature, self.signature(12, 987654322)[0])
+        self.assertNotEqual(signature, self.signature(13, 987654321)[0])
+
+
+if __name__ == "__main__":
+    unittest.main()
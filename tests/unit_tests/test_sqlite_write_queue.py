@@ -0,0 +1,219 @@
+"""Unit tests for the sqlite single writer queue with group commit"""
+
+import threading
+import time
+import unittest
+
+from sqlalchemy import Column, Integer, String, event, func, select, update
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.orm import declarative_base
+
+from sqlgold import create_db
+from sqlgold.utils.test_db_utils import create_sqlite_test_db
+
+Base = declarative_base()
+
+
+class Item(Base):
+    __tablename__ = "items"
+    id = Column(Integer, primary_key=True)
+    name = Column(String(50))
+
+
+class TestSqliteWriteQueue(unittest.TestCase):
+    def setUp(self):
+        self.db = self.enterContext(
+            create_sqlite_test_db("queue.sqlite", Base=Base, create_all=True)
+        )
+        self.queue = self.db.enable_write_queue(readers=4, max_batch=16)
+
+    def tearDown(self):
+        self.db.disable_write_queue()
+
+    def count(self) -> int:
+        with self.db.Session() as session:
+            return session.scalar(select(func.count(Item.id)))
+
+    def count_commits(self) -> list:
+        commits = []
+        event.listen(self.queue.writer_engine, "commit", commits.append)
+        return commits
+
+    def test_concurrent_writers_are_grouped(self):
+        commits = self.count_commits()
+        errors = []
+
+        def write(i):
+            try:
+                for j in range(25):
+                    with self.db.Session.begin() as session:
+                        session.add(Item(name=f"{i}-{j}"))
+            except Exception as e:
+                errors.append(e)
+
+        threads = [threading.Thread(target=write, args=(i,)) for i in range(8)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+
+        self.assertEqual(errors, [])
+        self.assertEqual(self.count(), 200)
+        stats = self.queue.stats()
+        self.assertEqual(stats["transactions"], 200)
+        self.assertEqual(stats["commits"], len(commits))
+        self.assertLess(len(commits), 200)
+
+    def test_queued_transactions_share_a_commit(self):
+        self.db.disable_write_queue()
+        self.queue = self.db.enable_write_queue(max_batch=16, max_delay_ms=60_000)
+        commits = self.count_commits()
+
+        def write(i):
+            with self.db.Session.begin() as session:
+                session.add(Item(name=str(i)))
+
+        with self.db.Session() as session:
+            session.add(Item(name="first"))
+            session.flush()  ## holds the writer
+            threads = [threading.Thread(target=write, args=(i,)) for i in range(7)]
+            for t in threads:
+                t.start()
+            while self.queue.stats()["waiting"] < 7:
+                time.sleep(0.001)
+            session.commit()
+        for t in threads:
+            t.join()
+
+        self.assertEqual(len(commits), 1)
+        self.assertEqual(self.queue.stats()["transactions"], 8)
+        self.assertEqual(self.count(), 8)
+
+    def test_long_transaction_does_not_hold_an_earlier_commit(self):
+        self.db.disable_write_queue()
+        self.queue = self.db.enable_write_queue(max_delay_ms=20)
+        elapsed = []
+        read = threading.Event()
+
+        def commit_early():
+            with self.db.Session() as session:
+                session.begin()
+                session.add(Item(name="early"))
+                session.flush()
+                start = time.monotonic()
+                session.commit()
+                elapsed.append(time.monotonic() - start)
+
+        def hold_long():
+            with self.db.Session.begin() as session:
+                session.scalar(select(func.count(Item.id)))
+                read.set()
+                time.sleep(0.5)
+                session.add(Item(name="late"))
+
+        with self.db.Session.begin() as session:
+            session.scalar(select(func.count(Item.id)))  ## holds the writer
+            early = threading.Thread(target=commit_early)
+            early.start()
+            while self.queue.stats()["waiting"] < 1:
+                time.sleep(0.001)
+            late = threading.Thread(target=hold_long)
+            late.start()
+            while self.queue.stats()["waiting"] < 2:
+                time.sleep(0.001)
+        early.join()
+        self.assertTrue(read.is_set())  ## the long transaction had the writer
+        self.assertLess(elapsed[0], 0.3)
+        late.join()
+
+        self.assertEqual(self.count(), 2)
+        stats = self.queue.stats()
+        self.assertEqual((stats["commits"], stats["transactions"]), (2, 3))
+
+    def test_begun_transactions_read_on_the_writer(self):
+        with self.db.Session.begin() as session:
+            session.add(Item(id=1, name="0"))
+
+        def increment():
+            for __ in range(20):
+                with self.db.Session.begin() as session:
+                    item = session.get(Item, 1)
+                    item.name = str(int(item.name) + 1)
+
+        threads = [threading.Thread(target=increment) for __ in range(4)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        with self.db.Session() as session:
+            self.assertEqual(session.get(Item, 1).name, "80")
+
+    def test_session_api(self):
+        with self.db.Session() as session:
+            item = Item(name="a")
+            session.add(item)
+            session.commit()
+            self.assertIsNotNone(item.id)
+
+            session.execute(update(Item).where(Item.id == item.id).values(name="b"))
+            ## reads after a write see it, they run on the writer
+            self.assertEqual(session.get(Item, item.id).name, "b")
+            session.commit()
+        self.assertEqual(self.count(), 1)
+
+    def test_failed_transaction_only_rolls_back_itself(self):
+        with self.db.Session.begin() as session:
+            session.add(Item(id=1, name="a"))
+        with self.db.Session() as session:
+            session.add(Item(id=1, name="duplicate"))
+            with self.assertRaises(IntegrityError):
+                session.commit()
+            session.rollback()
+        with self.db.Session.begin() as session:
+            session.add(Item(id=2, name="b"))
+        self.assertEqual(self.count(), 2)
+
+    def test_rollback_releases_the_writer(self):
+        with self.db.Session() as session:
+            session.add(Item(name="discarded"))
+            session.flush()
+            session.rollback()
+        self.assertEqual(self.queue.run(lambda c: 42), 42)
+        self.assertEqual(self.count(), 0)
+
+    def test_run(self):
+        rowid = self.queue.run(
+            lambda c: c.exec_driver_sql(
+                "INSERT INTO items (name) VALUES ('raw')"
+            ).lastrowid
+        )
+        self.assertEqual(rowid, 1)
+        self.assertEqual(self.count(), 1)
+
+    def test_second_write_transaction_in_thread_raises(self):
+        with self.db.Session() as first:
+            first.add(Item(name="a"))
+            first.flush()
+            with self.db.Session() as second:
+                second.add(Item(name="b"))
+                with self.assertRaises(RuntimeError):
+                    second.flush()
+            first.commit()
+        self.assertEqual(self.count(), 1)
+
+    def test_disable_restores_sessions(self):
+        self.db.disable_write_queue()
+        with self.db.Session.begin() as session:
+            session.add(Item(name="direct"))
+        self.assertNotIn("Queued", type(self.db.Session()).__name__)
+        self.queue = self.db.enable_write_queue()
+        self.assertEqual(self.count(), 1)
+
+    def test_memory_db_is_refused(self):
+        db = create_db("sqlite://", Base=None)
+        with self.assertRaises(ValueError):
+            db.enable_write_queue()
+
+
+if __name__ == "__main__":
+    unittest.main()
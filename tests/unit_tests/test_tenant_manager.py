@@ -0,0 +1,126 @@
+"""Unit tests for TenantDBManager"""
+import os
+import tempfile
+import threading
+import time
+import unittest
+
+from sqlalchemy import select
+from sqlalchemy.orm import Mapped, declarative_base, mapped_column
+
+from sqlgold.managers.db_manager import DBManager
+from sqlgold.managers.tenant_manager import TenantDBManager
+from sqlgold.metrics import MetricsRegistry
+
+Base = declarative_base()
+
+
+class TClass(Base):
+    __tablename__ = "tclass"
+
+    id: Mapped[int] = mapped_column(primary_key=True)
+
+
+class TestTenantDBManager(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        template = "sqlite:///" + os.path.join(self.tmpdir.name, "{tenant}.sqlite")
+        self.tenants = TenantDBManager(
+            template,
+            Base=Base,
+            max_size=2,
+            idle_ttl=None,
+            create_all=True,
+            registry=MetricsRegistry(),
+        )
+
+    def tearDown(self):
+        self.tenants.clear()
+        self.tmpdir.cleanup()
+
+    def test_lru_eviction_and_recreation(self):
+        a = self.tenants.get("a")
+        with a.Session.begin() as s:
+            s.add(TClass(id=1))
+        self.assertIs(self.tenants["a"], a)
+        self.tenants.get("b")
+        self.tenants.get("a")  ## b is now least recently used
+        self.tenants.get("c")
+        self.assertEqual(len(self.tenants), 2)
+        self.assertNotIn("b", self.tenants)
+        self.assertIn("a", self.tenants)
+
+        self.tenants.get("a")
+        self.tenants.get("d")
+        self.assertNotIn("c", self.tenants)
+        self.assertEqual(self.tenants.get("c").database, a.database.replace("a.", "c."))
+        self.assertNotIn("a", self.tenants)
+        ## the data survives eviction, it's in the tenant's database
+        with self.tenants.get("a").Session() as s:
+            self.assertEqual(s.scalars(select(TClass.id)).all(), [1])
+
+        stats = self.tenants.stats()
+        self.assertEqual(stats["size"], 2)
+        self.assertEqual(stats["hits"], 3)
+        self.assertEqual(stats["misses"], 6)
+        self.assertEqual(stats["evictions"], 4)
+
+    def test_idle_ttl(self):
+        self.tenants.idle_ttl = 0.05
+        db = self.tenants.get("a")
+        with db.Session() as s:
+            s.scalars(select(TClass)).all()
+        self.assertEqual(db.engine.pool.checkedin(), 1)
+        time.sleep(0.1)
+        self.tenants.evict_idle()
+        self.assertEqual(len(self.tenants), 0)
+        self.assertEqual(db.engine.pool.checkedin(), 0)  ## disposed
+
+    def test_dispose_outside_the_lock(self):
+        db = self.tenants.get("a")
+        self.tenants.get("b")
+        locked = []
+        dispose = db.engine.dispose
+
+        def check_lock(*args, **kwargs):
+            locked.append(self.tenants._lock.locked())
+            dispose(*args, **kwargs)
+
+        db.engine.dispose = check_lock
+        self.tenants.get("c")  ## evicts a
+        self.assertEqual(locked, [False])
+
+    def test_concurrent_lookups_create_once(self):
+        created = []
+        create = self.tenants._create
+
+        def slow_create(tenant):
+            created.append(tenant)
+            time.sleep(0.05)
+            return create(tenant)
+
+        self.tenants._create = slow_create
+        results = []
+        threads = [
+            threading.Thread(target=lambda: results.append(self.tenants.get("a")))
+            for __ in range(8)
+        ]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        self.assertEqual(created, ["a"])
+        self.assertEqual(len(set(map(id, results))), 1)
+
+    def test_invalid_tenant_and_db_manager(self):
+        with self.assertRaises(ValueError):
+            self.tenants.get("../etc")
+        manager = DBManager()
+        manager.set_tenant_manager("tenants", self.tenants)
+        db = manager.get_tenant_database("tenants", "x")
+        self.assertEqual(db.alias, "tenants:x")
+        self.assertNotIn(db, manager.databases.values())
+
+
+if __name__ == "__main__":
+    unittest.main()
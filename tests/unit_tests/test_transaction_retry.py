@@ -0,0 +1,171 @@
+"""Unit tests for DB.transaction retries"""
+
+import sqlite3
+import threading
+import unittest
+
+from sqlalchemy import event, select
+from sqlalchemy.exc import IntegrityError, OperationalError
+from sqlalchemy.orm import Mapped, declarative_base, mapped_column
+
+from sqlgold import create_db
+from sqlgold.dialects.mysql import MysqlDB
+from sqlgold.metrics import MetricsRegistry
+from sqlgold.utils.test_db_utils import create_sqlite_test_db
+
+Base = declarative_base()
+
+
+class TClass(Base):
+    __tablename__ = "tclass"
+
+    id: Mapped[int] = mapped_column(primary_key=True)
+
+
+def locked_error():
+    return OperationalError(
+        "INSERT", {}, sqlite3.OperationalError("database is locked")
+    )
+
+
+class FakeMysqlError(Exception):
+    pass
+
+
+class TestTransactionRetry(unittest.TestCase):
+    def setUp(self):
+        self.db = create_db(
+            "sqlite:///:memory:", Base=Base, create_all=True, alias="retry_db"
+        )
+        self.registry = MetricsRegistry()
+        self.db.enable_metrics(self.registry)
+
+    def tearDown(self):
+        self.db.disable_metrics()
+
+    def test_decorator_retries_then_succeeds(self):
+        calls = []
+
+        @self.db.transaction(retries=3, backoff=0.001)
+        def add(session, id):
+            calls.append(id)
+            session.add(TClass(id=id))
+            if len(calls) < 3:
+                raise locked_error()
+            return id
+
+        self.assertEqual(add(7), 7)
+        self.assertEqual(len(calls), 3)
+        with self.db.Session() as s:
+            self.assertEqual(s.scalars(select(TClass.id)).all(), [7])
+        retries = self.registry.counter(
+            "sqlgold_transaction_retries_total", db="retry_db", reason="locked"
+        )
+        self.assertEqual(retries.value, 2)
+
+    def test_retries_exhausted(self):
+        calls = []
+
+        def fail(session):
+            calls.append(1)
+            raise locked_error()
+
+        with self.assertRaises(OperationalError):
+            self.db.transaction(retries=2, backoff=0.001).run(fail)
+        self.assertEqual(len(calls), 3)
+
+    def test_not_retryable(self):
+        calls = []
+
+        def fail(session):
+            calls.append(1)
+            session.add(TClass(id=1))
+            session.add(TClass(id=1))
+            session.flush()
+
+        with self.assertRaises(Exception):
+            self.db.transaction(backoff=0.001).run(fail)
+        self.assertEqual(len(calls), 1)
+
+    def test_lost_connection_during_commit(self):
+        with create_sqlite_test_db("commit.db", Base=Base, create_all=True) as db:
+            calls = []
+
+            def lose_connection(session):
+                if len(calls) < 3:
+                    raise OperationalError(
+                        "COMMIT",
+                        {},
+                        sqlite3.OperationalError("gone"),
+                        connection_invalidated=True,
+                    )
+
+            def add(session):
+                calls.append(1)
+
+            event.listen(db.Session, "before_commit", lose_connection)
+            ## the outcome of the COMMIT is unknown, not retried by default
+            with self.assertRaises(OperationalError):
+                db.transaction(backoff=0.001).run(add)
+            self.assertEqual(len(calls), 1)
+
+            db.transaction(backoff=0.001, retry_ambiguous_commit=True).run(add)
+            self.assertEqual(len(calls), 3)
+            event.remove(db.Session, "before_commit", lose_connection)
+
+    def test_iterate_attempts(self):
+        attempts = 0
+        for attempt in self.db.transaction(backoff=0.001):
+            with attempt as session:
+                attempts += 1
+                session.add(TClass(id=attempts))
+                if attempts == 1:
+                    raise locked_error()
+        self.assertEqual(attempts, 2)
+        with self.db.Session() as s:
+            self.assertEqual(s.scalars(select(TClass.id)).all(), [2])
+
+    def test_context_manager_single_attempt(self):
+        with self.db.transaction() as session:
+            session.add(TClass(id=1))
+        with self.assertRaises(IntegrityError):
+            with self.db.transaction() as session:
+                session.add(TClass(id=1))
+
+    def test_mysql_error_classification(self):
+        for code, reason in ((1213, "deadlock"), (1205, "lock_wait_timeout")):
+            error = OperationalError("UPDATE", {}, FakeMysqlError(code, "error"))
+            self.assertEqual(MysqlDB.retryable_error_reason(error), reason)
+            self.assertFalse(MysqlDB.is_disconnect_error(error))
+        gone = OperationalError("SELECT", {}, FakeMysqlError(2006, "gone away"))
+        self.assertEqual(MysqlDB.retryable_error_reason(gone), "disconnect")
+        self.assertTrue(MysqlDB.is_disconnect_error(gone))
+        dup = IntegrityError("INSERT", {}, FakeMysqlError(1062, "duplicate"))
+        self.assertIsNone(MysqlDB.retryable_error_reason(dup))
+
+
+class TestSqliteLockContention(unittest.TestCase):
+    def test_retry_until_lock_released(self):
+        with create_sqlite_test_db(
+            "locked.db", Base=Base, create_all=True, connect_args={"timeout": 0.01}
+        ) as db:
+            blocker = sqlite3.connect(db.database, check_same_thread=False)
+            blocker.execute("BEGIN EXCLUSIVE")
+            timer = threading.Timer(0.2, blocker.rollback)
+            timer.start()
+            try:
+
+                @db.transaction(retries=50, backoff=0.01, max_backoff=0.05)
+                def add(session):
+                    session.add(TClass(id=1))
+
+                add()
+            finally:
+                timer.join()
+                blocker.close()
+            with db.Session() as s:
+                self.assertEqual(s.scalars(select(TClass.id)).all(), [1])
+
+
+if __name__ == "__main__":
+    unittest.main()
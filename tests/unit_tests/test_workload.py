@@ -0,0 +1,209 @@
+"""Unit tests for workload recording and replay"""
+
+import datetime
+import decimal
+import json
+import os
+import unittest
+
+from sqlalchemy import insert, select, text, update
+from sqlalchemy.orm import Mapped, declarative_base, mapped_column
+
+from sqlgold.ext.workload import (
+    BEGIN,
+    COMMIT,
+    END,
+    QUERY,
+    ParamstyleConverter,
+    WorkloadReplayer,
+    read_workload,
+    workload_files,
+)
+from sqlgold.utils.test_db_utils import create_sqlite_test_db
+
+Base = declarative_base()
+
+
+class Order(Base):
+    __tablename__ = "orders"
+
+    id: Mapped[int] = mapped_column(primary_key=True)
+    status: Mapped[str]
+    total: Mapped[decimal.Decimal]
+    created_at: Mapped[datetime.datetime]
+
+
+class TestWorkload(unittest.TestCase):
+    def setUp(self):
+        self.source = self._db("source.sqlite")
+        self.target = self._db("target.sqlite")
+        self.path = os.path.join(
+            os.path.dirname(self.source.database), "orders.workload"
+        )
+
+    def tearDown(self):
+        self.source.disable_workload_recording()
+
+    def _db(self, name):
+        db = self.enterContext(create_sqlite_test_db(name, Base=Base, create_all=True))
+        with db.Session.begin() as session:
+            session.execute(
+                insert(Order),
+                [
+                    {
+                        "id": i,
+                        "status": "new",
+                        "total": decimal.Decimal("9.99"),
+                        "created_at": datetime.datetime(2024, 1, 1, 12, i),
+                    }
+                    for i in range(10)
+                ],
+            )
+        return db
+
+    def _workload(self):
+        with self.source.Session.begin() as session:
+            session.execute(update(Order).where(Order.id < 4).values(status="paid"))
+            session.execute(
+                select(Order).where(
+                    Order.created_at >= datetime.datetime(2024, 1, 1, 12, 5)
+                )
+            ).all()
+        with self.source.engine.connect() as connection:
+            connection.execute(text("SELECT count(*) FROM orders")).all()
+
+    def test_record(self):
+        recorder = self.source.enable_workload_recording(self.path)
+        self._workload()
+        self.source.disable_workload_recording()
+        self.assertEqual(recorder.stats()["sessions"], 2)
+        self.assertEqual(recorder.stats()["statements"], 3)
+
+        events = list(read_workload(self.path))
+        kinds = [e.kind for e in events]
+        self.assertEqual(kinds.count(QUERY), 3)
+        self.assertIn(BEGIN, kinds)
+        self.assertIn(COMMIT, kinds)
+        self.assertEqual(kinds.count(END), 2)
+        queries = [e for e in events if e.kind == QUERY]
+        self.assertTrue(queries[0].statement.startswith("UPDATE orders"))
+        self.assertEqual(queries[0].rowcount, 4)
+        ## parameters as the driver got them, sqlite binds datetimes as strings
+        self.assertEqual(queries[1].parameters, ("2024-01-01 12:05:00.000000",))
+        self.assertEqual(queries[0].session, queries[1].session)
+        self.assertNotEqual(queries[0].session, queries[2].session)
+
+        ## statements are written once per file
+        with open(self.path) as fp:
+            records = [json.loads(line) for line in fp]
+        self.assertEqual(records[0][0], "H")
+        self.assertEqual(sum(1 for r in records if r[0] == "S"), 3)
+
+    def test_rotation_and_sampling(self):
+        self.source.enable_workload_recording(self.path, max_bytes=600, backups=2)
+        for __ in range(10):
+            self._workload()
+        self.source.disable_workload_recording()
+        files = workload_files(self.path)
+        self.assertEqual(
+            [os.path.basename(f) for f in files],
+            ["orders.workload.2", "orders.workload.1", "orders.workload"],
+        )
+        ## every file can be read on its own
+        self.assertTrue(
+            all(e.statement for e in read_workload(self.path) if e.kind == QUERY)
+        )
+
+        recorder = self.source.enable_workload_recording(self.path, sample_rate=0.01)
+        for __ in range(10):
+            self._workload()
+        self.assertLess(recorder.stats()["sessions"], 10)
+
+    def test_replay(self):
+        self.source.enable_workload_recording(self.path)
+        self._workload()
+        self.source.disable_workload_recording()
+        ## the target already has every order paid
+        with self.target.engine.begin() as connection:
+            connection.execute(update(Order).where(Order.id < 2).values(status="x"))
+            connection.execute(text("DELETE FROM orders WHERE id >= 8"))
+
+        report = self.target.replay_workload(self.path, speed=None, concurrency=2)
+        self.assertEqual(report.sessions, 2)
+        self.assertEqual(report.statements, 3)
+        self.assertEqual(report.errors, 0)
+        self.assertEqual(report.latency["count"], 3)
+        self.assertEqual(report.recorded_latency["count"], 3)
+        with self.target.engine.connect() as connection:
+            paid = connection.execute(
+                text("SELECT count(*) FROM orders WHERE status = 'paid'")
+            ).scalar()
+        self.assertEqual(paid, 4)
+        ## sqlite reports no row count for selects, the update matched 4 rows
+        ## in both
+        self.assertEqual(report.divergent, 0)
+
+        with self.target.engine.begin() as connection:
+            connection.execute(text("DELETE FROM orders WHERE id < 2"))
+        report = self.target.replay_workload(self.path, speed=None)
+        self.assertEqual(report.divergent, 1)
+        self.assertEqual(report.divergences[0].recorded_rows, 4)
+        self.assertEqual(report.divergences[0].replayed_rows, 2)
+        self.assertEqual(len(report.by_fingerprint), 3)
+
+    def test_replay_pace(self):
+        self.source.enable_workload_recording(self.path)
+        self._workload()
+        recorder = self.source.workload_recorder
+        recorder._started -= 0.4  ## the next session starts 0.4s later
+        self._workload()
+        self.source.disable_workload_recording()
+        report = self.target.replay_workload(self.path, speed=2)
+        self.assertGreaterEqual(report.seconds, 0.2)
+        report = self.target.replay_workload(self.path, speed=None)
+        self.assertLess(report.seconds, 0.2)
+
+    def test_replay_bounded_read_ahead(self):
+        self.source.enable_workload_recording(self.path)
+        ## two sessions open at once, more than the replay runs at a time
+        with self.source.engine.connect() as first:
+            with self.source.engine.connect() as second:
+                for i in range(20):
+                    first.execute(text(f"SELECT {i}")).all()
+                    second.execute(text(f"SELECT {i}")).all()
+        self.source.disable_workload_recording()
+        replayer = WorkloadReplayer(
+            self.target, self.path, speed=None, concurrency=1, max_pending=2
+        )
+        report = replayer.run()
+        self.assertEqual(report.sessions, 2)
+        self.assertEqual((report.statements, report.errors), (40, 0))
+
+    def test_paramstyle_conversion(self):
+        converter = ParamstyleConverter(
+            "SELECT * FROM t WHERE a = %s AND b LIKE '50%%' AND c = %s AND d %% 2",
+            "format",
+            "qmark",
+        )
+        self.assertEqual(
+            converter.statement,
+            "SELECT * FROM t WHERE a = ? AND b LIKE '50%' AND c = ? AND d % 2",
+        )
+        self.assertEqual(converter.parameters((1, 2)), (1, 2))
+
+        converter = ParamstyleConverter(
+            "UPDATE t SET a = ? WHERE b = '?' AND c = ? AND d % 2", "qmark", "pyformat"
+        )
+        self.assertEqual(
+            converter.statement,
+            "UPDATE t SET a = %(p0)s WHERE b = '?' AND c = %(p1)s AND d %% 2",
+        )
+        self.assertEqual(converter.parameters((1, 2)), {"p0": 1, "p1": 2})
+
+        converter = ParamstyleConverter("SELECT :a, :b, :a, '::x'", "named", "format")
+        self.assertEqual(converter.statement, "SELECT %s, %s, %s, '::x'")
+        self.assertEqual(converter.parameters({"a": 1, "b": 2}), (1, 2, 1))
+
+
+if __name__ == "__main__":
+    unittest.main()
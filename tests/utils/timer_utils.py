@@ -1,9 +1,10 @@
 import atexit
 import logging
 import time
-from collections import defaultdict
 from dataclasses import dataclass
 
+from sqlgold.metrics import MetricsRegistry
+
 
 @dataclass
 class Stat:
@@ -16,9 +17,10 @@ class Stat:
 
 class Timer:
     """A class to time and log a metric.
-    These metrics can be retrieved later as a Pandas Dataframe"""
+    These metrics can be retrieved later as a Pandas Dataframe.
+    Totals are kept in a thread safe sqlgold.metrics registry"""
 
-    _all = defaultdict(Stat)
+    _all = MetricsRegistry()
     _out_metrics = None
     _prefix = ""
 
@@ -40,8 +42,7 @@ class Timer:
         Logs to metric if metrics exist
         """
         et = time.perf_counter() - self._start
-        Timer._all[self._output_str].num += 1
-        Timer._all[self._output_str].total += et
+        Timer._all.histogram(self._output_str).observe(et)
         output = [f"{Timer._prefix}{self._output_str}", et]
         if self._out_metrics:
             self._out_metrics.log_metric(*output)
@@ -63,7 +64,8 @@ class Timer:
 
 @atexit.register
 def print_stats():
-    if Timer._all:
+    histograms = Timer._all.collect()
+    if histograms:
         print("----- Printing stats ------")
-        for k, v in Timer._all.items():
-            print(k, v)
+        for h in histograms:
+            print(h.name, Stat(num=h.count, total=h.sum))